@@ -518,6 +518,98 @@ def acl_represent(acl, options):
 
     return " ".join(values)
 
+# =============================================================================
+# Scheduler
+# =============================================================================
+@auth.s3_requires_membership(1)
+def task():
+    """
+        Scheduler Jobs: RESTful CRUD controller, with the status of
+        the scheduler queues on top of the list
+    """
+
+    tablename = s3base.S3Task.TASK_TABLENAME
+
+    def prep(r):
+        s3task.configure_tasktable_crud()
+
+        table = r.table
+        table.function_name.readable = True
+        field = table.group_name
+        field.label = T("Queue")
+        field.readable = True
+        field.writable = True
+        field.requires = IS_IN_SET([queue for queue, workers in s3task.queues],
+                                   zero=None)
+        table.status.readable = True
+        table.times_run.readable = True
+        table.times_failed.readable = True
+
+        s3db.configure(tablename,
+                       insertable = False,
+                       list_fields = ["id",
+                                      "function_name",
+                                      (T("Queue"), "group_name"),
+                                      "enabled",
+                                      "repeats",
+                                      "period",
+                                      (T("Last run"), "last_run_time"),
+                                      (T("Last status"), "status"),
+                                      (T("Next run"), "next_run_time"),
+                                      "times_run",
+                                      "times_failed",
+                                      ],
+                       orderby = "%s.next_run_time desc" % tablename,
+                       )
+        return True
+    s3.prep = prep
+
+    def rheader(r):
+        """ Status of the scheduler queues """
+
+        if r.record or r.representation != "html":
+            return None
+
+        NONE = current.messages["NONE"]
+        def seconds(value):
+            return "%d s" % round(value) if value is not None else NONE
+
+        header = TR(TH(T("Queue")),
+                    TH(T("Workers")),
+                    TH(T("Active Workers")),
+                    TH(T("Due")),
+                    TH(T("Scheduled")),
+                    TH(T("Running")),
+                    TH(T("Longest Wait")),
+                    TH(T("Runs (24h)")),
+                    TH(T("Failed (24h)")),
+                    TH(T("Average Run Time")),
+                    TH(T("Longest Run Time")),
+                    )
+        rows = []
+        for item in s3task.status():
+            rows.append(TR(item.queue,
+                           item.workers,
+                           item.alive,
+                           item.due,
+                           item.scheduled,
+                           item.running,
+                           seconds(item.wait),
+                           item.runs,
+                           item.failed,
+                           seconds(item.duration),
+                           seconds(item.max_duration),
+                           ))
+        return DIV(H3(T("Queues")),
+                   TABLE(THEAD(header), TBODY(*rows),
+                         _class="dataTable display"),
+                   _id="task-queues",
+                   )
+
+    return s3_rest_controller("scheduler", "task",
+                              rheader = rheader,
+                              )
+
 # =============================================================================
 # Ticket viewing
 # =============================================================================
@@ -2227,7 +2227,6 @@ def layer_shapefile():
     """ RESTful CRUD controller """
 
     tablename = "%s_%s" % (module, resourcename)
-    table = s3db[tablename]
 
     # CRUD Strings
     type = "Shapefile"
@@ -2261,24 +2260,7 @@ def layer_shapefile():
             # Define the Table
             id = args[0]
             _tablename = "gis_layer_shapefile_%s" % id
-            Fields = [Field("lat", "float"),
-                      Field("lon", "float"),
-                      Field("wkt", "text"),
-                      Field("layer_id", table),
-                      ]
-            append = Fields.append
-            row = db(table.id == id).select(table.data,
-                                            limitby=(0, 1)
-                                            ).first()
-            if row and row.data:
-                fields = json.loads(row.data)
-                for field in fields:
-                    # Unicode fieldnames not supported
-                    append(Field(str(field[0]), field[1]))
-                if settings.get_gis_spatialdb():
-                    # Add a spatial field
-                    append(Field("the_geom", "geometry()"))
-                s3db.define_table(_tablename, *Fields)
+            if gis.define_shapefile_table(id) is not None:
                 new_arg = _tablename[4:]
                 extension = test[4:]
                 if extension:
@@ -2437,6 +2419,37 @@ def theme_data():
 
     return output
 
+# -----------------------------------------------------------------------------
+def tile():
+    """
+        Vector Tiles (Mapbox Vector Tile format) for Feature, Theme and
+        Shapefile Layers and Admin Boundaries, served from a tile cache
+
+        URL: /gis/tile/{layer}/{z}/{x}/{y}.mvt
+            - layer: the layer_id of the layer, or L0..L5 for Admin Boundaries
+    """
+
+    args = request.args
+    if len(args) != 4:
+        raise HTTP(400, "Invalid URL: use tile/{layer}/{z}/{x}/{y}.mvt")
+    layer = args[0]
+    y = args[3]
+    if y.endswith(".mvt"):
+        y = y[:-4]
+    try:
+        z, x, y = int(args[1]), int(args[2]), int(y)
+    except ValueError:
+        raise HTTP(400, "Invalid tile coordinates")
+
+    output = gis.get_vector_tile(layer, z, x, y)
+    if output is None:
+        raise HTTP(404, "Layer not found")
+
+    headers = response.headers
+    headers["Content-Type"] = "application/vnd.mapbox-vector-tile"
+    headers["Cache-Control"] = "max-age=300"
+    return output
+
 # -----------------------------------------------------------------------------
 def layer_tms():
     """ RESTful CRUD controller """
@@ -3112,45 +3125,57 @@ def geocode():
         @param L5: Village/Census Tract (as ID)
         @param street: Street Address
         @param postcode: Postcode
+
+        @param addresses: alternatively, a JSON list of objects with
+                          the above keys, to geocode multiple addresses
+                          in a single request (returns a JSON list)
     """
 
-    # Read the request
-    vars = request.post_vars
-    street = vars.get("address", None)
-    postcode = vars.get("postcode", None)
-    L0 = vars.get("L0", None)
-    if L0:
-        L0 = int(L0)
-    L1 = vars.get("L1", None)
-    if L1:
-        L1 = int(L1)
-    L2 = vars.get("L2", None)
-    if L2:
-        L2 = int(L2)
-    L3 = vars.get("L3", None)
-    if L3:
-        L3 = int(L3)
-    L4 = vars.get("L4", None)
-    if L4:
-        L4 = int(L4)
-    L5 = vars.get("L5", None)
-    if L5:
-        L5 = int(L5)
-    # Is this a Street or Lx?
-    if street:
+    def address_tuple(vars):
+        """ Convert request vars into a tuple for gis.geocode_bulk """
+
         Lx_ids = []
         append = Lx_ids.append
-        for id in (L0, L1, L2, L3, L4, L5):
+        for level in ("L0", "L1", "L2", "L3", "L4", "L5"):
+            id = vars.get(level, None)
             if id:
-                append(id)
-        # Send request to external geocoders to get a Point
-        results = gis.geocode(street, postcode, Lx_ids)
+                append(int(id))
+        return (vars.get("address", None),
+                vars.get("postcode", None),
+                Lx_ids,
+                )
 
+    # Read the request
+    vars = request.post_vars
+    addresses = vars.get("addresses", None)
+    if addresses:
+        # Batch of addresses
+        try:
+            addresses = json.loads(addresses)
+        except ValueError:
+            raise HTTP(400, "Invalid JSON")
+        if not isinstance(addresses, list) or \
+           not all(isinstance(a, dict) for a in addresses):
+            # Reject the batch rather than skipping invalid entries,
+            # so that the results always line up with the addresses
+            raise HTTP(400, "Invalid JSON")
+        batch = [address_tuple(a) for a in addresses]
     else:
-        # Lx: Lookup Bounds in our own database
-        # @ToDo
-        # Not needed by S3LocationSelectorWidget2 as it downloads bounds with options
-        results = "NotImplementedError"
+        batch = [address_tuple(vars)]
+
+    # Is this a Street or Lx?
+    streets = [a for a in batch if a[0]]
+    if streets:
+        # Send all Streets to the external geocoder at once to get Points
+        geocoded = iter(gis.geocode_bulk(streets, "google"))
+    # Lx: Lookup Bounds in our own database
+    # @ToDo
+    # Not needed by S3LocationSelectorWidget2 as it downloads bounds with options
+    results = [geocoded.next() if a[0] else "NotImplementedError"
+               for a in batch]
+
+    if not addresses:
+        results = results[0]
 
     results = json.dumps(results, separators=SEPARATORS)
     response.headers["Content-Type"] = "application/json"
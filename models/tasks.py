@@ -174,7 +174,7 @@ def gis_update_location_tree(feature, user_id=None):
     # Run the Task & return the result
     feature = json.loads(feature)
     path = gis.update_location_tree(feature)
-    db.commit()
+    # NB Committed by the caller (S3Task.run_batch or the request)
     return path
 
 tasks["gis_update_location_tree"] = gis_update_location_tree
@@ -269,6 +269,20 @@ if settings.has_module("msg"):
 
     tasks["msg_poll"] = msg_poll
 
+    # -------------------------------------------------------------------------
+    def msg_poll_all(tablename, user_id=None):
+        """
+            Poll all enabled inbound channels of a type
+        """
+        if user_id:
+            auth.s3_impersonate(user_id)
+        # Run the Task & return the result
+        result = msg.poll_all(tablename)
+        db.commit()
+        return result
+
+    tasks["msg_poll_all"] = msg_poll_all
+
     # -----------------------------------------------------------------------------
     def msg_parse(channel_id, function_name, user_id=None):
         """
@@ -302,8 +316,8 @@ if settings.has_module("msg"):
             Asynchronous task to notify a subscriber about resource
             updates. This task is created by notify_check_subscriptions.
 
-            @param subscription: JSON with the subscription data
-            @param now: lookup date (@todo: remove this)
+            @param resource_id: the pr_subscription_resource record ID,
+                                or a list of IDs to notify in one batch
         """
         if user_id:
             auth.s3_impersonate(user_id)
@@ -364,7 +378,7 @@ if settings.has_module("stats"):
             auth.s3_impersonate(user_id)
         # Run the Task & return the result
         result = s3db.stats_demographic_update_aggregates(records)
-        db.commit()
+        # NB Committed by the caller (S3Task.run_batch or the request)
         return result
 
     tasks["stats_demographic_update_aggregates"] = stats_demographic_update_aggregates
@@ -493,6 +507,44 @@ if settings.has_module("sync"):
 
     tasks["sync_synchronize"] = sync_synchronize
 
+# -----------------------------------------------------------------------------
+def s3task_batch(task, user_id=None):
+    """
+        Run all pending calls of a batched task
+
+        @param task: the task name
+        @param user_id: calling request's auth.user.id or None
+    """
+    # Each call impersonates its own caller
+    result = s3task.run_batch(task)
+    db.commit()
+    return result
+
+tasks["s3task_batch"] = s3task_batch
+
+# -----------------------------------------------------------------------------
+# Tasks to run in batches: async calls within the time window (seconds)
+# are collected and run all together in a single scheduler task
+batch_tasks = {"gis_update_location_tree": 60,
+               }
+if settings.has_module("stats"):
+    batch_tasks["stats_demographic_update_aggregates"] = 60
+s3.batch_tasks = batch_tasks
+
+# -----------------------------------------------------------------------------
+# Long-running tasks, to not block the latency-sensitive ones (e.g.
+# msg_process_outbox, notify_notify) in the main queue, if the queue is
+# configured in settings.base.scheduler_queues (otherwise main queue)
+s3.task_queues = {"sync_synchronize": "slow",
+                  "gis_download_kml": "slow",
+                  "stats_demographic_update_aggregates": "slow",
+                  "stats_demographic_update_location_aggregate": "slow",
+                  "vulnerability_update_aggregates": "slow",
+                  "vulnerability_update_location_aggregate": "slow",
+                  "document_create_index": "slow",
+                  "deploy": "slow",
+                  }
+
 # -----------------------------------------------------------------------------
 # Instantiate Scheduler instance with the list of tasks
 s3.tasks = tasks
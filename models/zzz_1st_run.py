@@ -167,6 +167,20 @@ if len(pop_list) > 0:
     field = "name"
     db.executesql("CREATE INDEX %s__idx on %s(%s);" % (field, tablename, field))
 
+    # Hierarchies
+    # Add index for range queries over the node intervals
+    tablename = "s3_hierarchy_interval"
+    db.executesql("CREATE INDEX %s__idx on %s(hierarchy_id,node_id,lft);" % (tablename, tablename))
+
+    # Full-text Index
+    # Add trigram indexes (PostgreSQL) or index for the s3_fulltext table
+    s3base.S3FullText.create_indexes()
+
+    # Change-Log
+    # Add indexes for cursor lookups, and start the log
+    s3base.S3ChangeLog.create_indexes()
+    s3base.S3ChangeLog.prune()
+
     # Messaging Module
     if has_module("msg"):
         update_super = s3db.update_super
@@ -319,6 +333,13 @@ if len(pop_list) > 0:
         end = datetime.datetime.now()
         print >> sys.stdout, "Vulnerability data aggregation completed in %s" % (end - start)
 
+    # Build the full-text index (unless natively supported by the database)
+    if not s3base.S3FullText.native():
+        start = datetime.datetime.now()
+        s3base.S3FullText.rebuild()
+        end = datetime.datetime.now()
+        print >> sys.stdout, "Full-text index built in %s" % (end - start)
+
     grandTotalEnd = datetime.datetime.now()
     duration = grandTotalEnd - grandTotalStart
     try:
@@ -66,6 +66,9 @@ from s3task import *
 # Hierarchy Handling
 from s3hierarchy import *
 
+# Change-Log
+from s3changelog import *
+
 # Core Framework ==============================================================
 
 # Model Extensions
@@ -89,9 +92,11 @@ from s3forms import *
 
 # Filtering
 from s3filter import *
+from s3fulltext import *
 
 # Reporting
 from s3report import *
+from s3cube import *
 from s3timeplot import *
 
 # Profiles
@@ -119,6 +124,7 @@ from s3track import *
 
 # GIS Mapping
 from s3gis import *
+from s3geocode import *
 
 # Messaging
 from s3msg import *
@@ -6579,6 +6579,55 @@ class S3Audit(object):
         else:
             self.user_id = None
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def onwrite(tablename, form=None, record=None, method=None):
+        """
+            Refresh caches and indexes after a write to a table (called
+            for every create, update or delete, even if auditing is
+            disabled)
+
+            @param tablename: the tablename
+            @param form: the form
+            @param record: the record ID (or Row)
+            @param method: the write method ("create", "update" or "delete")
+        """
+
+        if isinstance(record, Row):
+            record = record.get("id", None)
+        elif not record and form:
+            try:
+                record = form.vars["id"]
+            except:
+                try:
+                    record = form["id"]
+                except:
+                    record = None
+
+        # Change-log
+        from s3changelog import S3ChangeLog
+        S3ChangeLog.onwrite(tablename, record_id=record, method=method)
+
+        # Table version (invalidates caches)
+        current.s3db.table_updated(tablename)
+
+        # Vector tiles
+        from s3gis import GIS
+        GIS.tile_cache_clear(tablename, record_id=record)
+
+        # Report cubes
+        from s3cube import S3ReportCube
+        S3ReportCube.onwrite(tablename, record_id=record)
+
+        # Hierarchies
+        from s3hierarchy import S3Hierarchy
+        S3Hierarchy.onwrite(tablename, record_id=record)
+
+        # Full-text index
+        from s3fulltext import S3FullText
+        S3FullText.onwrite(tablename, record_id=record)
+        return
+
     # -------------------------------------------------------------------------
     def __call__(self, method, prefix, name,
                  form=None,
@@ -6596,6 +6645,12 @@ class S3Audit(object):
             @param representation: the representation format
         """
 
+        if method in ("create", "update", "delete"):
+            self.onwrite("%s_%s" % (prefix, name),
+                         form=form,
+                         record=record,
+                         method=method)
+
         table = self.table
         if not table:
             # Don't Audit
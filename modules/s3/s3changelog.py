@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+
+""" S3 Change-Log
+
+    @copyright: 2014 (c) Sahana Software Foundation
+    @license: MIT
+
+    @requires: U{B{I{gluon}} <http://web2py.com>}
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation
+    files (the "Software"), to deal in the Software without
+    restriction, including without limitation the rights to use,
+    copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the
+    Software is furnished to do so, subject to the following
+    conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+    OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+    HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+    WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+    OTHER DEALINGS IN THE SOFTWARE.
+
+    @status: experimental
+"""
+
+__all__ = ("S3ChangeLog",
+           )
+
+import datetime
+
+try:
+    import json # try stdlib (Python 2.6)
+except ImportError:
+    try:
+        import simplejson as json # try external module
+    except:
+        import gluon.contrib.simplejson as json # fallback to pure-Python module
+
+from gluon import current
+
+# =============================================================================
+class S3ChangeLog(object):
+    """
+        Append-only log of all record writes through S3 (create, update
+        and delete, see S3Audit.onwrite).
+
+        Incremental exports find changed records and components by their
+        modified_on, and use the log only to find master records whose
+        components have been deleted since (the foreign keys of deleted
+        components are gone, so they can not be found by modified_on).
+        No lookup is driven by the log alone, so it does not reduce the
+        cost of finding updates, which remains a scan of modified_on.
+
+        The log is ordered by its sequence number (the record ID in the
+        s3_changelog table), and consumers read it from a cursor, i.e.
+        the sequence number of the last entry they have seen (see cursor).
+
+        The log only records writes through S3, so consumers must use it
+        only to narrow down what they would otherwise find by modified_on.
+
+        Entries older than settings.security.changelog days are removed
+        in the daily maintenance (see prune); a marker entry (op="start")
+        records the time since when the log is complete, so consumers can
+        fall back to scanning the tables for earlier times (see covers).
+    """
+
+    # Tolerance for concurrent writes when converting times into cursors
+    MARGIN = datetime.timedelta(seconds=60)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def enabled():
+        """
+            Whether the change-log is enabled
+
+            @return: True|False
+        """
+
+        return bool(current.deployment_settings.get_security_changelog())
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def onwrite(cls, tablename, record_id=None, method=None):
+        """
+            Log a write to a record
+
+            @param tablename: the tablename
+            @param record_id: the record ID
+            @param method: the write method ("create", "update" or "delete")
+        """
+
+        if not record_id or not cls.enabled():
+            return
+        try:
+            record_id = int(record_id)
+        except (ValueError, TypeError):
+            return
+
+        current.s3db.s3_changelog.insert(tablename = tablename,
+                                         record_id = record_id,
+                                         op = method or "update",
+                                         timestmp = datetime.datetime.utcnow(),
+                                         )
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def start(cls):
+        """
+            Get the time since when the log is complete
+
+            @return: datetime, or None if the log has not been started
+        """
+
+        if not cls.enabled():
+            return None
+
+        s3 = current.response.s3
+        if "changelog_start" not in s3:
+            table = current.s3db.s3_changelog
+            query = (table.op == "start")
+            row = current.db(query).select(table.timestmp,
+                                           orderby = ~table.timestmp,
+                                           limitby = (0, 1),
+                                           ).first()
+            s3.changelog_start = row.timestmp if row else None
+        return s3.changelog_start
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def covers(cls, timestmp):
+        """
+            Check whether the log covers all changes since a particular time
+
+            @param timestmp: the time (datetime, UTC)
+            @return: True|False
+        """
+
+        if timestmp is None:
+            return False
+        start = cls.start()
+        return start is not None and start <= timestmp - cls.MARGIN
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def cursor(cls, timestmp=None):
+        """
+            Get a cursor for reading the log
+
+            @param timestmp: get a cursor for all changes since this time
+                             (datetime, UTC), default: the current end of
+                             the log (i.e. for all future changes)
+
+            @return: the sequence number of the last entry before timestmp
+        """
+
+        db = current.db
+        table = current.s3db.s3_changelog
+
+        if timestmp is not None:
+            # Before the first entry since timestmp
+            first = table.id.min()
+            query = (table.timestmp >= timestmp - cls.MARGIN)
+            row = db(query).select(first).first()
+            if row and row[first]:
+                return row[first] - 1
+
+        # End of the log
+        last = table.id.max()
+        row = db(table.id > 0).select(last).first()
+        return (row[last] or 0) if row else 0
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def changes(tablenames, cursor, ops=None):
+        """
+            Get the records which have been written after a cursor
+
+            @param tablenames: the tablenames
+            @param cursor: the cursor (sequence number)
+            @param ops: limit to these write methods, e.g. ("delete",)
+
+            @return: dict {tablename: set of record IDs}
+        """
+
+        changes = dict((tablename, set()) for tablename in tablenames)
+        if not tablenames:
+            return changes
+
+        table = current.s3db.s3_changelog
+        query = (table.id > cursor) & \
+                (table.tablename.belongs(set(tablenames))) & \
+                (table.op != "start")
+        if ops:
+            query &= (table.op.belongs(ops))
+        rows = current.db(query).select(table.tablename,
+                                        table.record_id,
+                                        distinct = True,
+                                        )
+        for row in rows:
+            changes[row.tablename].add(row.record_id)
+        return changes
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def masters(cls, resource, cursor, ops=None):
+        """
+            Get the master records of a resource which have been written
+            after a cursor, or any of their components
+
+            @param resource: the S3Resource
+            @param cursor: the cursor (sequence number)
+            @param ops: limit to these write methods, e.g. ("delete",)
+
+            @return: set of record IDs
+        """
+
+        db = current.db
+
+        table = resource.table
+        components = resource.components.values()
+
+        tablenames = set([resource.tablename])
+        for component in components:
+            tablenames.add(component.tablename)
+            if component.linktable:
+                tablenames.add(component.linktable._tablename)
+        changes = cls.changes(tablenames, cursor, ops=ops)
+
+        master_ids = set(changes[resource.tablename])
+        for component in components:
+
+            ctable = component.table
+            cids = changes[component.tablename]
+
+            # Values of the master key in the changed records
+            keys = set()
+            linktable = component.linktable
+            if linktable:
+                lkey, rkey = component.lkey, component.rkey
+                lids = changes[linktable._tablename]
+                if lids:
+                    keys |= cls._keys(linktable, lids, lkey)
+                if cids:
+                    rkeys = cls._keys(ctable, cids, component.fkey)
+                    rkeys.discard(None)
+                    if rkeys:
+                        query = (linktable[rkey].belongs(rkeys))
+                        rows = db(query).select(linktable[lkey])
+                        keys |= set(row[lkey] for row in rows)
+            elif cids:
+                keys |= cls._keys(ctable, cids, component.fkey)
+            keys.discard(None)
+            if not keys:
+                continue
+
+            pkey = component.pkey
+            if pkey == table._id.name:
+                master_ids |= keys
+            else:
+                rows = db(table[pkey].belongs(keys)).select(table._id)
+                master_ids |= set(row[table._id] for row in rows)
+
+        return master_ids
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _keys(table, record_ids, fieldname):
+        """
+            Get the values of a key in records, including soft-deleted
+            records where the key has been moved into deleted_fk
+
+            @param table: the table
+            @param record_ids: the record IDs
+            @param fieldname: the key field name
+
+            @return: set of key values
+        """
+
+        field = table[fieldname]
+        fields = [field]
+        deleted_fk = "deleted_fk" in table.fields
+        if deleted_fk:
+            fields.append(table.deleted_fk)
+
+        keys = set()
+        rows = current.db(table._id.belongs(record_ids)).select(*fields)
+        for row in rows:
+            key = row[field]
+            if key is None and deleted_fk and row.deleted_fk:
+                try:
+                    key = json.loads(row.deleted_fk).get(fieldname)
+                except (ValueError, AttributeError):
+                    key = None
+            keys.add(key)
+        return keys
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def prune(cls):
+        """
+            Remove outdated entries from the log, and start the log if
+            not started yet (to be run in the daily maintenance)
+        """
+
+        days = current.deployment_settings.get_security_changelog()
+        if not days:
+            return
+
+        db = current.db
+        table = current.s3db.s3_changelog
+
+        now = datetime.datetime.utcnow()
+        start = cls.start()
+        if start is None:
+            # Start the log now
+            start = now
+        else:
+            start = max(start, now - datetime.timedelta(days=days))
+
+        db(table.timestmp < start).delete()
+        db(table.op == "start").delete()
+        table.insert(tablename = None,
+                     record_id = None,
+                     op = "start",
+                     timestmp = start,
+                     )
+        current.response.s3.changelog_start = start
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def create_indexes():
+        """
+            Create the database indexes, to be run once at 1st run or
+            after an upgrade
+        """
+
+        db = current.db
+        tablename = "s3_changelog"
+        current.s3db.table(tablename)
+        for name, fields in (("tablename", "tablename,id"),
+                             ("timestmp", "timestmp"),
+                             ):
+            try:
+                db.executesql("CREATE INDEX %s_%s__idx on %s(%s);" %
+                              (tablename, name, tablename, fields))
+            except:
+                # Index already present
+                pass
+
+# END =========================================================================
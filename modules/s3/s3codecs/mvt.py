@@ -0,0 +1,459 @@
+# -*- coding: utf-8 -*-
+
+"""
+    S3 Mapbox Vector Tile codec
+
+    @copyright: 2014 (c) Sahana Software Foundation
+    @license: MIT
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation
+    files (the "Software"), to deal in the Software without
+    restriction, including without limitation the rights to use,
+    copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the
+    Software is furnished to do so, subject to the following
+    conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+    OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+    HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+    WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+    OTHER DEALINGS IN THE SOFTWARE.
+
+    @requires: U{B{I{shapely}} <http://trac.gispython.org/lab/wiki/Shapely>}
+
+    @see: U{https://github.com/mapbox/vector-tile-spec/tree/master/2.1}
+"""
+
+__all__ = ["S3MVT"]
+
+import math
+import struct
+
+from ..s3utils import s3_unicode
+
+# Geometry types
+POINT = 1
+LINESTRING = 2
+POLYGON = 3
+
+# Geometry commands
+MOVETO = 1
+LINETO = 2
+CLOSEPATH = 7
+
+# =============================================================================
+class S3MVT(object):
+    """
+        Mapbox Vector Tile (MVT) encoder
+
+        Clips, simplifies and encodes features (shapely geometries in
+        EPSG:4326) into a vector tile of the Web Mercator tile grid.
+        Implements the subset of the Protocol Buffers wire format which
+        is needed for the vector tile schema, so does not require any
+        protobuf library.
+    """
+
+    def __init__(self, z, x, y, extent=4096, buffer=64):
+        """
+            Constructor
+
+            @param z: the zoom level
+            @param x: the tile column
+            @param y: the tile row (from the top, as in XYZ/Google)
+            @param extent: the number of units along a tile edge
+            @param buffer: the number of units outside the tile edges
+                           to include in clipped geometries (to avoid
+                           rendering artifacts at tile borders)
+        """
+
+        self.z = z
+        self.x = x
+        self.y = y
+        self.extent = extent
+        self.buffer = buffer
+
+        self.layers = []
+        self.cursor = (0, 0)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def tile_bounds(z, x, y):
+        """
+            Get the bounds of a tile in EPSG:4326
+
+            @return: tuple (lon_min, lat_min, lon_max, lat_max)
+        """
+
+        n = 2.0 ** z
+
+        def lat(row):
+            return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+        return (x / n * 360.0 - 180.0,
+                lat(y + 1),
+                (x + 1) / n * 360.0 - 180.0,
+                lat(y),
+                )
+
+    # -------------------------------------------------------------------------
+    def clip_bounds(self):
+        """
+            Get the bounds of the tile including the buffer, in EPSG:4326
+
+            @return: tuple (lon_min, lat_min, lon_max, lat_max)
+        """
+
+        lon_min, lat_min, lon_max, lat_max = self.tile_bounds(self.z,
+                                                              self.x,
+                                                              self.y)
+        ratio = float(self.buffer) / self.extent
+        dlon = (lon_max - lon_min) * ratio
+        dlat = (lat_max - lat_min) * ratio
+        return (max(lon_min - dlon, -180.0),
+                max(lat_min - dlat, -85.0511),
+                min(lon_max + dlon, 180.0),
+                min(lat_max + dlat, 85.0511),
+                )
+
+    # -------------------------------------------------------------------------
+    def tolerance(self):
+        """
+            The simplification tolerance for this zoom level, in degrees
+            (about one tile unit)
+        """
+
+        return 360.0 / (2 ** self.z) / self.extent
+
+    # -------------------------------------------------------------------------
+    def add_layer(self, name, features):
+        """
+            Add a layer to the tile
+
+            @param name: the layer name
+            @param features: iterable of tuples (id, shape, properties),
+                             where shape is a shapely geometry in EPSG:4326
+                             and properties is a dict of attributes
+        """
+
+        from shapely.geometry import box
+
+        lon_min, lat_min, lon_max, lat_max = self.clip_bounds()
+        clip = box(lon_min, lat_min, lon_max, lat_max)
+        tolerance = self.tolerance()
+
+        keys = []
+        key_index = {}
+        values = []
+        value_index = {}
+
+        encoded = []
+        append = encoded.append
+        for feature_id, shape, properties in features:
+
+            if shape is None or shape.is_empty:
+                continue
+            if shape.geom_type not in ("Point", "MultiPoint"):
+                if not shape.intersects(clip):
+                    continue
+                if not clip.contains(shape):
+                    shape = shape.intersection(clip)
+                shape = shape.simplify(tolerance, preserve_topology=True)
+            elif not shape.intersects(clip):
+                continue
+
+            geom_type, geometry = self._geometry(shape)
+            if not geometry:
+                continue
+
+            tags = []
+            if properties:
+                for k, v in properties.items():
+                    if v is None:
+                        continue
+                    if k not in key_index:
+                        key_index[k] = len(keys)
+                        keys.append(k)
+                    vkey = (type(v), v)
+                    if vkey not in value_index:
+                        value_index[vkey] = len(values)
+                        values.append(v)
+                    tags.extend((key_index[k], value_index[vkey]))
+
+            message = []
+            if feature_id is not None:
+                message.append(self._uint_field(1, feature_id))
+            if tags:
+                message.append(self._packed_field(2, tags))
+            message.append(self._uint_field(3, geom_type))
+            message.append(self._packed_field(4, geometry))
+            append("".join(message))
+
+        if not encoded:
+            return
+
+        layer = [self._string_field(1, name)]
+        for feature in encoded:
+            layer.append(self._bytes_field(2, feature))
+        for key in keys:
+            layer.append(self._string_field(3, key))
+        for value in values:
+            layer.append(self._bytes_field(4, self._value(value)))
+        layer.append(self._uint_field(5, self.extent))
+        layer.append(self._uint_field(15, 2))
+
+        self.layers.append("".join(layer))
+        return
+
+    # -------------------------------------------------------------------------
+    def encode(self):
+        """
+            Encode the tile
+
+            @return: the tile as (binary) str
+        """
+
+        return "".join(self._bytes_field(3, layer) for layer in self.layers)
+
+    # -------------------------------------------------------------------------
+    # Geometry encoding
+    # -------------------------------------------------------------------------
+    def _project(self, lon, lat):
+        """
+            Project a point into tile units
+
+            @param lon: the longitude
+            @param lat: the latitude
+        """
+
+        n = 2.0 ** self.z
+        extent = self.extent
+
+        lat = max(min(lat, 85.0511), -85.0511)
+        lat_rad = math.radians(lat)
+
+        px = ((lon + 180.0) / 360.0 * n - self.x) * extent
+        py = ((1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) / math.pi) / 2.0 * n - self.y) * extent
+        return int(round(px)), int(round(py))
+
+    # -------------------------------------------------------------------------
+    def _geometry(self, shape):
+        """
+            Encode a shapely geometry as MVT geometry commands
+
+            @param shape: the shapely geometry
+            @return: tuple (geometry type, [command integers])
+        """
+
+        self.cursor = (0, 0)
+
+        geom_type = shape.geom_type
+        if geom_type == "Point":
+            return POINT, self._points([shape])
+        elif geom_type == "MultiPoint":
+            return POINT, self._points(shape.geoms)
+        elif geom_type == "LineString":
+            return LINESTRING, self._line(shape.coords)
+        elif geom_type == "MultiLineString":
+            geometry = []
+            for line in shape.geoms:
+                geometry.extend(self._line(line.coords))
+            return LINESTRING, geometry
+        elif geom_type == "Polygon":
+            return POLYGON, self._polygon(shape)
+        elif geom_type == "MultiPolygon":
+            geometry = []
+            for polygon in shape.geoms:
+                geometry.extend(self._polygon(polygon))
+            return POLYGON, geometry
+        elif geom_type == "GeometryCollection":
+            # Result of a clip, only keep the polygonal parts
+            geometry = []
+            for part in shape.geoms:
+                if part.geom_type in ("Polygon", "MultiPolygon"):
+                    geometry.extend(self._geometry(part)[1])
+            return POLYGON, geometry
+        return None, None
+
+    # -------------------------------------------------------------------------
+    def _points(self, points):
+        """
+            Encode a list of points
+
+            @param points: the shapely points
+        """
+
+        coords = [self._project(p.x, p.y) for p in points]
+        if not coords:
+            return []
+        geometry = [self._command(MOVETO, len(coords))]
+        geometry.extend(self._deltas(coords))
+        return geometry
+
+    # -------------------------------------------------------------------------
+    def _line(self, coords, ring=False):
+        """
+            Encode a linestring or a polygon ring
+
+            @param coords: the coordinates (lon, lat)
+            @param ring: whether this is a polygon ring
+        """
+
+        project = self._project
+        points = []
+        last = None
+        for c in coords:
+            p = project(c[0], c[1])
+            if p != last:
+                points.append(p)
+                last = p
+        if ring:
+            if len(points) > 1 and points[0] == points[-1]:
+                points.pop()
+            if len(points) < 3:
+                return []
+        elif len(points) < 2:
+            return []
+
+        geometry = [self._command(MOVETO, 1)]
+        geometry.extend(self._deltas(points[:1]))
+        geometry.append(self._command(LINETO, len(points) - 1))
+        geometry.extend(self._deltas(points[1:]))
+        if ring:
+            geometry.append(self._command(CLOSEPATH, 1))
+        return geometry
+
+    # -------------------------------------------------------------------------
+    def _polygon(self, polygon):
+        """
+            Encode a polygon; the exterior ring must have a positive
+            area in tile units (clockwise, as y points down), interior
+            rings a negative area
+
+            @param polygon: the shapely polygon
+        """
+
+        exterior = list(polygon.exterior.coords)
+        # Signed area in lon/lat is inverse of the signed area in tile
+        # units, since the y axis flips
+        if self._area(exterior) > 0:
+            exterior.reverse()
+        geometry = self._line(exterior, ring=True)
+        if not geometry:
+            return []
+        for interior in polygon.interiors:
+            coords = list(interior.coords)
+            if self._area(coords) < 0:
+                coords.reverse()
+            geometry.extend(self._line(coords, ring=True))
+        return geometry
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _area(coords):
+        """ Signed area of a ring (positive = counter-clockwise) """
+
+        area = 0.0
+        for i in xrange(len(coords) - 1):
+            x1, y1 = coords[i][:2]
+            x2, y2 = coords[i + 1][:2]
+            area += x1 * y2 - x2 * y1
+        return area / 2.0
+
+    # -------------------------------------------------------------------------
+    def _deltas(self, points):
+        """
+            Encode points as zigzag-encoded deltas from the cursor
+
+            @param points: list of (x, y) in tile units
+        """
+
+        output = []
+        append = output.append
+        cx, cy = self.cursor
+        for x, y in points:
+            dx = x - cx
+            dy = y - cy
+            append((dx << 1) ^ (dx >> 31))
+            append((dy << 1) ^ (dy >> 31))
+            cx, cy = x, y
+        self.cursor = (cx, cy)
+        return output
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _command(command, count):
+        """ Command integer """
+
+        return (command & 0x7) | (count << 3)
+
+    # -------------------------------------------------------------------------
+    # Protocol Buffers wire format
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _varint(value):
+        """ Encode an unsigned integer as varint """
+
+        output = []
+        append = output.append
+        value = long(value) & 0xFFFFFFFFFFFFFFFF
+        while True:
+            bits = value & 0x7F
+            value >>= 7
+            if value:
+                append(chr(bits | 0x80))
+            else:
+                append(chr(bits))
+                break
+        return "".join(output)
+
+    @classmethod
+    def _key(cls, field, wire_type):
+        return cls._varint((field << 3) | wire_type)
+
+    @classmethod
+    def _uint_field(cls, field, value):
+        return cls._key(field, 0) + cls._varint(value)
+
+    @classmethod
+    def _bytes_field(cls, field, value):
+        return cls._key(field, 2) + cls._varint(len(value)) + value
+
+    @classmethod
+    def _string_field(cls, field, value):
+        return cls._bytes_field(field, s3_unicode(value).encode("utf-8"))
+
+    @classmethod
+    def _packed_field(cls, field, values):
+        varint = cls._varint
+        return cls._bytes_field(field, "".join(varint(v) for v in values))
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def _value(cls, value):
+        """
+            Encode a Value message
+
+            @param value: the attribute value
+        """
+
+        if isinstance(value, bool):
+            return cls._uint_field(7, int(value))
+        elif isinstance(value, (int, long)):
+            if value < 0:
+                # sint64 (zigzag)
+                return cls._uint_field(6, (value << 1) ^ (value >> 63))
+            return cls._uint_field(5, value)
+        elif isinstance(value, float):
+            return cls._key(3, 1) + struct.pack("<d", value)
+        else:
+            return cls._string_field(1, value)
+
+# END =========================================================================
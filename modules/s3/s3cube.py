@@ -0,0 +1,602 @@
+# -*- coding: utf-8 -*-
+
+""" S3 Report Cubes (materialized pivot tables)
+
+    @copyright: 2014 (c) Sahana Software Foundation
+    @license: MIT
+
+    @requires: U{B{I{gluon}} <http://web2py.com>}
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation
+    files (the "Software"), to deal in the Software without
+    restriction, including without limitation the rights to use,
+    copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the
+    Software is furnished to do so, subject to the following
+    conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+    OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+    HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+    WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+    OTHER DEALINGS IN THE SOFTWARE.
+
+    @status: experimental
+"""
+
+__all__ = ("S3ReportCube",
+           )
+
+import cPickle
+import hashlib
+import re
+
+from gluon import current
+
+from s3query import FS
+
+FACT = re.compile("([a-zA-Z]+)\((.*)\)\Z")
+
+# =============================================================================
+class S3ReportCube(object):
+    """
+        Materialized pivot table: the partial aggregates per cell of a
+        configured combination of dimensions, fact and filter are stored
+        in the database, and refreshed incrementally after records in
+        the table have been written (re-aggregating only the cells which
+        contain the records before or after the write). Writes only mark
+        the records as pending, the refresh happens at the next read.
+
+        Report cubes are configured per table, e.g.:
+
+            s3db.configure("org_facility",
+                           report_cubes = [{"rows": "location_id$L1",
+                                            "cols": "facility_type_id",
+                                            "fact": "count(id)",
+                                            "filter": FS("obsolete") == False,
+                                            },
+                                           ],
+                           )
+
+        S3PivotTable (and thus S3Report and S3Profile report widgets)
+        reads from the cube whenever a pivot table with the same
+        dimensions, fact and filter is requested by a user who has
+        access to all records.
+
+        Dimensions and fact must be suitable for aggregation in the
+        database (plain fields in the table or in tables referenced
+        by it, see S3PivotTable._sql_query). Cubes with dimensions or
+        filters in referenced tables are rebuilt (on the next read)
+        whenever those tables change.
+    """
+
+    def __init__(self, tablename, rows=None, cols=None, fact="count(id)", filter=None):
+        """
+            Constructor
+
+            @param tablename: the tablename
+            @param rows: field selector for the rows dimension
+            @param cols: field selector for the columns dimension
+            @param fact: the fact as "method(selector)"
+            @param filter: the filter (S3ResourceQuery)
+        """
+
+        if not rows and not cols:
+            raise SyntaxError("No rows or columns specified for report cube")
+
+        self.tablename = tablename
+        self.rows = rows
+        self.cols = cols
+
+        m = FACT.match(fact)
+        if m is None:
+            self.fact = (fact, "count")
+        else:
+            self.fact = (m.group(2), m.group(1))
+
+        self.filter = filter
+
+        self._key = None
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def cubes(cls, tablename):
+        """
+            Get the report cubes configured for a table
+
+            @param tablename: the tablename
+            @return: list of S3ReportCube instances
+        """
+
+        config = current.s3db.get_config(tablename, "report_cubes")
+        if not config:
+            return []
+        return [cls(tablename, **cube) for cube in config]
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def match(cls, resource, rows, cols, layers):
+        """
+            Find a report cube matching a pivot table request
+
+            @param resource: the S3Resource
+            @param rows: the rows selector (prefixed as in S3PivotTable)
+            @param cols: the cols selector (prefixed as in S3PivotTable)
+            @param layers: the layers (prefixed as in S3PivotTable)
+
+            @return: the S3ReportCube, or None if there is no match
+        """
+
+        if resource.parent is not None or len(layers) != 1:
+            return None
+        cubes = cls.cubes(resource.tablename)
+        if not cubes:
+            return None
+
+        alias = resource.alias
+        def prefix(selector):
+            if not selector:
+                return None
+            selector = resource.prefix_selector(selector)
+            if selector[:2] == "~.":
+                selector = "%s.%s" % (alias, selector[2:])
+            return selector
+
+        fact, method = layers[0]
+        candidates = [cube for cube in cubes
+                      if prefix(cube.rows) == rows and
+                         prefix(cube.cols) == cols and
+                         cube.fact[1] == method and
+                         prefix(cube.fact[0]) == fact]
+        if not candidates:
+            return None
+
+        # The request must have the same filter as the cube and access
+        # to all records (cubes are aggregated with auth.override)
+        rfilter = resource.rfilter
+        if rfilter is None:
+            rfilter = resource.build_query()
+        if rfilter.get_filter() is not None:
+            return None
+        query = str(rfilter.get_query())
+
+        auth = current.auth
+        override = auth.override
+        auth.override = True
+        try:
+            for cube in candidates:
+                if cube.key() == query:
+                    return cube
+        finally:
+            auth.override = override
+        return None
+
+    # -------------------------------------------------------------------------
+    def resource(self, query=None):
+        """
+            Get the resource for this cube
+
+            @param query: additional filter (S3ResourceQuery)
+        """
+
+        cube_filter = self.filter
+        if query is not None:
+            cube_filter = query if cube_filter is None else cube_filter & query
+        return current.s3db.resource(self.tablename, filter=cube_filter)
+
+    # -------------------------------------------------------------------------
+    def key(self):
+        """
+            The effective query of this cube, to match requests against
+            (call with auth.override)
+        """
+
+        if self._key is None:
+            self._key = str(self.resource().rfilter.get_query())
+        return self._key
+
+    # -------------------------------------------------------------------------
+    def cube_id(self):
+        """ The hash to identify this cube in the database """
+
+        definition = "%s|%s|%s|%s|%s" % (self.tablename,
+                                         self.rows,
+                                         self.cols,
+                                         "%s(%s)" % (self.fact[1], self.fact[0]),
+                                         self.key(),
+                                         )
+        return hashlib.md5(definition).hexdigest()
+
+    # -------------------------------------------------------------------------
+    def select(self, layer):
+        """
+            Read the partial aggregates from the cube, (re-)building it
+            if necessary
+
+            @param layer: the layer key of the pivot table
+
+            @return: tuple (partials, fvalues), see
+                     S3PivotTable._pivot_partials
+        """
+
+        auth = current.auth
+        override = auth.override
+        auth.override = True
+        try:
+            row = self._cube()
+            if row is None or row.versions != self.versions():
+                row = self.rebuild()
+            elif self._pending(row.id):
+                # Lock the cube while applying the pending updates
+                row = self._cube(lock=True)
+                if row is None:
+                    row = self.rebuild()
+                else:
+                    self.refresh(row.id)
+        finally:
+            auth.override = override
+
+        ctable = current.s3db.s3_report_cube_cell
+        query = (ctable.cube_id == row.id)
+        rows = current.db(query).select(ctable.dimensions,
+                                        ctable.numrecords,
+                                        ctable.partial,
+                                        ctable.fvalues,
+                                        )
+        loads = cPickle.loads
+        partials = []
+        fvalues = {}
+        for row in rows:
+            rvalue, cvalue = loads(row.dimensions)
+            partials.append((rvalue,
+                             cvalue,
+                             row.numrecords,
+                             [loads(row.partial)],
+                             ))
+            if row.fvalues:
+                values = loads(row.fvalues)
+                if values:
+                    fvalues[(rvalue, cvalue)] = {layer: values}
+        return partials, fvalues
+
+    # -------------------------------------------------------------------------
+    def rebuild(self):
+        """
+            (Re-)build the cube from all records (call with auth.override)
+
+            @return: the s3_report_cube Row
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        table = s3db.s3_report_cube
+        ctable = s3db.s3_report_cube_cell
+        rtable = s3db.s3_report_cube_record
+
+        versions = self.versions()
+
+        row = self._cube(lock=True)
+        if row:
+            if row.versions == versions:
+                # Rebuilt by a concurrent request
+                self.refresh(row.id)
+                return row
+            db(ctable.cube_id == row.id).delete()
+            db(rtable.cube_id == row.id).delete()
+            row.update_record(versions=versions)
+        else:
+            # A failed insert would abort the transaction in PostgreSQL
+            savepoint = db._dbname == "postgres"
+            if savepoint:
+                db.executesql("SAVEPOINT s3_report_cube;")
+            try:
+                table.insert(tablename=self.tablename,
+                             cube=self.cube_id(),
+                             versions=versions,
+                             )
+            except:
+                # Duplicate key: built by a concurrent request
+                if savepoint:
+                    db.executesql("ROLLBACK TO SAVEPOINT s3_report_cube;")
+                row = self._cube(lock=True)
+                if row is None:
+                    raise
+                self.refresh(row.id)
+                return row
+            if savepoint:
+                db.executesql("RELEASE SAVEPOINT s3_report_cube;")
+            row = self._cube(lock=True)
+
+        resource = self.resource()
+        pt = self._pivot(resource)
+
+        cells = []
+        for rvalue, cvalue, numrecords, partial in pt.partials:
+            cells.append(self._cell(row.id, pt, rvalue, cvalue, numrecords, partial))
+        if cells:
+            ctable.bulk_insert(cells)
+
+        # Cell of each record
+        records = self._records(pt, row.id)
+        if records:
+            rtable.bulk_insert(records)
+
+        return row
+
+    # -------------------------------------------------------------------------
+    def refresh(self, cube_id):
+        """
+            Update the cube for all records which have been written since
+            the last refresh (call with auth.override and the cube locked)
+
+            @param cube_id: the s3_report_cube record ID
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        ctable = s3db.s3_report_cube_cell
+        rtable = s3db.s3_report_cube_record
+
+        # Records written since the last refresh
+        query = (rtable.cube_id == cube_id) & \
+                (rtable.cell == None)
+        rows = db(query).select(rtable.id, rtable.record_id)
+        if not rows:
+            return
+        pending = [row.id for row in rows]
+        record_ids = list(set(row.record_id for row in rows))
+
+        # Cells containing the records before and after the write
+        query = (rtable.cube_id == cube_id) & \
+                (rtable.record_id.belongs(record_ids)) & \
+                (rtable.cell != None)
+        old = set(r.cell for r in db(query).select(rtable.cell))
+
+        resource = self.resource(FS("id").belongs(record_ids))
+        pt = self._pivot(resource)
+        new = dict((self.cell_key(r, c), (r, c)) for r, c, n, p in pt.partials)
+        records = self._records(pt, cube_id)
+
+        affected = dict(new)
+        lookup = old - set(new)
+        if lookup:
+            cquery = (ctable.cube_id == cube_id) & \
+                     (ctable.cell.belongs(lookup))
+            for r in db(cquery).select(ctable.cell, ctable.dimensions):
+                affected[r.cell] = cPickle.loads(r.dimensions)
+
+        if affected:
+            # Re-aggregate the affected cells
+            rows, cols = self.rows, self.cols
+            subqueries = []
+            for rvalue, cvalue in affected.values():
+                subquery = None
+                for selector, value in ((rows, rvalue), (cols, cvalue)):
+                    if selector:
+                        q = FS(selector) == value
+                        subquery = q if subquery is None else subquery & q
+                subqueries.append(subquery)
+            pt = self._pivot(self.resource(reduce(lambda x, y: x | y, subqueries)))
+
+            cquery = (ctable.cube_id == cube_id) & \
+                     (ctable.cell.belongs(affected.keys()))
+            db(cquery).delete()
+            cells = []
+            for rvalue, cvalue, numrecords, partial in pt.partials:
+                if self.cell_key(rvalue, cvalue) in affected:
+                    cells.append(self._cell(cube_id, pt,
+                                            rvalue, cvalue,
+                                            numrecords, partial))
+            if cells:
+                ctable.bulk_insert(cells)
+
+        # Replace the pending entries and previous cells of the records
+        db(rtable.id.belongs(pending)).delete()
+        db(query).delete()
+        if records:
+            rtable.bulk_insert(records)
+        return
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def onwrite(cls, tablename, record_id=None):
+        """
+            Mark a record as pending in all cubes of a table after it has
+            been written, so that the cubes get refreshed at the next read
+
+            @param tablename: the tablename
+            @param record_id: the record ID, None to rebuild the cubes
+                              (at the next read)
+        """
+
+        if not current.s3db.get_config(tablename, "report_cubes"):
+            return
+
+        db = current.db
+        s3db = current.s3db
+
+        table = s3db.s3_report_cube
+        query = (table.tablename == tablename)
+        if record_id:
+            rtable = s3db.s3_report_cube_record
+            for row in db(query).select(table.id):
+                rtable.insert(cube_id=row.id, record_id=record_id)
+        else:
+            db(query).update(versions=None)
+        return
+
+    # -------------------------------------------------------------------------
+    def versions(self):
+        """
+            Get the current versions of the other tables this cube
+            depends on (referenced tables in dimensions, fact or filter)
+
+            @return: dict {tablename: version}
+        """
+
+        tablename = self.tablename
+        resource = self.resource()
+
+        tablenames = set()
+        selectors = [s for s in (self.rows, self.cols, self.fact[0]) if s]
+        for rfield in resource.resolve_selectors(selectors)[0]:
+            tablenames.add(rfield.tname)
+        rfilter = resource.rfilter
+        rfilter.get_query()
+        for left in (True, False):
+            tablenames |= set(rfilter.get_joins(left=left).keys())
+        tablenames.discard(tablename)
+
+        if not tablenames:
+            return {}
+        return current.s3db.table_version(*tablenames)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def cell_key(rvalue, cvalue):
+        """
+            Get the hash of the dimension values of a cell
+
+            @param rvalue: the row value
+            @param cvalue: the column value
+        """
+
+        dumps = S3ReportCube._dumps
+        return hashlib.md5(dumps((rvalue, cvalue))).hexdigest()
+
+    # -------------------------------------------------------------------------
+    def _cube(self, lock=False):
+        """
+            Get the s3_report_cube record for this cube
+
+            @param lock: lock the record until the end of the transaction
+        """
+
+        table = current.s3db.s3_report_cube
+        query = (table.cube == self.cube_id())
+        return current.db(query).select(table.id,
+                                        table.versions,
+                                        limitby=(0, 1),
+                                        for_update=lock).first()
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _pending(cube_id):
+        """
+            Check whether records have been written since the last
+            refresh of a cube
+
+            @param cube_id: the s3_report_cube record ID
+        """
+
+        rtable = current.s3db.s3_report_cube_record
+        query = (rtable.cube_id == cube_id) & \
+                (rtable.cell == None)
+        row = current.db(query).select(rtable.id,
+                                       limitby=(0, 1)).first()
+        return row is not None
+
+    # -------------------------------------------------------------------------
+    def _pivot(self, resource):
+        """
+            Aggregate the cube in the database
+
+            @param resource: the resource
+            @return: the S3PivotTable
+        """
+
+        from s3data import S3PivotTable
+        pt = S3PivotTable(resource,
+                          self.rows,
+                          self.cols,
+                          [self.fact],
+                          cube=False)
+        if pt.partials is None:
+            raise SyntaxError("Report cube for %s can not be aggregated in the database" %
+                              self.tablename)
+        return pt
+
+    # -------------------------------------------------------------------------
+    def _cell(self, cube_id, pt, rvalue, cvalue, numrecords, partial):
+        """
+            Get the s3_report_cube_cell record for a cell
+
+            @param cube_id: the s3_report_cube record ID
+            @param pt: the S3PivotTable
+            @param rvalue: the row value
+            @param cvalue: the column value
+            @param numrecords: the number of records in the cell
+            @param partial: the partial aggregates (list of layers)
+        """
+
+        dumps = self._dumps
+        fvalues = pt.fvalues.get((rvalue, cvalue)) if pt.fvalues else None
+        if fvalues:
+            fvalues = fvalues.get(pt.layers[0])
+        return {"cube_id": cube_id,
+                "cell": self.cell_key(rvalue, cvalue),
+                "dimensions": dumps((rvalue, cvalue)),
+                "numrecords": numrecords,
+                "partial": dumps(partial[0]),
+                "fvalues": dumps(fvalues) if fvalues else None,
+                }
+
+    # -------------------------------------------------------------------------
+    def _records(self, pt, cube_id):
+        """
+            Get the s3_report_cube_record records for all records
+
+            @param pt: the S3PivotTable
+            @param cube_id: the s3_report_cube record ID
+        """
+
+        sql = pt._sql_query()
+        table = pt.resource.table
+        rfield, cfield = sql.rfield, sql.cfield
+
+        rows = current.db(sql.query).select(table._id,
+                                            *sql.groupby,
+                                            join=sql.join,
+                                            left=sql.left,
+                                            distinct=True)
+        cell_key = self.cell_key
+        return [{"cube_id": cube_id,
+                 "record_id": row[table._id],
+                 "cell": cell_key(row[rfield] if rfield is not None else None,
+                                  row[cfield] if cfield is not None else None),
+                 }
+                for row in rows]
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _dumps(value):
+        """
+            Pickle a (tuple of) dimension value(s) or aggregate(s), with
+            consistent types (e.g. for References, or int vs long)
+
+            @param value: the value
+        """
+
+        def normalize(v):
+            if isinstance(v, tuple):
+                return tuple(normalize(i) for i in v)
+            elif isinstance(v, list):
+                return [normalize(i) for i in v]
+            elif isinstance(v, bool):
+                return v
+            elif isinstance(v, (int, long)):
+                return int(v)
+            return v
+
+        return cPickle.dumps(normalize(value))
+
+# END =========================================================================
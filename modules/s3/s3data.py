@@ -1269,7 +1269,7 @@ class S3PivotTable(object):
                #"std": "Standard Deviation"
                }
 
-    def __init__(self, resource, rows, cols, layers, strict=True):
+    def __init__(self, resource, rows, cols, layers, strict=True, cube=True):
         """
             Constructor - extracts all unique records, generates a
             pivot table from them with the given dimensions and
@@ -1282,6 +1282,7 @@ class S3PivotTable(object):
                            for the value aggregation(s)
             @param strict: filter out dimension values which don't match
                            the resource filter
+            @param cube: use a matching report cube if available
         """
 
         # Initialize ----------------------------------------------------------
@@ -1306,7 +1307,14 @@ class S3PivotTable(object):
                 {
                  <record_id>: <Row>
                 }
+            (None if the pivot table has been aggregated in the database)
         """
+        self.numrecords = None
+        """ The number of records, if aggregated in the database """
+
+        self.partials = None
+        self.fvalues = None
+        """ The partial results per cell, if aggregated in the database """
 
         self.empty = False
         """ Empty-flag (True if no records could be found) """
@@ -1364,10 +1372,17 @@ class S3PivotTable(object):
             _start = datetime.datetime.now()
             _debug("S3PivotTable %s starting" % tablename)
 
-        # Retrieve the records ------------------------------------------------
+        # Read from a report cube, or aggregate in the database if possible -
         #
-        data = resource.select(self.rfields.keys(), limit=None)
-        drows = data["rows"]
+        if cube and self._cube_pivot():
+            drows = None
+        elif self._sql_pivot():
+            drows = None
+        else:
+            # Retrieve the records --------------------------------------------
+            #
+            data = resource.select(self.rfields.keys(), limit=None)
+            drows = data["rows"]
         if drows:
 
             key = str(resource.table._id)
@@ -1410,47 +1425,54 @@ class S3PivotTable(object):
                 #duration = '{:.2f}'.format(duration.total_seconds())
                 #_debug("Dataframe complete after %s seconds" % duration)
                 
-            # Group the records -----------------------------------------------
+            # Group the records and add the layers (vectorized) --------------
             #
-            matrix, rnames, cnames = self._pivot(dataframe,
-                                                 pkey_colname,
-                                                 rows_colname,
-                                                 cols_colname)
-
-            #if DEBUG:
-                #duration = datetime.datetime.now() - _start
-                #duration = '{:.2f}'.format(duration.total_seconds())
-                #_debug("Pivoting complete after %s seconds" % duration)
+            if not self._columnar_pivot(dataframe,
+                                        pkey_colname,
+                                        rows_colname,
+                                        cols_colname):
+
+                # Group the records -----------------------------------------------
+                #
+                matrix, rnames, cnames = self._pivot(dataframe,
+                                                     pkey_colname,
+                                                     rows_colname,
+                                                     cols_colname)
+
+                #if DEBUG:
+                    #duration = datetime.datetime.now() - _start
+                    #duration = '{:.2f}'.format(duration.total_seconds())
+                    #_debug("Pivoting complete after %s seconds" % duration)
                 
-            # Initialize columns and rows -------------------------------------
-            #
-            if cols:
-                self.col = [Storage({"value": v}) for v in cnames]
-                self.numcols = len(self.col)
-            else:
-                self.col = [Storage({"value": None})]
-                self.numcols = 1
-
-            if rows:
-                self.row = [Storage({"value": v}) for v in rnames]
-                self.numrows = len(self.row)
-            else:
-                self.row = [Storage({"value": None})]
-                self.numrows = 1
-
-            # Add the layers --------------------------------------------------
-            #
-            add_layer = self._add_layer
-            layers = list(self.layers)
-            for f, m in self.layers:
-                add_layer(matrix, f, m)
-
-            #if DEBUG:
-                #duration = datetime.datetime.now() - _start
-                #duration = '{:.2f}'.format(duration.total_seconds())
-                #_debug("Layers complete after %s seconds" % duration)
+                # Initialize columns and rows -------------------------------------
+                #
+                if cols:
+                    self.col = [Storage({"value": v}) for v in cnames]
+                    self.numcols = len(self.col)
+                else:
+                    self.col = [Storage({"value": None})]
+                    self.numcols = 1
 
-        else:
+                if rows:
+                    self.row = [Storage({"value": v}) for v in rnames]
+                    self.numrows = len(self.row)
+                else:
+                    self.row = [Storage({"value": None})]
+                    self.numrows = 1
+
+                # Add the layers --------------------------------------------------
+                #
+                add_layer = self._add_layer
+                layers = list(self.layers)
+                for f, m in self.layers:
+                    add_layer(matrix, f, m)
+
+                #if DEBUG:
+                    #duration = datetime.datetime.now() - _start
+                    #duration = '{:.2f}'.format(duration.total_seconds())
+                    #_debug("Layers complete after %s seconds" % duration)
+
+        elif self.numrecords is None:
             # No items to report on -------------------------------------------
             #
             self.empty = True
@@ -1466,6 +1488,8 @@ class S3PivotTable(object):
     def __len__(self):
         """ Total number of records in the report """
 
+        if self.numrecords is not None:
+            return self.numrecords
         items = self.records
         if items is None:
             return 0
@@ -1676,41 +1700,26 @@ class S3PivotTable(object):
 
                         rfield = rfields[f]
                         field = rfield.field
-                        colname = rfield.colname
                         has_fk = field is not None and s3_has_foreign_key(field)
-                        for record_id in cell.records:
-
-                            record = self.records[record_id]
-                            try:
-                                fvalue = record[colname]
-                            except AttributeError:
-                                fvalue = None
-
-                            if fvalue is not None:
-                                if has_fk:
-                                    if type(fvalue) is not list:
-                                        fvalue = [fvalue]
-                                    # list of foreign keys
-                                    for fk in fvalue:
-                                        if fk is not None and fk not in layer_ids:
-                                            layer_ids.append(int(fk))
-                                            if fk not in layer_values:
-                                                layer_values[fk] = s3_unicode(field.represent(fk))
+                        for fvalue in self._cell_values(cell, layer):
+
+                            if has_fk:
+                                # foreign key
+                                if fvalue not in layer_ids:
+                                    layer_ids.append(int(fvalue))
+                                    if fvalue not in layer_values:
+                                        layer_values[fvalue] = s3_unicode(field.represent(fvalue))
+                            else:
+                                if fvalue not in cell_vals:
+                                    next_id = len(cell_vals)
+                                    cell_vals[fvalue] = next_id
+                                    layer_ids.append(next_id)
+                                    layer_values[next_id] = s3_unicode(represent(fvalue))
                                 else:
-                                    if type(fvalue) is not list:
-                                        fvalue = [fvalue]
-                                    for val in fvalue:
-                                        if val is not None:
-                                            if val not in cell_vals:
-                                                next_id = len(cell_vals)
-                                                cell_vals[val] = next_id
-                                                layer_ids.append(next_id)
-                                                layer_values[next_id] = s3_unicode(represent(val))
-                                            else:
-                                                prev_id = cell_vals[val]
-                                                if prev_id not in layer_ids:
-                                                    layer_ids.append(prev_id)
-                                                    
+                                    prev_id = cell_vals[fvalue]
+                                    if prev_id not in layer_ids:
+                                        layer_ids.append(prev_id)
+
                         layer_ids.sort(key=lambda i: layer_values[i])
 
                     cell_ids.append(layer_ids)
@@ -1927,7 +1936,11 @@ class S3PivotTable(object):
                     items = cell[layer]
                     value = items if is_numeric \
                                   else len(cell_records)
-                                  
+                    if method == "count":
+                        fvalues = self._cell_values(cell, layer)
+                    else:
+                        fvalues = None
+
                     for ri in ridx:
                         if ri not in cells:
                             orow = cells[ri] = {}
@@ -1943,11 +1956,14 @@ class S3PivotTable(object):
                                     ocell["value"] = value
                                     ocell["items"] = items
                                 ocell["records"] = cell_records
+                                ocell["fvalues"] = fvalues
                             else:
                                 ocell = orow[ci]
                                 ocell["value"].append(value)
                                 ocell["items"].append(items)
                                 ocell["records"].extend(cell_records)
+                                if fvalues:
+                                    ocell["fvalues"].extend(fvalues)
 
             # Aggregate the grouped values
             ctotals = True
@@ -1998,34 +2014,22 @@ class S3PivotTable(object):
                     # Build a lookup table for field values if counting
                     if method == "count":
                         keys = []
-                        for record_id in cell_records:
-                            record = self.records[record_id]
-                            try:
-                                fvalue = record[rfield.colname]
-                            except AttributeError:
-                                continue
-                            if fvalue is None:
-                                continue
-                            if type(fvalue) is not list:
-                                fvalue = [fvalue]
-                            for v in fvalue:
-                                if v is None:
-                                    continue
-                                if has_fk:
-                                    if v not in keys:
-                                        keys.append(v)
-                                    if v not in lookup:
-                                        lookup[v] = _repr(v)
+                        for v in cell["fvalues"]:
+                            if has_fk:
+                                if v not in keys:
+                                    keys.append(v)
+                                if v not in lookup:
+                                    lookup[v] = _repr(v)
+                            else:
+                                if v not in value_map:
+                                    next_id = len(value_map)
+                                    value_map[v] = next_id
+                                    keys.append(next_id)
+                                    lookup[next_id] = _repr(v)
                                 else:
-                                    if v not in value_map:
-                                        next_id = len(value_map)
-                                        value_map[v] = next_id
-                                        keys.append(next_id)
-                                        lookup[next_id] = _repr(v)
-                                    else:
-                                        prev_id = value_map[v]
-                                        if prev_id not in keys:
-                                            keys.append(prev_id)
+                                    prev_id = value_map[v]
+                                    if prev_id not in keys:
+                                        keys.append(prev_id)
                         keys.sort(key=lambda i: lookup[i])
                     else:
                         keys = None
@@ -2282,6 +2286,648 @@ class S3PivotTable(object):
 
     # -------------------------------------------------------------------------
     # Internal methods
+    # -------------------------------------------------------------------------
+    def _sql_pivot(self):
+        """
+            Aggregate the pivot table in the database (GROUP BY) rather
+            than extracting all records - possible if the dimensions and
+            facts are all plain (non-list) fields in the master table or
+            in tables referenced by it, and all layers use SQL aggregate
+            methods (i.e. not "list")
+
+            Updates self.cell, self.row, self.col, self.totals and
+            self.numrecords; cells and headers get empty record lists.
+            The partial results per cell are retained in self.partials.
+
+            @return: True if successful, False if the pivot table must
+                     be computed from the records instead
+        """
+
+        sql = self._sql_query()
+        if sql is None:
+            return False
+
+        db = current.db
+        table = self.resource.table
+        rfields = self.rfields
+        query = sql.query
+        join = sql.join
+        left = sql.left
+        groupby = sql.groupby
+        rfield = sql.rfield
+        cfield = sql.cfield
+
+        # Aggregates
+        count = table._id.count()
+        expressions = [count]
+        aggregates = []
+        for fact, method in self.layers:
+            field = rfields[fact].field
+            if method == "count":
+                expr = (field.count(distinct=True),)
+            elif method == "avg":
+                expr = (field.sum(), field.count())
+            else:
+                expr = (getattr(field, method)(),)
+            aggregates.append(expr)
+            expressions.extend(expr)
+
+        dbrows = db(query).select(*(groupby + expressions),
+                                  join=join,
+                                  left=left,
+                                  groupby=groupby)
+
+        partials = []
+        for row in dbrows:
+            rvalue = row[rfield] if rfield is not None else None
+            cvalue = row[cfield] if cfield is not None else None
+            partials.append((rvalue,
+                             cvalue,
+                             row[count],
+                             [tuple(row[e] for e in expr) for expr in aggregates],
+                             ))
+        self.partials = partials
+
+        if not partials:
+            # Let the standard method handle empty results
+            return False
+
+        # Distinct fact values per cell for the drill-down of count layers
+        fvalues = {}
+        for fact, method in self.layers:
+            if method != "count" or fact == self.pkey:
+                continue
+            layer = (fact, method)
+            field = rfields[fact].field
+            rows = db(query & (field != None)).select(*(groupby + [field]),
+                                                      join=join,
+                                                      left=left,
+                                                      distinct=True)
+            for row in rows:
+                rvalue = row[rfield] if rfield is not None else None
+                cvalue = row[cfield] if cfield is not None else None
+                cell = fvalues.setdefault((rvalue, cvalue), {})
+                cell.setdefault(layer, []).append(row[field])
+        self.fvalues = fvalues
+
+        self._pivot_partials(partials, fvalues)
+        return True
+
+    # -------------------------------------------------------------------------
+    def _cube_pivot(self):
+        """
+            Read the pivot table from a matching report cube (see
+            S3ReportCube) rather than aggregating the records
+
+            @return: True if successful, False if there is no matching
+                     report cube
+        """
+
+        from s3cube import S3ReportCube
+        cube = S3ReportCube.match(self.resource,
+                                  self.rows,
+                                  self.cols,
+                                  self.layers)
+        if cube is None:
+            return False
+
+        partials, fvalues = cube.select(self.layers[0])
+        if not partials:
+            return False
+
+        self._pivot_partials(partials, fvalues)
+        return True
+
+    # -------------------------------------------------------------------------
+    def _sql_query(self):
+        """
+            Check whether the pivot table can be aggregated in the database,
+            and if so, construct the query, joins and GROUP BY fields
+
+            @return: Storage with the query, join, left, groupby as well
+                     as the rows/cols Fields (rfield/cfield), or None if
+                     the pivot table can not be aggregated in the database
+        """
+
+        resource = self.resource
+        rfields = self.rfields
+        alias = resource.alias
+
+        rows = self.rows
+        cols = self.cols
+        layers = self.layers
+
+        NUMERIC = ("integer", "bigint", "double")
+        def pushable(selector, method=None):
+            rfield = rfields[selector]
+            if rfield.field is None or rfield.ftype[:5] == "list:":
+                return False
+            if selector.split("$", 1)[0].split(".", 1)[0] != alias:
+                # Component field (may have multiple values per record)
+                return False
+            if method in ("sum", "min", "max", "avg"):
+                ftype = rfield.ftype
+                return ftype in NUMERIC or ftype[:7] == "decimal"
+            return True
+
+        for dim in (rows, cols):
+            if dim and not pushable(dim):
+                return None
+        for fact, method in layers:
+            if method not in ("count", "sum", "min", "max", "avg") or \
+               not pushable(fact, method):
+                return None
+
+        db = current.db
+        table = resource.table
+        tablename = resource.tablename
+
+        # Resource query and joins
+        rfilter = resource.rfilter
+        if rfilter is None:
+            rfilter = resource.build_query()
+        query = rfilter.get_query()
+
+        from s3query import S3Joins
+        ijoins = S3Joins(tablename, rfilter.get_joins(left=False))
+        ljoins = S3Joins(tablename, rfilter.get_joins(left=True))
+
+        if rfilter.get_filter() is not None:
+            # Virtual filter: must resolve the record IDs first
+            data = resource.select([table._id.name],
+                                   limit=None,
+                                   getids=True)
+            query = table._id.belongs(data["ids"])
+            ijoins = S3Joins(tablename)
+            ljoins = S3Joins(tablename)
+        elif rfilter.distinct:
+            # Filter joins may duplicate records: filter by sub-select
+            subselect = db(query)._select(table._id,
+                                          join=ijoins.as_list(prefer=ljoins),
+                                          left=ljoins.as_list(),
+                                          distinct=True)
+            query = table._id.belongs(subselect)
+            ijoins = S3Joins(tablename)
+            ljoins = S3Joins(tablename)
+
+        # Joins for dimensions and facts
+        for selector in set([rows, cols] + [fact for fact, m in layers]):
+            if selector:
+                ljoins.extend(rfields[selector].left)
+
+        # Dimensions
+        groupby = []
+        rfield = rfields[rows].field if rows else None
+        if rfield is not None:
+            groupby.append(rfield)
+        cfield = rfields[cols].field if cols else None
+        if cfield is not None and (rfield is None or str(cfield) != str(rfield)):
+            groupby.append(cfield)
+
+        return Storage(query = query,
+                       join = ijoins.as_list(prefer=ljoins),
+                       left = ljoins.as_list(),
+                       groupby = groupby,
+                       rfield = rfield,
+                       cfield = cfield,
+                       )
+
+    # -------------------------------------------------------------------------
+    def _pivot_partials(self, partials, fvalues=None):
+        """
+            Build the pivot table from partial results per cell (as
+            produced by _sql_pivot, or read from a report cube)
+
+            @param partials: list of tuples (row value, column value,
+                             number of records, [partial per layer]),
+                             where the partial of each layer is a tuple
+                             (sum, count) for avg, or (value,) otherwise
+            @param fvalues: distinct fact values per cell for the
+                            drill-down of count layers, as dict
+                            {(row value, column value): {layer: values}}
+
+            Updates self.cell, self.row, self.col, self.totals and
+            self.numrecords; cells and headers get empty record lists.
+        """
+
+        layers = self.layers
+
+        rvalues = {}
+        cvalues = {}
+        cells = {}
+        numrecords = 0
+        for rvalue, cvalue, number, cell_partials in partials:
+            r = rvalues.get(rvalue)
+            if r is None:
+                r = rvalues[rvalue] = len(rvalues)
+            c = cvalues.get(cvalue)
+            if c is None:
+                c = cvalues[cvalue] = len(cvalues)
+            cells[(r, c)] = cell_partials
+            numrecords += number
+
+        self.numrecords = numrecords
+
+        rnames = [None] * len(rvalues)
+        for k, v in rvalues.items():
+            rnames[v] = k
+        cnames = [None] * len(cvalues)
+        for k, v in cvalues.items():
+            cnames[v] = k
+
+        self.row = [Storage(value=v, records=[]) for v in rnames] \
+                   if self.rows else [Storage(value=None, records=[])]
+        self.col = [Storage(value=v, records=[]) for v in cnames] \
+                   if self.cols else [Storage(value=None, records=[])]
+        self.numrows = numrows = len(self.row)
+        self.numcols = numcols = len(self.col)
+        self.cell = [[Storage(records=[]) for c in xrange(numcols)]
+                     for r in xrange(numrows)]
+
+        # Aggregation methods for partial results
+        def combine(method, partials):
+            partials = [p for p in partials if p is not None]
+            if method == "avg":
+                total = sum(p[0] or 0 for p in partials)
+                number = sum(p[1] or 0 for p in partials)
+                return float(total) / number if number else 0.0
+            values = [p[0] for p in partials if p[0] is not None]
+            if method in ("count", "sum"):
+                return sum(values)
+            elif values:
+                return min(values) if method == "min" else max(values)
+            else:
+                return None
+
+        for index, layer in enumerate(layers):
+            method = layer[1]
+            all_partials = []
+            col_partials = [[] for c in xrange(numcols)]
+            for r in xrange(numrows):
+                row_partials = []
+                for c in xrange(numcols):
+                    partials = cells.get((r, c))
+                    partial = partials[index] if partials else None
+                    self.cell[r][c][layer] = combine(method, [partial])
+                    row_partials.append(partial)
+                    col_partials[c].append(partial)
+                self.row[r][layer] = combine(method, row_partials)
+                all_partials.extend(row_partials)
+            for c in xrange(numcols):
+                self.col[c][layer] = combine(method, col_partials[c])
+            self.totals[layer] = combine(method, all_partials)
+
+        # Distinct fact values per cell for the drill-down of count layers
+        if fvalues:
+            for (rvalue, cvalue), values in fvalues.items():
+                r = rvalues.get(rvalue)
+                c = cvalues.get(cvalue)
+                if r is None or c is None:
+                    continue
+                self.cell[r][c]["fvalues"] = dict(values)
+        return
+
+    # -------------------------------------------------------------------------
+    def _cell_values(self, cell, layer):
+        """
+            Get the fact values of all records in a cell, for the
+            drill-down of count layers
+
+            @param cell: the cell
+            @param layer: the layer
+
+            @return: list of values (may contain duplicates)
+        """
+
+        if self.records is None:
+            # Aggregated in the database
+            fvalues = cell.get("fvalues")
+            return list(fvalues.get(layer, ())) if fvalues else []
+
+        colname = self.rfields[layer[0]].colname
+        records = self.records
+
+        values = []
+        append = values.append
+        for record_id in cell["records"]:
+            try:
+                fvalue = records[record_id][colname]
+            except AttributeError:
+                continue
+            if fvalue is None:
+                continue
+            if type(fvalue) is list:
+                values.extend(v for v in fvalue if v is not None)
+            else:
+                append(fvalue)
+        return values
+
+    # -------------------------------------------------------------------------
+    def _columnar_pivot(self, items, pkey_colname, rows_colname, cols_colname):
+        """
+            Vectorized alternative to _pivot and _add_layer: groups the
+            items and computes all layers with NumPy array operations
+            instead of nested per-cell loops, updates:
+
+                - self.cell, self.row, self.col: as _add_layer
+                - self.totals: the overall totals per layer
+                - self.numrows, self.numcols: the dimensions
+
+            @param items: list of unique items as dicts
+            @param pkey_colname: column name of the primary key
+            @param rows_colname: column name of the row dimension
+            @param cols_colname: column name of the column dimension
+
+            @return: True if successful, False if NumPy is not available
+                     (=> fall back to _pivot and _add_layer)
+        """
+
+        try:
+            import numpy as np
+        except ImportError:
+            return False
+
+        layers = self.layers
+        for fact, method in layers:
+            if fact is None or method not in self.METHODS:
+                # Let _add_layer handle (or reject) these
+                return False
+        if not items:
+            return False
+
+        # Factorize the dimension values, in order of appearance
+        rindex = {}
+        cindex = {}
+        rnames = []
+        cnames = []
+        rcodes = []
+        ccodes = []
+        ids = []
+        for item in items:
+            rvalue = item[rows_colname] if rows_colname else None
+            cvalue = item[cols_colname] if cols_colname else None
+            r = rindex.get(rvalue)
+            if r is None:
+                r = rindex[rvalue] = len(rnames)
+                rnames.append(rvalue)
+            c = cindex.get(cvalue)
+            if c is None:
+                c = cindex[cvalue] = len(cnames)
+                cnames.append(cvalue)
+            record_id = item[pkey_colname]
+            if record_id is None:
+                continue
+            rcodes.append(r)
+            ccodes.append(c)
+            ids.append(record_id)
+
+        numrows = len(rnames)
+        numcols = len(cnames)
+        numcells = numrows * numcols
+
+        # Sort the items by cell (stable sort => order of appearance
+        # within cells), so that every cell, and every row, is a slice
+        cellidx = np.array(rcodes, dtype=np.int64) * numcols + \
+                  np.array(ccodes, dtype=np.int64)
+        order = np.argsort(cellidx, kind="mergesort")
+        cellidx = cellidx[order]
+        ids = [ids[i] for i in order.tolist()]
+        bounds = np.searchsorted(cellidx,
+                                 np.arange(numcells + 1)).tolist()
+
+        # Initialize cells, rows and columns
+        RECORDS = "records"
+        self.cell = cells = [[Storage({RECORDS: ids[bounds[r * numcols + c]:
+                                                    bounds[r * numcols + c + 1]]})
+                              for c in xrange(numcols)]
+                             for r in xrange(numrows)]
+        self.row = rows = [Storage({"value": v,
+                                    RECORDS: ids[bounds[r * numcols]:
+                                                 bounds[(r + 1) * numcols]],
+                                    })
+                           for r, v in enumerate(rnames)]
+        self.col = cols = []
+        for c, v in enumerate(cnames):
+            col_records = []
+            for r in xrange(numrows):
+                col_records.extend(cells[r][c][RECORDS])
+            cols.append(Storage({"value": v, RECORDS: col_records}))
+        self.numrows = numrows
+        self.numcols = numcols
+
+        # Extract the fact values (per record, then per item)
+        records = self.records
+        extract = self._extract
+        icells = cellidx.tolist()
+        facts = {}
+        for fact, method in layers:
+            if fact in facts:
+                continue
+            values = {}
+            vcells = []
+            vals = []
+            for k, record_id in enumerate(ids):
+                if record_id in values:
+                    rvalues = values[record_id]
+                else:
+                    value = extract(records[record_id], fact)
+                    if value is None:
+                        rvalues = []
+                    elif type(value) in (list, tuple):
+                        rvalues = list(s3_flatlist(value))
+                    else:
+                        rvalues = [value]
+                    values[record_id] = rvalues
+                if rvalues:
+                    vcells.extend([icells[k]] * len(rvalues))
+                    vals.extend(rvalues)
+            vcells = np.array(vcells, dtype=np.int64)
+            vbounds = np.searchsorted(vcells,
+                                      np.arange(numcells + 1)).tolist()
+            facts[fact] = (vcells, vals, vbounds)
+
+        # Compute the layers
+        aggregate = self._aggregate
+        for layer in layers:
+            fact, method = layer
+            vcells, vals, vbounds = facts[fact]
+
+            if method == "count":
+                cell_totals = self._count_distinct(np, vcells, vals, numcells)
+                cell_totals = cell_totals.reshape(numrows, numcols)
+                row_totals = cell_totals.sum(axis=1).tolist()
+                col_totals = cell_totals.sum(axis=0).tolist()
+                total = int(cell_totals.sum())
+                cell_totals = cell_totals.tolist()
+
+            elif method != "list" and \
+                 all(type(v) in (int, long, float) for v in vals):
+                rowidx = vcells // numcols
+                colidx = vcells % numcols
+                reduce = self._numeric_reduce
+                totals = [reduce(np, index, vals, method, size)
+                          for index, size in ((vcells, numcells),
+                                              (rowidx, numrows),
+                                              (colidx, numcols),
+                                              (np.zeros(len(vals), dtype=np.int64), 1),
+                                              )]
+                if None in totals:
+                    # Out of range for vectorized aggregation
+                    totals = None
+                else:
+                    cell_totals = [totals[0][r * numcols:(r + 1) * numcols]
+                                   for r in xrange(numrows)]
+                    row_totals, col_totals = totals[1:3]
+                    total = totals[3][0]
+            else:
+                totals = None
+
+            if method != "count" and totals is None:
+                # Aggregate the grouped values
+                if method == "list":
+                    cell_values = [list(set(vals[vbounds[k]:vbounds[k + 1]]))
+                                   for k in xrange(numcells)]
+                else:
+                    cell_values = [vals[vbounds[k]:vbounds[k + 1]]
+                                   for k in xrange(numcells)]
+                cell_totals = [[aggregate(cell_values[r * numcols + c], method)
+                                for c in xrange(numcols)]
+                               for r in xrange(numrows)]
+                row_totals = []
+                for r in xrange(numrows):
+                    row_values = []
+                    for c in xrange(numcols):
+                        row_values.extend(cell_values[r * numcols + c])
+                    row_totals.append(aggregate(row_values, method))
+                col_totals = []
+                for c in xrange(numcols):
+                    col_values = []
+                    for r in xrange(numrows):
+                        col_values.extend(cell_values[r * numcols + c])
+                    col_totals.append(aggregate(col_values, method))
+                all_values = []
+                for values in cell_values:
+                    all_values.extend(values)
+                total = aggregate(all_values, method)
+
+            for r in xrange(numrows):
+                row_cells = cells[r]
+                row_totals_r = cell_totals[r]
+                for c in xrange(numcols):
+                    row_cells[c][layer] = row_totals_r[c]
+                rows[r][layer] = row_totals[r]
+            for c in xrange(numcols):
+                cols[c][layer] = col_totals[c]
+            self.totals[layer] = total
+
+        return True
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _count_distinct(np, index, values, size):
+        """
+            Count the distinct (non-None) values per group
+
+            @param np: the numpy module
+            @param index: array of the group index of each value
+            @param values: list of values
+            @param size: the number of groups
+
+            @return: array with the number of distinct values per group
+        """
+
+        codes = {}
+        vcodes = []
+        vindex = []
+        for i, value in enumerate(values):
+            if value is None:
+                continue
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(codes)
+            vcodes.append(code)
+            vindex.append(i)
+
+        numcodes = len(codes)
+        if not numcodes:
+            return np.zeros(size, dtype=np.int64)
+
+        keys = index[np.array(vindex, dtype=np.int64)] * numcodes + \
+               np.array(vcodes, dtype=np.int64)
+        groups = np.unique(keys) // numcodes
+        return np.bincount(groups, minlength=size).astype(np.int64)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _numeric_reduce(np, index, values, method, size):
+        """
+            Aggregate numeric values per group, with the same results
+            (and result types) as _aggregate for each group
+
+            @param np: the numpy module
+            @param index: array of the group index of each value
+            @param values: list of numeric values (int, long or float)
+            @param method: the aggregation method (sum, min, max or avg)
+            @param size: the number of groups
+
+            @return: list of aggregate values per group, or None if the
+                     values can not be aggregated as 64-bit numbers
+        """
+
+        isfloat = np.array([type(v) is float for v in values], dtype=bool)
+        dtype = np.float64 if isfloat.any() else np.int64
+        try:
+            array = np.array(values, dtype=dtype)
+        except OverflowError:
+            return None
+        if dtype is np.int64 and len(values) and \
+           float(np.abs(array).max()) * len(values) >= 2 ** 53:
+            # Sums could not be computed exactly
+            return None
+
+        counts = np.bincount(index, minlength=size)
+        floats = np.bincount(index, weights=isfloat, minlength=size) > 0
+
+        if method in ("sum", "avg"):
+            # bincount adds up in order, like sum() does
+            result = np.bincount(index, weights=array, minlength=size)
+        elif method in ("min", "max"):
+            if method == "min":
+                ufunc = np.minimum
+                start = np.inf if dtype is np.float64 else np.iinfo(dtype).max
+            else:
+                ufunc = np.maximum
+                start = -np.inf if dtype is np.float64 else np.iinfo(dtype).min
+            result = np.empty(size, dtype=dtype)
+            result.fill(start)
+            ufunc.at(result, index, array)
+
+            # Return the first matching value of each group, like min()
+            # and max() do (keeps its original type in mixed groups)
+            hits = np.flatnonzero(array == result[index])
+            first = np.empty(size, dtype=np.int64)
+            first.fill(len(values))
+            np.minimum.at(first, index[hits], hits)
+            return [values[i] if count else None
+                    for i, count in zip(first.tolist(), counts.tolist())]
+        else:
+            return None
+
+        output = []
+        append = output.append
+        for value, count, hasfloat in zip(result.tolist(),
+                                          counts.tolist(),
+                                          floats.tolist()):
+            if method == "avg":
+                append(value / float(count) if count else 0.0)
+            elif not count:
+                append(0)
+            elif hasfloat:
+                append(float(value))
+            else:
+                append(int(value))
+        return output
+
     # -------------------------------------------------------------------------
     def _pivot(self, items, pkey_colname, rows_colname, cols_colname):
         """
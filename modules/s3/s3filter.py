@@ -43,6 +43,7 @@ __all__ = ("S3DateFilter",
            )
 
 import datetime
+import hashlib
 import re
 
 try:
@@ -61,6 +62,7 @@ except:
     from gluon.contrib.simplejson.ordered_dict import OrderedDict
 
 from gluon import *
+from gluon.languages import lazyT
 from gluon.storage import Storage
 from gluon.tools import callback
 
@@ -466,6 +468,36 @@ class S3FilterWidget(object):
         else:
             return selector
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _cache(name, tablenames, key, lookup):
+        """
+            Cache the result of an options lookup in RAM, until any of
+            the tables it reads from is written to, or until the cache
+            expires (settings.search.filter_options_cache)
+
+            @param name: prefix for the cache key
+            @param tablenames: the names of the tables the lookup reads
+                               from (their versions are part of the key)
+            @param key: a string identifying the lookup, e.g. the query
+                        (which includes the realms of the user)
+            @param lookup: the lookup function, no arguments
+
+            @return: the result of the lookup
+        """
+
+        expire = current.deployment_settings.get_search_filter_options_cache()
+        if not expire:
+            return lookup()
+
+        tablenames = sorted(set(tablenames))
+        versions = current.s3db.table_version(*tablenames)
+        version = "-".join(str(versions[tn]) for tn in tablenames)
+
+        key = hashlib.md5(s3_unicode(key).encode("utf-8")).hexdigest()
+        key = "filter_%s_%s_%s" % (name, version, key)
+        return current.cache.ram(key, lookup, time_expire=expire)
+
 # =============================================================================
 class S3TextFilter(S3FilterWidget):
     """ Text filter widget """
@@ -1017,11 +1049,7 @@ class S3LocationFilter(S3FilterWidget):
         options = opts.get("options")
         if options:
             # Fixed options (=list of location IDs)
-            resource = s3db.resource("gis_location", id=options)
-            fields = ["id"] + [l for l in levels]
-            if translate:
-                fields.append("path")
-            joined = False
+            rows = self._locations(options, levels, accessible=True)
 
         elif selector:
             # Lookup options from resource
@@ -1029,23 +1057,16 @@ class S3LocationFilter(S3FilterWidget):
             if not rfield.field or rfield.ftype != ftype:
                 # Must be a real reference to gis_location
                 return default
-            fields = [selector] + ["%s$%s" % (selector, l) for l in levels]
-            if translate:
-                fields.append("%s$path" % selector)
-            joined = True
             # Filter out old Locations
             # @ToDo: Allow override
             resource.add_filter(gtable.end_date == None)
+            rows = self._locations_in_use(resource, rfield, levels)
 
         else:
             # Neither fixed options nor resource to look them up
             return default
 
         # Find the options
-        rows = resource.select(fields=fields,
-                               limit=None,
-                               virtual=False,
-                               as_rows=True)
         rows2 = []
         if not rows:
             if values:
@@ -1054,7 +1075,6 @@ class S3LocationFilter(S3FilterWidget):
                 fields = ["id"] + [l for l in levels]
                 if translate:
                     fields.append("path")
-                joined = False
                 rows = []
                 for f in values:
                     v = values[f]
@@ -1125,26 +1145,14 @@ class S3LocationFilter(S3FilterWidget):
         if translate:
             # Get IDs via Path to lookup name_l10n
             ids = set()
-            if joined:
-                if "$" in selector:
-                    selector = "%s.%s" % (rfield.field.tablename, selector.split("$", 1)[1])
-                elif "." in selector:
-                    selector = "%s.%s" % (rfield.field.tablename, selector.split(".", 1)[1])
-                else:
-                    selector = "%s.%s" % (resource.tablename, selector)
             for row in rows:
-                _row = getattr(row, "gis_location") if joined else row
-                path = _row.path
+                path = row.path
                 if path:
                     path = path.split("/")
                 else:
                     # Build it
-                    if joined:
-                        location_id = row[selector]
-                        if location_id:
-                            _row.id = location_id
-                    if "id" in _row:
-                        path = current.gis.update_location_tree(_row)
+                    if "id" in row:
+                        path = current.gis.update_location_tree(row)
                         path = path.split("/")
                 if path:
                     ids |= set(path)
@@ -1174,8 +1182,7 @@ class S3LocationFilter(S3FilterWidget):
 
         # Populate the Options and the Hierarchy
         for row in rows:
-            _row = getattr(row, "gis_location") if joined else row
-            self.__options(_row, levels, inject_hierarchy, hierarchy, _level, translate, name_l10n)
+            self.__options(row, levels, inject_hierarchy, hierarchy, _level, translate, name_l10n)
         for row in rows2:
             self.__options(row, levels, inject_hierarchy, hierarchy, _level, translate, name_l10n)
 
@@ -1203,6 +1210,83 @@ class S3LocationFilter(S3FilterWidget):
 
         return (ftype, levels, None)
 
+    # -------------------------------------------------------------------------
+    def _locations_in_use(self, resource, rfield, levels):
+        """
+            Look up the locations which are actually referenced by the
+            records in the resource (=the index of all Lx names which can
+            appear in the options), cached per resource query, i.e. per
+            filter and realms of the user
+
+            @param resource: the S3Resource
+            @param rfield: the S3ResourceField for the location reference
+            @param levels: the hierarchy levels
+
+            @return: list of locations, see _locations
+        """
+
+        field = rfield.field
+        colname = rfield.colname
+
+        rfilter = resource.rfilter
+        if rfilter is None:
+            rfilter = resource.build_query()
+        vfilter = rfilter.get_filter() is not None
+
+        def lookup():
+            # Only the distinct location IDs, not every record
+            rows = resource.select([rfield.selector],
+                                   limit=None,
+                                   groupby=None if vfilter else field,
+                                   virtual=False,
+                                   as_rows=True)
+            ids = set(row[colname] for row in rows)
+            ids.discard(None)
+            return self._locations(ids, levels)
+
+        if vfilter:
+            # Virtual filters can't be part of the cache key
+            return lookup()
+
+        tablenames = [resource.tablename, field.tablename, "gis_location"]
+        tablenames.extend(rfield.join)
+        tablenames.extend(rfilter.get_joins(as_list=False))
+        tablenames.extend(rfilter.get_joins(left=True, as_list=False))
+
+        key = "%s|%s|%s" % (rfilter.get_query(), colname, ",".join(levels))
+        return self._cache("locations_%s" % resource.tablename,
+                           tablenames,
+                           key,
+                           lookup)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _locations(ids, levels, accessible=False):
+        """
+            Look up locations by ID
+
+            @param ids: the location IDs
+            @param levels: the hierarchy levels
+            @param accessible: only locations the user is permitted to read
+
+            @return: list of locations, Storage with id, path and the
+                     names of the Lx ancestors for each level
+        """
+
+        if not ids:
+            return []
+
+        gtable = current.s3db.gis_location
+        fields = [gtable.id, gtable.path] + [gtable[level] for level in levels]
+
+        query = (gtable.id.belongs(ids)) & \
+                (gtable.deleted != True)
+        if accessible:
+            query &= current.auth.s3_accessible_query("read", gtable)
+        rows = current.db(query).select(*fields)
+
+        return [Storage(row.as_dict()) for row in rows]
+
     # -------------------------------------------------------------------------
     def _selector(self, resource, fields):
         """
@@ -1471,7 +1555,7 @@ class S3OptionsFilter(S3FilterWidget):
                 # a reverse lookup of primary IDs in the lookup table which
                 # are linked to at least one record in the resource => better
                 # scalability.
-                rows = None
+                lookup = None
                 if field:
                     ktablename, key, m = s3_get_foreign_key(field, m2m=False)
                     if ktablename:
@@ -1529,38 +1613,74 @@ class S3OptionsFilter(S3FilterWidget):
                                           (ktable.organisation_id == None))
                             #else:
                             #    query &= (ktable.organisation_id == None)
-            
-                        rows = current.db(query).select(key_field,
-                                                        resource._id.min(),
-                                                        groupby=key_field,
-                                                        left=left)
+
+                        lookup = lambda: \
+                                 current.db(query).select(key_field,
+                                                          resource._id.min(),
+                                                          groupby=key_field,
+                                                          left=left)
+
+                        # The query includes the realms of the user
+                        tablenames = [resource.tablename, ktablename]
+                        tablenames.extend(joins)
+                        cache_key = str(query)
 
                 # If we can not perform a reverse lookup, then we need
                 # to do a forward lookup of all unique values of the
                 # search field from all records in the table :/ still ok,
                 # but not endlessly scalable:
-                if rows is None:
-                    rows = resource.select([selector],
-                                           limit=None,
-                                           orderby=field,
-                                           groupby=groupby,
-                                           virtual=virtual,
-                                           as_rows=True)
-
-                opt_keys = [] # Can't use set => would make orderby pointless
-                if rows:
-                    kappend = opt_keys.append
-                    kextend = opt_keys.extend
-                    for row in rows:
-                        val = row[colname]
-                        if virtual and callable(val):
-                            val = val()
-                        if multiple or \
-                           virtual and isinstance(val, (list, tuple, set)):
-                            kextend([v for v in val
-                                       if v not in opt_keys])
-                        elif val not in opt_keys:
-                            kappend(val)
+                if lookup is None:
+                    lookup = lambda: resource.select([selector],
+                                                     limit=None,
+                                                     orderby=field,
+                                                     groupby=groupby,
+                                                     virtual=virtual,
+                                                     as_rows=True)
+
+                    rfilter = resource.rfilter
+                    if rfilter is None:
+                        rfilter = resource.build_query()
+                    if virtual or rfilter.get_filter() is not None:
+                        # Virtual fields and filters can't be cached
+                        cache_key = None
+                    else:
+                        # The resource query includes the realms of the user
+                        tablenames = [resource.tablename, field.tablename]
+                        tablenames.extend(rfield.join)
+                        tablenames.extend(rfilter.get_joins(as_list=False))
+                        tablenames.extend(rfilter.get_joins(left=True,
+                                                            as_list=False))
+                        cache_key = "%s|%s|%s" % (rfilter.get_query(),
+                                                  rfilter.get_joins(),
+                                                  rfilter.get_joins(left=True))
+
+                def option_keys():
+                    rows = lookup()
+                    opt_keys = [] # Can't use set => would make orderby pointless
+                    if rows:
+                        kappend = opt_keys.append
+                        kextend = opt_keys.extend
+                        for row in rows:
+                            val = row[colname]
+                            if virtual and callable(val):
+                                val = val()
+                            if multiple or \
+                               virtual and isinstance(val, (list, tuple, set)):
+                                kextend([v for v in val
+                                           if v not in opt_keys])
+                            elif val not in opt_keys:
+                                kappend(val)
+                    return opt_keys
+
+                if cache_key is None:
+                    opt_keys = option_keys()
+                else:
+                    # Copy, since the selected values get added below
+                    cache_key = "%s|%s|%s" % (cache_key, colname, multiple)
+                    opt_keys = list(self._cache("options_%s" % resource.tablename,
+                                                tablenames,
+                                                cache_key,
+                                                option_keys))
 
         # Make sure the selected options are in the available options
         # (not possible if we have a fixed options dict)
@@ -1601,9 +1721,7 @@ class S3OptionsFilter(S3FilterWidget):
 
             if hasattr(represent, "bulk"):
                 # S3Represent => use bulk option
-                opt_dict = represent.bulk(opt_keys,
-                                          list_type=False,
-                                          show_link=False)
+                opt_dict = self._represent(represent, opt_keys, colname)
                 if None in opt_keys:
                     opt_dict[None] = EMPTY
                 elif None in opt_dict:
@@ -1688,6 +1806,44 @@ class S3OptionsFilter(S3FilterWidget):
         # Sort the options
         return (ftype, options, None)
 
+    # -------------------------------------------------------------------------
+    def _represent(self, represent, opt_keys, colname):
+        """
+            Represent the options with an S3Represent, cached per language
+            until the lookup table is written to
+
+            @param represent: the S3Represent instance
+            @param opt_keys: the option keys
+            @param colname: the column name of the filter field
+
+            @return: dict {key: representation}
+        """
+
+        def lookup():
+            opt_dict = represent.bulk(opt_keys,
+                                      list_type=False,
+                                      show_link=False)
+            # Translate now, lazyT are bound to the current request
+            for k, v in opt_dict.items():
+                if isinstance(v, lazyT):
+                    opt_dict[k] = s3_unicode(v)
+            return opt_dict
+
+        tablename = getattr(represent, "tablename", None)
+        if not tablename:
+            return lookup()
+
+        key = "%s|%s|%s|%s" % (current.session.s3.language,
+                               colname,
+                               represent.__class__.__name__,
+                               opt_keys)
+        opt_dict = self._cache("represent_%s" % tablename,
+                               [tablename],
+                               key,
+                               lookup)
+        # Copy, since the caller modifies it
+        return dict(opt_dict)
+
     # -------------------------------------------------------------------------
     @staticmethod
     def _values(get_vars, variable):
@@ -2636,16 +2792,38 @@ class S3FilterString(object):
         Helper class to render a human-readable representation of a
         filter query, as representation method of JSON-serialized
         queries in saved filters.
+
+        Saved filters also store the compiled query (see serialize),
+        so that they need not be parsed again every time they are used,
+        as long as the structure of the tables and components they refer
+        to remains unchanged.
     """
 
-    def __init__(self, resource, query):
+    # Version of the serialization format
+    VERSION = 3
+
+    def __init__(self, resource, query, serialized=None):
         """
             Constructor
 
             @param query: the URL query (list of key-value pairs or a
                           string with such a list in JSON)
+            @param serialized: the compiled query (as returned from
+                               serialize), used instead of parsing the
+                               query if still valid
         """
 
+        self.resource = resource
+        self.queries = None
+
+        compiled = self.deserialize(resource, serialized) \
+                   if serialized else None
+        if compiled is not None:
+            self.query, self.get_vars, self.queries = compiled
+            self.compiled = True
+            return
+        self.compiled = False
+
         if type(query) is not list:
             try:
                 self.query = json.loads(query)
@@ -2667,9 +2845,159 @@ class S3FilterString(object):
                 else:
                     get_vars[key] = v
 
-        self.resource = resource
         self.get_vars = get_vars
 
+    # -------------------------------------------------------------------------
+    def parse(self):
+        """
+            Parse the query (unless compiled)
+
+            @return: Storage of S3ResourceQuery like {alias: [query]},
+                     see S3URLQuery.parse
+        """
+
+        queries = self.queries
+        if queries is None:
+            queries = self.queries = S3URLQuery.parse(self.resource,
+                                                      self.get_vars)
+        return queries
+
+    # -------------------------------------------------------------------------
+    def serialize(self):
+        """
+            Compile the query for storage with the saved filter
+
+            @return: JSON string, or None if the query can not be compiled
+        """
+
+        resource = self.resource
+        queries = self.parse()
+
+        compiled = {}
+        try:
+            for alias, subqueries in queries.items():
+                compiled[alias] = [q.serialize() for q in subqueries]
+        except SyntaxError:
+            return None
+
+        # Resolve the field selectors, to find all tables and components
+        # the query depends on
+        tablenames = set([resource.tablename])
+        components = set()
+        for alias, subqueries in queries.items():
+            if alias != resource.alias:
+                components.add(alias)
+            for q in subqueries:
+                for selector in q.fields():
+                    try:
+                        rfield = resource.resolve_selector(selector)
+                    except (AttributeError, SyntaxError):
+                        continue
+                    tablenames |= set(rfield._joins.keys())
+                    field = rfield.field
+                    if field is not None:
+                        table = field.table
+                        tablenames.add(getattr(table, "_ot", None) or
+                                       table._tablename)
+        tablenames = sorted(tablenames)
+        components = sorted(components)
+
+        data = {"version": self.VERSION,
+                "resource": resource.tablename,
+                "query": self.query,
+                "get_vars": self.get_vars,
+                "queries": compiled,
+                "tables": tablenames,
+                "components": components,
+                "signature": self.signature(resource, tablenames, components),
+                }
+        return json.dumps(data, separators=SEPARATORS)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def deserialize(cls, resource, serialized):
+        """
+            Load a compiled query
+
+            @param resource: the S3Resource
+            @param serialized: the compiled query (JSON string)
+
+            @return: tuple (query, get_vars, queries), or None if the
+                     compiled query is invalid or outdated
+        """
+
+        try:
+            data = json.loads(serialized)
+        except (ValueError, TypeError):
+            return None
+        if not isinstance(data, dict) or \
+           data.get("version") != cls.VERSION or \
+           data.get("resource") != resource.tablename:
+            return None
+
+        try:
+            signature = cls.signature(resource,
+                                      data["tables"],
+                                      data["components"],
+                                      )
+            if data["signature"] != signature:
+                # Table structure or component configuration has changed
+                return None
+            queries = Storage()
+            deserialize = S3ResourceQuery.deserialize
+            for alias, subqueries in data["queries"].items():
+                queries[str(alias)] = [deserialize(q) for q in subqueries]
+            return data["query"], data["get_vars"], queries
+        except (KeyError, IndexError, TypeError, SyntaxError):
+            return None
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def signature(resource, tablenames, components):
+        """
+            Compute a signature of the table structure and component
+            configuration a compiled query depends on - unlike table
+            versions, this does not change with ordinary record writes
+
+            @param resource: the S3Resource
+            @param tablenames: the names of the tables involved
+            @param components: the aliases of the components involved
+
+            @return: the signature (string)
+        """
+
+        s3db = current.s3db
+
+        items = []
+        for tablename in tablenames:
+            tablename = str(tablename)
+            table = s3db.table(tablename)
+            if table is None:
+                items.append((tablename, None))
+            else:
+                items.append((tablename,
+                              [(f.name, str(f.type)) for f in table],
+                              ))
+        for alias in components:
+            alias = str(alias)
+            hook = s3db.get_component(resource.tablename, alias)
+            if hook is None:
+                items.append((alias, None))
+            else:
+                linktable = hook.linktable
+                items.append((alias,
+                              hook.tablename,
+                              hook.pkey,
+                              hook.fkey,
+                              linktable._tablename if linktable else None,
+                              hook.lkey,
+                              hook.rkey,
+                              hook.filterby,
+                              hook.filterfor,
+                              ))
+
+        return hashlib.md5(s3_unicode(items).encode("utf-8")).hexdigest()
+
     # -------------------------------------------------------------------------
     def represent(self):
         """ Render the query representation for the given resource """
@@ -2681,7 +3009,7 @@ class S3FilterString(object):
         if not get_vars:
             return default
         else:
-            queries = S3URLQuery.parse(resource, get_vars)
+            queries = self.parse()
 
         # Get alternative field labels
         labels = {}
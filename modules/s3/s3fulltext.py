@@ -0,0 +1,435 @@
+# -*- coding: utf-8 -*-
+
+""" S3 Full-Text Index
+
+    @copyright: 2014 (c) Sahana Software Foundation
+    @license: MIT
+
+    @requires: U{B{I{gluon}} <http://web2py.com>}
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation
+    files (the "Software"), to deal in the Software without
+    restriction, including without limitation the rights to use,
+    copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the
+    Software is furnished to do so, subject to the following
+    conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+    OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+    HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+    WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+    OTHER DEALINGS IN THE SOFTWARE.
+
+    @status: experimental
+"""
+
+__all__ = ("S3FullText",
+           )
+
+import re
+
+from gluon import current
+
+from s3utils import s3_unicode
+
+# Wildcards in LIKE patterns
+WILDCARDS = re.compile(r"[%_]")
+
+# =============================================================================
+class S3FullText(object):
+    """
+        Trigram index of text fields, to speed up LIKE-queries with
+        leading wildcards (e.g. S3TextFilter, search_ac autocompletes)
+        which would otherwise require a full table scan.
+
+        The fields to index are configured per table, like:
+
+            s3db.configure(tablename, fulltext = ["name", "acronym"])
+
+        On PostgreSQL, LIKE-queries use GIN trigram indexes (pg_trgm)
+        on the lowercase fields directly (see create_indexes), so there
+        is nothing else to do.
+
+        With other databases, the distinct trigrams of the indexed fields
+        of every record are stored in the s3_fulltext table (maintained
+        on write, see onwrite), and S3ResourceQuery.transform adds a
+        lookup of the matching records in that table to LIKE-queries.
+        This lookup only pre-selects candidates, the LIKE-query itself
+        still decides which records match.
+
+        @note: records which are updated bypassing S3 (i.e. without
+               S3Audit.onwrite) are not re-indexed until the next rebuild
+               (e.g. in the daily maintenance), records created after the
+               last rebuild are always included as candidates though
+    """
+
+    # Maximum number of trigrams to look up per pattern
+    MAX_TRIGRAMS = 12
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def native():
+        """
+            Whether the database supports trigram indexes natively
+
+            @return: True|False
+        """
+
+        return current.db._dbname == "postgres"
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def fields(tablename):
+        """
+            Get the names of the indexed fields of a table
+
+            @param tablename: the tablename
+            @return: list of field names
+        """
+
+        s3db = current.s3db
+        table = s3db.table(tablename)
+        if table is None:
+            return []
+        fields = s3db.get_config(tablename, "fulltext")
+        if not fields:
+            return []
+        return [fn for fn in fields if fn in table.fields]
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def tablenames(cls):
+        """
+            Get the names of all tables with a full-text index (loads
+            all models)
+
+            @return: list of tablenames
+        """
+
+        current.s3db.load_all_models()
+        return [tablename
+                for tablename, config in current.model.config.items()
+                if config and config.get("fulltext")]
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def normalize(text):
+        """
+            Normalize a text for indexing
+
+            @param text: the text
+            @return: unicode, lowercase
+        """
+
+        return s3_unicode(text).lower() if text else u""
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def trigrams(cls, text):
+        """
+            Get the set of trigrams of a text
+
+            @param text: the text
+            @return: set of unicode strings
+        """
+
+        text = cls.normalize(text)
+        return set(text[i:i+3] for i in xrange(len(text) - 2))
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def pattern_trigrams(cls, pattern):
+        """
+            Get the set of trigrams which all matches of a LIKE pattern
+            must contain
+
+            @param pattern: the LIKE pattern (with % and _ wildcards)
+            @return: set of unicode strings
+        """
+
+        trigrams = set()
+        for segment in WILDCARDS.split(cls.normalize(pattern)):
+            trigrams |= cls.trigrams(segment)
+        return trigrams
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def create_indexes(cls, *tablenames):
+        """
+            Create the database indexes, to be run once at 1st run or
+            after an upgrade
+
+            @param tablenames: the tables to create indexes for
+                               (default: all tables with full-text index)
+        """
+
+        db = current.db
+        if not tablenames:
+            tablenames = cls.tablenames()
+
+        if cls.native():
+
+            def executesql(sql):
+                # Failures must not abort the transaction
+                db.executesql("SAVEPOINT s3_fulltext;")
+                try:
+                    db.executesql(sql)
+                except:
+                    db.executesql("ROLLBACK TO SAVEPOINT s3_fulltext;")
+                    return False
+                db.executesql("RELEASE SAVEPOINT s3_fulltext;")
+                return True
+
+            if not executesql("CREATE EXTENSION IF NOT EXISTS pg_trgm;"):
+                # Requires superuser privileges
+                current.log.error("Could not create extension pg_trgm")
+                return
+            for tablename in tablenames:
+                for fieldname in cls.fields(tablename):
+                    # Fails if the index is already present
+                    executesql("CREATE INDEX %s_%s__trgm on %s USING gin (lower(%s) gin_trgm_ops);" %
+                               (tablename, fieldname, tablename, fieldname))
+        else:
+            tablename = "s3_fulltext"
+            current.s3db.table(tablename)
+            try:
+                db.executesql("CREATE INDEX %s__idx on %s(trigram,tablename,record_id);" %
+                              (tablename, tablename))
+            except:
+                # Index already present
+                pass
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def rebuild(cls, *tablenames):
+        """
+            Rebuild the index
+
+            @param tablenames: the tables to rebuild the index for
+                               (default: all tables with full-text index)
+        """
+
+        if cls.native():
+            return
+
+        db = current.db
+        itable = current.s3db.s3_fulltext
+        if not tablenames:
+            tablenames = cls.tablenames()
+
+        for tablename in tablenames:
+
+            db(itable.tablename == tablename).delete()
+
+            fields = cls.fields(tablename)
+            if not fields:
+                continue
+            table = current.s3db.table(tablename)
+
+            query = (table._id > 0)
+            if "deleted" in table.fields:
+                query &= (table.deleted != True)
+            rows = db(query).select(table._id,
+                                    *[table[fn] for fn in fields])
+
+            pkey = table._id.name
+            items = []
+            append = items.append
+            last_id = 0
+            for row in rows:
+                record_id = row[pkey]
+                if record_id > last_id:
+                    last_id = record_id
+                for trigram in cls._record_trigrams(row, fields):
+                    append({"tablename": tablename,
+                            "record_id": record_id,
+                            "trigram": trigram,
+                            })
+                if len(items) >= 5000:
+                    itable.bulk_insert(items)
+                    del items[:]
+            if items:
+                itable.bulk_insert(items)
+
+            # Marker for the index being complete up to last_id
+            itable.insert(tablename = tablename,
+                          record_id = last_id,
+                          trigram = None,
+                          )
+
+        current.response.s3.fulltext = None
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def onwrite(cls, tablename, record_id=None):
+        """
+            Update the index for a record after it has been written
+
+            @param tablename: the tablename
+            @param record_id: the record ID
+        """
+
+        if not record_id or cls.native():
+            return
+        fields = cls.fields(tablename)
+        if not fields:
+            return
+
+        db = current.db
+        itable = current.s3db.s3_fulltext
+        table = current.s3db.table(tablename)
+
+        query = (itable.tablename == tablename) & \
+                (itable.record_id == record_id) & \
+                (itable.trigram != None)
+        db(query).delete()
+
+        query = (table._id == record_id)
+        if "deleted" in table.fields:
+            query &= (table.deleted != True)
+        row = db(query).select(table._id,
+                               *[table[fn] for fn in fields],
+                               limitby = (0, 1)).first()
+        if row:
+            itable.bulk_insert([{"tablename": tablename,
+                                 "record_id": record_id,
+                                 "trigram": trigram,
+                                 } for trigram in cls._record_trigrams(row, fields)])
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def prefilter(cls, resource, query):
+        """
+            Construct a lookup of candidate records in the index for
+            a LIKE-query, or an OR-combination of LIKE-queries on the
+            same table
+
+            @param resource: the S3Resource
+            @param query: the S3ResourceQuery
+
+            @return: a DAL Query, or None if the index can't be used
+        """
+
+        if cls.native():
+            return None
+
+        from s3query import S3FieldSelector, S3ResourceQuery
+        LIKE = S3ResourceQuery.LIKE
+        OR = S3ResourceQuery.OR
+
+        # Collect the sub-queries
+        subqueries = []
+        pending = [query]
+        while pending:
+            q = pending.pop()
+            if not isinstance(q, S3ResourceQuery):
+                return None
+            if q.op == OR:
+                pending.extend((q.left, q.right))
+            elif q.op == LIKE:
+                subqueries.append(q)
+            else:
+                return None
+
+        table = None
+        trigrams = None
+        for q in subqueries:
+            selector, pattern = q.left, q.right
+            if not isinstance(selector, S3FieldSelector) or \
+               not isinstance(pattern, basestring):
+                return None
+            try:
+                rfield = selector.resolve(resource)
+            except (SyntaxError, AttributeError):
+                return None
+            field = rfield.field
+            if field is None:
+                return None
+            if table is None:
+                table = field.table
+            elif field.table is not table:
+                return None
+            tablename = getattr(table, "_ot", None) or table._tablename
+            if field.name not in cls.fields(tablename):
+                return None
+            # Every match must contain all trigrams of its pattern, so
+            # matches of any of the patterns contain the intersection
+            pattern_trigrams = cls.pattern_trigrams(pattern)
+            if trigrams is None:
+                trigrams = pattern_trigrams
+            else:
+                trigrams &= pattern_trigrams
+            if not trigrams:
+                return None
+
+        if not trigrams:
+            return None
+        last_id = cls.indexed(tablename)
+        if last_id is None:
+            # Index not yet built
+            return None
+
+        trigrams = sorted(trigrams)[:cls.MAX_TRIGRAMS]
+
+        itable = current.s3db.s3_fulltext
+        record_id = itable.record_id
+        subquery = (itable.trigram.belongs(trigrams)) & \
+                   (itable.tablename == tablename)
+        subselect = current.db(subquery)._select(record_id,
+                                                 groupby = record_id,
+                                                 having = record_id.count() == len(trigrams),
+                                                 )
+
+        # Records created after the index was built are always candidates
+        return (table._id.belongs(subselect)) | (table._id > last_id)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def indexed(tablename):
+        """
+            Check whether the index for a table has been built
+
+            @param tablename: the tablename
+            @return: the highest record ID at the time the index was
+                     built, or None if it hasn't been built yet
+        """
+
+        s3 = current.response.s3
+        cache = s3.fulltext
+        if cache is None:
+            cache = s3.fulltext = {}
+        if tablename not in cache:
+            itable = current.s3db.s3_fulltext
+            query = (itable.tablename == tablename) & \
+                    (itable.trigram == None)
+            row = current.db(query).select(itable.record_id,
+                                           limitby = (0, 1),
+                                           ).first()
+            cache[tablename] = row.record_id if row else None
+        return cache[tablename]
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def _record_trigrams(cls, row, fields):
+        """
+            Get the distinct trigrams of all indexed fields in a record
+
+            @param row: the record
+            @param fields: the indexed field names
+            @return: set of unicode strings
+        """
+
+        trigrams = set()
+        for fn in fields:
+            trigrams |= cls.trigrams(row[fn])
+        return trigrams
+
+# END =========================================================================
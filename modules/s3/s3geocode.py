@@ -0,0 +1,556 @@
+# -*- coding: utf-8 -*-
+
+""" S3 Geocoding Toolkit
+
+    @copyright: 2014 (c) Sahana Software Foundation
+    @license: MIT
+
+    @requires: U{B{I{gluon}} <http://web2py.com>}
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation
+    files (the "Software"), to deal in the Software without
+    restriction, including without limitation the rights to use,
+    copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the
+    Software is furnished to do so, subject to the following
+    conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+    OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+    HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+    WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+    OTHER DEALINGS IN THE SOFTWARE.
+
+    @status: experimental
+"""
+
+__all__ = ("S3Gazetteer",
+           "S3GeocodeThrottle",
+           "S3PrefetchGeocoder",
+           )
+
+import re
+import sys
+import threading
+import time
+import unicodedata
+
+from gluon import current
+
+from s3utils import s3_unicode
+
+WORDS = re.compile(r"\w+", re.UNICODE)
+
+# =============================================================================
+class S3Gazetteer(object):
+    """
+        In-memory index of the names (incl. local/alternate names) of
+        all Locations with coordinates, to match addresses which the
+        external Geocoder can not resolve.
+
+        Names are normalized (lowercase, no diacritics or punctuation)
+        and indexed in a character trie for exact and prefix matches,
+        and in a trigram index for fuzzy matches.
+    """
+
+    # Minimum similarity (Dice coefficient of trigrams) of fuzzy matches
+    THRESHOLD = 0.6
+
+    # Minimum length of names to search for by prefix
+    PREFIX_LENGTH = 4
+
+    # Shared instance, and lock to update and read it
+    _instance = None
+    _lock = threading.RLock()
+
+    # -------------------------------------------------------------------------
+    def __init__(self):
+        """ Constructor """
+
+        self.trie = {}
+        self.ngrams = {}
+        self.names = {}
+        self.locations = {}
+
+        # Names (keys) per location ID, to remove locations
+        self.location_keys = {}
+
+        self.version = None
+        # Latest modification date of the loaded records
+        self.mtime = None
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def get(cls):
+        """
+            Get the shared gazetteer, building it on first use, and
+            updating it with the records modified since if gis_location
+            or gis_location_name have changed
+
+            @return: the S3Gazetteer instance
+        """
+
+        versions = current.s3db.table_version("gis_location",
+                                              "gis_location_name")
+        version = (versions["gis_location"], versions["gis_location_name"])
+
+        with cls._lock:
+            gazetteer = cls._instance
+            if gazetteer is None:
+                gazetteer = cls()
+                gazetteer.load()
+                cls._instance = gazetteer
+            elif gazetteer.version != version:
+                gazetteer.load(since=gazetteer.mtime)
+            gazetteer.version = version
+        return gazetteer
+
+    # -------------------------------------------------------------------------
+    def load(self, since=None):
+        """
+            Load all named locations with coordinates from the database
+
+            @param since: only (re-)load locations which have been modified
+                          since this datetime, or which have alternate
+                          names modified since then
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        table = s3db.gis_location
+        ntable = s3db.gis_location_name
+
+        query = (table.deleted != True) & \
+                (table.name != None) & \
+                (table.lat != None) & \
+                (table.lon != None)
+
+        mtime = self.mtime
+        if since is not None:
+            # Find the locations modified since (incl. deleted ones)
+            ids = set()
+            rows = db(table.modified_on >= since).select(table.id,
+                                                         table.modified_on)
+            for row in rows:
+                ids.add(row.id)
+                if mtime is None or row.modified_on > mtime:
+                    mtime = row.modified_on
+            rows = db(ntable.modified_on >= since).select(ntable.location_id,
+                                                          ntable.modified_on)
+            for row in rows:
+                ids.add(row.location_id)
+                if mtime is None or row.modified_on > mtime:
+                    mtime = row.modified_on
+            self.mtime = mtime
+            if not ids:
+                return
+            remove = self.remove
+            for location_id in ids:
+                remove(location_id)
+            query &= (table.id.belongs(ids))
+
+        rows = db(query).select(table.id,
+                                table.name,
+                                table.level,
+                                table.path,
+                                table.lat,
+                                table.lon,
+                                table.modified_on,
+                                )
+        add = self.add
+        for row in rows:
+            add(row.id, row.name, row.lat, row.lon,
+                level=row.level, path=row.path)
+            if since is None and (mtime is None or row.modified_on > mtime):
+                mtime = row.modified_on
+
+        query &= (ntable.location_id == table.id) & \
+                 (ntable.deleted != True) & \
+                 (ntable.name_l10n != None)
+        rows = db(query).select(ntable.location_id,
+                                ntable.name_l10n,
+                                ntable.modified_on,
+                                )
+        add_name = self.add_name
+        for row in rows:
+            add_name(row.location_id, row.name_l10n)
+            if since is None and (mtime is None or row.modified_on > mtime):
+                mtime = row.modified_on
+
+        self.mtime = mtime
+        return
+
+    # -------------------------------------------------------------------------
+    def add(self, location_id, name, lat, lon, level=None, path=None):
+        """
+            Add a location to the index
+
+            @param location_id: the gis_location record ID
+            @param name: the name of the location
+            @param lat: the latitude
+            @param lon: the longitude
+            @param level: the hierarchy level (L0..L5 or None)
+            @param path: the path of the location in the hierarchy
+        """
+
+        if path:
+            path = set(str(path).split("/"))
+        else:
+            path = None
+        self.locations[location_id] = (lat, lon, level, path)
+        self.add_name(location_id, name)
+
+    # -------------------------------------------------------------------------
+    def add_name(self, location_id, name):
+        """
+            Add a (further) name for a location to the index
+
+            @param location_id: the gis_location record ID
+            @param name: the name
+        """
+
+        key = self.normalize(name)
+        if not key:
+            return
+
+        ids = self.names.get(key)
+        if ids is None:
+            ids = self.names[key] = set()
+            # Add to trie
+            node = self.trie
+            for char in key:
+                node = node.setdefault(char, {})
+            node[None] = ids
+            # Add to trigram index
+            ngrams = self.ngrams
+            for ngram in self.trigrams(key):
+                if ngram in ngrams:
+                    ngrams[ngram].add(key)
+                else:
+                    ngrams[ngram] = set([key])
+        ids.add(location_id)
+
+        keys = self.location_keys.get(location_id)
+        if keys is None:
+            self.location_keys[location_id] = set([key])
+        else:
+            keys.add(key)
+
+    # -------------------------------------------------------------------------
+    def remove(self, location_id):
+        """
+            Remove a location (with all its names) from the index
+
+            @param location_id: the gis_location record ID
+        """
+
+        self.locations.pop(location_id, None)
+        keys = self.location_keys.pop(location_id, None)
+        if not keys:
+            return
+
+        names = self.names
+        ngrams = self.ngrams
+        for key in keys:
+            ids = names.get(key)
+            if ids is None:
+                continue
+            ids.discard(location_id)
+            if ids:
+                continue
+            # No more locations with this name
+            del names[key]
+            node = self.trie
+            for char in key:
+                node = node.get(char)
+                if node is None:
+                    break
+            if node is not None:
+                node.pop(None, None)
+            for ngram in self.trigrams(key):
+                candidates = ngrams.get(ngram)
+                if candidates is not None:
+                    candidates.discard(key)
+                    if not candidates:
+                        del ngrams[ngram]
+
+    # -------------------------------------------------------------------------
+    def lookup(self, name, parent=None):
+        """
+            Find locations by name
+
+            @param name: the name
+            @param parent: limit to descendants of this location ID
+
+            @return: list of tuples (score, location_id), best first,
+                     score 1.0 for exact matches
+        """
+
+        key = self.normalize(name)
+        if not key:
+            return []
+
+        # The shared instance may be updated concurrently
+        with self._lock:
+            return self._lookup(key, parent)
+
+    # -------------------------------------------------------------------------
+    def _lookup(self, key, parent=None):
+        """
+            Find locations by normalized name, see lookup
+
+            @param key: the normalized name
+            @param parent: limit to descendants of this location ID
+        """
+
+        # Exact match
+        node = self.trie
+        for char in key:
+            node = node.get(char)
+            if node is None:
+                break
+        if node is not None and None in node:
+            matches = self._filter(node[None], parent)
+            if matches:
+                return [(1.0, location_id) for location_id in matches]
+
+        # Unique prefix match
+        if node is not None and len(key) >= self.PREFIX_LENGTH:
+            ids = set()
+            stack = [node]
+            while stack:
+                node = stack.pop()
+                for char, child in node.items():
+                    if char is None:
+                        ids |= child
+                    else:
+                        stack.append(child)
+            matches = self._filter(ids, parent)
+            if len(matches) == 1:
+                return [(0.9, matches[0])]
+
+        # Fuzzy match
+        ngrams = self.ngrams
+        trigrams = self.trigrams(key)
+        shared = {}
+        for ngram in trigrams:
+            for candidate in ngrams.get(ngram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+        size = len(trigrams)
+        scores = {}
+        threshold = self.THRESHOLD
+        names = self.names
+        for candidate, count in shared.items():
+            score = 2.0 * count / (size + len(self.trigrams(candidate)))
+            if score < threshold:
+                continue
+            for location_id in self._filter(names[candidate], parent):
+                if score > scores.get(location_id, 0):
+                    scores[location_id] = score
+        return sorted(((score, location_id)
+                       for location_id, score in scores.items()),
+                      reverse=True)
+
+    # -------------------------------------------------------------------------
+    def geocode(self, address, Lx_ids=None):
+        """
+            Geocode an address by matching its components (most specific
+            first) against the names of locations
+
+            @param address: the address
+            @param Lx_ids: list of ancestor IDs (the last one being the
+                           most specific), to limit the match to their
+                           descendants
+
+            @return: dict(lat=lat, lon=lon) or None if no unambiguous
+                     match could be found
+        """
+
+        if not address:
+            return None
+        parent = Lx_ids[-1] if Lx_ids else None
+
+        with self._lock:
+            for component in s3_unicode(address).split(","):
+                matches = self.lookup(component, parent=parent)
+                if not matches:
+                    continue
+                if len(matches) > 1 and matches[0][0] == matches[1][0]:
+                    # Ambiguous
+                    continue
+                lat, lon = self.locations[matches[0][1]][:2]
+                return dict(lat=lat, lon=lon)
+        return None
+
+    # -------------------------------------------------------------------------
+    def _filter(self, ids, parent):
+        """
+            Filter location IDs by ancestor
+
+            @param ids: the location IDs
+            @param parent: the ancestor ID (or None to not filter)
+        """
+
+        if parent is None:
+            return list(ids)
+        parent = str(parent)
+        locations = self.locations
+        matches = []
+        for location_id in ids:
+            path = locations[location_id][3]
+            if path and parent in path and str(location_id) != parent:
+                matches.append(location_id)
+        return matches
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def normalize(name):
+        """
+            Normalize a name for matching: lowercase, without diacritics,
+            punctuation or redundant whitespace
+
+            @param name: the name
+        """
+
+        if not name:
+            return ""
+        name = unicodedata.normalize("NFKD", s3_unicode(name).lower())
+        name = u"".join(c for c in name if not unicodedata.combining(c))
+        return u" ".join(WORDS.findall(name))
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def trigrams(key):
+        """
+            Get the set of trigrams of a normalized name
+
+            @param key: the normalized name
+        """
+
+        key = u"  %s " % key
+        return set(key[i:i+3] for i in xrange(len(key) - 2))
+
+# =============================================================================
+class S3GeocodeThrottle(object):
+    """
+        Concurrent, rate-limited requests to an external Geocoder
+
+        @note: the requests run in separate threads which have no access
+               to current.db & co, so they must only talk to the Geocoder
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, rate=None):
+        """
+            Constructor
+
+            @param rate: maximum number of requests per second (None or
+                         0 for unlimited)
+        """
+
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next = 0
+
+    # -------------------------------------------------------------------------
+    def wait(self):
+        """ Wait for the next free request slot """
+
+        interval = self.interval
+        if not interval:
+            return
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next)
+            self.next = slot + interval
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+    # -------------------------------------------------------------------------
+    def map(self, func, items, threads=1):
+        """
+            Call a function for each item
+
+            @param func: the function
+            @param items: the items
+            @param threads: the number of concurrent calls
+
+            @return: dict {item: result}, with the exception instance
+                     as result for failed calls
+        """
+
+        items = list(items)
+        results = {}
+        if not items:
+            return results
+
+        lock = threading.Lock()
+        queue = list(reversed(items))
+
+        def worker():
+            while True:
+                with lock:
+                    if not queue:
+                        return
+                    item = queue.pop()
+                self.wait()
+                try:
+                    result = func(item)
+                except:
+                    result = sys.exc_info()[1]
+                results[item] = result
+
+        workers = [threading.Thread(target=worker)
+                   for i in xrange(max(1, min(threads, len(items))))]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        return results
+
+# =============================================================================
+class S3PrefetchGeocoder(object):
+    """
+        Wrapper for a geopy-style Geocoder which answers queries from
+        previously fetched results (e.g. by S3GeocodeThrottle.map)
+    """
+
+    def __init__(self, geocoder, results):
+        """
+            Constructor
+
+            @param geocoder: the Geocoder instance
+            @param results: dict {location: results}
+        """
+
+        self.geocoder = geocoder
+        self.results = results
+
+    # -------------------------------------------------------------------------
+    def geocode(self, location, exactly_one=False):
+        """
+            Geocode a location
+
+            @param location: the location string
+            @param exactly_one: passed through to the Geocoder
+                                if not prefetched
+        """
+
+        results = self.results
+        if location in results:
+            result = results[location]
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return self.geocoder.geocode(location, exactly_one=exactly_one)
+
+# END =========================================================================
@@ -37,6 +37,7 @@ __all__ = ("GIS",
 
 import datetime         # Needed for Feed Refresh checks
 import os
+import time
 import re
 import sys
 #import logging
@@ -55,6 +56,12 @@ except ImportError:
 
 KML_NAMESPACE = "http://earth.google.com/kml/2.2"
 
+# WKT parsing for GIS.bulk_bounds
+WKT_TYPE = re.compile(r"\s*(MULTI)?(POINT|LINESTRING|POLYGON)\s*\(", re.I)
+WKT_RING = re.compile(r"\(([^()]*)\)")
+WKT_DIMENSIONS = {"POINT": 0, "LINESTRING": 1, "POLYGON": 2}
+WKT_FEATURE_TYPES = {"POINT": 1, "LINESTRING": 2, "POLYGON": 3}
+
 try:
     import json # try stdlib (Python 2.6)
 except ImportError:
@@ -114,6 +121,10 @@ CLUSTER_ATTRIBUTE = "colour"
 CLUSTER_DISTANCE = 20   # pixels
 CLUSTER_THRESHOLD = 2   # minimum # of features to form a cluster
 
+# Feature Layer GeoJSON cache
+LAYER_CACHE_SIZE = 200  # maximum number of entries per layer
+LAYER_CACHE_TTL = 3600  # seconds
+
 # Garmin GPS Symbols
 GPS_SYMBOLS = ["Airport",
                "Amusement Park"
@@ -493,15 +504,10 @@ class GIS(object):
 
     # -------------------------------------------------------------------------
     @staticmethod
-    def geocode(address, postcode=None, Lx_ids=None, geocoder="google"):
+    def get_geocoder(geocoder="google"):
         """
-            Geocode an Address
-            - used by S3LocationSelectorWidget2
-                      settings.get_gis_geocode_imported_addresses
+            Get a Geocoder instance
 
-            @param address: street address
-            @param postcode: postcode
-            @param Lx_ids: list of ancestor IDs
             @param geocoder: which geocoder service to use
         """
 
@@ -515,6 +521,27 @@ class GIS(object):
         else:
             # @ToDo
             raise NotImplementedError
+        return g
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def geocode(address, postcode=None, Lx_ids=None, geocoder="google"):
+        """
+            Geocode an Address
+            - used by S3LocationSelectorWidget2
+                      settings.get_gis_geocode_imported_addresses
+
+            @param address: street address
+            @param postcode: postcode
+            @param Lx_ids: list of ancestor IDs
+            @param geocoder: which geocoder service to use, or a
+                             Geocoder instance
+        """
+
+        if isinstance(geocoder, basestring):
+            g = GIS.get_geocoder(geocoder)
+        else:
+            g = geocoder
 
         location = address
         if postcode:
@@ -673,6 +700,171 @@ class GIS(object):
 
         return output
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def geocode_bulk(addresses, geocoder=None, gazetteer=None):
+        """
+            Geocode a batch of Addresses
+            - results are cached in gis_geocode_cache
+            - uncached addresses are sent to the external Geocoder
+              concurrently (settings.get_gis_geocode_threads), but
+              rate-limited (settings.get_gis_geocode_rate)
+            - addresses which the Geocoder can't resolve are matched
+              against the names of our own Locations (S3Gazetteer)
+
+            @param addresses: list of tuples (address, postcode, Lx_ids)
+            @param geocoder: which geocoder service to use, or a Geocoder
+                             instance, defaults to
+                             settings.get_gis_geocode_imported_addresses
+            @param gazetteer: whether to fall back to the local gazetteer,
+                              defaults to settings.get_gis_geocode_gazetteer
+
+            @return: list of results in the same order as addresses,
+                     each either a dict(lat=lat, lon=lon) or an error
+                     message (as in geocode)
+        """
+
+        import hashlib
+        from s3geocode import S3Gazetteer, S3GeocodeThrottle, S3PrefetchGeocoder
+
+        db = current.db
+        s3db = current.s3db
+        settings = current.deployment_settings
+
+        if geocoder is None:
+            geocoder = settings.get_gis_geocode_imported_addresses()
+        if not geocoder or geocoder is True:
+            geocoder = "google"
+        if isinstance(geocoder, basestring):
+            name = geocoder
+            g = GIS.get_geocoder(geocoder)
+        else:
+            name = geocoder.__class__.__name__
+            g = geocoder
+        if gazetteer is None:
+            gazetteer = settings.get_gis_geocode_gazetteer()
+
+        # Look up the names of all Lx at once
+        Lx_names = {}
+        ids = set()
+        for address, postcode, Lx_ids in addresses:
+            if Lx_ids:
+                ids.update(Lx_ids)
+        if ids:
+            table = s3db.gis_location
+            rows = db(table.id.belongs(ids)).select(table.id,
+                                                    table.name,
+                                                    table.level,
+                                                    )
+            for row in rows:
+                Lx_names[row.id] = (row.level, row.name)
+
+        # Build the queries
+        items = []
+        for address, postcode, Lx_ids in addresses:
+            location = address
+            if postcode:
+                location = "%s,%s" % (location, postcode)
+            names = None
+            if Lx_ids:
+                # Same order as in geocode (most specific first)
+                Lx = sorted([Lx_names[i] for i in Lx_ids if i in Lx_names],
+                            reverse=True)
+                if Lx:
+                    names = ",".join([l[1] for l in Lx])
+                    location = "%s,%s" % (location, names)
+            key = "%s|%s|%s" % (name, s3_unicode(location).lower(), Lx_ids)
+            key = hashlib.md5(key.encode("utf-8")).hexdigest()
+            items.append((address, postcode, Lx_ids, location, names, key))
+
+        # Cached results
+        ctable = s3db.gis_geocode_cache
+        keys = set(item[5] for item in items)
+        rows = db(ctable.query_key.belongs(keys)).select(ctable.query_key,
+                                                          ctable.lat,
+                                                          ctable.lon,
+                                                          )
+        cached = dict((row.query_key, dict(lat=row.lat, lon=row.lon))
+                      for row in rows)
+
+        # Fetch all uncached queries from the Geocoder
+        queries = set()
+        for address, postcode, Lx_ids, location, names, key in items:
+            if key not in cached:
+                queries.add(location)
+                if names:
+                    # geocode checks whether results are specific enough
+                    queries.add(names)
+        if queries:
+            throttle = S3GeocodeThrottle(settings.get_gis_geocode_rate())
+            fetch = lambda location: g.geocode(location, exactly_one=False)
+            results = throttle.map(fetch, queries,
+                                   threads=settings.get_gis_geocode_threads())
+            g = S3PrefetchGeocoder(g, results)
+
+        output = []
+        append = output.append
+        local = None
+        for address, postcode, Lx_ids, location, names, key in items:
+            if key in cached:
+                append(cached[key])
+                continue
+            result = GIS.geocode(address, postcode, Lx_ids, geocoder=g)
+            if isinstance(result, dict):
+                GIS._geocode_cache_store(key, location, name, result)
+                cached[key] = result
+            elif gazetteer:
+                if local is None:
+                    local = S3Gazetteer.get()
+                match = local.geocode(address, Lx_ids)
+                if match:
+                    result = match
+            append(result)
+
+        return output
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _geocode_cache_store(key, location, geocoder, result):
+        """
+            Add a result to gis_geocode_cache, unless a concurrent request
+            has already added it
+
+            @param key: the query key
+            @param location: the query
+            @param geocoder: the geocoder name
+            @param result: the result, dict(lat=lat, lon=lon)
+        """
+
+        db = current.db
+        ctable = current.s3db.gis_geocode_cache
+
+        query = (ctable.query_key == key)
+        if db(query).update(lat = result["lat"],
+                            lon = result["lon"],
+                            ):
+            return
+
+        # A failed insert would abort the transaction in PostgreSQL
+        savepoint = db._dbname == "postgres"
+        if savepoint:
+            db.executesql("SAVEPOINT gis_geocode_cache;")
+        try:
+            ctable.insert(query_key = key,
+                          location = location,
+                          geocoder = geocoder,
+                          lat = result["lat"],
+                          lon = result["lon"],
+                          )
+        except:
+            # Duplicate key: added by a concurrent request
+            if savepoint:
+                db.executesql("ROLLBACK TO SAVEPOINT gis_geocode_cache;")
+        else:
+            if savepoint:
+                db.executesql("RELEASE SAVEPOINT gis_geocode_cache;")
+        return
+
     # -------------------------------------------------------------------------
     @staticmethod
     def geocode_r(lat, lon):
@@ -1902,6 +2094,185 @@ class GIS(object):
         wkt = "POLYGON ((%s))" % ", ".join(pairs)
         return wkt
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def bulk_bounds(features):
+        """
+            Calculate Bounds & Centroids of many WKT geometries at once
+            - used by update_location_tree, e.g. after importing
+              admin boundaries
+
+            The coordinates of all (Multi)Point, (Multi)LineString and
+            (Multi)Polygon geometries are parsed into one NumPy array,
+            and bounds and centroids (area-weighted for polygons,
+            length-weighted for lines, like shapely) are computed for
+            all of them together. Other geometries (or all, if NumPy
+            is not available) fall back to wkt_centroid.
+
+            @param features: list of WKT strings, or of dicts/Rows
+                             with a "wkt" key
+
+            @return: list with a dict for each feature, containing
+                     gis_feature_type, lat, lon, lat_min, lon_min,
+                     lat_max and lon_max - or None if the geometry
+                     could not be parsed
+        """
+
+        wkts = [f if isinstance(f, basestring) else f.get("wkt")
+                for f in features]
+        results = [None] * len(wkts)
+
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+
+        # Parse the WKT into rings (coordinate sequences)
+        batch = []
+        texts = []
+        ring_len = []
+        ring_geom = []
+        ring_sign = []
+        fallback = []
+        if np is not None:
+            match = WKT_TYPE.match
+            find_rings = WKT_RING.finditer
+            for index, wkt in enumerate(wkts):
+                m = match(wkt) if wkt else None
+                if not m:
+                    fallback.append(index)
+                    continue
+                multi, geometry = m.groups()
+                geometry = geometry.upper()
+                dim = WKT_DIMENSIONS[geometry]
+                geom = len(batch)
+                rings = 0
+                for ring in find_rings(wkt):
+                    text = ring.group(1)
+                    if not text.strip():
+                        continue
+                    sign = 1
+                    if dim == 2:
+                        # First ring of each polygon is the exterior
+                        i = ring.start() - 1
+                        while wkt[i] in " \t\r\n":
+                            i -= 1
+                        if wkt[i] != "(":
+                            sign = -1
+                    texts.append(text)
+                    ring_len.append(text.count(",") + 1)
+                    ring_geom.append(geom)
+                    ring_sign.append(sign)
+                    rings += 1
+                if rings:
+                    feature_type = WKT_FEATURE_TYPES[geometry]
+                    if multi:
+                        feature_type += 3
+                    batch.append((index, dim, feature_type))
+        else:
+            fallback = range(len(wkts))
+
+        if batch:
+            coords = np.fromstring(" ".join(texts).replace(",", " "),
+                                   dtype=float, sep=" ")
+            if coords.size != 2 * sum(ring_len):
+                # 3D or malformed coordinates
+                fallback.extend([item[0] for item in batch])
+                fallback.sort()
+                batch = []
+
+        if batch:
+            X = coords[0::2]
+            Y = coords[1::2]
+            ring_len = np.array(ring_len)
+            ring_geom = np.array(ring_geom)
+            ring_sign = np.array(ring_sign, dtype=float)
+            num_rings = len(ring_len)
+            num_geoms = len(batch)
+
+            point_ring = np.repeat(np.arange(num_rings), ring_len)
+            point_geom = ring_geom[point_ring]
+
+            # Bounds (the points of each geometry are contiguous)
+            ring_start = np.cumsum(ring_len) - ring_len
+            geom_start = ring_start[np.searchsorted(ring_geom,
+                                                    np.arange(num_geoms))]
+            lon_min = np.minimum.reduceat(X, geom_start)
+            lon_max = np.maximum.reduceat(X, geom_start)
+            lat_min = np.minimum.reduceat(Y, geom_start)
+            lat_max = np.maximum.reduceat(Y, geom_start)
+
+            # Segments within the rings
+            valid = point_ring[:-1] == point_ring[1:]
+            x0 = X[:-1][valid]
+            x1 = X[1:][valid]
+            y0 = Y[:-1][valid]
+            y1 = Y[1:][valid]
+            seg_ring = point_ring[:-1][valid]
+            seg_geom = ring_geom[seg_ring]
+
+            # Polygons: signed areas and centroids of the rings, with
+            # exterior rings counted positive and holes negative
+            cross = x0 * y1 - x1 * y0
+            area = np.bincount(seg_ring, cross, num_rings) / 2.0
+            cx = np.bincount(seg_ring, (x0 + x1) * cross, num_rings) / 6.0
+            cy = np.bincount(seg_ring, (y0 + y1) * cross, num_rings) / 6.0
+            orientation = ring_sign * np.sign(area)
+            area = np.bincount(ring_geom, area * orientation, num_geoms)
+            cx = np.bincount(ring_geom, cx * orientation, num_geoms)
+            cy = np.bincount(ring_geom, cy * orientation, num_geoms)
+
+            # Lines: length-weighted segment midpoints
+            length = np.hypot(x1 - x0, y1 - y0)
+            total = np.bincount(seg_geom, length, num_geoms)
+            mx = np.bincount(seg_geom, length * (x0 + x1) / 2.0, num_geoms)
+            my = np.bincount(seg_geom, length * (y0 + y1) / 2.0, num_geoms)
+
+            # Points: mean of all points
+            count = np.bincount(point_geom, None, num_geoms)
+            px = np.bincount(point_geom, X, num_geoms) / count
+            py = np.bincount(point_geom, Y, num_geoms) / count
+
+            for geom, (index, dim, feature_type) in enumerate(batch):
+                if dim == 2 and area[geom] > 0:
+                    lon = cx[geom] / area[geom]
+                    lat = cy[geom] / area[geom]
+                elif dim >= 1 and total[geom] > 0:
+                    lon = mx[geom] / total[geom]
+                    lat = my[geom] / total[geom]
+                else:
+                    lon = px[geom]
+                    lat = py[geom]
+                results[index] = dict(gis_feature_type = feature_type,
+                                      lat = float(lat),
+                                      lon = float(lon),
+                                      lat_min = float(lat_min[geom]),
+                                      lon_min = float(lon_min[geom]),
+                                      lat_max = float(lat_max[geom]),
+                                      lon_max = float(lon_max[geom]),
+                                      )
+
+        # Everything else one-by-one
+        wkt_centroid = GIS.wkt_centroid
+        for index in fallback:
+            wkt = wkts[index]
+            if not wkt:
+                continue
+            form = Storage(vars=Storage(wkt=wkt), errors=Storage())
+            wkt_centroid(form)
+            if form.errors:
+                continue
+            form_vars = form.vars
+            results[index] = dict(gis_feature_type = form_vars.gis_feature_type,
+                                  lat = form_vars.lat,
+                                  lon = form_vars.lon,
+                                  lat_min = form_vars.lat_min,
+                                  lon_min = form_vars.lon_min,
+                                  lat_max = form_vars.lat_max,
+                                  lon_max = form_vars.lon_max,
+                                  )
+        return results
+
     # -------------------------------------------------------------------------
     @staticmethod
     def get_bounds_from_radius(lat, lon, radius):
@@ -2579,6 +2950,362 @@ class GIS(object):
                     attributes = attributes,
                     )
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_location_joins(resource):
+        """
+            Find the join from a resource to the locations of its records
+            (for point layers)
+
+            @param resource: the S3Resource
+            @return: tuple (gtable, joins) with the gis_location table
+                     and the joins as dict {tablename: [join, ...]},
+                     or (None, None) if the resource can't be mapped
+        """
+
+        s3db = current.s3db
+        table = resource.table
+        tablename = resource.tablename
+
+        if tablename == "gis_location":
+            return table, {}
+
+        gtable = s3db.gis_location
+        if "location_id" in table.fields:
+            joins = [gtable.on(gtable.id == table.location_id)]
+        elif "site_id" in table.fields:
+            stable = s3db.org_site
+            joins = [stable.on(stable.site_id == table.site_id),
+                     gtable.on(gtable.id == stable.location_id)]
+        else:
+            return None, None
+
+        return gtable, {"gis_location": joins}
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_cluster_zoom(get_vars):
+        """
+            Determine the zoom level for server-side clustering, either
+            from the zoom URL variable or from the width of the bbox
+
+            @param get_vars: the URL GET vars
+        """
+
+        zoom = get_vars.get("zoom")
+        if zoom is not None:
+            try:
+                zoom = int(zoom)
+            except ValueError:
+                zoom = None
+        if zoom is None:
+            bbox = get_vars.get("bbox")
+            if type(bbox) is list:
+                bbox = bbox[-1]
+            try:
+                minLon, minLat, maxLon, maxLat = [float(v) for v in bbox.split(",")]
+            except (AttributeError, ValueError):
+                return 0
+            width = maxLon - minLon
+            if width <= 0:
+                return 0
+            # Assume a map of 4 tiles (1024 pixels) width
+            import math
+            zoom = int(round(math.log(360.0 * 4 / width, 2)))
+        return max(0, min(zoom, 20))
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def quantize_bbox(bbox):
+        """
+            Expand a bbox to the tiles of the zoom level which fits its
+            width, so that map requests for nearby views share the same
+            bbox (and hence can be served from the layer cache)
+
+            @param bbox: the bbox URL variable "minLon,minLat,maxLon,maxLat"
+            @return: the quantized bbox URL variable
+        """
+
+        if type(bbox) is list:
+            bbox = bbox[-1]
+        try:
+            minLon, minLat, maxLon, maxLat = [float(v) for v in bbox.split(",")]
+        except (AttributeError, ValueError):
+            # Badly-formed bbox - leave for parse_bbox_query to ignore
+            return bbox
+
+        import math
+        zoom = GIS.get_cluster_zoom({"bbox": bbox})
+        size = 360.0 / 2 ** zoom
+        floor = lambda v: math.floor(v / size) * size
+        ceil = lambda v: math.ceil(v / size) * size
+        return "%s,%s,%s,%s" % (max(floor(minLon), -180.0),
+                                max(floor(minLat), -90.0),
+                                min(ceil(maxLon), 180.0),
+                                min(ceil(maxLat), 90.0),
+                                )
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_layer_cache(r):
+        """
+            Find the cache entry for a Feature Layer GeoJSON request
+
+            The key covers the layer, the resource query (which includes
+            the realm and bbox filters), the user's realms, the URL
+            variables, the language and the versions of the tables
+            involved, so entries get invalidated by writes to any of
+            these tables.
+
+            @param r: the S3Request
+            @return: tuple (etag, filename) or None if not cacheable
+        """
+
+        layer_id = r.get_vars.get("layer")
+        try:
+            layer_id = int(layer_id)
+        except (TypeError, ValueError):
+            return None
+
+        resource = r.resource
+        tablename = resource.tablename
+
+        tablenames = [tablename, "gis_location", "gis_layer_feature"]
+        if "site_id" in resource.table.fields:
+            tablenames.append("org_site")
+        versions = current.s3db.table_version(*tablenames)
+        versions = ",".join(["%s:%s" % (tn, versions[tn]) for tn in tablenames])
+
+        user = current.auth.user
+        if user and user.realms:
+            realms = sorted(user.realms.keys())
+        else:
+            realms = None
+
+        # The bbox is part of the resource query (quantized)
+        get_vars = sorted((k, v) for k, v in r.get_vars.items()
+                                 if k not in ("_dc", "bbox"))
+
+        import hashlib
+        key = "|".join([str(item) for item in (tablename,
+                                               layer_id,
+                                               resource.get_query(),
+                                               realms,
+                                               get_vars,
+                                               current.T.accepted_language,
+                                               )])
+        version = hashlib.md5(versions).hexdigest()[:8]
+        key = "%s_%s" % (version, hashlib.md5(key).hexdigest())
+
+        path = os.path.join(current.request.folder, "uploads", "geojson",
+                            str(layer_id))
+        return '"%s"' % key, os.path.join(path, "%s.json" % key)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def read_layer_cache(filename):
+        """
+            Read a Feature Layer GeoJSON response from the cache
+
+            @param filename: the cache filename (from get_layer_cache)
+            @return: the GeoJSON, or None if not cached or expired
+        """
+
+        try:
+            if time.time() - os.path.getmtime(filename) > LAYER_CACHE_TTL:
+                return None
+            with open(filename, "rb") as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def put_layer_cache(filename, output):
+        """
+            Add a Feature Layer GeoJSON response to the cache, and remove
+            entries of previous table versions for the same layer, as well
+            as expired entries and the oldest entries beyond
+            LAYER_CACHE_SIZE
+
+            @param filename: the cache filename (from get_layer_cache)
+            @param output: the GeoJSON
+        """
+
+        def remove(fn):
+            # Concurrent requests may have removed the file already
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+
+        path, name = os.path.split(filename)
+        version = name.split("_", 1)[0]
+        try:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            else:
+                now = time.time()
+                entries = []
+                for f in os.listdir(path):
+                    fn = os.path.join(path, f)
+                    if f.split("_", 1)[0] != version:
+                        remove(fn)
+                        continue
+                    try:
+                        mtime = os.path.getmtime(fn)
+                    except OSError:
+                        continue
+                    if now - mtime > LAYER_CACHE_TTL:
+                        remove(fn)
+                    else:
+                        entries.append((mtime, fn))
+                if len(entries) >= LAYER_CACHE_SIZE:
+                    entries.sort()
+                    for mtime, fn in entries[:len(entries) - LAYER_CACHE_SIZE + 1]:
+                        remove(fn)
+            tmp = "%s.%s.tmp" % (filename, os.getpid())
+            with open(tmp, "wb") as f:
+                f.write(output)
+            os.rename(tmp, filename)
+        except (IOError, OSError):
+            current.log.error("Could not write layer cache %s" % filename)
+        return
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_clusters(resource, zoom=0, layer_id=None):
+        """
+            Aggregate the points of a Feature Layer into a grid of clusters
+            in the database, to avoid sending all features to the client
+
+            Called by S3Request.get_tree() for geojson requests with
+            cluster=1, the bbox filter of the request is applied as part
+            of the resource filter.
+
+            @param resource: the S3Resource (filtered by bbox)
+            @param zoom: the zoom level to cluster for
+            @param layer_id: the gis_layer_feature record ID
+
+            @return: a GeoJSON FeatureCollection of the clusters (as str),
+                     or None if the number of features is small enough
+                     to be sent without clustering (or the resource
+                     can't be clustered)
+        """
+
+        settings = current.deployment_settings
+        if not settings.get_gis_cluster_server():
+            return None
+
+        if resource.count() <= settings.get_gis_max_features():
+            # Send the individual features
+            return None
+
+        gtable, location_joins = GIS.get_location_joins(resource)
+        if gtable is None:
+            return None
+
+        db = current.db
+        table = resource.table
+        tablename = resource.tablename
+
+        rfilter = resource.rfilter
+        if rfilter is None:
+            rfilter = resource.build_query()
+        query = rfilter.get_query()
+
+        from s3query import S3Joins
+        ijoins = S3Joins(tablename, rfilter.get_joins(left=False))
+        ljoins = S3Joins(tablename, rfilter.get_joins(left=True))
+        if location_joins:
+            # Re-use the location join of the bbox filter if present
+            ljoins.extend(location_joins)
+
+        if rfilter.get_filter() is not None:
+            # Virtual filter can't be applied in the database,
+            # so resolve the record IDs first
+            data = resource.select([table._id.name],
+                                   limit=None,
+                                   getids=True)
+            query = table._id.belongs(data["ids"])
+            ijoins = S3Joins(tablename)
+            ljoins = S3Joins(tablename, location_joins)
+
+        query &= (gtable.lat != None) & (gtable.lon != None)
+
+        # Per-layer cluster index
+        # - keyed by the query (includes bbox and realm filters) and
+        #   the table versions, which get updated on write
+        cache = current.cache
+        versions = current.s3db.table_version(tablename, "gis_location")
+        version = "%s-%s" % (versions[tablename], versions["gis_location"])
+
+        join = ijoins.as_list(prefer=ljoins)
+        left = ljoins.as_list()
+
+        import hashlib
+        key = "%s|%s|%s|%s" % (query, join, left, zoom)
+        key = "gis_cluster_%s_%s_%s" % (layer_id or tablename,
+                                        version,
+                                        hashlib.md5(key).hexdigest())
+
+        def aggregate():
+            # Grid cell size in degrees
+            cell = 360.0 / (256 * 2 ** zoom) * CLUSTER_DISTANCE
+
+            # Shift into positive range so that cells don't straddle 0
+            cx = ((gtable.lon + 180) / cell).cast("integer")
+            cy = ((gtable.lat + 90) / cell).cast("integer")
+
+            count = table._id.count()
+            record_id = table._id.min()
+            lat = gtable.lat.sum()
+            lon = gtable.lon.sum()
+            lat_min = gtable.lat.min()
+            lat_max = gtable.lat.max()
+            lon_min = gtable.lon.min()
+            lon_max = gtable.lon.max()
+
+            rows = db(query).select(count,
+                                    record_id,
+                                    lat,
+                                    lon,
+                                    lat_min,
+                                    lat_max,
+                                    lon_min,
+                                    lon_max,
+                                    join=join,
+                                    left=left,
+                                    groupby=cx|cy)
+
+            features = []
+            append = features.append
+            for row in rows:
+                n = row[count]
+                if not n:
+                    continue
+                properties = {"count": n}
+                if n == 1:
+                    properties["id"] = row[record_id]
+                else:
+                    properties["bounds"] = [row[lon_min], row[lat_min],
+                                            row[lon_max], row[lat_max]]
+                geometry = {"type": "Point",
+                            "coordinates": [round(row[lon] / n, 6),
+                                            round(row[lat] / n, 6)]}
+                append({"type": "Feature",
+                        "geometry": geometry,
+                        "properties": properties,
+                        })
+
+            output = {"type": "FeatureCollection",
+                      "features": features,
+                      "zoom": zoom,
+                      }
+            return json.dumps(output, separators=SEPARATORS)
+
+        return cache.ram(key, aggregate, time_expire=60)
+
     # -------------------------------------------------------------------------
     @staticmethod
     def get_screenshot(config_id):
@@ -2800,6 +3527,381 @@ class GIS(object):
         # return 'locations'
         return dict(geojsons = _geojsons)
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def define_shapefile_table(layer_id):
+        """
+            Define the data table of a Shapefile Layer
+
+            @param layer_id: the gis_layer_shapefile record ID
+            @return: the Table, or None if the layer has no data
+        """
+
+        db = current.db
+        tablename = "gis_layer_shapefile_%s" % layer_id
+        if tablename in db:
+            return db[tablename]
+
+        table = current.s3db.gis_layer_shapefile
+        row = db(table.id == layer_id).select(table.data,
+                                              limitby=(0, 1)
+                                              ).first()
+        if not row or not row.data:
+            return None
+
+        fields = [Field("lat", "float"),
+                  Field("lon", "float"),
+                  Field("wkt", "text"),
+                  Field("layer_id", table),
+                  ]
+        append = fields.append
+        for field in json.loads(row.data):
+            # Unicode fieldnames not supported
+            append(Field(str(field[0]), field[1]))
+        if current.deployment_settings.get_gis_spatialdb():
+            # Add a spatial field
+            append(Field("the_geom", "geometry()"))
+        return current.s3db.define_table(tablename, *fields)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def tile_cache_path(*args):
+        """
+            Get the path of the Vector Tile cache, or a path inside it
+
+            @param args: path elements
+        """
+
+        return os.path.join(current.request.folder, "uploads", "tiles",
+                            *[str(arg) for arg in args])
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def tile_cache_clear(tablename, record_id=None):
+        """
+            Invalidate the cached Vector Tiles built from a table; called
+            by S3Audit when records in the table are written
+
+            @param tablename: the tablename
+            @param record_id: the record ID
+        """
+
+        import shutil
+
+        root = GIS.tile_cache_path()
+        if not os.path.isdir(root):
+            return
+
+        db = current.db
+        s3db = current.s3db
+
+        if tablename == "gis_location":
+            level = None
+            if record_id:
+                table = s3db.gis_location
+                row = db(table.id == record_id).select(table.level,
+                                                       limitby=(0, 1)
+                                                       ).first()
+                if row:
+                    level = row.level
+            if level:
+                # Admin boundary => Admin Boundary & Theme Layers
+                tablenames = ("gis_location", "gis_theme_data")
+            else:
+                # Point => Feature Layers of tables referencing it
+                tablenames = []
+                for tn in os.listdir(root):
+                    if tn in ("gis_location", "gis_theme_data") or \
+                       tn[:20] == "gis_layer_shapefile_":
+                        continue
+                    table = s3db.table(tn)
+                    if table is None:
+                        continue
+                    if "location_id" in table.fields:
+                        query = (table.location_id == record_id)
+                    elif "site_id" in table.fields:
+                        stable = s3db.org_site
+                        query = (table.site_id == stable.site_id) & \
+                                (stable.location_id == record_id)
+                    else:
+                        # Not mapped by location
+                        continue
+                    if not record_id or \
+                       db(query).select(table._id, limitby=(0, 1)).first():
+                        tablenames.append(tn)
+        elif tablename == "gis_layer_shapefile" and record_id:
+            # Layer (re-)uploaded => tiles of its data table
+            tablenames = (tablename, "%s_%s" % (tablename, record_id))
+        else:
+            tablenames = (tablename,)
+
+        for tn in tablenames:
+            path = os.path.join(root, tn)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+        return
+
+    # -------------------------------------------------------------------------
+    def get_vector_tile(self, layer, z, x, y):
+        """
+            Get a Mapbox Vector Tile for a layer, from the tile cache if
+            available, otherwise encode it and add it to the cache
+
+            @param layer: the layer, either a gis_layer_entity layer_id of
+                          a Feature, Theme or Shapefile Layer, or an
+                          admin level ("L0".."L5") for Admin Boundaries
+            @param z: the zoom level
+            @param x: the tile column
+            @param y: the tile row
+
+            @return: the encoded tile (str), or None if the layer
+                     was not found or is not accessible
+        """
+
+        if z < 0 or z > 22 or not (0 <= x < 2 ** z) or not (0 <= y < 2 ** z):
+            return None
+
+        source = self._tile_source(layer)
+        if source is None:
+            return None
+        tablename, name, realm, features = source
+
+        path = self.tile_cache_path(tablename, layer, realm, z, x)
+        filename = os.path.join(path, "%s.mvt" % y)
+        if os.path.exists(filename):
+            with open(filename, "rb") as f:
+                return f.read()
+
+        from s3codecs.mvt import S3MVT
+        tile = S3MVT(z, x, y)
+        tile.add_layer(name, features(tile.clip_bounds()))
+        output = tile.encode()
+
+        # Add to the cache (write to a temporary file, then rename, so
+        # that concurrent requests never read incomplete tiles)
+        try:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            tmp = "%s.%s.tmp" % (filename, os.getpid())
+            with open(tmp, "wb") as f:
+                f.write(output)
+            os.rename(tmp, filename)
+        except (IOError, OSError):
+            current.log.error("Could not write tile cache %s" % filename)
+
+        return output
+
+    # -------------------------------------------------------------------------
+    def _tile_source(self, layer):
+        """
+            Find the source of the features for a Vector Tile layer
+
+            @param layer: the layer (see get_vector_tile)
+
+            @return: tuple (tablename, layer name, realm, features) where
+                     features is a function(bounds) returning an iterable
+                     of (id, shape, properties), or None if the layer is
+                     not found or not accessible
+        """
+
+        db = current.db
+        s3db = current.s3db
+        auth = current.auth
+        has_permission = auth.s3_has_permission
+
+        from shapely.wkt import loads as wkt_loads
+        from shapely.geometry import Point
+
+        def overlaps(gtable, bounds):
+            lon_min, lat_min, lon_max, lat_max = bounds
+            return (gtable.lon_max >= lon_min) & \
+                   (gtable.lon_min <= lon_max) & \
+                   (gtable.lat_max >= lat_min) & \
+                   (gtable.lat_min <= lat_max)
+
+        def shape(wkt):
+            try:
+                return wkt_loads(wkt)
+            except:
+                return None
+
+        gtable = s3db.gis_location
+
+        if layer in self.hierarchy_level_keys:
+            # Admin Boundaries
+            if not has_permission("read", gtable):
+                return None
+            def features(bounds):
+                query = (gtable.level == layer) & \
+                        (gtable.deleted != True) & \
+                        overlaps(gtable, bounds)
+                rows = db(query).select(gtable.id,
+                                        gtable.name,
+                                        gtable.wkt)
+                return ((row.id, shape(row.wkt), {"name": row.name})
+                        for row in rows if row.wkt)
+            return "gis_location", layer, "public", features
+
+        try:
+            layer_id = int(layer)
+        except ValueError:
+            return None
+
+        etable = s3db.gis_layer_entity
+        entity = db(etable.layer_id == layer_id).select(etable.instance_type,
+                                                        limitby=(0, 1)
+                                                        ).first()
+        if not entity:
+            return None
+        instance_type = entity.instance_type
+
+        if instance_type == "gis_layer_theme":
+            ltable = s3db.gis_layer_theme
+            row = db(ltable.layer_id == layer_id).select(ltable.id,
+                                                         ltable.name,
+                                                         limitby=(0, 1)
+                                                         ).first()
+            table = s3db.gis_theme_data
+            if not row or not has_permission("read", table):
+                return None
+            theme_id = row.id
+            def features(bounds):
+                query = (table.layer_theme_id == theme_id) & \
+                        (table.deleted != True) & \
+                        (table.location_id == gtable.id) & \
+                        overlaps(gtable, bounds)
+                rows = db(query).select(table.id,
+                                        table.value,
+                                        gtable.name,
+                                        gtable.wkt)
+                return ((row[table.id],
+                         shape(row[gtable.wkt]),
+                         {"value": row[table.value],
+                          "name": row[gtable.name],
+                          })
+                        for row in rows if row[gtable.wkt])
+            return "gis_theme_data", row.name, "public", features
+
+        elif instance_type == "gis_layer_shapefile":
+            ltable = s3db.gis_layer_shapefile
+            row = db(ltable.layer_id == layer_id).select(ltable.id,
+                                                         ltable.name,
+                                                         ltable.modified_on,
+                                                         limitby=(0, 1)
+                                                         ).first()
+            if not row:
+                return None
+            table = self.define_shapefile_table(row.id)
+            if table is None or not has_permission("read", ltable):
+                return None
+            skip = ("id", "lat", "lon", "wkt", "layer_id", "the_geom")
+            fields = [f for f in table.fields if f not in skip]
+
+            if "the_geom" in table.fields:
+                def intersects(bounds):
+                    envelope = "POLYGON((%s %s,%s %s,%s %s,%s %s,%s %s))" % \
+                               (bounds[0], bounds[1], bounds[2], bounds[1],
+                                bounds[2], bounds[3], bounds[0], bounds[3],
+                                bounds[0], bounds[1])
+                    return table.the_geom.st_intersects(envelope)
+            else:
+                # Shapefile tables have no bounds, only centroids (lat/lon)
+                # => extend the bbox by the maximum distance of any point
+                #    of a feature from its centroid, computed once per
+                #    layer upload
+                def extent():
+                    dx = dy = 0.0
+                    rows = db(table.id > 0).select(table.lat,
+                                                   table.lon,
+                                                   table.wkt)
+                    for r in rows:
+                        if r.lat is None or r.lon is None:
+                            continue
+                        s = shape(r.wkt) if r.wkt else None
+                        if s is None or s.is_empty:
+                            continue
+                        lon_min, lat_min, lon_max, lat_max = s.bounds
+                        dx = max(dx, r.lon - lon_min, lon_max - r.lon)
+                        dy = max(dy, r.lat - lat_min, lat_max - r.lat)
+                    return dx, dy
+                key = "gis_shapefile_extent_%s_%s" % (row.id, row.modified_on)
+                dx, dy = current.cache.ram(key, extent, time_expire=None)
+                def intersects(bounds):
+                    lon_min, lat_min, lon_max, lat_max = bounds
+                    return (table.lon >= lon_min - dx) & \
+                           (table.lon <= lon_max + dx) & \
+                           (table.lat >= lat_min - dy) & \
+                           (table.lat <= lat_max + dy)
+
+            def features(bounds):
+                rows = db(intersects(bounds)).select(table.id,
+                                                     table.wkt,
+                                                     *[table[f] for f in fields])
+                return ((row.id,
+                         shape(row.wkt),
+                         dict((f, row[f]) for f in fields),
+                         )
+                        for row in rows if row.wkt)
+            return str(table), row.name, "public", features
+
+        elif instance_type == "gis_layer_feature":
+            ltable = s3db.gis_layer_feature
+            row = db(ltable.layer_id == layer_id).select(ltable.name,
+                                                         ltable.controller,
+                                                         ltable.function,
+                                                         ltable.filter,
+                                                         ltable.polygons,
+                                                         limitby=(0, 1)
+                                                         ).first()
+            if not row:
+                return None
+            tablename = "%s_%s" % (row.controller, row.function)
+            table = s3db.table(tablename)
+            if not table or \
+               not has_permission("read", c=row.controller, f=row.function):
+                return None
+
+            # Tiles are cached per set of realms the user can see
+            import hashlib
+            aquery = auth.s3_accessible_query("read", table)
+            realm = hashlib.md5(str(aquery)).hexdigest()[:12]
+
+            get_vars = {}
+            if row.filter:
+                import urlparse
+                get_vars = dict(urlparse.parse_qsl(row.filter))
+            polygons = row.polygons
+
+            def features(bounds):
+                get_vars["bbox"] = ",".join([str(b) for b in bounds])
+                resource = s3db.resource(tablename, vars=get_vars)
+                g, joins = GIS.get_location_joins(resource)
+                if g is None:
+                    return []
+                ids = resource.select([table._id.name],
+                                      limit=None,
+                                      getids=True)["ids"]
+                if not ids:
+                    return []
+                query = (table._id.belongs(ids))
+                join = joins["gis_location"] if joins else None
+                if polygons:
+                    fields = [table._id, g.wkt]
+                else:
+                    fields = [table._id, g.lat, g.lon]
+                rows = db(query).select(join=join, *fields)
+                if polygons:
+                    return ((r[table._id], shape(r[g.wkt]), None)
+                            for r in rows if r[g.wkt])
+                else:
+                    return ((r[table._id], Point(r[g.lon], r[g.lat]), None)
+                            for r in rows
+                            if r[g.lat] is not None and r[g.lon] is not None)
+
+            return tablename, row.name, realm, features
+
+        return None
+
     # -------------------------------------------------------------------------
     @staticmethod
     def greatCircleDistance(lat1, lon1, lat2, lon2, quick=True):
@@ -4307,7 +5409,12 @@ class GIS(object):
             form = Storage()
             form.vars = feature
             form.errors = Storage()
-            wkt_centroid(form)
+            bounds = feature.get("_bounds")
+            if bounds:
+                # Pre-calculated by bulk_bounds
+                feature.update(bounds)
+            else:
+                wkt_centroid(form)
             form_vars = form.vars
             if "lat_max" in form_vars:
                 wkt = form_vars.wkt
@@ -4347,6 +5454,11 @@ class GIS(object):
                 except MemoryError:
                     current.log.error("S3GIS: Unable to update Location Tree for level %s: MemoryError" % level)
                 else:
+                    # Calculate Bounds/Centroids of all Lines & Polygons at once
+                    shapes = [feature for feature in features
+                              if feature.wkt and not feature.wkt.startswith("POI")]
+                    for feature, bounds in zip(shapes, GIS.bulk_bounds(shapes)):
+                        feature["_bounds"] = bounds
                     for feature in features:
                         feature["level"] = level
                         wkt = feature["wkt"]
@@ -7678,6 +8790,10 @@ class LayerFeature(Layer):
                 url = "%s&%s" % (url, self.filter)
             if self.trackable:
                 url = "%s&track=1" % url
+            cluster_server = not self.polygons and \
+                             current.deployment_settings.get_gis_cluster_server()
+            if cluster_server:
+                url = "%s&cluster=1" % url
             style = self.style
             if style:
                 try:
@@ -7716,6 +8832,8 @@ class LayerFeature(Layer):
             # Attributes which are defaulted client-side if not set
             self.setup_folder_visibility_and_opacity(output)
             self.setup_clustering(output)
+            if cluster_server:
+                output["cluster_server"] = 1
             if not popup_format:
                 output["no_popups"] = 1
             style = self.style
@@ -41,6 +41,10 @@ except ImportError:
     except:
         import gluon.contrib.simplejson as json # fallback to pure-Python module
 
+import hashlib
+import threading
+import uuid
+
 from gluon import *
 from s3utils import s3_unicode
 
@@ -50,6 +54,14 @@ DEFAULT = lambda: None
 class S3Hierarchy(object):
     """ Class representing an object hierarchy """
 
+    # Minimum number of nodes to use range queries (rather than belongs)
+    RANGE_QUERY_MIN = 50
+
+    # Process-level copies of the stored hierarchies, shared between
+    # requests, structure: {tablename: (version, nodes, intervals)}
+    _shared = {}
+    _lock = threading.Lock()
+
     # -------------------------------------------------------------------------
     def __init__(self,
                  tablename=None,
@@ -78,8 +90,7 @@ class S3Hierarchy(object):
         self.filter = filter
         self.leafonly = leafonly
 
-        self.__theset = None
-        self.__flags = None
+        self.__hierarchy = None
 
         self.__nodes = None
         self.__roots = None
@@ -102,20 +113,21 @@ class S3Hierarchy(object):
                 }}
         """
 
-        if self.__theset is None:
+        if self.__hierarchy is None:
             self.__connect()
         if self.__status("dirty"):
             self.read()
-        return self.__theset
+            self.save()
+        return self.__hierarchy["nodes"]
 
     # -------------------------------------------------------------------------
     @property
     def flags(self):
         """ Dict of status flags """
 
-        if self.__flags is None:
+        if self.__hierarchy is None:
             theset = self.theset
-        return self.__flags
+        return self.__hierarchy["flags"]
 
     # -------------------------------------------------------------------------
     @property
@@ -192,19 +204,15 @@ class S3Hierarchy(object):
         if tablename :
             hierarchies = current.model.hierarchies
             if tablename in hierarchies:
-                hierarchy = hierarchies[tablename]
-                self.__theset = hierarchy["nodes"]
-                self.__flags = hierarchy["flags"]
+                self.__hierarchy = hierarchies[tablename]
             else:
-                self.__theset = dict()
-                self.__flags = dict()
+                self.__hierarchy = {"nodes": dict(),
+                                    "flags": dict()}
                 self.load()
-                hierarchy = {"nodes": self.__theset,
-                             "flags": self.__flags}
-                hierarchies[tablename] = hierarchy
+                hierarchies[tablename] = self.__hierarchy
         else:
-            self.__theset = dict()
-            self.__flags = dict()
+            self.__hierarchy = {"nodes": dict(),
+                                "flags": dict()}
         return
 
     # -------------------------------------------------------------------------
@@ -232,7 +240,10 @@ class S3Hierarchy(object):
 
     # -------------------------------------------------------------------------
     def load(self):
-        """ Try loading the hierarchy from s3_hierarchy """
+        """
+            Try loading the hierarchy from s3_hierarchy, or rather use
+            the process-level copy if it has the same version
+        """
 
         if not self.config:
             return
@@ -243,23 +254,45 @@ class S3Hierarchy(object):
             self.__status(dirty=True)
             return
 
+        db = current.db
         htable = current.s3db.s3_hierarchy
         query = (htable.tablename == tablename)
-        row = current.db(query).select(htable.dirty,
-                                       htable.hierarchy,
-                                       limitby=(0, 1)).first()
-        if row and not row.dirty:
-            data = row.hierarchy
-            theset = self.__theset
-            theset.clear()
-            for node_id, item in data["nodes"].items():
-                theset[long(node_id)] = {"p": item["p"],
-                                         "c": item["c"],
-                                         "s": set(item["s"]) \
-                                              if item["s"] else set()}
+        row = db(query).select(htable.id,
+                               htable.dirty,
+                               htable.version,
+                               limitby=(0, 1)).first()
+        if row and not row.dirty and row.version:
+            version = row.version
+            shared = self._shared.get(tablename)
+            if shared and shared[0] == version:
+                theset, intervals = shared[1:]
+            else:
+                # Decode the stored hierarchy
+                record = db(htable.id == row.id).select(htable.hierarchy,
+                                                        limitby=(0, 1)).first()
+                data = record.hierarchy if record else None
+                if not data:
+                    self.__status(dirty=True,
+                                  dbupdate=None,
+                                  dbstatus=False)
+                    return
+                theset = {}
+                for node_id, item in data["nodes"].items():
+                    theset[long(node_id)] = {"p": item["p"],
+                                             "c": item["c"],
+                                             "s": set(item["s"]) \
+                                                  if item["s"] else set()}
+                intervals = {}
+                with self._lock:
+                    self._shared[tablename] = (version, theset, intervals)
+            self.__hierarchy["nodes"] = theset
+            self.__hierarchy["intervals"] = intervals
             self.__status(dirty=False,
                           dbupdate=None,
-                          dbstatus=True)
+                          dbstatus=True,
+                          version=version,
+                          base=None,
+                          shared=True)
             return
         else:
             self.__status(dirty=True,
@@ -288,8 +321,10 @@ class S3Hierarchy(object):
                                         if node["s"] else []}
 
         # Generate record
+        version = uuid.uuid4().hex
         data = {"tablename": tablename,
                 "dirty": False,
+                "version": version,
                 "hierarchy": {"nodes": nodes_dict}
                 }
 
@@ -297,17 +332,35 @@ class S3Hierarchy(object):
         htable = current.s3db.s3_hierarchy
         query = (htable.tablename == tablename)
         row = current.db(query).select(htable.id,
+                                       htable.dirty,
+                                       htable.version,
                                        limitby=(0, 1)).first()
 
         if row:
+            base = self.__status("base")
+            if base is not None and (row.dirty or row.version != base):
+                # Incrementally updated, but the stored hierarchy has
+                # been changed elsewhere in the meantime => rebuild
+                self.dirty(tablename)
+                return
             # Update record
             row.update_record(**data)
         else:
             # Create new record
             htable.insert(**data)
 
+        # Share with other requests
+        intervals = self.__hierarchy.setdefault("intervals", {})
+        with self._lock:
+            self._shared[tablename] = (version, theset, intervals)
+
         # Update status
-        self.__status(dirty=False, dbupdate=None, dbstatus=True)
+        self.__status(dirty=False,
+                      dbupdate=None,
+                      dbstatus=True,
+                      version=version,
+                      base=None,
+                      shared=True)
         return
         
     # -------------------------------------------------------------------------
@@ -377,8 +430,11 @@ class S3Hierarchy(object):
             query = (table.id > 0)
         rows = current.db(query).select(left = self.left, *fields)
 
-        self.__theset.clear()
-        
+        # Start with a new nodes dict (the current one may be shared)
+        self.__hierarchy["nodes"] = {}
+        self.__hierarchy["intervals"] = {}
+        self.__status(version=None, base=None, shared=None)
+
         add = self.add
         cfield = table[ckey]
         for row in rows:
@@ -488,7 +544,8 @@ class S3Hierarchy(object):
             @param category: the category
         """
 
-        theset = self.__theset
+        self.__private()
+        theset = self.__hierarchy["nodes"]
 
         if node_id in theset:
             node = theset[node_id]
@@ -510,6 +567,474 @@ class S3Hierarchy(object):
         theset[node_id] = node
         return node
 
+    # -------------------------------------------------------------------------
+    def remove(self, node_id):
+        """
+            Remove a node from the hierarchy
+
+            @param node_id: the node ID
+        """
+
+        self.__private()
+        theset = self.__hierarchy["nodes"]
+
+        node = theset.get(node_id)
+        if node is None:
+            return
+        parent_id = self.__detach(node_id)
+
+        if node["s"]:
+            # Child nodes still refer to this node (like in read())
+            node["c"] = None
+        else:
+            del theset[node_id]
+        self.__prune(parent_id)
+        return
+
+    # -------------------------------------------------------------------------
+    def update(self, node_id):
+        """
+            Update a node after a write to the target table (add, move
+            or remove it); the hierarchy is saved once at the end of the
+            transaction (see S3Model.before_commit)
+
+            @param node_id: the node ID
+        """
+
+        if not node_id:
+            return
+        theset = self.theset
+        if not self.config:
+            return
+
+        rows = self.__rows(node_id)
+
+        if rows:
+            ckey = self.ckey
+            cfield = current.s3db[self.tablename][ckey] if ckey else None
+            row = rows.first()
+            parent_id = row[self.fkey]
+            category = row[cfield] if cfield else None
+
+            node = theset.get(node_id)
+            if node is not None and node["p"] != parent_id:
+                # Move
+                self.__private()
+                self.__prune(self.__detach(node_id))
+            node = self.add(node_id, parent_id=parent_id, category=category)
+            node["c"] = category
+        else:
+            self.remove(node_id)
+
+        # Update status: memory is clean, db needs update (the stored
+        # version becomes the base version for save)
+        version = self.__status("version")
+        if version is not None:
+            self.__status(base=version, version=None)
+        self.__status(dbupdate=True)
+
+        tablename = self.tablename
+        current.s3db.before_commit("hierarchy:%s" % tablename,
+                                   lambda: S3Hierarchy(tablename).save())
+
+        # Remove subset
+        self.__roots = None
+        self.__nodes = None
+        return
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def onwrite(cls, tablename, record_id=None):
+        """
+            Update all hierarchies depending on a table after a record
+            has been written
+
+            @param tablename: the tablename
+            @param record_id: the record ID, None to rebuild the
+                              hierarchies (at the next read)
+        """
+
+        if not tablename:
+            return
+        s3db = current.s3db
+
+        config = s3db.get_config(tablename, "hierarchy")
+        if config:
+            if record_id:
+                auth = current.auth
+                override = auth.override
+                auth.override = True
+                try:
+                    cls(tablename).update(record_id)
+                finally:
+                    auth.override = override
+            else:
+                cls.dirty(tablename)
+
+        # Hierarchies with the parent key in a link table
+        for name, settings in current.model.config.items():
+            config = settings.get("hierarchy") if settings else None
+            if not config:
+                continue
+            if isinstance(config, tuple):
+                config = config[0]
+            if config and ":" in config and \
+               config.split(":", 1)[1].split(".", 1)[0] == tablename:
+                cls.dirty(name)
+        return
+
+    # -------------------------------------------------------------------------
+    def __rows(self, node_id):
+        """
+            Select a node (with parent key and category) from the
+            target table
+
+            @param node_id: the node ID
+
+            @return: the Rows
+        """
+
+        table = current.s3db[self.tablename]
+
+        pkey = self.pkey
+        fields = [pkey, self.fkey]
+        ckey = self.ckey
+        if ckey is not None:
+            fields.append(table[ckey])
+
+        query = (pkey == node_id)
+        if "deleted" in table:
+            query &= (table.deleted != True)
+        return current.db(query).select(left = self.left, *fields)
+
+    # -------------------------------------------------------------------------
+    def __detach(self, node_id):
+        """
+            Detach a node from its parent
+
+            @param node_id: the node ID
+
+            @return: the former parent ID
+        """
+
+        theset = self.__hierarchy["nodes"]
+        node = theset[node_id]
+
+        parent_id = node["p"]
+        if parent_id and parent_id in theset:
+            theset[parent_id]["s"].discard(node_id)
+        node["p"] = None
+        return parent_id
+
+    # -------------------------------------------------------------------------
+    def __prune(self, node_id):
+        """
+            Remove a node which has no children left, if it only
+            existed as parent of other nodes (i.e. has been deleted)
+
+            @param node_id: the node ID
+        """
+
+        theset = self.__hierarchy["nodes"]
+        node = theset.get(node_id)
+        if node is None or node["s"] or node["p"] or node["c"] is not None:
+            return
+        if not self.__rows(node_id):
+            del theset[node_id]
+        return
+
+    # -------------------------------------------------------------------------
+    def __private(self):
+        """
+            Copy the nodes before modifying them if they are shared
+            with other requests
+        """
+
+        hierarchy = self.__hierarchy
+        if hierarchy["flags"].get("shared"):
+            hierarchy["nodes"] = dict((node_id, {"p": node["p"],
+                                                 "c": node["c"],
+                                                 "s": set(node["s"]),
+                                                 })
+                                      for node_id, node in hierarchy["nodes"].items())
+            hierarchy["flags"].pop("shared", None)
+        if hierarchy.get("intervals"):
+            # Intervals need to be re-computed
+            hierarchy["intervals"] = {}
+        return
+
+    # -------------------------------------------------------------------------
+    @property
+    def intervals(self):
+        """
+            The pre-order intervals of all nodes like:
+
+                {<node_id>: (<left>, <right>)}
+
+            where left is the position of the node in the pre-order
+            sequence of all nodes, and right the position of its last
+            descendant (i.e. node B is a descendant of node A if
+            left(A) < left(B) <= right(A))
+        """
+
+        return self.__intervals()["intervals"]
+
+    # -------------------------------------------------------------------------
+    def __intervals(self):
+        """
+            Compute the pre-order intervals of all nodes (or rather use
+            those previously computed for the same nodes)
+
+            @return: dict {"intervals": {node_id: (left, right)},
+                           "order": [node_id, ...]}
+        """
+
+        theset = self.theset
+
+        hierarchy = self.__hierarchy
+        container = hierarchy.get("intervals")
+        if container is None:
+            container = hierarchy["intervals"] = {}
+        if "order" in container:
+            return container
+
+        intervals = {}
+        order = []
+        roots = sorted(node_id for node_id, node in theset.items()
+                       if not node["p"] or node["p"] not in theset)
+        for root_id in roots:
+            intervals[root_id] = [len(order)]
+            order.append(root_id)
+            stack = [(root_id, iter(sorted(theset[root_id]["s"])))]
+            while stack:
+                node_id, children = stack[-1]
+                for child_id in children:
+                    if child_id in intervals or child_id not in theset:
+                        continue
+                    intervals[child_id] = [len(order)]
+                    order.append(child_id)
+                    stack.append((child_id,
+                                  iter(sorted(theset[child_id]["s"]))))
+                    break
+                else:
+                    stack.pop()
+                    intervals[node_id].append(len(order) - 1)
+
+        with self._lock:
+            container["intervals"] = dict((node_id, tuple(interval))
+                                          for node_id, interval in intervals.items())
+            container["order"] = order
+        return container
+
+    # -------------------------------------------------------------------------
+    def range_query(self, field, node_ids):
+        """
+            Construct a query for a field referencing a set of nodes,
+            as range predicates (BETWEEN) over the stored pre-order
+            intervals rather than a (possibly very long) list of node IDs
+
+            The query joins s3_hierarchy_interval (aliased per field) on
+            the node ID, so the resource query should include the left
+            join returned by range_join for the same field and node set
+            (required when the query is negated or OR-combined).
+
+            @param field: the Field
+            @param node_ids: the set of node IDs, must include all
+                             descendants of each node in the set
+                             (e.g. as returned by findall(inclusive=True))
+
+            @return: the query, or None if the node set is too small
+                     or can not be expressed as ranges
+        """
+
+        ranges = self.__ranges(node_ids)
+        if not ranges:
+            return None
+        itable, join = self.__join(field)
+
+        query = None
+        for left, right in ranges:
+            if left == right:
+                q = (itable.lft == left)
+            else:
+                q = (itable.lft >= left) & (itable.lft <= right)
+            query = q if query is None else query | q
+        return join & query
+
+    # -------------------------------------------------------------------------
+    def range_join(self, field, node_ids):
+        """
+            Get the left join with s3_hierarchy_interval for a range
+            query (see range_query)
+
+            @param field: the Field
+            @param node_ids: the set of node IDs
+
+            @return: dict {alias: [join]} like S3ResourceField._joins,
+                     or None if no range query is possible
+        """
+
+        if not self.__ranges(node_ids):
+            return None
+        itable, join = self.__join(field)
+        return {itable._tablename: [itable.on(join)]}
+
+    # -------------------------------------------------------------------------
+    def __ranges(self, node_ids):
+        """
+            Express a set of nodes as ranges of pre-order positions,
+            and make sure the intervals are stored for the current
+            version of the hierarchy
+
+            @param node_ids: the set of node IDs
+
+            @return: list of [left, right] pairs, or None if the node
+                     set is too small or can not be expressed as ranges
+        """
+
+        if not node_ids or len(node_ids) < self.RANGE_QUERY_MIN:
+            return None
+        if not self.config:
+            return None
+
+        intervals = self.intervals
+        try:
+            ranges = sorted(intervals[node_id] for node_id in node_ids)
+        except KeyError:
+            # Node without interval
+            return None
+
+        # Merge nested and adjacent intervals
+        merged = []
+        for left, right in ranges:
+            if merged and left <= merged[-1][1] + 1:
+                if right > merged[-1][1]:
+                    merged[-1][1] = right
+            else:
+                merged.append([left, right])
+
+        # Must be exactly the node set (e.g. not a filtered subset)
+        if sum(right - left + 1 for left, right in merged) != len(node_ids):
+            return None
+
+        if not self.__store():
+            return None
+        return merged
+
+    # -------------------------------------------------------------------------
+    def __join(self, field):
+        """
+            Get the aliased s3_hierarchy_interval table and the join
+            condition for a field referencing the nodes
+
+            @param field: the Field
+
+            @return: tuple (Table, Query)
+        """
+
+        alias = "s3_hierarchy_interval_%s" % \
+                hashlib.md5(str(field)).hexdigest()[:8]
+        itable = current.s3db.s3_hierarchy_interval.with_alias(alias)
+        join = (itable.hierarchy_id == self.__status("stored_id")) & \
+               (itable.node_id == field)
+        return itable, join
+
+    # -------------------------------------------------------------------------
+    def __store(self):
+        """
+            Store the intervals for the current version of the hierarchy
+            in s3_hierarchy_interval (if not stored yet), updating only
+            the intervals which have changed since the last version
+
+            @return: the version, or None if this hierarchy does not
+                     match the stored version
+        """
+
+        version = self.__status("version")
+        if not version:
+            return None
+        if self.__status("stored") == version:
+            return version
+
+        db = current.db
+        htable = current.s3db.s3_hierarchy
+        query = (htable.tablename == self.tablename)
+        fields = (htable.id, htable.version, htable.intervals)
+
+        row = db(query).select(limitby=(0, 1), *fields).first()
+        if not row or row.version != version:
+            return None
+        if row.intervals != version:
+            # Lock the hierarchy while updating the intervals
+            row = db(query).select(limitby=(0, 1),
+                                   for_update=True,
+                                   *fields).first()
+            if not row or row.version != version:
+                return None
+            if row.intervals != version:
+                self.__update_intervals(row.id)
+                row.update_record(intervals=version)
+
+        self.__status(stored=version, stored_id=row.id)
+        return version
+
+    # -------------------------------------------------------------------------
+    def __update_intervals(self, hierarchy_id):
+        """
+            Update the stored intervals of the hierarchy nodes, writing
+            only those which have changed (adding a node only shifts
+            the nodes after it in pre-order)
+
+            Nodes shifted by the same offsets are updated in a single
+            statement; however, since intervals are dense, a change can
+            still shift O(n) rows. This is deferred until the next range
+            query though (see __store), so that any number of changes in
+            between require only one update.
+
+            @param hierarchy_id: the s3_hierarchy record ID
+        """
+
+        db = current.db
+        itable = current.s3db.s3_hierarchy_interval
+
+        query = (itable.hierarchy_id == hierarchy_id)
+        rows = db(query).select(itable.id,
+                                itable.node_id,
+                                itable.lft,
+                                itable.rgt,
+                                )
+        stored = dict((row.node_id, row) for row in rows)
+
+        inserts = []
+        shifts = {}
+        for node_id, (left, right) in self.intervals.items():
+            row = stored.pop(node_id, None)
+            if row is None:
+                inserts.append({"hierarchy_id": hierarchy_id,
+                                "node_id": node_id,
+                                "lft": left,
+                                "rgt": right,
+                                })
+            elif row.lft != left or row.rgt != right:
+                shift = (left - row.lft, right - row.rgt)
+                if shift in shifts:
+                    shifts[shift].append(row.id)
+                else:
+                    shifts[shift] = [row.id]
+
+        # Update shifted intervals, one statement per shift
+        for (dl, dr), row_ids in shifts.items():
+            db(itable.id.belongs(row_ids)).update(lft = itable.lft + dl,
+                                                  rgt = itable.rgt + dr,
+                                                  )
+
+        # Remove intervals of removed nodes
+        if stored:
+            db(itable.id.belongs([row.id for row in stored.values()])).delete()
+        if inserts:
+            itable.bulk_insert(inserts)
+        return
+
     # -------------------------------------------------------------------------
     def __subset(self):
         """ Generate the subset of accessible nodes which match the filter """
@@ -780,17 +1305,61 @@ class S3Hierarchy(object):
         node = nodes.get(node_id)
         if not node:
             return result
-        if node["s"]:
-            result |= findall(node["s"],
-                              category=category,
-                              classify=classify,
-                              inclusive=True)
-        if inclusive:
-            this = (node_id, node["c"]) if classify else node_id
+
+        container = self.__intervals()
+        interval = container["intervals"].get(node_id)
+        if interval is None:
+            # Not reachable from a root node
+            if node["s"]:
+                result |= findall(node["s"],
+                                  category=category,
+                                  classify=classify,
+                                  inclusive=True)
+            if inclusive:
+                this = (node_id, node["c"]) if classify else node_id
+                if category is DEFAULT or category == node["c"]:
+                    result.add(this)
+            return result
+
+        # All descendants follow the node in pre-order
+        left, right = interval
+        if not inclusive:
+            left += 1
+        for n in container["order"][left:right + 1]:
+            node = nodes.get(n)
+            if node is None:
+                # Not in the subset
+                continue
             if category is DEFAULT or category == node["c"]:
-                result.add(this)
+                result.add((n, node["c"]) if classify else n)
         return result
 
+    # -------------------------------------------------------------------------
+    def is_descendant(self, node_id, ancestor_id, inclusive=False):
+        """
+            Check whether a node is a descendant of another node
+
+            @param node_id: the node ID
+            @param ancestor_id: the ancestor node ID
+            @param inclusive: also return True if both are the same node
+
+            @return: True|False
+        """
+
+        nodes = self.nodes
+        if node_id not in nodes or ancestor_id not in nodes:
+            return False
+        if node_id == ancestor_id:
+            return inclusive
+
+        intervals = self.intervals
+        if node_id in intervals and ancestor_id in intervals:
+            left, right = intervals[ancestor_id]
+            return left < intervals[node_id][0] <= right
+        else:
+            # Not reachable from a root node
+            return node_id in self.findall(ancestor_id)
+
     # -------------------------------------------------------------------------
     def _represent(self, node_ids=None, renderer=None):
         """
@@ -1753,6 +1753,10 @@ class S3ImportItem(object):
         self.modified = True
         self.conflict = False
 
+        # Change detection
+        self.hash = None
+        self.unchanged = False
+
         # Allowed import methods
         self.strategy = job.strategy
         # Update and conflict resolution policies
@@ -1850,6 +1854,7 @@ class S3ImportItem(object):
             self.mtime = data[MTIME]
         if MCI in data:
             self.mci = data[MCI]
+        self.hash = element.get(xml.ATTRIBUTE.hash, None)
 
         _debug("New item: %s" % self)
         return True
@@ -2153,6 +2158,14 @@ class S3ImportItem(object):
 
         _debug("Committing item %s" % self)
 
+        # Skip records which are unchanged since the last import
+        if self._unchanged():
+            _debug("Unchanged: %s" % self)
+            self.unchanged = True
+            self.committed = True
+            self._update_referencing_items()
+            return True
+
         # Resolve references
         self._resolve_references()
 
@@ -2492,27 +2505,65 @@ class S3ImportItem(object):
                 callback(onaccept, form, tablename=tablename)
 
         # Update referencing items
-        if self.update and self.id:
-            for u in self.update:
-                item = u.get("item", None)
-                if not item:
-                    continue
-                field = u.get("field", None)
-                if isinstance(field, (list, tuple)):
-                    pkey, fkey = field
-                    query = (table.id == self.id)
-                    row = db(query).select(table[pkey],
-                                           limitby=(0, 1)).first()
-                    if row:
-                        item._update_reference(fkey, row[pkey])
-                else:
-                    item._update_reference(field, self.id)
+        self._update_referencing_items()
 
         _debug("Success: %s, id=%s %sd" % (tablename, self.id,
                                            self.skip and "skippe" or \
                                            method))
         return True
 
+    # -------------------------------------------------------------------------
+    def _unchanged(self):
+        """
+            Check whether this item has the same content hash as the
+            last import of the existing record, and the record hasn't
+            been modified locally since then - in which case it doesn't
+            need to be validated or written again
+
+            @return: True if unchanged, otherwise False
+        """
+
+        if not self.hash or not self.id or self.original is None:
+            return False
+
+        stored = self.job.hashes.get((self.tablename, self.id))
+        if not stored:
+            return False
+
+        content_hash, mtime = stored
+        MTIME = current.xml.MTIME
+        return content_hash == self.hash and \
+               MTIME in self.original and \
+               self.original[MTIME] == mtime
+
+    # -------------------------------------------------------------------------
+    def _update_referencing_items(self):
+        """
+            Update the references in items which have been committed
+            before this item (circular references)
+        """
+
+        if not self.update or not self.id:
+            return
+
+        db = current.db
+        table = self.table
+
+        for u in self.update:
+            item = u.get("item", None)
+            if not item:
+                continue
+            field = u.get("field", None)
+            if isinstance(field, (list, tuple)):
+                pkey, fkey = field
+                query = (table.id == self.id)
+                row = db(query).select(table[pkey],
+                                       limitby=(0, 1)).first()
+                if row:
+                    item._update_reference(fkey, row[pkey])
+            else:
+                item._update_reference(field, self.id)
+
     # -------------------------------------------------------------------------
     def _dynamic_defaults(self, data):
         """
@@ -2874,6 +2925,9 @@ class S3ImportJob():
         self.last_sync = last_sync
         self.onconflict = onconflict
 
+        # Content hashes of existing records {(tablename, id): (hash, mtime)}
+        self.hashes = {}
+
         if job_id:
             self.__define_tables()
             jobtable = self.job_table
@@ -3323,6 +3377,7 @@ class S3ImportJob():
         tablename = self.table._tablename
 
         self.log = log_items
+        self.load_hashes()
         failed = False
         for item_id in import_list:
             item = items[item_id]
@@ -3351,9 +3406,11 @@ class S3ImportJob():
                         self.error_tree.append(deepcopy(element))
                     
             elif item.tablename == tablename:
-                count += 1
                 if mtime is None or item.mtime > mtime:
                     mtime = item.mtime
+                if item.unchanged:
+                    continue
+                count += 1
                 if item.id:
                     if item.method == METHOD.CREATE:
                         cappend(item.id)
@@ -3364,7 +3421,10 @@ class S3ImportJob():
                         
         if failed:
             return False
-            
+
+        self.onimport()
+        self.store_hashes()
+
         self.count = count
         self.mtime = mtime
         self.created = created
@@ -3372,6 +3432,129 @@ class S3ImportJob():
         self.deleted = deleted
         return True
 
+    # -------------------------------------------------------------------------
+    def onimport(self):
+        """
+            Call the onimport-callbacks of all tables written by this
+            job, once per table with the IDs of all imported records,
+            so that expensive post-processing (e.g. geocoding) can be
+            done in bulk rather than per item
+        """
+
+        items = self.items
+
+        record_ids = {}
+        for item_id in items:
+            item = items[item_id]
+            if not item.id or not item.committed or \
+               item.unchanged or item.skip:
+                continue
+            if item.method not in (item.METHOD.CREATE, item.METHOD.UPDATE):
+                continue
+            tablename = item.tablename
+            if tablename in record_ids:
+                record_ids[tablename].append(item.id)
+            else:
+                record_ids[tablename] = [item.id]
+
+        get_config = current.s3db.get_config
+        for tablename, ids in record_ids.items():
+            onimport = get_config(tablename, "onimport")
+            if onimport:
+                callback(onimport, ids, tablename=tablename)
+        return
+
+    # -------------------------------------------------------------------------
+    def load_hashes(self):
+        """
+            Look up the stored content hashes of the existing records
+            for all items which have a content hash
+        """
+
+        items = self.items
+
+        record_ids = {}
+        for item_id in items:
+            item = items[item_id]
+            if item.hash and item.id:
+                tablename = item.tablename
+                if tablename in record_ids:
+                    record_ids[tablename].append(item.id)
+                else:
+                    record_ids[tablename] = [item.id]
+
+        hashes = self.hashes = {}
+        if not record_ids:
+            return
+
+        db = current.db
+        htable = current.s3db.s3_content_hash
+        for tablename, ids in record_ids.items():
+            query = (htable.tablename == tablename) & \
+                    (htable.record_id.belongs(ids))
+            rows = db(query).select(htable.record_id,
+                                    htable.hash,
+                                    htable.mtime,
+                                    )
+            for row in rows:
+                hashes[(tablename, row.record_id)] = (row.hash, row.mtime)
+        return
+
+    # -------------------------------------------------------------------------
+    def store_hashes(self):
+        """
+            Store the content hashes of all records written by this job,
+            together with their modification dates (which are read back
+            from the database, so that subsequent writes by onaccept
+            callbacks or reference updates are included)
+
+            @note: conflicts are not stored because their resolution
+                   depends on the time of the last synchronization
+        """
+
+        items = self.items
+
+        record_ids = {}
+        for item_id in items:
+            item = items[item_id]
+            if not item.hash or not item.id or \
+               not item.committed or item.unchanged or \
+               item.skip or item.conflict:
+                continue
+            tablename = item.tablename
+            if tablename in record_ids:
+                record_ids[tablename][item.id] = item.hash
+            else:
+                record_ids[tablename] = {item.id: item.hash}
+
+        if not record_ids:
+            return
+
+        db = current.db
+        s3db = current.s3db
+        htable = s3db.s3_content_hash
+        MTIME = current.xml.MTIME
+
+        for tablename, ids in record_ids.items():
+
+            table = s3db.table(tablename)
+            if not table or MTIME not in table.fields:
+                continue
+
+            query = (htable.tablename == tablename) & \
+                    (htable.record_id.belongs(ids.keys()))
+            db(query).delete()
+
+            rows = db(table._id.belongs(ids.keys())).select(table._id,
+                                                             table[MTIME],
+                                                             )
+            htable.bulk_insert([{"tablename": tablename,
+                                 "record_id": row[table._id],
+                                 "hash": ids[row[table._id]],
+                                 "mtime": row[MTIME],
+                                 } for row in rows])
+        return
+
     # -------------------------------------------------------------------------
     def __define_tables(self):
         """
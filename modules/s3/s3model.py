@@ -422,6 +422,155 @@ class S3Model(object):
                 [config[tn].pop(k, None) for k in keys]
         return
 
+    # -------------------------------------------------------------------------
+    # Table versions
+    # -------------------------------------------------------------------------
+    @classmethod
+    def table_version(cls, *tablenames):
+        """
+            Get the current versions of tables, to use as part of cache
+            keys (versions are incremented whenever a record in the table
+            is written, see table_updated)
+
+            @param tablenames: the tablenames
+            @return: a dict {tablename: version}
+        """
+
+        s3 = current.response.s3
+        versions = s3.table_versions
+        if versions is None:
+            versions = s3.table_versions = {}
+
+        lookup = [tn for tn in tablenames if tn not in versions]
+        if lookup:
+            vtable = cls.table("s3_table_version")
+            query = (vtable.tablename.belongs(lookup))
+            rows = current.db(query).select(vtable.tablename,
+                                            vtable.version)
+            for tn in lookup:
+                versions[tn] = 0
+            for row in rows:
+                versions[row.tablename] = row.version
+
+        return dict((tn, versions[tn]) for tn in tablenames)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def table_updated(cls, tablename):
+        """
+            Register a write to a table; the table version gets incremented
+            once per transaction, right before the commit (see
+            update_table_versions), so that concurrent writers do not
+            hold the lock of the version row for the whole request
+            - outside of HTTP requests (no commit hook), the version gets
+              incremented immediately with every write
+
+            @param tablename: the tablename
+        """
+
+        s3 = current.response.s3
+        updated = s3.table_updated
+        if updated is None:
+            updated = s3.table_updated = {}
+        if tablename in updated:
+            return
+        updated[tablename] = True
+
+        # Forget the previously read version
+        versions = s3.table_versions
+        if versions:
+            versions.pop(tablename, None)
+
+        response = current.response
+        if current.request.env.request_method is None:
+            # Not an HTTP request (scheduler, CLI), so no commit hook
+            # => update the version immediately
+            cls.update_table_versions()
+        elif not response.custom_commit:
+            response.custom_commit = cls.commit
+        return
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def update_table_versions(cls):
+        """
+            Increment the versions of all tables which have been written
+            since the last call; must be called before the commit, and
+            is called automatically by the commit hook (see commit)
+        """
+
+        s3 = current.response.s3
+        updated = s3.table_updated
+        if not updated:
+            return
+
+        # Forget the written tables, so that subsequent writes (i.e. in
+        # the next transaction) increment the versions again
+        s3.table_updated = None
+
+        db = current.db
+        vtable = cls.table("s3_table_version")
+        for tablename in sorted(updated):
+            query = (vtable.tablename == tablename)
+            if not db(query).update(version = vtable.version + 1):
+                vtable.insert(tablename = tablename, version = 1)
+        return
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def before_commit(cls, key, callback):
+        """
+            Register a callback to be run once right before the commit of
+            the current transaction, e.g. to write back data which have
+            been updated incrementally during the request
+
+            @param key: a key for the callback, only the first callback
+                        registered for the same key will be run
+            @param callback: the callback function (without arguments)
+        """
+
+        response = current.response
+        if current.request.env.request_method is None:
+            # Not an HTTP request (scheduler, CLI), so no commit hook
+            # => run the callback immediately
+            callback()
+            return
+
+        callbacks = response.s3.before_commit
+        if callbacks is None:
+            callbacks = response.s3.before_commit = []
+        if key not in [k for k, c in callbacks]:
+            callbacks.append((key, callback))
+        if not response.custom_commit:
+            response.custom_commit = cls.commit
+        return
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def commit(cls, adapter=None):
+        """
+            Commit hook for HTTP requests (response.custom_commit), runs
+            the callbacks registered with before_commit, updates the
+            table versions and then commits the transaction
+
+            @param adapter: the DAL adapter to commit (web2py calls the
+                            hook with the adapter), default: current.db
+        """
+
+        s3 = current.response.s3
+        callbacks = s3.before_commit
+        if callbacks:
+            s3.before_commit = None
+            for key, callback in callbacks:
+                callback()
+
+        cls.update_table_versions()
+        if adapter is not None:
+            adapter.commit()
+        else:
+            current.db.commit()
+        return
+
     # -------------------------------------------------------------------------
     @classmethod
     def onaccept(cls, table, record, method="create"):
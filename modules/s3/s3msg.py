@@ -41,10 +41,22 @@ __all__ = ("S3Msg",
 
 import base64
 import datetime
+import errno
+import hashlib
+import Queue
+import smtplib
+import socket
 import string
+import sys
+import threading
+import time
 import urllib
 import urllib2
 
+from email.header import Header
+from email.mime.text import MIMEText
+from email.utils import formatdate
+
 try:
     from cStringIO import StringIO    # Faster, where available
 except:
@@ -67,6 +79,7 @@ except ImportError:
 
 from gluon import current, redirect
 from gluon.html import *
+from gluon.storage import Storage
 
 from s3codec import S3Codec
 from s3crud import S3CRUD
@@ -449,8 +462,8 @@ class S3Msg(object):
             if len(rows) == 1:
                 lookup_org = False
                 row = rows.first()
-                outgoing_sms_handler = row["msg_channel.instance_type"]
-                channel_id = row["msg_sms_outbound_gateway.channel_id"]
+                default_channel = dict(outgoing_sms_handler = row["msg_channel.instance_type"],
+                                       channel_id = row["msg_sms_outbound_gateway.channel_id"])
             else:
                 lookup_org = True
                 org_branches = current.deployment_settings.get_org_branches()
@@ -462,6 +475,38 @@ class S3Msg(object):
                         dict(outgoing_sms_handler = row["msg_channel.instance_type"],
                              channel_id = row["msg_sms_outbound_gateway.channel_id"])
 
+            # Channel per organisation, looked up only once per batch
+            org_channels = {}
+
+            def get_channel(organisation_id):
+                """
+                    Helper method to find the SMS channel to send the
+                    messages of an organisation through
+
+                    @param organisation_id: the organisation_id
+                    @return: dict with outgoing_sms_handler and channel_id,
+                             or None if there is no suitable channel
+                """
+
+                if not lookup_org:
+                    return default_channel
+                if organisation_id in org_channels:
+                    return org_channels[organisation_id]
+                channel = channels.get(organisation_id)
+                if not channel and \
+                    org_branches:
+                    orgs = org_parents(organisation_id)
+                    for org in orgs:
+                        channel = channels.get(org)
+                        if channel:
+                            break
+                if not channel:
+                    # Look for an unrestricted channel
+                    channel = channels.get(None)
+                # None if there is no unrestricted channel & none which matches this Org
+                org_channels[organisation_id] = channel
+                return channel
+
         elif contact_method == "TWITTER":
             twitter_settings = self.get_twitter_api()
             if not twitter_settings:
@@ -486,62 +531,17 @@ class S3Msg(object):
                 @param message_id: the message_id
                 @param organisation_id: the organisation_id (for SMS)
                 @param contact_method: the contact method
+
+                @note: emails and SMS are sent in bulk (see send_email_batch
+                       and send_sms_batch)
             """
 
             # Get the recipient's contact info
-            table = s3db.pr_contact
-            query = (table.pe_id == pe_id) & \
-                    (table.contact_method == contact_method) & \
-                    (table.deleted == False)
-            contact_info = db(query).select(table.value,
-                                            orderby=table.priority,
-                                            limitby=(0, 1)).first()
+            address = contacts.get(pe_id)
+
             # Send the message
-            if contact_info:
-                address = contact_info.value
-                if contact_method == "EMAIL":
-                    return self.send_email(address,
-                                           subject,
-                                           message)
-                elif contact_method == "SMS":
-                    if lookup_org:
-                        channel = channels.get(organisation_id)
-                        if not channel and \
-                            org_branches:
-                            orgs = org_parents(organisation_id)
-                            for org in orgs:
-                                channel = channels.get(org)
-                                if channel:
-                                    break
-                        if not channel:
-                            # Look for an unrestricted channel
-                            channel = channels.get(None)
-                        if not channel:
-                            # We can't send this message as there is no unrestricted channel & none which matches this Org
-                            return False
-                        outgoing_sms_handler = channel["outgoing_sms_handler"]
-                        channel_id = channel["channel_id"]
-                    if outgoing_sms_handler == "msg_sms_webapi_channel":
-                        return self.send_sms_via_api(address,
-                                                     message,
-                                                     message_id,
-                                                     channel_id)
-                    elif outgoing_sms_handler == "msg_sms_smtp_channel":
-                        return self.send_sms_via_smtp(address,
-                                                      message,
-                                                      channel_id)
-                    elif outgoing_sms_handler == "msg_sms_modem_channel":
-                        return self.send_sms_via_modem(address,
-                                                       message,
-                                                       channel_id)
-                    elif outgoing_sms_handler == "msg_sms_tropo_channel":
-                        # NB This does not mean the message is sent
-                        return self.send_sms_via_tropo(outbox_id,
-                                                       message_id,
-                                                       address,
-                                                       message,
-                                                       channel_id)
-                elif contact_method == "TWITTER":
+            if address:
+                if contact_method == "TWITTER":
                     return self.send_tweet(message, address)
 
             return False
@@ -618,6 +618,22 @@ class S3Msg(object):
                                (ptable.deleted != True))
                      ]
 
+        # Look up the contact info of all individual recipients at once
+        ctable = s3db.pr_contact
+        pe_ids = set(row["msg_outbox.pe_id"] for row in rows
+                     if row["pr_pentity.instance_type"] == "pr_person")
+        query = (ctable.pe_id.belongs(pe_ids)) & \
+                (ctable.contact_method == contact_method) & \
+                (ctable.deleted == False)
+        contacts = {}
+        if pe_ids:
+            contact_info = db(query).select(ctable.pe_id,
+                                            ctable.value,
+                                            orderby=ctable.priority)
+            for contact in contact_info:
+                if contact.pe_id not in contacts:
+                    contacts[contact.pe_id] = contact.value
+
         # chainrun: used to fire process_outbox again,
         # when messages are sent to groups or organisations
         chainrun = False
@@ -625,6 +641,35 @@ class S3Msg(object):
         # Set a default for non-SMS
         organisation_id = None
 
+        def update_status(row, status):
+            """
+                Helper method to update the status of an outbox record,
+                and commit it right away, so that the message is not sent
+                again if processing fails later
+
+                @param row: the msg_outbox Row
+                @param status: True if sent, False if failed, None if not
+                               sent due to the daily limit (try again later),
+                               "invalid" for unsupported recipients
+            """
+
+            query = (outbox.id == row.id)
+            if status == "invalid":
+                db(query).update(status = 4) # Invalid
+            elif status:
+                db(query).update(status = 2) # Sent
+            elif status is None:
+                return
+            elif row.retries > 0:
+                db(query).update(retries = outbox.retries - 1)
+            elif row.retries is not None:
+                db(query).update(status = 5) # Failed
+            db.commit()
+
+        # Emails and SMS to send in bulk
+        emails = []
+        sms = []
+
         for row in rows:
 
             status = True
@@ -699,31 +744,52 @@ class S3Msg(object):
                 status = True
 
             elif entity_type == "pr_person":
-                # Send the message to this person
-                try:
-                    status = dispatch_to_pe_id(pe_id,
-                                               subject,
-                                               message,
-                                               row.id,
-                                               message_id,
-                                               organisation_id)
-                except:
+                if contact_method == "EMAIL":
+                    # Send later, together with all other emails
+                    address = contacts.get(pe_id)
+                    if address:
+                        emails.append((row, address, subject, message))
+                        continue
+                    status = False
+                elif contact_method == "SMS":
+                    # Send later, together with all other SMS
+                    address = contacts.get(pe_id)
+                    channel = get_channel(organisation_id) if address else None
+                    if channel:
+                        sms.append((row, address, message, channel))
+                        continue
                     status = False
+                else:
+                    # Send the message to this person
+                    try:
+                        status = dispatch_to_pe_id(pe_id,
+                                                   subject,
+                                                   message,
+                                                   row.id,
+                                                   message_id,
+                                                   organisation_id)
+                    except:
+                        status = False
             else:
                 # Unsupported entity type
-                row.update_record(status = 4) # Invalid
-                db.commit()
-                continue
+                status = "invalid"
 
-            if status:
-                row.update_record(status = 2) # Sent
-                db.commit()
-            else:
-                if row.retries > 0:
-                    row.update_record(retries = row.retries - 1)
-                    db.commit()
-                elif row.retries is not None:
-                    row.update_record(status = 5) # Failed
+            update_status(row, status)
+
+        # Send emails and SMS in bulk, updating the outbox as they are sent
+        if emails:
+            self.send_email_batch([email[1:] for email in emails],
+                                  callback = lambda index, status: \
+                                             update_status(emails[index][0], status))
+        if sms:
+            self.send_sms_batch([(address,
+                                  message,
+                                  row.message_id,
+                                  row.id,
+                                  channel,
+                                  ) for row, address, message, channel in sms],
+                                callback = lambda index, status: \
+                                           update_status(sms[index][0], status))
 
         if chainrun:
             self.process_outbox(contact_method)
@@ -744,15 +810,33 @@ class S3Msg(object):
                    sender=None,
                    encoding="utf-8",
                    #from_address=None,
+                   connection=None,
+                   limit=True,
                    ):
         """
             Function to send Email
             - simple Wrapper over Web2Py's Email API
+
+            @param connection: an open S3SMTPConnection to send the email
+                               through (requires sender, and supports
+                               neither attachments nor cc/bcc), the daily
+                               limit is not checked in this case
+            @param limit: check the daily limit (settings.mail.limit)
         """
 
         if not to:
             return False
 
+        if connection is not None:
+            # Can be called from a worker thread, so no access to current
+            return connection.send(to,
+                                   subject,
+                                   message,
+                                   sender,
+                                   reply_to=reply_to,
+                                   encoding=encoding,
+                                   )
+
         settings = current.deployment_settings
 
         default_sender = settings.get_mail_sender()
@@ -763,7 +847,7 @@ class S3Msg(object):
         if not sender:
             sender = default_sender
 
-        limit = settings.get_mail_limit()
+        limit = settings.get_mail_limit() if limit else None
         if limit:
             # Check whether we've reached our daily limit
             day = datetime.timedelta(hours=24)
@@ -796,6 +880,115 @@ class S3Msg(object):
 
         return result
 
+    # -------------------------------------------------------------------------
+    def send_email_batch(self, emails, callback=None):
+        """
+            Send multiple emails at once, through persistent SMTP connections
+            in concurrent threads (settings.msg.outbox_workers)
+
+            @param emails: list of tuples (to, subject, message)
+            @param callback: function to call with (index, status) for each
+                             email as soon as it has been sent (called in
+                             this thread, so it can write to the database)
+
+            @return: list of status for each email: True if sent, False
+                     if failed, None if not sent due to the daily limit
+
+            @note: the connections use the web2py Mail settings (server,
+                   login, TLS/SSL, hostname, timeout); signed or encrypted
+                   emails are sent one by one through web2py Mail
+        """
+
+        db = current.db
+        settings = current.deployment_settings
+        mail_settings = current.mail.settings
+
+        results = [None] * len(emails)
+
+        sender = mail_settings.sender or settings.get_mail_sender()
+        if not sender:
+            current.log.warning("Email sending disabled until the Sender address has been set in models/000_config.py")
+            return results
+
+        # Check the daily limit once for the whole batch
+        limit = settings.get_mail_limit()
+        if limit:
+            table = current.s3db.msg_channel_limit
+            cutoff = current.request.utcnow - datetime.timedelta(hours=24)
+            # @ToDo: Include Channel Info
+            count = db(table.created_on > cutoff).count()
+            pending = range(min(len(emails), max(0, limit - count)))
+        else:
+            pending = range(len(emails))
+        if not pending:
+            return results
+
+        def done(index, status):
+            results[index] = status
+            if limit and status is not None:
+                # Log the sending
+                table.insert()
+            if callback:
+                callback(index, status)
+
+        if mail_settings.server in ("logging", "gae") or \
+           mail_settings.cipher_type:
+            # Not an SMTP server, or signed/encrypted emails
+            # => send one by one via web2py Mail
+            for index in pending:
+                to, subject, message = emails[index]
+                try:
+                    status = self.send_email(to,
+                                             subject,
+                                             message,
+                                             sender=sender,
+                                             limit=False,
+                                             )
+                except:
+                    status = False
+                done(index, status)
+        else:
+            lock = threading.Lock()
+            queue = list(reversed(pending))
+            finished = Queue.Queue()
+            send_email = self.send_email
+
+            def worker():
+                # No access to current.db & co in this thread
+                connection = S3SMTPConnection(mail_settings)
+                try:
+                    while True:
+                        with lock:
+                            if not queue:
+                                return
+                            index = queue.pop()
+                        to, subject, message = emails[index]
+                        try:
+                            status = send_email(to,
+                                                subject,
+                                                message,
+                                                sender=sender,
+                                                connection=connection,
+                                                )
+                        except:
+                            status = False
+                        finished.put((index, status))
+                finally:
+                    connection.close()
+
+            threads = settings.get_msg_outbox_workers() or 1
+            workers = [threading.Thread(target=worker)
+                       for i in xrange(max(1, min(threads, len(pending))))]
+            for thread in workers:
+                thread.start()
+            # Process the results as they come in
+            for i in xrange(len(pending)):
+                done(*finished.get())
+            for thread in workers:
+                thread.join()
+
+        return results
+
     # -------------------------------------------------------------------------
     def send_email_by_pe_id(self,
                             pe_id,
@@ -924,6 +1117,30 @@ class S3Msg(object):
         if not sms_api:
             return False
 
+        request = self._sms_api_request(sms_api, mobile, text)
+        if request is None:
+            return False
+
+        success, output = self._sms_api_post(*request)
+        if not success:
+            current.log.error("SMS message send failed: %s" % output)
+            return False
+
+        return self._sms_api_result(sms_api, output, message_id)
+
+    # -------------------------------------------------------------------------
+    def _sms_api_request(self, sms_api, mobile, text):
+        """
+            Construct the request to send an SMS via Web API
+
+            @param sms_api: the msg_sms_webapi_channel record
+            @param mobile: the recipient's phone number
+            @param text: the message text
+
+            @return: tuple (urllib2.Request, POST data), or None if the
+                     message can not be sent through this channel
+        """
+
         post_data = {}
 
         parts = sms_api.parameters.split("&")
@@ -953,7 +1170,7 @@ class S3Msg(object):
             text_len = len(text)
             if text_len > 480:
                 current.log.error("Clickatell messages cannot exceed 480 chars")
-                return False
+                return None
             elif text_len > 320:
                 post_data["concat"] = 3
             elif text_len > 160:
@@ -965,31 +1182,284 @@ class S3Msg(object):
             # e.g. Mobile Commons
             base64string = base64.encodestring("%s:%s" % (sms_api.username, sms_api.password)).replace("\n", "")
             request.add_header("Authorization", "Basic %s" % base64string)
-        try:
-            result = urllib2.urlopen(request, query)
-        except urllib2.HTTPError, e:
-            current.log.error("SMS message send failed: %s" % e)
-            return False
-        else:
-            # Parse result
-            output = result.read()
-            if clickatell:
-                if output.startswith("ERR"):
-                    current.log.error("Clickatell message send failed: %s" % output)
-                    return False
-                elif message_id and output.startswith("ID"):
-                    # Store ID from Clickatell to be able to followup
-                    remote_id = output[4:]
-                    db(s3db.msg_sms.message_id == message_id).update(remote_id=remote_id)
-            elif "mcommons" in url:
-                # http://www.mobilecommons.com/mobile-commons-api/rest/#errors
-                # Good = <response success="true"></response>
-                # Bad = <response success="false"><errror id="id" message="message"></response>
-                if "error" in output:
-                    current.log.error("Mobile Commons message send failed: %s" % output)
-                    return False
 
-            return True
+        return request, query
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _sms_api_post(request, query, retries=0, timeout=30):
+        """
+            Send a request to an SMS Web API, retrying with exponential
+            backoff if the gateway has not accepted the request
+
+            @param request: the urllib2.Request
+            @param query: the POST data
+            @param retries: the maximum number of retries
+            @param timeout: the timeout for each attempt (seconds)
+
+            @return: tuple (success, output or error message)
+
+            @note: only retries if the connection has been refused, or if
+                   the gateway has explicitly rejected the request as
+                   overloaded (HTTP 429/503) - after timeouts and other
+                   errors the message may have been sent nonetheless
+            @note: does not use current, so can be used in worker threads
+        """
+
+        error = None
+        for attempt in xrange(retries + 1):
+            if attempt:
+                time.sleep(2 ** (attempt - 1))
+            try:
+                result = urllib2.urlopen(request, query, timeout)
+                output = result.read()
+            except urllib2.HTTPError, e:
+                error = e
+                if e.code not in (429, 503):
+                    break
+            except urllib2.URLError, e:
+                error = e
+                reason = e.reason
+                if not isinstance(reason, socket.error) or \
+                   reason.errno != errno.ECONNREFUSED:
+                    break
+            except IOError, e:
+                error = e
+                break
+            else:
+                return True, output
+        return False, str(error)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _sms_api_result(sms_api, output, message_id=None):
+        """
+            Parse the response of an SMS Web API
+
+            @param sms_api: the msg_sms_webapi_channel record
+            @param output: the response body
+            @param message_id: the message_id (to store the remote ID)
+
+            @return: True if the message has been accepted, otherwise False
+        """
+
+        url = sms_api.url
+        if "clickatell" in url:
+            if output.startswith("ERR"):
+                current.log.error("Clickatell message send failed: %s" % output)
+                return False
+            elif message_id and output.startswith("ID"):
+                # Store ID from Clickatell to be able to followup
+                remote_id = output[4:]
+                s3db = current.s3db
+                current.db(s3db.msg_sms.message_id == message_id).update(remote_id=remote_id)
+        elif "mcommons" in url:
+            # http://www.mobilecommons.com/mobile-commons-api/rest/#errors
+            # Good = <response success="true"></response>
+            # Bad = <response success="false"><errror id="id" message="message"></response>
+            if "error" in output:
+                current.log.error("Mobile Commons message send failed: %s" % output)
+                return False
+
+        return True
+
+    # -------------------------------------------------------------------------
+    def send_sms_batch(self, messages, callback=None):
+        """
+            Send multiple SMS at once:
+                - through Web API channels concurrently (settings.msg.sms_workers
+                  requests per channel), rate-limited (settings.msg.sms_rate)
+                  and with retries if the gateway has not accepted the request
+                  (settings.msg.sms_retries)
+                - through SMTP channels in bulk (see send_email_batch)
+                - through all other channels one by one
+
+            @param messages: list of tuples (mobile, text, message_id,
+                             outbox_id, channel), where channel is a dict
+                             with outgoing_sms_handler and channel_id
+            @param callback: function to call with (index, status) for each
+                             message as soon as it has been sent (called in
+                             this thread, so it can write to the database)
+
+            @return: list of status for each message: True if sent, False
+                     if failed, None if not sent due to the daily limit
+
+            @note: the throughput of each Web API channel is recorded in
+                   its channel status, and logged (info)
+        """
+
+        db = current.db
+        s3db = current.s3db
+        settings = current.deployment_settings
+
+        results = [False] * len(messages)
+
+        reported = set()
+        def done(index, status):
+            results[index] = status
+            reported.add(index)
+            if callback:
+                callback(index, status)
+
+        # Group the messages by channel
+        webapi = {}
+        smtp = {}
+        for index, message in enumerate(messages):
+            mobile, text, message_id, outbox_id, channel = message
+            handler = channel["outgoing_sms_handler"]
+            channel_id = channel["channel_id"]
+            if handler == "msg_sms_webapi_channel":
+                webapi.setdefault(channel_id, []).append(index)
+                continue
+            elif handler == "msg_sms_smtp_channel":
+                smtp.setdefault(channel_id, []).append(index)
+                continue
+            status = False
+            try:
+                if handler == "msg_sms_modem_channel":
+                    status = self.send_sms_via_modem(mobile,
+                                                     text,
+                                                     channel_id)
+                elif handler == "msg_sms_tropo_channel":
+                    # NB This does not mean the message is sent
+                    status = self.send_sms_via_tropo(outbox_id,
+                                                     message_id,
+                                                     mobile,
+                                                     text,
+                                                     channel_id = channel_id)
+            except:
+                status = False
+            done(index, status)
+
+        # SMTP channels
+        if smtp:
+            table = s3db.msg_sms_smtp_channel
+            rows = db(table.channel_id.belongs(smtp.keys())).select(table.channel_id,
+                                                                    table.address,
+                                                                    )
+            for row in rows:
+                indexes = smtp[row.channel_id]
+                emails = []
+                for index in indexes:
+                    mobile = self.sanitise_phone(messages[index][0])
+                    emails.append(("%s@%s" % (mobile, row.address),
+                                   "",
+                                   messages[index][1],
+                                   ))
+                statuses = self.send_email_batch(emails,
+                                                 callback = lambda i, status, indexes=indexes: \
+                                                            done(indexes[i], status))
+                for index, status in zip(indexes, statuses):
+                    if index not in reported:
+                        # Not sent due to the daily limit
+                        done(index, status)
+
+        # Web API channels
+        if webapi:
+            table = s3db.msg_sms_webapi_channel
+            rows = db(table.channel_id.belongs(webapi.keys())).select()
+
+            rates = settings.get_msg_sms_rate()
+            workers = settings.get_msg_sms_workers() or 1
+            retries = settings.get_msg_sms_retries() or 0
+
+            post = self._sms_api_post
+            requests = {}
+            finished = Queue.Queue()
+
+            def worker(channel):
+                # No access to current.db & co in this thread
+                while True:
+                    with channel["lock"]:
+                        queue = channel["queue"]
+                        if not queue:
+                            # The last worker to finish ends the channel
+                            channel["workers"] -= 1
+                            if not channel["workers"]:
+                                channel["end"] = time.time()
+                            return
+                        index = queue.pop()
+                        # Wait for the next free slot of this channel
+                        now = time.time()
+                        slot = max(now, channel["next"])
+                        channel["next"] = slot + channel["interval"]
+                    if slot > now:
+                        time.sleep(slot - now)
+                    try:
+                        output = post(*requests[index], retries = retries)
+                    except:
+                        output = (False, str(sys.exc_info()[1]))
+                    finished.put((channel, index, output))
+
+            channels = []
+            for row in rows:
+                pending = []
+                for index in webapi[row.channel_id]:
+                    mobile, text = messages[index][:2]
+                    request = self._sms_api_request(row, mobile, text)
+                    if request is not None:
+                        requests[index] = request
+                        pending.append(index)
+                if not pending:
+                    continue
+                if isinstance(rates, dict):
+                    rate = rates.get(row.name, rates.get(None))
+                else:
+                    rate = rates
+                channels.append({"sms_api": row,
+                                 "pending": pending,
+                                 "queue": list(reversed(pending)),
+                                 "lock": threading.Lock(),
+                                 "interval": 1.0 / rate if rate else 0,
+                                 "next": 0,
+                                 "start": time.time(),
+                                 "end": None,
+                                 "sent": 0,
+                                 })
+
+            threads = []
+            for channel in channels:
+                channel["workers"] = max(1, min(workers, len(channel["pending"])))
+                for i in xrange(channel["workers"]):
+                    threads.append(threading.Thread(target=worker,
+                                                    args=(channel,)))
+            for thread in threads:
+                thread.start()
+
+            # Process the responses as they come in
+            for i in xrange(sum(len(channel["pending"]) for channel in channels)):
+                channel, index, (success, output) = finished.get()
+                if success:
+                    status = self._sms_api_result(channel["sms_api"],
+                                                  output,
+                                                  messages[index][2])
+                else:
+                    current.log.error("SMS message send failed: %s" % output)
+                    status = False
+                if status:
+                    channel["sent"] += 1
+                done(index, status)
+
+            for thread in threads:
+                thread.join()
+
+            for channel in channels:
+                sms_api = channel["sms_api"]
+
+                # Record the throughput
+                total = len(channel["pending"])
+                duration = max(channel["end"] - channel["start"], 0.001)
+                status = "Sent %s of %s messages at %.1f/s" % \
+                         (channel["sent"], total, total / duration)
+                current.log.info("SMS channel %s: %s" % (sms_api.channel_id, status))
+                self.update_channel_status(sms_api.channel_id, status)
+
+        # Messages which could not be sent through any channel
+        for index in xrange(len(messages)):
+            if index not in reported:
+                done(index, results[index])
+
+        return results
 
     # -------------------------------------------------------------------------
     def send_sms_via_modem(self, mobile, text="", channel_id=None):
@@ -1351,6 +1821,35 @@ class S3Msg(object):
         result = fn(channel_id)
         return result
 
+    # -------------------------------------------------------------------------
+    def poll_all(self, tablename):
+        """
+            Poll all enabled Channels of a type for New Messages
+            (see settings.msg.poll_all)
+
+            @param tablename: the channel tablename
+            @return: dict {channel_id: result}
+        """
+
+        if tablename == "msg_rss_channel":
+            # Fetch the feeds concurrently
+            return self.poll_rss_all()
+
+        table = current.s3db.table(tablename)
+        if not table or "enabled" not in table.fields:
+            error = "Unsupported Channel: %s" % tablename
+            current.log.error(error)
+            return error
+
+        query = (table.enabled == True) & \
+                (table.deleted != True)
+        rows = current.db(query).select(table.channel_id)
+
+        results = {}
+        for row in rows:
+            results[row.channel_id] = self.poll(tablename, row.channel_id)
+        return results
+
     # -------------------------------------------------------------------------
     @staticmethod
     def poll_email(channel_id):
@@ -1386,6 +1885,8 @@ class S3Msg(object):
                                    table.use_ssl,
                                    table.port,
                                    table.delete_from_server,
+                                   table.uid_validity,
+                                   table.last_uid,
                                    limitby=(0, 1)).first()
         if not channel:
             return "No Such Email Channel: %s" % channel_id
@@ -1563,23 +2064,50 @@ class S3Msg(object):
 
             # Select inbox
             M.select()
+
+            # Only download messages with UIDs above the watermark
+            # (UIDs are only valid as long as UIDVALIDITY is unchanged)
+            typ, data = M.response("UIDVALIDITY")
+            try:
+                uid_validity = int(data[0])
+            except (TypeError, ValueError, IndexError):
+                uid_validity = None
+            last_uid = channel.last_uid
+            if uid_validity is None or \
+               uid_validity != channel.uid_validity:
+                last_uid = None
+            if last_uid:
+                criteria = "UID %s:*" % (last_uid + 1)
+            else:
+                criteria = "ALL"
+
             # Search for Messages to Download
-            typ, data = M.search(None, "ALL")
-            mblist = data[0].split()
-            for number in mblist:
-                typ, msg_data = M.fetch(number, "(RFC822)")
+            typ, data = M.uid("search", None, criteria)
+            uids = [int(uid) for uid in data[0].split()]
+            if last_uid:
+                # n:* always includes the latest message, even if its
+                # UID is lower than n
+                uids = [uid for uid in uids if uid > last_uid]
+            for uid in uids:
+                typ, msg_data = M.uid("fetch", str(uid), "(RFC822)")
                 for response_part in msg_data:
                     if isinstance(response_part, tuple):
                         parse_email(response_part[1])
                         if delete:
                             # Add it to the list of messages to delete later
-                            dellist.append(number)
+                            dellist.append(uid)
             # Iterate over the list of messages to delete
-            for number in dellist:
-                typ, response = M.store(number, "+FLAGS", r"(\Deleted)")
+            for uid in dellist:
+                typ, response = M.uid("store", str(uid), "+FLAGS", r"(\Deleted)")
             M.close()
             M.logout()
 
+            # Update the watermark
+            if uids:
+                last_uid = max(uids)
+            db(query).update(uid_validity = uid_validity,
+                             last_uid = last_uid)
+
     # -------------------------------------------------------------------------
     @staticmethod
     def poll_mcommons(channel_id):
@@ -1751,28 +2279,137 @@ class S3Msg(object):
             Fetches all new messages from a subscribed RSS Feed
         """
 
-        db = current.db
-        s3db = current.s3db
-        table = s3db.msg_rss_channel
+        table = current.s3db.msg_rss_channel
         query = (table.channel_id == channel_id)
-        channel = db(query).select(table.date,
-                                   table.etag,
-                                   table.url,
-                                   limitby=(0, 1)).first()
+        channel = current.db(query).select(table.date,
+                                           table.etag,
+                                           table.url,
+                                           limitby=(0, 1)).first()
         if not channel:
             return "No Such RSS Channel: %s" % channel_id
 
+        feed = S3Msg._fetch_rss(channel.url, channel.etag, channel.date)
+        return S3Msg._store_rss(channel_id, feed)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def poll_rss_all(channel_ids=None):
+        """
+            Fetches all new messages from multiple RSS Feeds, fetching
+            the feeds concurrently (settings.msg.poll_workers)
+
+            @param channel_ids: the channel IDs (default: all enabled)
+            @return: dict {channel_id: result}
+        """
+
+        db = current.db
+        table = current.s3db.msg_rss_channel
+
+        if channel_ids is None:
+            query = (table.enabled == True)
+        else:
+            query = (table.channel_id.belongs(channel_ids))
+        query &= (table.deleted != True)
+        channels = db(query).select(table.channel_id,
+                                    table.date,
+                                    table.etag,
+                                    table.url,
+                                    ).as_list()
+        if not channels:
+            return {}
+
+        threads = current.deployment_settings.get_msg_poll_workers() or 1
+
+        lock = threading.Lock()
+        queue = list(channels)
+        fetch = S3Msg._fetch_rss
+        feeds = {}
+
+        def worker():
+            # No access to current.db & co in this thread
+            while True:
+                with lock:
+                    if not queue:
+                        return
+                    channel = queue.pop()
+                try:
+                    feed = fetch(channel["url"],
+                                 channel["etag"],
+                                 channel["date"],
+                                 )
+                except:
+                    feed = sys.exc_info()[1]
+                feeds[channel["channel_id"]] = feed
+
+        workers = [threading.Thread(target=worker)
+                   for i in xrange(max(1, min(threads, len(channels))))]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+        results = {}
+        for channel in channels:
+            channel_id = channel["channel_id"]
+            feed = feeds[channel_id]
+            if isinstance(feed, Exception):
+                error = "Fetch failed: %s" % feed
+                current.log.error(error)
+                S3Msg.update_channel_status(channel_id, status=error)
+                results[channel_id] = error
+            else:
+                results[channel_id] = S3Msg._store_rss(channel_id, feed)
+        return results
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _fetch_rss(url, etag=None, modified=None):
+        """
+            Fetch and parse an RSS Feed, with conditional request if
+            it has been fetched before
+
+            @param url: the feed URL
+            @param etag: the ETag from the last fetch
+            @param modified: the time of the last fetch (datetime, UTC)
+
+            @return: the feedparser result
+
+            @note: does not use current, so can be used in worker threads
+        """
+
         # http://pythonhosted.org/feedparser
         import feedparser
-        if channel.etag:
-            # http://pythonhosted.org/feedparser/http-etag.html
-            # NB This won't help for a server like Drupal 7 set to not allow caching & hence generating a new ETag/Last Modified each request!
-            d = feedparser.parse(channel.url, etag=channel.etag)
-        elif channel.date:
-            d = feedparser.parse(channel.url, modified=channel.date.utctimetuple())
-        else:
-            # We've not polled this feed before
-            d = feedparser.parse(channel.url)
+
+        # http://pythonhosted.org/feedparser/http-etag.html
+        # NB This won't help for a server like Drupal 7 set to not allow caching & hence generating a new ETag/Last Modified each request!
+        kwargs = {}
+        if etag:
+            kwargs["etag"] = etag
+        if modified:
+            kwargs["modified"] = modified.utctimetuple()
+        return feedparser.parse(url, **kwargs)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _store_rss(channel_id, d):
+        """
+            Store the new or updated entries of a fetched RSS Feed
+
+            @param channel_id: the channel ID
+            @param d: the feedparser result
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        table = s3db.msg_rss_channel
+        query = (table.channel_id == channel_id)
+
+        now = current.request.utcnow
+        if d.get("status") == 304:
+            # Not modified since the last fetch
+            db(query).update(date=now)
+            return "OK"
 
         if d.bozo:
             # Something doesn't seem right
@@ -1782,7 +2419,6 @@ class S3Msg(object):
             return
 
         # Update ETag/Last-polled
-        now = current.request.utcnow
         data = dict(date=now)
         etag = d.get("etag", None)
         if etag:
@@ -1807,19 +2443,59 @@ class S3Msg(object):
             pinsert = ptable.insert
 
         entries = d.entries
-        if entries:
-            # Check how many we have already to see if any are new
-            count_old = db(mtable.id > 0).count()
+        if not entries:
+            return "OK"
+
+        # Hash all entries
+        hashes = []
         for entry in entries:
+            content = entry.get("content", None)
+            item = (entry.get("link", None),
+                    entry.get("title", None),
+                    content[0].value if content else entry.get("description", None),
+                    entry.get("author", None),
+                    entry.get("published", entry.get("updated", None)),
+                    [t.term for t in entry.get("tags", None) or []],
+                    entry.get("geo_lat", None),
+                    entry.get("geo_long", None),
+                    entry.get("georss_point", None),
+                    )
+            hashes.append(hashlib.md5(json.dumps(item, default=s3_unicode)).hexdigest())
+
+        # Look up all previously stored entries at once
+        # (ETag just saves bandwidth, doesn't filter the contents of the feed)
+        links = set(entry.get("link", None) for entry in entries)
+        links.discard(None)
+        query = (mtable.channel_id == channel_id) & \
+                (mtable.content_hash.belongs(hashes))
+        if links:
+            query |= (mtable.from_address.belongs(links))
+        rows = db(query).select(mtable.id,
+                                mtable.channel_id,
+                                mtable.location_id,
+                                mtable.message_id,
+                                mtable.from_address,
+                                mtable.content_hash,
+                                )
+        by_link = {}
+        unchanged = set()
+        for row in rows:
+            if row.from_address:
+                by_link[row.from_address] = row
+            if row.channel_id == channel_id:
+                unchanged.add(row.content_hash)
+
+        new = 0
+        for entry, content_hash in zip(entries, hashes):
+
+            if content_hash in unchanged:
+                # Already stored, and not modified since
+                continue
+
             link = entry.get("link", None)
 
             # Check for duplicates
-            # (ETag just saves bandwidth, doesn't filter the contents of the feed)
-            exists = db(mtable.from_address == link).select(mtable.id,
-                                                            mtable.location_id,
-                                                            mtable.message_id,
-                                                            limitby=(0, 1)
-                                                            ).first()
+            exists = by_link.get(link) if link else None
             if exists:
                 location_id = exists.location_id
             else:
@@ -1860,12 +2536,12 @@ class S3Msg(object):
                 try:
                     query = (gtable.lat == lat) &\
                             (gtable.lon == lon)
-                    exists = db(query).select(gtable.id,
-                                              limitby=(0, 1),
-                                              orderby=gtable.level,
-                                              ).first()
-                    if exists:
-                        location_id = exists.id
+                    location = db(query).select(gtable.id,
+                                                limitby=(0, 1),
+                                                orderby=gtable.level,
+                                                ).first()
+                    if location:
+                        location_id = location.id
                     else:
                         data = dict(lat=lat,
                                     lon=lon,
@@ -1895,6 +2571,7 @@ class S3Msg(object):
                                                   date = date_published,
                                                   location_id = location_id,
                                                   tags = tags,
+                                                  content_hash = content_hash,
                                                   # @ToDo: Enclosures
                                                   )
                 if parser:
@@ -1910,6 +2587,7 @@ class S3Msg(object):
                               date = date_published,
                               location_id = location_id,
                               tags = tags,
+                              content_hash = content_hash,
                               # @ToDo: Enclosures
                               )
                 record = dict(id=_id)
@@ -1917,16 +2595,19 @@ class S3Msg(object):
                 if parser:
                     pinsert(message_id = record["message_id"],
                             channel_id = channel_id)
-
-        if entries:
-            # Check again to see if there were any new ones
-            count_new = db(mtable.id > 0).count()
-            if count_new == count_old:
-                # No new posts?
-                # Back-off in-case the site isn't respecting ETags/Last-Modified
-                S3Msg.update_channel_status(channel_id,
-                                            status="+1",
-                                            period=(300, 3600))
+                new += 1
+                if link:
+                    by_link[link] = Storage(id = _id,
+                                            location_id = location_id,
+                                            message_id = record["message_id"],
+                                            )
+
+        if not new:
+            # No new posts?
+            # Back-off in-case the site isn't respecting ETags/Last-Modified
+            S3Msg.update_channel_status(channel_id,
+                                        status="+1",
+                                        period=(300, 3600))
 
         return "OK"
 
@@ -2211,6 +2892,120 @@ class S3Msg(object):
         else:
             return hashdef["defs"]["def"]["text"]
 
+# =============================================================================
+class S3SMTPConnection(object):
+    """
+        Persistent connection to an SMTP server, to send multiple emails
+        without re-connecting for each of them (see S3Msg.send_email_batch)
+
+        @note: not thread-safe, use a separate connection in each thread;
+               does not use current, so can be used in worker threads
+    """
+
+    def __init__(self, settings):
+        """
+            Constructor
+
+            @param settings: the web2py Mail settings (current.mail.settings)
+        """
+
+        self.server = settings.server
+        self.login = settings.login
+        self.tls = settings.tls
+        self.ssl = settings.ssl
+        self.hostname = settings.hostname
+        self.timeout = settings.timeout
+
+        self.smtp = None
+        self.error = None
+
+    # -------------------------------------------------------------------------
+    def connect(self):
+        """ Connect to the server (unless connected already) """
+
+        if self.smtp is not None:
+            return
+
+        args = self.server.split(":")
+        kwargs = {}
+        if self.timeout:
+            kwargs["timeout"] = self.timeout
+        if self.ssl:
+            smtp = smtplib.SMTP_SSL(*args, **kwargs)
+        else:
+            smtp = smtplib.SMTP(*args, **kwargs)
+        if self.tls and not self.ssl:
+            smtp.ehlo(self.hostname)
+            smtp.starttls()
+            smtp.ehlo(self.hostname)
+        if self.login:
+            smtp.login(*self.login.split(":", 1))
+        self.smtp = smtp
+
+    # -------------------------------------------------------------------------
+    def close(self):
+        """ Close the connection """
+
+        smtp = self.smtp
+        if smtp is not None:
+            self.smtp = None
+            try:
+                smtp.quit()
+            except:
+                pass
+
+    # -------------------------------------------------------------------------
+    def send(self, to, subject, message, sender, reply_to=None, encoding="utf-8"):
+        """
+            Send an email
+
+            @param to: the recipient address
+            @param subject: the subject
+            @param message: the message body (HTML if enclosed in
+                            <html></html>, otherwise plain text)
+            @param sender: the sender address
+            @param reply_to: the reply-to address
+            @param encoding: the character encoding
+
+            @return: True if successful, otherwise False (see self.error)
+        """
+
+        body = s3_unicode(message)
+        stripped = body.strip()
+        if stripped.startswith("<html") and stripped.endswith("</html>"):
+            subtype = "html"
+        else:
+            subtype = "plain"
+
+        payload = MIMEText(body.encode(encoding), subtype, encoding)
+        payload["Subject"] = Header(s3_unicode(subject), encoding)
+        payload["From"] = sender
+        payload["To"] = to
+        if reply_to:
+            payload["Reply-To"] = reply_to
+        payload["Date"] = formatdate()
+        payload = payload.as_string()
+
+        # Re-connect once if the server has closed the connection
+        for attempt in (0, 1):
+            try:
+                self.connect()
+                self.smtp.sendmail(sender, [to], payload)
+            except smtplib.SMTPServerDisconnected:
+                self.smtp = None
+                if not attempt:
+                    continue
+                self.error = str(sys.exc_info()[1])
+                return False
+            except:
+                self.error = str(sys.exc_info()[1])
+                self.close()
+                return False
+            break
+
+        self.error = None
+        return True
+
 # =============================================================================
 class S3Compose(S3CRUD):
     """ RESTful method for messaging """
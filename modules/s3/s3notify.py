@@ -67,6 +67,10 @@ else:
 class S3Notifications(object):
     """ Framework to send notifications about subscribed events """
 
+    # Minimum batch window (seconds), the period of the
+    # notify_check_subscriptions task
+    BATCH_WINDOW = 300
+
     # -------------------------------------------------------------------------
     @classmethod
     def check_subscriptions(cls):
@@ -81,13 +85,36 @@ class S3Notifications(object):
 
         subscriptions = cls._subscriptions(now)
         if subscriptions:
-            async = current.s3task.async
+            db = current.db
+            rtable = db.pr_subscription_resource
+
+            # In batch mode, subscriptions with the same resource, URL,
+            # filter and last check time window are handled in the same task
+            batch = current.deployment_settings.get_msg_notify_batch()
+            tasks = {}
             for row in subscriptions:
+                r = row.pr_subscription_resource
+                if batch:
+                    key = (r.resource, r.url, row.pr_filter.query,
+                           cls._batch_time(r.last_check_time,
+                                           row.pr_subscription.frequency))
+                else:
+                    key = r.id
+                if key in tasks:
+                    tasks[key].append(r.id)
+                else:
+                    tasks[key] = [r.id]
+
+            async = current.s3task.async
+            for resource_ids in tasks.values():
                 # Create asynchronous notification task.
-                row.update_record(locked=True)
-                async("notify_notify", args=[row.id])
+                db(rtable.id.belongs(resource_ids)).update(locked=True)
+                if batch:
+                    async("notify_notify", args=[resource_ids])
+                else:
+                    async("notify_notify", args=resource_ids)
             message = "%s notifications scheduled." % len(subscriptions)
-            current.db.commit()
+            db.commit()
         else:
             message = "No notifications to schedule."
 
@@ -103,9 +130,14 @@ class S3Notifications(object):
             controller which extracts the data and renders and sends
             the notification message (see send()).
 
-            @param resource_id: the pr_subscription_resource record ID
+            @param resource_id: the pr_subscription_resource record ID,
+                                or a list of record IDs to notify them
+                                in-process (see notify_batch())
         """
 
+        if isinstance(resource_id, (list, tuple)):
+            return cls.notify_batch(resource_id)
+
         _debug("S3Notifications.notify(resource_id=%s)" % resource_id)
 
         db = current.db
@@ -130,7 +162,9 @@ class S3Notifications(object):
                                                   rtable.resource,
                                                   rtable.url,
                                                   rtable.last_check_time,
+                                                  ftable.id,
                                                   ftable.query,
+                                                  ftable.serialized,
                                                   join=join,
                                                   left=left).first()
         if not row:
@@ -157,32 +191,11 @@ class S3Notifications(object):
         # Break up the URL into its components
         purl = list(urlparse.urlparse(lookup_url))
 
-        # Subscription parameters
+        # Subscription parameters and filters
         last_check_time = current.xml.encode_iso_datetime(r.last_check_time)
         query = {"subscription": auth_token, "format": "msg"}
-        if "upd" in s.notify_on:
-            query["~.modified_on__ge"] = last_check_time
-        else:
-            query["~.created_on__ge"] = last_check_time
-
-        # Filters
-        if f.query:
-            from s3filter import S3FilterString
-            resource = s3db.resource(r.resource)
-            fstring = S3FilterString(resource, f.query)
-            for k, v in fstring.get_vars.iteritems():
-                if v is not None:
-                    if k in query:
-                        value = query[k]
-                        if type(value) is list:
-                            value.append(v)
-                        else:
-                            query[k] = [value, v]
-                    else:
-                        query[k] = v
-            query_nice = s3_unicode(fstring.represent())
-        else:
-            query_nice = None
+        lookup_vars, query_nice = cls._lookup_vars(s, r, f)
+        query.update(lookup_vars)
 
         # Add subscription parameters and filters to the URL query, and
         # put the URL back together
@@ -286,6 +299,322 @@ class S3Notifications(object):
         if not auth.s3_logged_in() or auth.user.pe_id != pe_id:
             r.unauthorised()
 
+        # Extract the data
+        data = cls._select(resource)
+        if data is None:
+            return json_message(message="No records found")
+
+        # Render and send the message(s)
+        success, errors = cls._deliver(resource, data, subscription)
+
+        # Done
+        if errors:
+            message = ", ".join(errors)
+        else:
+            message = "Success"
+        return json_message(success=success,
+                            statuscode=200 if success else 403,
+                            message=message)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def notify_batch(cls, resource_ids):
+        """
+            Asynchronous task to notify a batch of subscribers about
+            updates in-process: the updates are looked up only once for
+            all subscriptions with the same resource, URL, filter, last
+            check time window, language and permissions, and then rendered
+            and sent to each of their subscribers.
+
+            @param resource_ids: list of pr_subscription_resource record IDs
+
+            @note: the lookup uses the resource customisation, but not
+                   the controller pre-processing (unlike notify()), see
+                   settings.msg.notify_batch
+        """
+
+        _debug("S3Notifications.notify_batch(resource_ids=%s)" % resource_ids)
+
+        db = current.db
+        s3db = current.s3db
+        auth = current.auth
+
+        stable = s3db.pr_subscription
+        rtable = db.pr_subscription_resource
+        ftable = s3db.pr_filter
+        utable = s3db.pr_person_user
+
+        # Extract the subscription data
+        join = stable.on(rtable.subscription_id == stable.id)
+        left = [ftable.on(ftable.id == stable.filter_id),
+                utable.on(utable.pe_id == stable.pe_id),
+                ]
+        rows = db(rtable.id.belongs(resource_ids)).select(stable.id,
+                                                          stable.pe_id,
+                                                          stable.frequency,
+                                                          stable.notify_on,
+                                                          stable.method,
+                                                          stable.email_format,
+                                                          rtable.id,
+                                                          rtable.resource,
+                                                          rtable.url,
+                                                          rtable.last_check_time,
+                                                          ftable.id,
+                                                          ftable.query,
+                                                          ftable.serialized,
+                                                          utable.user_id,
+                                                          join=join,
+                                                          left=left)
+
+        # Group the subscriptions by lookup
+        groups = {}
+        failed = []
+        seen = set()
+        for row in rows:
+            r = row.pr_subscription_resource
+            if r.id in seen:
+                continue
+            seen.add(r.id)
+            s = row.pr_subscription
+            f = row.pr_filter
+            user_id = row.pr_person_user.user_id
+            table = s3db.table(r.resource)
+            if not user_id or table is None:
+                # Subscriber must be a user
+                failed.append(r)
+                continue
+            try:
+                auth.s3_impersonate(user_id)
+            except ValueError:
+                failed.append(r)
+                continue
+            key = (r.resource,
+                   r.url,
+                   f.query,
+                   cls._batch_time(r.last_check_time, s.frequency),
+                   tuple(sorted(s.notify_on or [])),
+                   current.T.accepted_language,
+                   str(auth.s3_accessible_query("read", table)),
+                   )
+            if key in groups:
+                groups[key].append((s, r, f, user_id))
+            else:
+                groups[key] = [(s, r, f, user_id)]
+
+        intervals = s3db.pr_subscription_check_intervals
+        xml = current.xml
+        sent = 0
+        for subscriptions in groups.values():
+
+            # Look up the updates as the first subscriber, since the
+            # earliest last check time in the group (so that no updates
+            # are missed for any of the subscriptions)
+            s, r, f, user_id = subscriptions[0]
+            times = [subscription[1].last_check_time
+                     for subscription in subscriptions]
+            r.last_check_time = None if None in times else min(times)
+            auth.s3_impersonate(user_id)
+
+            # The new last check time for all subscriptions in the group
+            # (taken before the lookup, so that no updates are missed,
+            # and shared, so that they remain in the same group)
+            now = datetime.datetime.utcnow()
+            try:
+                resource, filter_query = cls._lookup(s, r, f)
+                data = cls._select(resource)
+            except:
+                exc_info = sys.exc_info()[:2]
+                current.log.error("Notification lookup failed: %s: %s" %
+                                  (exc_info[0].__name__, exc_info[1]))
+                failed.extend(subscription[1] for subscription in subscriptions)
+                continue
+
+            public_url = current.deployment_settings.get_base_public_url()
+            page_url = "%s/%s/%s" % (public_url,
+                                     current.request.application,
+                                     r.url.lstrip("/"))
+            last_check_time = xml.encode_iso_datetime(r.last_check_time)
+
+            # Render and send the messages, re-using the rendered contents
+            contents = {}
+            for s, r, f, user_id in subscriptions:
+                if data is None or not s.notify_on or not s.method:
+                    # Nothing to send
+                    success = True
+                else:
+                    subscription = {"pe_id": s.pe_id,
+                                    "notify_on": s.notify_on,
+                                    "method": s.method,
+                                    "email_format": s.email_format,
+                                    "resource": r.resource,
+                                    "last_check_time": last_check_time,
+                                    "filter_query": filter_query,
+                                    "page_url": page_url,
+                                    "item_url": None,
+                                    }
+                    success, errors = cls._deliver(resource, data,
+                                                   subscription,
+                                                   contents=contents)
+                    if errors:
+                        _debug(", ".join(errors))
+
+                # Update time stamps and unlock
+                if success:
+                    sent += 1
+                    interval = intervals.get(s.frequency, 0)
+                    next_check_time = now + \
+                                      datetime.timedelta(minutes=interval)
+                    r.update_record(auth_token=None,
+                                    locked=False,
+                                    last_check_time=now,
+                                    next_check_time=next_check_time)
+                else:
+                    r.update_record(auth_token=None,
+                                    locked=False)
+            db.commit()
+
+        # Unlock failed subscriptions (will be retried next time)
+        for r in failed:
+            r.update_record(auth_token=None, locked=False)
+        db.commit()
+
+        message = "%s of %s subscriptions notified in %s lookups." % \
+                  (sent, len(seen), len(groups))
+        _debug(message)
+        return message
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def _batch_time(cls, last_check_time, frequency):
+        """
+            Get the start of the batch window of the last check time of
+            a subscription, to group subscriptions for batch notification;
+            the window is the check interval of the subscription (but at
+            least the scheduler period)
+
+            @param last_check_time: the last check time (datetime)
+            @param frequency: the notification frequency of the subscription
+        """
+
+        if last_check_time is None:
+            return None
+
+        intervals = current.s3db.pr_subscription_check_intervals
+        window = max(intervals.get(frequency, 0) * 60, cls.BATCH_WINDOW)
+
+        epoch = datetime.datetime(1970, 1, 1)
+        delta = last_check_time - epoch
+        seconds = delta.days * 86400 + delta.seconds
+        return epoch + datetime.timedelta(seconds=seconds - seconds % window)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _lookup_vars(s, r, f):
+        """
+            Get the URL query for the updates lookup of a subscription
+
+            @param s: the pr_subscription Row
+            @param r: the pr_subscription_resource Row
+            @param f: the pr_filter Row
+
+            @return: tuple (vars, filter_query), with filter_query
+                     being a human-readable representation of the
+                     subscription filter
+        """
+
+        last_check_time = current.xml.encode_iso_datetime(r.last_check_time)
+        query = {}
+        if "upd" in s.notify_on:
+            query["~.modified_on__ge"] = last_check_time
+        else:
+            query["~.created_on__ge"] = last_check_time
+
+        # Filters
+        if f.query:
+            from s3filter import S3FilterString
+            resource = current.s3db.resource(r.resource)
+            fstring = S3FilterString(resource, f.query,
+                                     serialized=f.serialized)
+            if not fstring.compiled:
+                # Outdated or not yet compiled => compile now
+                ftable = current.s3db.pr_filter
+                current.db(ftable.id == f.id).update(
+                                        serialized=fstring.serialize())
+            for k, v in fstring.get_vars.iteritems():
+                if v is not None:
+                    if k in query:
+                        value = query[k]
+                        if type(value) is list:
+                            value.append(v)
+                        else:
+                            query[k] = [value, v]
+                    else:
+                        query[k] = v
+            query_nice = s3_unicode(fstring.represent())
+        else:
+            query_nice = None
+
+        return query, query_nice
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def _lookup(cls, s, r, f):
+        """
+            Construct the resource for an in-process updates lookup,
+            with the URL query of the subscribed page, the subscription
+            filter and the resource customisation
+
+            @param s: the pr_subscription Row
+            @param r: the pr_subscription_resource Row
+            @param f: the pr_filter Row
+
+            @return: tuple (resource, filter_query)
+        """
+
+        url = r.url
+        path = [p for p in urlparse.urlparse(url).path.split("/") if p]
+        if len(path) < 2:
+            raise SyntaxError("Invalid subscription URL: %s" % url)
+        controller, function = path[0], path[1].split(".", 1)[0]
+
+        from s3query import S3URLQuery
+        get_vars = S3URLQuery.parse_url(url)
+        lookup_vars, filter_query = cls._lookup_vars(s, r, f)
+        for k, v in lookup_vars.items():
+            if k in get_vars:
+                value = get_vars[k]
+                if type(value) is not list:
+                    value = [value]
+                get_vars[k] = value + (v if type(v) is list else [v])
+            else:
+                get_vars[k] = v
+        get_vars["format"] = "msg"
+
+        from s3rest import S3Request
+        prefix, name = r.resource.split("_", 1)
+        current.response.s3.filter = None
+        request = S3Request(prefix=prefix,
+                            name=name,
+                            c=controller,
+                            f=function,
+                            args=[],
+                            vars=get_vars,
+                            http="GET")
+        request.customise_resource()
+
+        return request.resource, filter_query
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _select(resource):
+        """
+            Extract the updates for a notification
+
+            @param resource: the S3Resource (filtered for the updates)
+            @return: the data as returned from S3Resource.select, or
+                     None if there are no updates
+        """
+
         # Fields to extract
         fields = resource.list_fields(key="notify_fields")
         if "created_on" not in fields:
@@ -295,14 +624,35 @@ class S3Notifications(object):
         data = resource.select(fields,
                                represent=True,
                                raw_data=True)
-        rows = data["rows"]
 
         # How many records do we have?
-        numrows = len(rows)
-        if not numrows:
-            return json_message(message="No records found")
+        if not len(data["rows"]):
+            return None
+        return data
 
-        #_debug("%s rows:" % numrows)
+    # -------------------------------------------------------------------------
+    @classmethod
+    def _deliver(cls, resource, data, subscription, contents=None):
+        """
+            Render the notification message(s) for a subscription and
+            send them to the subscriber
+
+            @param resource: the S3Resource
+            @param data: the data returned from S3Resource.select
+            @param subscription: the subscription data (dict)
+            @param contents: dict to cache the rendered contents in, to
+                             re-use them for other subscribers of the
+                             same updates
+
+            @return: tuple (success, errors)
+        """
+
+        notify_on = subscription["notify_on"]
+        methods = subscription["method"]
+        pe_id = subscription["pe_id"]
+
+        rows = data["rows"]
+        numrows = len(rows)
 
         # Prepare meta-data
         get_config = resource.get_config
@@ -342,13 +692,14 @@ class S3Notifications(object):
         if not renderer:
             renderer = cls._render
 
-        contents = {}
+        if contents is None:
+            contents = {}
         if email_format == "html" and "EMAIL" in methods:
-            contents["html"] = renderer(resource, data, meta_data, "html")
-            contents["default"] = contents["html"]
+            if "html" not in contents:
+                contents["html"] = renderer(resource, data, meta_data, "html")
         if email_format != "html" or "EMAIL" not in methods or len(methods) > 1:
-            contents["text"] = renderer(resource, data, meta_data, "text")
-            contents["default"] = contents["text"]
+            if "text" not in contents:
+                contents["text"] = renderer(resource, data, meta_data, "text")
         
         # Subject line
         subject = get_config("notify_subject")
@@ -398,7 +749,7 @@ class S3Notifications(object):
                 path = join("views", "msg")
                 template = get_template(path, filenames)
             if template is None:
-                template = StringIO(T("New updates are available."))
+                template = StringIO(current.T("New updates are available."))
 
             # Select contents format
             if method == "EMAIL" and email_format == "html":
@@ -440,14 +791,7 @@ class S3Notifications(object):
                 if error:
                     errors.append(error)
 
-        # Done
-        if errors:
-            message = ", ".join(errors)
-        else:
-            message = "Success"
-        return json_message(success=success,
-                            statuscode=200 if success else 403,
-                            message=message)
+        return success, errors
 
     # -------------------------------------------------------------------------
     @classmethod
@@ -457,7 +801,7 @@ class S3Notifications(object):
             notified now.
 
             @param now: current datetime (UTC)
-            @return: joined Rows pr_subscription/pr_subscription_resource,
+            @return: joined Rows pr_subscription_resource/pr_filter,
                      or None if no due subscriptions could be found
 
             @todo: take notify_on into account when checking
@@ -524,7 +868,15 @@ class S3Notifications(object):
                     ((rtable.next_check_time == None) | \
                      (rtable.next_check_time <= now)) & \
                     query
-            return db(query).select(rtable.id, join=join)
+            left = ftable.on(ftable.id == stable.filter_id)
+            return db(query).select(stable.frequency,
+                                    rtable.id,
+                                    rtable.resource,
+                                    rtable.url,
+                                    rtable.last_check_time,
+                                    ftable.query,
+                                    join=join,
+                                    left=left)
         else:
             return None
 
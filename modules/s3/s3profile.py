@@ -62,6 +62,9 @@ class S3Profile(S3CRUD):
             @param attr: controller attributes for the request
         """
 
+        # Context queries, shared by the widgets of this request
+        self.contexts = {}
+
         if r.http in ("GET", "POST", "DELETE"):
             if r.record:
                 output = self.profile(r, **attr)
@@ -125,21 +128,31 @@ class S3Profile(S3CRUD):
                 else:
                     # @ToDo: Check permissions to the Resource & do
                     # something different if no permission
-                    datalist = self._datalist(r, widgets[index], **attr)
+                    widget = widgets[index]
+                    render = lambda: self._datalist(r, widget, **attr)
+                    resource, tablenames = self._widget_resource(r, widget)
+                    datalist = self._cached_widget(r, index, render,
+                                                   tablenames=tablenames,
+                                                   resource=resource)
             output["item"] = datalist
 
         elif r.representation == "aadata":
-            # Ajax-update of one datalist
+            # Ajax-update of one datatable
             index = r.get_vars.get("update", None)
             if index:
                 try:
                     index = int(index)
                 except ValueError:
-                    datalist = ""
+                    datatable = ""
                 else:
                     # @ToDo: Check permissions to the Resource & do
                     # something different if no permission
-                    datatable = self._datatable(r, widgets[index], **attr)
+                    widget = widgets[index]
+                    render = lambda: self._datatable(r, widget, **attr)
+                    resource, tablenames = self._widget_resource(r, widget)
+                    datatable = self._cached_widget(r, index, render,
+                                                    tablenames=tablenames,
+                                                    resource=resource)
             return datatable
 
         else:
@@ -199,19 +212,55 @@ class S3Profile(S3CRUD):
         return output
 
     # -------------------------------------------------------------------------
-    @staticmethod
-    def _resolve_context(r, tablename, context):
+    def _widget_resource(self, r, widget):
+        """
+            Get the resource of a widget (with context and widget filter)
+            and the names of all tables the widget reads from, to cache
+            the widget output (see S3Method._cached_widget)
+
+            @param r: the S3Request
+            @param widget: the widget definition as dict
+
+            @return: tuple (resource, tablenames)
+        """
+
+        tablename = widget.get("tablename", None)
+        resource, context = self._resolve_context(r,
+                                                  tablename,
+                                                  widget.get("context", None))
+        widget_filter = widget.get("filter", None)
+        if widget_filter:
+            resource.add_filter(widget_filter)
+
+        list_fields = widget.get("list_fields",
+                                 resource.get_config("list_fields", None))
+        return resource, self._widget_tablenames(resource, list_fields)
+
+    # -------------------------------------------------------------------------
+    def _resolve_context(self, r, tablename, context):
         """
             Resolve a context filter
 
             @param context: the context (as a string)
             @param id: the record_id
+
+            @note: the context query is resolved only once per request
+                   and shared by all widgets with the same table and
+                   context, each widget gets its own resource though
+                   (since it adds its own filters)
         """
 
         record_id = r.id
         if not record_id:
             return None
 
+        contexts = self.contexts
+        key = (tablename, context)
+        if key in contexts:
+            query = contexts[key]
+            resource = current.s3db.resource(tablename, filter=query)
+            return resource, query
+
         if not context:
             query = None
 
@@ -238,6 +287,8 @@ class S3Profile(S3CRUD):
             s = "(%s)" % context
             query = (FS(s) == record_id)
 
+        contexts[key] = query
+
         # Define target resource
         resource = current.s3db.resource(tablename, filter=query)
         return resource, query
@@ -1111,6 +1111,9 @@ class S3ResourceQuery(object):
         self.left = left
         self.right = right
 
+        # Resolved hierarchies for TYPEOF, {str(field): tuple}
+        self._hierarchies = {}
+
     # -------------------------------------------------------------------------
     def __and__(self, other):
         """ AND """
@@ -1171,6 +1174,12 @@ class S3ResourceQuery(object):
                 distinct = rfield.distinct
                 if distinct and left or not distinct and not left:
                     joins = rfield._joins
+                if op == self.TYPEOF and left and rfield.field is not None:
+                    # Left join for range queries over the node intervals
+                    ijoins = self._typeof_join(rfield.field, r)
+                    if ijoins:
+                        joins = dict(joins)
+                        joins.update(ijoins)
 
         return (joins, distinct)
         
@@ -1272,12 +1281,40 @@ class S3ResourceQuery(object):
     # -------------------------------------------------------------------------
     def transform(self, resource):
         """
-            Placeholder for transformation method
+            Transform this query for faster execution, i.e. add lookups
+            in the full-text index to LIKE-queries on indexed fields
 
             @param resource: the S3Resource
+            @return: the transformed S3ResourceQuery
         """
 
-        # @todo: implement
+        op = self.op
+        l = self.left
+        r = self.right
+
+        if op == self.AND:
+            if isinstance(l, S3ResourceQuery):
+                l = l.transform(resource)
+            if isinstance(r, S3ResourceQuery):
+                r = r.transform(resource)
+            return S3ResourceQuery(op, l, r)
+
+        elif op in (self.OR, self.LIKE):
+            if op == self.OR and self.split(resource)[1] is not None:
+                # Contains virtual filters, can't be transformed
+                return self
+            from s3fulltext import S3FullText
+            prefilter = S3FullText.prefilter(resource, self)
+            if prefilter is not None:
+                # Keep self as left operand, so that split() works
+                return S3ResourceQuery(self.AND, self, prefilter)
+            elif op == self.OR:
+                if isinstance(l, S3ResourceQuery):
+                    l = l.transform(resource)
+                if isinstance(r, S3ResourceQuery):
+                    r = r.transform(resource)
+                return S3ResourceQuery(op, l, r)
+
         return self
 
     # -------------------------------------------------------------------------
@@ -1431,7 +1468,7 @@ class S3ResourceQuery(object):
             @param r: the right operator
         """
 
-        hierarchy, field, nodeset, none = self._resolve_hierarchy(l, r)
+        hierarchy, field, nodeset, none = self._typeof_hierarchy(l, r)
         if not hierarchy:
             # Not a hierarchical query => use simple belongs
             return self._query_belongs(l, r)
@@ -1445,7 +1482,10 @@ class S3ResourceQuery(object):
             if list_type:
                 q = (field.contains(list(nodeset)))
             elif len(nodeset) > 1:
-                q = (field.belongs(nodeset))
+                # Range query over the node intervals if possible
+                q = None if none else hierarchy.range_query(field, nodeset)
+                if q is None:
+                    q = (field.belongs(nodeset))
             else:
                 q = (field == tuple(nodeset)[0])
         else:
@@ -1464,6 +1504,41 @@ class S3ResourceQuery(object):
 
         return q
 
+    # -------------------------------------------------------------------------
+    def _typeof_hierarchy(self, l, r):
+        """
+            Resolve the hierarchical lookup in a typeof-query, once
+            per field (see _resolve_hierarchy)
+
+            @param l: the left operator
+            @param r: the right operator
+        """
+
+        key = str(l)
+        hierarchies = self._hierarchies
+        if key not in hierarchies:
+            hierarchies[key] = self._resolve_hierarchy(l, r)
+        return hierarchies[key]
+
+    # -------------------------------------------------------------------------
+    def _typeof_join(self, l, r):
+        """
+            Get the left join with the node intervals for a typeof-query
+            which can be resolved as range query (see S3Hierarchy.range_join)
+
+            @param l: the left operator
+            @param r: the right operator
+
+            @return: dict {alias: [join]}, or None
+        """
+
+        hierarchy, field, nodeset, none = self._typeof_hierarchy(l, r)
+        if not hierarchy or not field or none or \
+           not nodeset or len(nodeset) < 2 or \
+           str(field.type)[:5] == "list:":
+            return None
+        return hierarchy.range_join(field, nodeset)
+
     # -------------------------------------------------------------------------
     @classmethod
     def _resolve_hierarchy(cls, l, r):
@@ -1472,6 +1547,10 @@ class S3ResourceQuery(object):
 
             @param l: the left operator
             @param r: the right operator
+
+            @return: tuple (hierarchy, field, nodeset, none), hierarchy
+                     being the S3Hierarchy instance, or False if this
+                     is not a hierarchical query
         """
         
         from s3hierarchy import S3Hierarchy
@@ -1518,7 +1597,7 @@ class S3ResourceQuery(object):
                     subquery = None
                 if not subquery:
                     # Field doesn't exist
-                    return True, None, None, None
+                    return hierarchy, None, None, None
 
                 # Execute query and retrieve the lookup table IDs
                 DELETED = current.xml.DELETED
@@ -1554,7 +1633,7 @@ class S3ResourceQuery(object):
         elif keys is None:
             none = True
 
-        return True, field, nodeset, none
+        return hierarchy, field, nodeset, none
 
     # -------------------------------------------------------------------------
     @staticmethod
@@ -1953,6 +2032,73 @@ class S3ResourceQuery(object):
             _serialize(l.name, op, r, False)
         return url_query
 
+    # -------------------------------------------------------------------------
+    def serialize(self):
+        """
+            Serialize this query as a JSON-serializable tree, e.g. to
+            store a compiled query (inverse of deserialize)
+
+            @return: nested lists like [op, left, right] (or [op, left]
+                     for NOT), with field selectors as dicts like
+                     {"field": name, "op": op}
+        """
+
+        op = self.op
+        l = self.left
+        r = self.right
+
+        if op in (self.AND, self.OR):
+            if not isinstance(l, S3ResourceQuery) or \
+               not isinstance(r, S3ResourceQuery):
+                raise SyntaxError("Can not serialize DAL queries")
+            return [op, l.serialize(), r.serialize()]
+        elif op == self.NOT:
+            return [op, l.serialize()]
+
+        def operand(value):
+            if isinstance(value, S3FieldSelector):
+                return {"field": value.name, "op": value.op}
+            elif isinstance(value, (list, tuple)):
+                return [operand(v) for v in value]
+            elif value is None or \
+                 isinstance(value, (basestring, bool, int, long, float)):
+                return value
+            else:
+                raise SyntaxError("Can not serialize %s" % type(value))
+
+        return [op, operand(l), operand(r)]
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def deserialize(cls, data):
+        """
+            Construct a query from its serialized form (see serialize)
+
+            @param data: the serialized query
+            @return: the S3ResourceQuery
+        """
+
+        op = data[0]
+        if op in (cls.AND, cls.OR):
+            return cls(op, cls.deserialize(data[1]), cls.deserialize(data[2]))
+        elif op == cls.NOT:
+            return cls(op, cls.deserialize(data[1]))
+
+        def operand(value):
+            if isinstance(value, dict):
+                selector = S3FieldSelector(value["field"])
+                selector.op = value.get("op")
+                return selector
+            elif isinstance(value, list):
+                return [operand(v) for v in value]
+            elif isinstance(value, unicode):
+                # Same as URL-parsed values
+                return value.encode("utf-8")
+            else:
+                return value
+
+        return cls(op, operand(data[1]), operand(data[2]))
+
     # -------------------------------------------------------------------------
     def _or(self):
         """
@@ -1678,7 +1678,9 @@ class S3Resource(object):
                    as_json=False,
                    maxbounds=False,
                    filters=None,
+                   orderby=None,
                    pretty_print=False,
+                   content_hash=False,
                    **args):
         """
             Export this resource as S3XML
@@ -1699,7 +1701,10 @@ class S3Resource(object):
             @param as_json: represent the XML tree as JSON
             @param filters: additional URL filters (Sync), as dict
                             {tablename: {url_var: string}}
+            @param orderby: the order of the master records (slicing),
+                            default: modification date if msince
             @param pretty_print: insert newlines/indentation in the output
+            @param content_hash: add content hashes to the elements (Sync)
             @param args: dict of arguments to pass to the XSLT stylesheet
         """
 
@@ -1725,8 +1730,10 @@ class S3Resource(object):
                                 rcomponents=rcomponents,
                                 references=references,
                                 filters=filters,
+                                orderby=orderby,
                                 maxbounds=maxbounds,
-                                xmlformat=xmlformat)
+                                xmlformat=xmlformat,
+                                content_hash=content_hash)
         #if DEBUG:
             #end = datetime.datetime.now()
             #duration = end - _start
@@ -1786,8 +1793,10 @@ class S3Resource(object):
                     mcomponents=None,
                     rcomponents=None,
                     filters=None,
+                    orderby=None,
                     maxbounds=False,
-                    xmlformat=None):
+                    xmlformat=None,
+                    content_hash=False):
         """
             Export the resource as element tree
 
@@ -1805,8 +1814,12 @@ class S3Resource(object):
                                 for all
             @param filters: additional URL filters (Sync), as dict
                             {tablename: {url_var: string}}
+            @param orderby: the order of the master records (slicing),
+                            default: modification date if msince
             @param maxbounds: include lat/lon boundaries in the top
                               level element (off by default)
+            @param xmlformat: the S3XMLFormat of the export
+            @param content_hash: add content hashes to the elements (Sync)
         """
 
         xml = current.xml
@@ -1832,15 +1845,29 @@ class S3Resource(object):
             queries = S3URLQuery.parse(self, filters[tablename])
             [self.add_filter(q) for a in queries for q in queries[a]]
 
+        # Pre-select records which have been modified since msince, or
+        # any of their components (so that chunked exports do not page
+        # through unmodified records), plus those with components
+        # deleted since according to the change-log
+        if msince is not None and "modified_on" in table.fields:
+            query = self.__modified_since(msince, mcomponents)
+            from s3changelog import S3ChangeLog
+            if S3ChangeLog.covers(msince):
+                cursor = S3ChangeLog.cursor(msince)
+                master_ids = S3ChangeLog.masters(self, cursor,
+                                                 ops=("delete",))
+                if master_ids:
+                    query |= (table._id.belongs(master_ids))
+            self.add_filter(query)
+
         # Initialize export metadata
         self.muntil = None
         self.results = 0
 
         # Load slice
-        if msince is not None and "modified_on" in table.fields:
+        if orderby is None and \
+           msince is not None and "modified_on" in table.fields:
             orderby = "%s ASC" % table["modified_on"]
-        else:
-            orderby = None
 
         # Fields to load
         if xmlformat:
@@ -1925,7 +1952,8 @@ class S3Resource(object):
                                       filters=filters,
                                       msince=msince,
                                       location_data=location_data,
-                                      xmlformat=xmlformat)
+                                      xmlformat=xmlformat,
+                                      content_hash=content_hash)
             if element is None:
                 results -= 1
 
@@ -2023,7 +2051,8 @@ class S3Resource(object):
                                               filters=filters,
                                               master=False,
                                               location_data=location_data,
-                                              xmlformat=xmlformat)
+                                              xmlformat=xmlformat,
+                                              content_hash=content_hash)
 
                     # Mark as referenced element (for XSLT)
                     if element is not None:
@@ -2062,6 +2091,44 @@ class S3Resource(object):
 
         return tree
 
+    # -------------------------------------------------------------------------
+    def __modified_since(self, msince, components=None):
+        """
+            Get a query for the master records which have been modified
+            since a particular time, or any of their components (i.e. the
+            records to export, see __export_resource)
+
+            @param msince: the time (datetime, UTC)
+            @param components: list of tablenames of the components to
+                               include, empty list for all, None for none
+
+            @return: the Query
+        """
+
+        db = current.db
+        table = self.table
+
+        query = (table.modified_on > msince)
+        if components is None:
+            return query
+
+        for component in self.components.values():
+            if components and component.tablename not in components:
+                continue
+            # Link table components are exported with the link records
+            if component.linktable is not None:
+                ctable = component.linktable
+                fkey = component.lkey
+            else:
+                ctable = component.table
+                fkey = component.fkey
+            if "modified_on" not in ctable.fields:
+                continue
+            subselect = db(ctable.modified_on > msince)._select(ctable[fkey])
+            query |= (table[component.pkey].belongs(subselect))
+
+        return query
+
     # -------------------------------------------------------------------------
     def __export_resource(self,
                           record,
@@ -2077,7 +2144,8 @@ class S3Resource(object):
                           msince=None,
                           master=True,
                           location_data=None,
-                          xmlformat=None):
+                          xmlformat=None,
+                          content_hash=False):
         """
             Add a <resource> to the element tree
 
@@ -2095,6 +2163,8 @@ class S3Resource(object):
             @param msince: the minimum update datetime for exported records
             @param master: True of this is the master resource
             @param location_data: the location_data for GIS encoding
+            @param xmlformat: the S3XMLFormat of the export
+            @param content_hash: add content hashes to the elements (Sync)
         """
 
         xml = current.xml
@@ -2119,7 +2189,8 @@ class S3Resource(object):
                                url=record_url,
                                msince=msince,
                                master=master,
-                               location_data=location_data)
+                               location_data=location_data,
+                               content_hash=content_hash)
                                
         if element is not None:
             add = True
@@ -2218,7 +2289,8 @@ class S3Resource(object):
                                              url=crecord_url,
                                              msince=msince,
                                              master=False,
-                                             location_data=location_data)
+                                             location_data=location_data,
+                                             content_hash=content_hash)
                     if celement is not None:
                         add = True # keep the parent record
 
@@ -2252,7 +2324,8 @@ class S3Resource(object):
                        url=None,
                        msince=None,
                        master=True,
-                       location_data=None):
+                       location_data=None,
+                       content_hash=False):
         """
             Exports a single record to the element tree.
 
@@ -2265,6 +2338,8 @@ class S3Resource(object):
             @param msince: minimum last update time
             @param master: True if this is a record in the master resource
             @param location_data: the location_data for GIS encoding
+            @param content_hash: add the content hash to the element (for
+                                 change detection by the importer, Sync)
         """
 
         xml = current.xml
@@ -2326,6 +2401,11 @@ class S3Resource(object):
                                url=url,
                                postprocess=postprocess)
 
+        # Add the content hash (for change detection by the importer)
+        if content_hash:
+            element.set(xml.ATTRIBUTE.hash,
+                        xml.record_hash(table, record, dfields, rmap))
+
         # Add the references
         xml.add_references(element, rmap,
                            show_ids=current.xml.show_ids, lazy=lazy)
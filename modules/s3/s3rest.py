@@ -33,6 +33,7 @@ __all__ = ("S3Request",
            )
 
 import datetime
+import hashlib
 import os
 import re
 import sys
@@ -61,9 +62,10 @@ from gluon import *
 from gluon.storage import Storage
 
 from s3resource import S3Resource
-from s3utils import s3_get_extension, s3_remove_last_record_id, s3_store_last_record_id
+from s3utils import s3_get_extension, s3_get_foreign_key, s3_remove_last_record_id, s3_store_last_record_id, s3_unicode
 
 REGEX_FILTER = re.compile(".+\..+|.*\(.+\).*")
+REGEX_SECHO = re.compile('"sEcho":\s*[0-9]+')
 
 DEBUG = False
 if DEBUG:
@@ -193,6 +195,11 @@ class S3Request(object):
         else:
             cnames = None
 
+        # Snap map layer bboxes to the tile grid (for the layer cache)
+        if self.representation == "geojson" and \
+           "layer" in get_vars and "bbox" in get_vars:
+            get_vars["bbox"] = current.gis.quantize_bbox(get_vars["bbox"])
+
         # Append component ID to the URL query
         component_name = self.component_name
         component_id = self.component_id
@@ -906,24 +913,49 @@ class S3Request(object):
         headers["Content-Type"] = s3.content_type.get(representation,
                                                       default)
 
+        # Cached Feature Layer data
+        layer_cache = None
+        if representation == "geojson" and "layer" in _vars:
+            layer_cache = current.gis.get_layer_cache(r)
+            if layer_cache is not None:
+                etag, filename = layer_cache
+                headers["ETag"] = etag
+                if current.request.env.http_if_none_match == etag:
+                    raise HTTP(304, **headers)
+                output = current.gis.read_layer_cache(filename)
+                if output is not None:
+                    return output
+
+        # Server-side clustering of large Feature Layers
+        output = None
+        if representation == "geojson" and "cluster" in _vars:
+            gis = current.gis
+            output = gis.get_clusters(r.resource,
+                                      zoom = gis.get_cluster_zoom(_vars),
+                                      layer_id = _vars.get("layer"))
+
         # Export the resource
-        output = r.resource.export_xml(start=start,
-                                       limit=limit,
-                                       msince=msince,
-                                       fields=fields,
-                                       dereference=True,
-                                       # maxdepth in args
-                                       references=references,
-                                       mcomponents=mcomponents,
-                                       rcomponents=rcomponents,
-                                       stylesheet=stylesheet,
-                                       as_json=as_json,
-                                       maxbounds=maxbounds,
-                                       **args)
+        if output is None:
+            output = r.resource.export_xml(start=start,
+                                           limit=limit,
+                                           msince=msince,
+                                           fields=fields,
+                                           dereference=True,
+                                           # maxdepth in args
+                                           references=references,
+                                           mcomponents=mcomponents,
+                                           rcomponents=rcomponents,
+                                           stylesheet=stylesheet,
+                                           as_json=as_json,
+                                           maxbounds=maxbounds,
+                                           **args)
         # Transformation error?
         if not output:
             r.error(400, "XSLT Transformation Error: %s " % current.xml.error)
 
+        if layer_cache is not None:
+            current.gis.put_layer_cache(layer_cache[1], output)
+
         return output
 
     # -------------------------------------------------------------------------
@@ -1958,6 +1990,172 @@ class S3Method(object):
         return Storage((k, v) for k, v in vars.iteritems()
                               if not REGEX_FILTER.match(k))
 
+    # -------------------------------------------------------------------------
+    def _cached_widget(self, r, widget_id, render,
+                       tablenames=None,
+                       resource=None):
+        """
+            Get the output for an Ajax-request of a page widget from the
+            cache, or render and cache it
+
+            @param r: the S3Request
+            @param widget_id: identifier of the widget within the page
+            @param render: function to render the widget output, no
+                           arguments
+            @param tablenames: names of all tables the widget reads from
+                               (see _widget_tablenames), r.tablename and
+                               the tables joined by the resource filter
+                               are added automatically
+            @param resource: the resource the widget reads from, if other
+                             than r.resource
+
+            @return: the widget output
+
+            @note: the cache key includes the URL vars, the resolved
+                   resource query and filter (i.e. including server-side
+                   filters), the language and the accessible-query of the
+                   user for each table (i.e. the user's realms), and the
+                   versions of the tables (see S3Model.table_version)
+            @note: only GET-requests for non-HTML formats are cached, and
+                   only outputs which are strings or dicts of strings
+                   and XML components (the latter are cached serialized)
+        """
+
+        expire = current.deployment_settings.get_ui_widget_cache()
+        if not expire or r.http != "GET" or \
+           r.representation in ("html", "popup", "iframe"):
+            return render()
+
+        auth = current.auth
+        s3db = current.s3db
+        response = current.response
+
+        if resource is None:
+            resource = r.resource
+
+        tablenames = set(tn for tn in tablenames or [] if tn)
+        tablenames.add(r.tablename)
+        tablenames |= self._widget_tablenames(resource)
+        tablenames = sorted(tablenames)
+
+        # Resolved query and (virtual) filter of the resource
+        query = resource.get_query()
+        vfilter = resource.get_filter()
+        if vfilter is not None:
+            vfilter = vfilter.represent(resource)
+
+        # Cache key
+        get_vars = r.get_vars
+        accessible = []
+        for tablename in tablenames:
+            table = s3db.table(tablename)
+            if table is not None:
+                accessible.append(str(auth.s3_accessible_query("read", table)))
+        key = [self.__class__.__name__,
+               r.tablename,
+               r.id,
+               r.component_name,
+               r.representation,
+               widget_id,
+               sorted((k, s3_unicode(v)) for k, v in get_vars.items()
+                                         if k != "sEcho"),
+               str(query),
+               vfilter,
+               current.T.accepted_language,
+               accessible,
+               ]
+        key = hashlib.md5(s3_unicode(key).encode("utf-8")).hexdigest()
+        versions = s3db.table_version(*tablenames)
+        version = "-".join(str(versions[tn]) for tn in tablenames)
+        key = "widget_%s_%s" % (version, key)
+
+        rendered = []
+        def serialize():
+            # Render the widget and serialize the output (None if the
+            # output can not be cached)
+            output = render()
+            rendered.append(output)
+            if isinstance(output, basestring):
+                item = output
+            elif isinstance(output, dict):
+                item = {}
+                for k, v in output.items():
+                    if v is None or isinstance(v, basestring):
+                        item[k] = v
+                    elif hasattr(v, "xml"):
+                        item[k] = XML(v.xml())
+                    else:
+                        return None
+            else:
+                return None
+            return (item,
+                    response.view,
+                    response.headers.get("Content-Type"),
+                    )
+
+        cached = current.cache.ram(key, serialize, time_expire=expire)
+        if rendered:
+            if cached is None:
+                current.cache.ram(key, None)
+            return rendered[0]
+        elif cached is None:
+            return render()
+
+        item, view, content_type = cached
+        if view:
+            response.view = view
+        if content_type:
+            response.headers["Content-Type"] = content_type
+        if isinstance(item, dict):
+            output = dict(item)
+        else:
+            output = item
+            if "sEcho" in get_vars:
+                # Datatables require the request counter to be echoed
+                try:
+                    sEcho = int(get_vars.sEcho or 0)
+                except ValueError:
+                    sEcho = 0
+                output = REGEX_SECHO.sub('"sEcho":%s' % sEcho, output, 1)
+        return output
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _widget_tablenames(resource, selectors=None):
+        """
+            Get the names of the tables a widget reads from, i.e. the
+            tables of the selected fields and the tables they reference
+            (for representation), as well as the tables joined by the
+            resource filter
+
+            @param resource: the S3Resource
+            @param selectors: the field selectors of the widget
+
+            @return: set of tablenames
+        """
+
+        tablenames = set([resource.tablename])
+
+        if selectors:
+            rfields = resource.resolve_selectors(selectors)[0]
+            for rfield in rfields:
+                tablenames.add(rfield.tname)
+                field = rfield.field
+                if field is not None:
+                    ktablename = s3_get_foreign_key(field)[0]
+                    if ktablename:
+                        tablenames.add(ktablename)
+
+        rfilter = resource.rfilter
+        if rfilter is not None:
+            rfilter.get_query()
+            for left in (True, False):
+                for tn in rfilter.get_joins(left=left):
+                    table = current.s3db.table(tn)
+                    if table is not None:
+                        tablenames.add(table._tablename)
+        return tablenames
+
     # -------------------------------------------------------------------------
     @staticmethod
     def crud_string(tablename, name):
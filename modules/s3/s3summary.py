@@ -29,12 +29,16 @@
     OTHER DEALINGS IN THE SOFTWARE.
 """
 
+import re
+
 from gluon import current, A, DIV, LI, UL
 
 from s3filter import S3FilterForm
 from s3gis import MAP
 from s3rest import S3Method
 
+FACT = re.compile(r"[a-zA-Z]+\((.*)\)\Z")
+
 # =============================================================================
 class S3Summary(S3Method):
     """ Resource Summary Pages """
@@ -302,24 +306,71 @@ class S3Summary(S3Method):
             for widget in widgets:
                 if widget_id == "summary-%s" % i:
                     method = widget.get("method", None)
-                    output = None
                     if callable(method):
-                        output = method(r, widget_id=widget_id, **attr)
+                        render = lambda: method(r,
+                                                widget_id=widget_id,
+                                                **attr)
                     else:
                         handler = r.get_widget_handler(method)
                         if handler is not None:
-                            output = handler(r,
-                                             method=method,
-                                             widget_id=widget_id,
-                                             **attr)
+                            render = lambda: handler(r,
+                                                     method=method,
+                                                     widget_id=widget_id,
+                                                     **attr)
                         else:
                             r.error(405, current.ERROR.BAD_METHOD)
-                    return output
+                    # Ajax-requests for the same widget, filters and
+                    # realms are served from the cache for a short time
+                    tablenames = self._tablenames(r, method)
+                    return self._cached_widget(r, widget_id, render,
+                                               tablenames=tablenames)
                 i += 1
 
         # Not found?
         return None
 
+    # -------------------------------------------------------------------------
+    def _tablenames(self, r, method):
+        """
+            Get the names of the tables a summary widget reads from
+
+            @param r: the S3Request
+            @param method: the widget method
+        """
+
+        resource = r.resource
+        get_config = resource.get_config
+
+        if method == "report":
+            # Rows, columns and facts of the pivot table
+            get_vars = r.get_vars
+            report_options = get_config("report_options") or {}
+            defaults = report_options.get("defaults") or {}
+            selectors = []
+            for key in ("rows", "cols", "fact"):
+                values = get_vars.get(key, defaults.get(key))
+                if not values:
+                    continue
+                if isinstance(values, basestring):
+                    values = values.split(",")
+                elif not isinstance(values, (list, tuple)):
+                    values = [values]
+                for value in values:
+                    if isinstance(value, tuple):
+                        value = value[-1]
+                    if not isinstance(value, basestring):
+                        continue
+                    m = FACT.match(value)
+                    selectors.append(m.group(1) if m else value)
+        else:
+            # Datatable, data list or custom method
+            selectors = get_config("list_fields")
+
+        tablenames = self._widget_tablenames(resource, selectors)
+        if method == "map":
+            tablenames.add("gis_location")
+        return tablenames
+
     # -------------------------------------------------------------------------
     @staticmethod
     def _get_config(resource):
@@ -8,6 +8,9 @@
     To run a worker node: python web2py.py -K eden
     or use UWSGI's 'Mule'
 
+    To run the workers for all scheduler queues (settings.base.scheduler_queues):
+    python web2py.py -S eden -M -R applications/eden/static/scripts/tools/scheduler_pool.py
+
     NB
         Need WEB2PY_PATH environment variable to be defined (e.g. /etc/profile)
         Tasks need to be defined outside conditional model loads (e.g. models/tasks.py)
@@ -45,6 +48,8 @@
 __all__ = ("S3Task",)
 
 import datetime
+import sys
+import uuid
 
 try:
     import json # try stdlib (Python 2.6)
@@ -67,11 +72,38 @@ class S3Task(object):
 
     TASK_TABLENAME = "scheduler_task"
 
+    # Task to run the pending calls of a batched task
+    BATCH_TASK = "s3task_batch"
+
+    # Maximum timeout of a batch (seconds), calls claimed by a batch
+    # which has not finished within this time are run again
+    BATCH_TIMEOUT = 86400
+
+    # Timeout for batches scheduled by a previous batch (seconds)
+    BATCH_DEFAULT_TIMEOUT = 300
+
+    # Queue for tasks without configured queue (=web2py's default group)
+    DEFAULT_QUEUE = "main"
+
     # -------------------------------------------------------------------------
     def __init__(self):
 
-        migrate = current.deployment_settings.get_base_migrate()
-        tasks = current.response.s3.tasks
+        settings = current.deployment_settings
+        migrate = settings.get_base_migrate()
+        s3 = current.response.s3
+        tasks = s3.tasks
+
+        # Tasks to run in batches {task: time window in seconds}
+        self.batch_tasks = s3.batch_tasks or {}
+
+        # Scheduler queues, in order of priority [(name, workers)]
+        self.queues = [(name, max(int(workers), 0))
+                       for name, workers in settings.get_base_scheduler_queues()]
+        if not self.queues:
+            self.queues = [(self.DEFAULT_QUEUE, 1)]
+
+        # Queues for tasks {task: queue name}
+        self.task_queues = s3.task_queues or {}
 
         # Instantiate Scheduler
         try:
@@ -135,7 +167,6 @@ class S3Task(object):
                 ))
 
         if not task:
-            import uuid
             task = str(uuid.uuid4())
         field = table.task_name
         field.default = task
@@ -148,6 +179,8 @@ class S3Task(object):
             field.readable = False
             field.writable = False
 
+        table.group_name.default = self.queue(function)
+
         field = table.args
         field.default = json.dumps(args)
         field.readable = False
@@ -237,6 +270,13 @@ class S3Task(object):
             @param vars: The list of named vars to send to the function
             @param timeout: The length of time available for the task to complete
                             - default 300s (5 mins)
+
+            @note: calls identical to a call of the same request which is
+                   still queued (same task, args and vars) are merged with
+                   the queued call
+            @note: calls of batched tasks (s3.batch_tasks in models/tasks.py)
+                   are collected and run all together in a single scheduler
+                   task at the end of the time window, see run_batch
         """
 
         # Check that task is defined
@@ -272,19 +312,145 @@ class S3Task(object):
         auth = current.auth
         if auth.is_logged_in():
             # Add the current user to the vars
+            vars = dict(vars)
             vars["user_id"] = auth.user.id
 
-        # Run the task asynchronously
-        record = current.db.scheduler_task.insert(application_name="%s/default" % current.request.application,
-                                                  task_name=task,
-                                                  function_name=task,
-                                                  args=json.dumps(args),
-                                                  vars=json.dumps(vars),
-                                                  timeout=timeout)
+        window = self.batch_tasks.get(task)
+        if window:
+            # Add to the pending calls of the batch
+            return self._batch(task, args, vars, timeout, window)
+
+        db = current.db
+        ttable = db.scheduler_task
+        _args = json.dumps(args)
+
+        # Look for an identical call of this request which is still queued
+        # - calls of other requests could be run before this request has
+        #   committed its data, so they must not be merged with this call
+        queued = current.response.s3.queued_tasks
+        if queued is None:
+            queued = current.response.s3.queued_tasks = {}
+        key = (task, _args, json.dumps(vars, sort_keys=True))
+        query = (ttable.function_name == task) & \
+                (ttable.args == _args) & \
+                (ttable.status == "QUEUED") & \
+                (ttable.repeats == 1) & \
+                (ttable.times_run == 0)
+        record = queued.get(key)
+        if record:
+            if not db(query & (ttable.id == record)).select(ttable.id,
+                                                           limitby=(0, 1)
+                                                           ).first():
+                record = None
+
+        if not record:
+            # Run the task asynchronously
+            record = ttable.insert(application_name="%s/default" % current.request.application,
+                                   task_name=task,
+                                   function_name=task,
+                                   args=_args,
+                                   vars=json.dumps(vars),
+                                   group_name=self.queue(task),
+                                   timeout=timeout)
+        queued[key] = record
 
         # Return record so that status can be polled
         return record
 
+    # -------------------------------------------------------------------------
+    def _batch(self, task, args, vars, timeout, window):
+        """
+            Add a call to the pending calls of a batched task, and
+            schedule the batch if not scheduled yet
+
+            @param task: the task name
+            @param args: the task args
+            @param vars: the task vars
+            @param timeout: the timeout for the task
+            @param window: the time window to collect calls (seconds)
+
+            @return: the scheduler_task record ID of the batch
+        """
+
+        db = current.db
+
+        # Add the call, unless an identical call of this request is
+        # still pending (calls of other requests could be run before this
+        # request has committed its data, see run_batch for their merging)
+        btable = current.s3db.s3_task_batch
+        _args = json.dumps(args)
+        _vars = json.dumps(vars, sort_keys=True)
+
+        batched = current.response.s3.batched_calls
+        if batched is None:
+            batched = current.response.s3.batched_calls = {}
+        key = (task, _args, _vars)
+        record_id = batched.get(key)
+        if record_id:
+            query = (btable.id == record_id) & \
+                    (btable.status == None)
+            if not db(query).select(btable.id, limitby=(0, 1)).first():
+                record_id = None
+        if record_id:
+            added = False
+        else:
+            batched[key] = btable.insert(task_name = task,
+                                         args = _args,
+                                         vars = _vars,
+                                         timeout = timeout,
+                                         )
+            added = True
+
+        return self._schedule_batch(task,
+                                    timeout if added else 0,
+                                    window)
+
+    # -------------------------------------------------------------------------
+    def _schedule_batch(self, task, timeout, window):
+        """
+            Schedule the batch of a batched task, unless a batch which has
+            not yet started is scheduled already
+
+            @param task: the task name
+            @param timeout: the additional time required for the batch
+                            (seconds)
+            @param window: the time window to collect calls (seconds)
+
+            @return: the scheduler_task record ID of the batch
+        """
+
+        db = current.db
+
+        # Find the batch which has not yet started
+        ttable = db.scheduler_task
+        batch_task = self.BATCH_TASK
+        batch_args = json.dumps([task])
+        query = (ttable.function_name == batch_task) & \
+                (ttable.args == batch_args) & \
+                (ttable.status == "QUEUED")
+        batch = db(query).select(ttable.id,
+                                 ttable.timeout,
+                                 limitby=(0, 1)).first()
+        if batch:
+            if timeout:
+                # Allow the time for this call, too (but max 1 day)
+                batch.update_record(timeout=min(batch.timeout + timeout,
+                                                max(timeout, self.BATCH_TIMEOUT)))
+            return batch.id
+
+        # Schedule a new batch at the end of the window
+        # (the scheduler uses local time)
+        start = datetime.datetime.now() + datetime.timedelta(seconds=window)
+        return ttable.insert(application_name="%s/default" % current.request.application,
+                             task_name=batch_task,
+                             function_name=batch_task,
+                             args=batch_args,
+                             vars=json.dumps({}),
+                             start_time=start,
+                             next_run_time=start,
+                             group_name=self.queue(task),
+                             timeout=timeout or self.BATCH_DEFAULT_TIMEOUT)
+
     # -------------------------------------------------------------------------
     def schedule_task(self,
                       task,
@@ -356,8 +522,8 @@ class S3Task(object):
             # NB None => enabled
             kwargs["enabled"] = enabled
 
-        if group_name:
-            kwargs["group_name"] = group_name
+        # Default to the queue of the task
+        kwargs["group_name"] = group_name or self.queue(function_name)
 
         if not ignore_duplicate and self._duplicate_task_exists(task, args, vars):
             # if duplicate task exists, do not insert a new one
@@ -382,6 +548,153 @@ class S3Task(object):
                                           **kwargs)
         return record
 
+    # -------------------------------------------------------------------------
+    def queue(self, task):
+        """
+            Get the queue (scheduler group) for a task
+
+            @param task: the task (function) name
+            @return: the queue name
+        """
+
+        names = [name for name, workers in self.queues]
+        queue = self.task_queues.get(task)
+        if queue in names:
+            return queue
+        elif self.DEFAULT_QUEUE in names:
+            return self.DEFAULT_QUEUE
+        else:
+            # Not configured => use the queue with the highest priority
+            return names[0]
+
+    # -------------------------------------------------------------------------
+    def worker_groups(self):
+        """
+            Get the scheduler groups for the workers of all queues: the
+            workers of each queue also serve the queues with higher priority
+            so that short tasks can never be blocked by long ones, whilst
+            long tasks can only occupy the workers of their own queue and
+            lower-priority queues (=per-queue concurrency limit)
+
+            @return: list of tuples (queue name, number of workers,
+                     [group names]), in order of priority
+        """
+
+        groups = []
+        higher = []
+        for name, workers in self.queues:
+            groups.append((name, workers, [name] + higher))
+            higher = higher + [name]
+        return groups
+
+    # -------------------------------------------------------------------------
+    def status(self, hours=24):
+        """
+            Get the status of all scheduler queues
+
+            @param hours: the time span for run statistics (hours)
+
+            @return: list of Storages in order of priority, with:
+                     queue: the queue name
+                     workers: the number of configured workers
+                     alive: the number of active workers serving the queue
+                     due: the number of tasks due to run
+                     scheduled: the number of tasks scheduled for later
+                     running: the number of running tasks
+                     wait: the waiting time of the oldest due task (seconds)
+                     runs: the number of runs in the time span
+                     failed: the number of failed runs in the time span
+                     duration: the average run time (seconds)
+                     max_duration: the maximum run time (seconds)
+        """
+
+        db = current.db
+        ttable = db.scheduler_task
+        rtable = db.scheduler_run
+        wtable = db.scheduler_worker
+
+        # The scheduler uses local time
+        now = datetime.datetime.now()
+
+        status = {}
+        def get_status(group_name):
+            if group_name not in status:
+                status[group_name] = Storage(queue = group_name,
+                                             workers = 0,
+                                             alive = 0,
+                                             due = 0,
+                                             scheduled = 0,
+                                             running = 0,
+                                             wait = None,
+                                             runs = 0,
+                                             failed = 0,
+                                             duration = None,
+                                             max_duration = None,
+                                             )
+            return status[group_name]
+
+        for name, workers in self.queues:
+            get_status(name).workers = workers
+        # Tasks without group run in the default queue
+        default = self.queue(None)
+
+        # Active workers
+        offset = datetime.timedelta(minutes=1)
+        query = (wtable.last_heartbeat > (now - offset))
+        rows = db(query).select(wtable.group_names)
+        for row in rows:
+            for group_name in row.group_names or [default]:
+                get_status(group_name).alive += 1
+
+        # Queue depths
+        query = (ttable.status.belongs(("QUEUED", "ASSIGNED", "RUNNING"))) & \
+                (ttable.enabled == True)
+        rows = db(query).select(ttable.group_name,
+                                ttable.status,
+                                ttable.next_run_time)
+        for row in rows:
+            item = get_status(row.group_name or default)
+            if row.status == "RUNNING":
+                item.running += 1
+            elif row.next_run_time and row.next_run_time > now:
+                item.scheduled += 1
+            else:
+                item.due += 1
+                if row.next_run_time:
+                    wait = (now - row.next_run_time).total_seconds()
+                    if item.wait is None or wait > item.wait:
+                        item.wait = wait
+
+        # Run statistics
+        since = now - datetime.timedelta(hours=hours)
+        query = (rtable.start_time > since) & \
+                (rtable.status != "RUNNING") & \
+                (rtable.task_id == ttable.id)
+        rows = db(query).select(ttable.group_name,
+                                rtable.status,
+                                rtable.start_time,
+                                rtable.stop_time)
+        durations = {}
+        for row in rows:
+            group_name = row[ttable.group_name] or default
+            item = get_status(group_name)
+            run = row[rtable]
+            item.runs += 1
+            if run.status in ("FAILED", "TIMEOUT"):
+                item.failed += 1
+            if run.start_time and run.stop_time:
+                duration = (run.stop_time - run.start_time).total_seconds()
+                durations.setdefault(group_name, []).append(duration)
+        for group_name, values in durations.items():
+            item = status[group_name]
+            item.duration = sum(values) / len(values)
+            item.max_duration = max(values)
+
+        # Groups which are not configured (e.g. after a configuration
+        # change) are never served by the pool, but still show them
+        queues = [status.pop(name) for name, workers in self.queues]
+        return queues + [status[name] for name in sorted(status)]
+
     # -------------------------------------------------------------------------
     def _duplicate_task_exists(self, task, args, vars):
         """
@@ -459,6 +772,98 @@ class S3Task(object):
     # =========================================================================
     # Functions run within the Task itself
     # =========================================================================
+    def run_batch(self, task):
+        """
+            Run all pending calls of a batched task
+            - run from within the task (s3task_batch)
+
+            @param task: the task name
+            @return: the number of calls run
+
+            @note: the calls are claimed by this batch before running
+                   them, and each is removed only once it has succeeded
+                   (and then committed), so they are neither lost if the
+                   batch dies, nor run twice by concurrent batches
+            @note: failed calls are kept with status FAILED
+            @note: identical calls are run only once, and the next batch
+                   is scheduled if there are pending calls after the run
+        """
+
+        tasks = current.response.s3.tasks
+        function = tasks.get(task) if tasks else None
+        if function is None:
+            current.log.error("Batched task not defined: %s" % task)
+            return 0
+
+        db = current.db
+        btable = current.s3db.s3_task_batch
+
+        # Claim all pending calls, and those claimed by batches which
+        # have died meanwhile
+        now = datetime.datetime.utcnow()
+        expired = now - datetime.timedelta(seconds=self.BATCH_TIMEOUT)
+        worker = str(uuid.uuid4())
+        query = (btable.task_name == task) & \
+                ((btable.status == None) | \
+                 ((btable.status == "RUNNING") & (btable.claimed_on < expired)))
+        db(query).update(status = "RUNNING",
+                         worker = worker,
+                         claimed_on = now,
+                         )
+        db.commit()
+
+        query = (btable.worker == worker) & \
+                (btable.status == "RUNNING")
+        rows = db(query).select(btable.id,
+                                btable.args,
+                                btable.vars,
+                                orderby=btable.id)
+
+        # Identical calls (of different requests) are run only once
+        calls = {}
+        for row in rows:
+            key = (row.args, row.vars)
+            if key in calls:
+                calls[key].append(row.id)
+            else:
+                calls[key] = [row.id]
+
+        count = 0
+        for row in rows:
+            record_ids = calls.pop((row.args, row.vars), None)
+            if not record_ids:
+                continue
+            count += 1
+            args = json.loads(row.args)
+            vars = dict((str(k), v) for k, v in json.loads(row.vars).items())
+            query = (btable.id.belongs(record_ids))
+            try:
+                function(*args, **vars)
+            except:
+                # Don't let one failing call stop all others
+                current.log.error("Batched task %s failed: %s" % \
+                                  (task, sys.exc_info()[1]))
+                db.rollback()
+                db(query).update(status = "FAILED")
+            else:
+                db(query).delete()
+            db.commit()
+
+        # Calls added while this batch was running, or not yet committed
+        # by their callers when it started (their batch may have started
+        # too early) => schedule the next batch
+        if rows:
+            query = (btable.task_name == task) & \
+                    (btable.status == None)
+            pending = db(query).select(btable.timeout)
+            timeout = sum(row.timeout or self.BATCH_DEFAULT_TIMEOUT
+                          for row in pending)
+            self._schedule_batch(task,
+                                 min(timeout, self.BATCH_TIMEOUT),
+                                 self.batch_tasks.get(task) or 0)
+            db.commit()
+        return count
+
     def authenticate(self, user_id):
         """
             Activate the authentication passed from the caller to this new request
@@ -48,9 +48,12 @@ except ImportError:
     except:
         import gluon.contrib.simplejson as json # fallback to pure-Python module
 
+from bisect import bisect_left, bisect_right
 from dateutil.relativedelta import *
 from dateutil.rrule import *
+from heapq import heappop, heappush
 from itertools import izip, tee
+from math import fsum
 
 from gluon import current
 from gluon.storage import Storage
@@ -972,12 +975,16 @@ class S3TimePlotPeriod(object):
 
     methods = ("count", "cumulate", "sum", "avg", "min", "max")
 
-    def __init__(self, start, end=None):
+    def __init__(self, start, end=None, frame=None, index=None):
         """
             Constructor
 
             @param start: start time of the period (datetime.datetime)
             @param end: end time of the period (datetime.datetime)
+            @param frame: the event frame this period belongs to, to
+                          compute aggregates for all periods at once
+                          (S3TimePlotEventFrame)
+            @param index: the index of this period in the event frame
         """
 
         self.start = tp_tzsafe(start)
@@ -987,6 +994,11 @@ class S3TimePlotPeriod(object):
         self.csets = {}
         self.psets = {}
 
+        # Event frame (event sets get loaded only when needed)
+        self.frame = frame
+        self.index = index
+        self._loaded = False
+
     # -------------------------------------------------------------------------
     def add_current(self, event):
         """
@@ -995,6 +1007,7 @@ class S3TimePlotPeriod(object):
             @param event: the event (S3TimePlotEvent)
         """
 
+        self._detach()
         self._add(self.csets, event)
 
     # -------------------------------------------------------------------------
@@ -1005,8 +1018,29 @@ class S3TimePlotPeriod(object):
             @param event: the event (S3TimePlotEvent)
         """
 
+        self._detach()
         self._add(self.psets, event)
 
+    # -------------------------------------------------------------------------
+    def _load(self):
+        """ Load the event sets of this period from the event frame """
+
+        frame = self.frame
+        if frame is not None and not self._loaded:
+            frame.load(self)
+            self._loaded = True
+
+    # -------------------------------------------------------------------------
+    def _detach(self):
+        """
+            Detach this period from the event frame (to add events
+            manually, so aggregates must be computed from the event sets)
+        """
+
+        if self.frame is not None:
+            self._load()
+            self.frame = None
+
     # -------------------------------------------------------------------------
     def _add(self, sets, event):
 
@@ -1031,6 +1065,14 @@ class S3TimePlotPeriod(object):
             @param method: the aggregation method
         """
 
+        if self.frame is not None:
+            return self.frame.aggregate(self.index,
+                                        method=method,
+                                        fields=fields,
+                                        arguments=arguments,
+                                        event_type=event_type,
+                                        )
+
         if fields is None and method == "count":
             return self.count(event_type)
 
@@ -1120,11 +1162,49 @@ class S3TimePlotPeriod(object):
             end_date = event.end
         if event.start is None or event.start >= end_date:
             return 0
-        rule = self.get_rule(event.start, end_date, slots)
-        if rule:
-            return rule.count()
-        else:
+        return self.count_slots(event.start, end_date, slots)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def count_slots(cls, start, end, slots):
+        """
+            Count the slots between start and end, i.e. the number of
+            occurences of get_rule(start, end, slots) - computed without
+            iterating over the rule where possible
+
+            @param start: the start datetime
+            @param end: the end datetime
+            @param slots: the slot length (string)
+
+            @return: the number of slots (1 if slots is invalid)
+        """
+
+        if start > end:
+            return 0
+        match = re.match("\s*(\d*)\s*([hdwmy]{1}).*", slots)
+        if not match:
             return 1
+        num, delta = match.groups()
+        num = int(num) if num else 1
+        if not num:
+            return 1
+
+        if delta in ("h", "d", "w"):
+            seconds = {"h": 3600, "d": 86400, "w": 604800}[delta] * num
+            return int((end - start).total_seconds() // seconds) + 1
+        elif start.day <= 28:
+            # Monthly/yearly on the same day (all months have this day)
+            if delta == "y":
+                num *= 12
+            months = (end.year - start.year) * 12 + end.month - start.month
+            count = months // num
+            if start + relativedelta(months=count * num) > end:
+                count -= 1
+            return count + 1
+        else:
+            # Rule skips months which don't have this day
+            rule = cls.get_rule(start, end, slots)
+            return rule.count() if rule else 1
 
     # -------------------------------------------------------------------------
     @staticmethod
@@ -1204,6 +1284,7 @@ class S3TimePlotPeriod(object):
             Return a list of all events of the given type
         """
 
+        self._load()
         if event_type in self.csets:
             events = dict(self.csets[event_type])
         else:
@@ -1234,6 +1315,7 @@ class S3TimePlotPeriod(object):
             Return a list of events of the given type from the given sets
         """
 
+        self._load()
         if event_type in sets:
             events = sets[event_type]
             return events.values()
@@ -1249,6 +1331,7 @@ class S3TimePlotPeriod(object):
             @param event_type: the event type identifier (string)
         """
 
+        self._load()
         sets = self.csets
         if event_type in sets:
             return len(sets[event_type])
@@ -1257,7 +1340,15 @@ class S3TimePlotPeriod(object):
 
 # =============================================================================
 class S3TimePlotEventFrame(object):
-    """ Class representing the whole time frame of a time plot """
+    """
+        Class representing the whole time frame of a time plot
+
+        Events are assigned to periods by binary search over the sorted
+        period boundaries, and aggregates are computed for all periods at
+        once (prefix sums over the periods in which each event is current,
+        or a heap for min/max), rather than looping over all events for
+        each period.
+    """
 
     def __init__(self, start, end, slots=None):
         """
@@ -1288,6 +1379,13 @@ class S3TimePlotEventFrame(object):
 
         self.rule = self.get_rule()
 
+        self.events = {}
+
+        # Index, structure: (period starts, period ends,
+        #                    {event_type: [(event, first, last)]})
+        self._index = None
+        self._aggregates = {}
+
     # -------------------------------------------------------------------------
     def get_rule(self):
         """
@@ -1313,75 +1411,403 @@ class S3TimePlotEventFrame(object):
 
         if not events:
             return
-        empty = self.empty
 
-        # Order events by start datetime
-        events = sorted(events)
+        add = self.events.setdefault
+        for event in events:
+            add(event.event_type, {})[event.event_id] = event
+
+        self._index = None
+        self._aggregates = {}
+
+        starts, ends, index = self.index()
+        numperiods = len(starts)
+        for items in index.values():
+            for event, first, last in items:
+                if first < numperiods:
+                    self.empty = False
+                    break
+        return
+
+    # -------------------------------------------------------------------------
+    def index(self):
+        """
+            Determine the period in which each event becomes current (i.e.
+            starts before the end of the period), and the last period in
+            which it is current (i.e. does not end before the period) - it
+            is a previous event in all subsequent periods.
+
+            @return: tuple (period starts, period ends, index), where index
+                     is a dict {event_type: [(event, first, last)]}, with
+                     first and last being indexes of periods
+        """
+
+        if self._index is not None:
+            return self._index
 
         rule = self.rule
-        periods = self.periods
+        starts = []
+        if rule:
+            end = self.end
+            for dt in rule:
+                if dt >= end:
+                    break
+                starts.append(dt)
+        ends = starts[1:] + [self.end] if starts else []
+        numperiods = len(starts)
+
+        index = {}
+        for event_type, events in self.events.items():
+            items = index[event_type] = []
+            append = items.append
+            for event in events.values():
+                start = event.start
+                end = event.end
+                first = bisect_right(ends, start) if start is not None else 0
+                if end is None:
+                    last = numperiods - 1
+                elif first < numperiods and end < starts[first]:
+                    # Ended before it started
+                    last = first - 1
+                else:
+                    last = min(max(first, bisect_left(ends, end)),
+                               numperiods - 1)
+                append((event, first, last))
+
+        self._index = (starts, ends, index)
+        return self._index
+
+    # -------------------------------------------------------------------------
+    def load(self, period):
+        """
+            Add the current and previous events to a period of this frame
+
+            @param period: the S3TimePlotPeriod
+        """
+
+        k = period.index
+        add = period._add
+        csets = period.csets
+        psets = period.psets
+        for items in self.index()[2].values():
+            for event, first, last in items:
+                if first > k:
+                    continue
+                elif k <= last:
+                    add(csets, event)
+                elif event.end is not None:
+                    add(psets, event)
+        return
+
+    # -------------------------------------------------------------------------
+    def aggregate(self, k, method="count", fields=None, arguments=None, event_type=None):
+        """
+            Aggregate event data in a period of this frame, computes (and
+            caches) the aggregates for all periods at once
+
+            @param k: the index of the period
+            @param method: the aggregation method
+            @param fields: the attributes to aggregate
+            @param arguments: the aggregation arguments
+            @param event_type: the event type
+
+            @return: the aggregate value, see S3TimePlotPeriod.aggregate
+        """
+
+        key = (method,
+               tuple(fields) if fields else None,
+               tuple(arguments) if arguments else None,
+               event_type,
+               )
+        aggregates = self._aggregates.get(key)
+        if aggregates is None:
+            starts, ends, index = self.index()
+            items = index.get(event_type, [])
+            if method == "cumulate":
+                aggregates = self._cumulate(items, ends, fields, arguments)
+            elif fields is None and method == "count":
+                aggregates = self._current(items, len(starts), None, method)
+            elif fields:
+                aggregates = self._current(items, len(starts), fields[0], method)
+            else:
+                aggregates = [None] * len(starts)
+            self._aggregates[key] = aggregates
+        return aggregates[k]
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _current(items, numperiods, field, method):
+        """
+            Aggregate the values of current events per period
+
+            @param items: the index items (event, first, last)
+            @param numperiods: the number of periods
+            @param field: the attribute to aggregate (None to count events)
+            @param method: the aggregation method
+
+            @return: list of aggregates per period
+        """
+
+        size = numperiods + 1
+
+        if method in ("min", "max"):
+            # Sweep over the periods with a heap of the current events
+            # (ordered by their minimum/maximum value)
+            starting = [[] for k in xrange(size)]
+            for event, first, last in items:
+                if first > last or first >= numperiods:
+                    continue
+                values = S3TimePlotEventFrame._values(event, field)
+                if not values:
+                    continue
+                try:
+                    value = min(values) if method == "min" else max(values)
+                except (TypeError, ValueError):
+                    continue
+                starting[first].append((value, last))
+
+            if method == "min":
+                wrap = lambda value: value
+            else:
+                wrap = S3TimePlotMaxItem
+
+            aggregates = []
+            heap = []
+            for k in xrange(numperiods):
+                for value, last in starting[k]:
+                    heappush(heap, (wrap(value), last))
+                while heap and heap[0][1] < k:
+                    heappop(heap)
+                if heap:
+                    value = heap[0][0]
+                    aggregates.append(value if method == "min" else value.value)
+                else:
+                    aggregates.append(None)
+            return aggregates
+
+        # Running totals over the differences between periods
+        counts = [0] * size
+        sums = S3TimePlotTotals(size)
+        invalid = [0] * size
+        for event, first, last in items:
+            if first > last or first >= numperiods:
+                continue
+            last += 1
+            if field is None:
+                counts[first] += 1
+                counts[last] -= 1
+                continue
+            values = S3TimePlotEventFrame._values(event, field)
+            if not values:
+                continue
+            counts[first] += len(values)
+            counts[last] -= len(values)
+            if method in ("sum", "avg"):
+                try:
+                    sums.add(first, last, sum(values))
+                except (TypeError, ValueError):
+                    invalid[first] += 1
+                    invalid[last] -= 1
+
+        aggregates = []
+        count = errors = 0
+        totals = sums.totals()
+        for k in xrange(numperiods):
+            count += counts[k]
+            errors += invalid[k]
+            total = totals.next()
+            if method == "count":
+                aggregates.append(count)
+            elif errors:
+                aggregates.append(None)
+            elif method == "sum":
+                aggregates.append(total)
+            elif method == "avg":
+                aggregates.append(total / float(count) if count else None)
+            else:
+                aggregates.append(None)
+        return aggregates
 
-        # No point to loop over periods before the first event:
-        start = events[0].start
-        if start is None or start <= self.start:
-            first = rule[0]
+    # -------------------------------------------------------------------------
+    @classmethod
+    def _cumulate(cls, items, ends, fields, arguments):
+        """
+            Cumulative aggregation per period (base value plus slope
+            multiplied by the duration of the event before the end of
+            the period), of all events which start before the end of
+            the period
+
+            @param items: the index items (event, first, last)
+            @param ends: the period ends
+            @param fields: the attributes (base, slope)
+            @param arguments: the aggregation arguments (slots)
+
+            @return: list of aggregates per period
+        """
+
+        numperiods = len(ends)
+        size = numperiods + 1
+
+        slots = arguments[0] if arguments else None
+        if len(fields) > 1:
+            base, slope = fields[:2]
         else:
-            first = rule.before(start, inc=True)
+            if slots:
+                base, slope = None, fields[0]
+            else:
+                base, slope = fields[0], None
+
+        count_slots = S3TimePlotPeriod.count_slots
 
-        current_events = {}
-        previous_events = {}
-        for start in rule.between(first, self.end, inc=True):
+        # Slot numbers of the period ends, if the duration of events
+        # is a linear function of the period
+        numbers = cls._slot_numbers(ends, slots) if slots else None
 
-            # Compute end of this period
-            end = rule.after(start)
-            if not end:
-                if start < self.end:
-                    end = self.end
+        # Constant contributions as differences between periods,
+        # variable contributions as offset plus slope per slot number
+        constant = S3TimePlotTotals(size)
+        offsets = S3TimePlotTotals(size)
+        slopes = S3TimePlotTotals(size)
+        invalid = [0] * size
+        for event, first, last in items:
+
+            if event.start is None or first >= numperiods:
+                continue
+
+            base_value = event[base] if base else None
+            slope_value = event[slope] if slope else None
+
+            if base_value is None:
+                if not slope or slope_value is None:
+                    continue
                 else:
-                    # Period start is at the end of the event frame
-                    break
+                    base_value = 0
+            elif type(base_value) is list:
+                try:
+                    base_value = sum(base_value)
+                except (TypeError, ValueError):
+                    continue
 
-            # Find all current events
-            for index, event in enumerate(events):
-                if event.end and event.end < start:
-                    # Event ended before this period
-                    previous_events[event.event_id] = event
-                elif event.start is None or event.start < end:
-                    # Event starts before or during this period
-                    current_events[event.event_id] = event
+            if slope_value is None:
+                if not base or base_value is None:
+                    continue
                 else:
-                    # Event starts only after this period
-                    break
+                    slope_value = 0
+            elif type(slope_value) is list:
+                try:
+                    slope_value = sum(slope_value)
+                except (TypeError, ValueError):
+                    continue
+
+            k = first
+            try:
+                if not slope_value or not slots:
+                    constant.add(k, numperiods, base_value + slope_value)
+                    continue
 
-            # Add current events to current period
-            period = periods.get(start)
-            if period is None:
-                period = periods[start] = S3TimePlotPeriod(start, end=end)
-            for event in current_events.values():
-                period.add_current(event)
-            for event in previous_events.values():
-                period.add_previous(event)
-
-            empty = False
-
-            # Remaining events
-            events = events[index:]
-            if not events:
-                # No more events
-                break
-
-            # Remove events which end during this period
-            remaining = {}
-            for event_id, event in current_events.items():
-                if not event.end or event.end > end:
-                    remaining[event_id] = event
+                # Duration grows until the period in which the event ends
+                start = event.start
+                end = event.end
+                if end is None:
+                    last = numperiods
+                else:
+                    last = max(k, bisect_left(ends, end))
+                if numbers is not None:
+                    # Periods ending before the event starts
+                    begin = min(max(k, bisect_right(ends, start)), last)
+                    if begin > k:
+                        offsets.add(k, begin, base_value)
+                    # Periods ending after the event starts
+                    if begin < last:
+                        offset = count_slots(start, ends[begin], slots) - \
+                                 numbers[begin]
+                        offsets.add(begin, last,
+                                    base_value + slope_value * offset)
+                        slopes.add(begin, last, slope_value)
+                    k = last
                 else:
-                    previous_events[event_id] = event
-            current_events = remaining
+                    while k < last:
+                        if start < ends[k]:
+                            duration = count_slots(start, ends[k], slots)
+                        else:
+                            duration = 0
+                        offsets.add(k, k + 1, base_value + slope_value * duration)
+                        k += 1
+                if k < numperiods:
+                    duration = count_slots(start, end, slots) \
+                               if start < end else 0
+                    constant.add(k, numperiods,
+                                 base_value + slope_value * duration)
+            except (TypeError, ValueError):
+                invalid[k] += 1
+
+        aggregates = []
+        errors = 0
+        totals = izip(constant.totals(), offsets.totals(), slopes.totals())
+        for k in xrange(numperiods):
+            total, offset, slope_total = totals.next()
+            errors += invalid[k]
+            if errors:
+                aggregates.append(None)
+            elif numbers is not None:
+                aggregates.append(total + offset + slope_total * numbers[k])
+            else:
+                aggregates.append(total + offset)
+        return aggregates
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _slot_numbers(ends, slots):
+        """
+            Get the slot numbers of the period ends (relative to the first
+            period end), for hourly, daily or weekly slots if the period
+            ends are whole numbers of slots apart - the duration of any
+            event before the end of a period is then its slot number plus
+            a constant per event (see count_slots)
+
+            @param ends: the period ends
+            @param slots: the slot length (string)
+
+            @return: list of slot numbers, or None if the durations are
+                     not linear in the periods
+        """
+
+        match = re.match("\s*(\d*)\s*([hdwmy]{1}).*", slots)
+        if not match:
+            return None
+        num, delta = match.groups()
+        num = int(num) if num else 1
+        if not num or delta not in ("h", "d", "w"):
+            return None
+        length = {"h": 3600, "d": 86400, "w": 604800}[delta] * num
+
+        numbers = []
+        append = numbers.append
+        for end in ends:
+            diff = end - ends[0]
+            seconds = diff.days * 86400 + diff.seconds
+            if diff.microseconds or seconds % length:
+                return None
+            append(seconds // length)
+        return numbers
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _values(event, field):
+        """
+            Get the (non-None) values of an event attribute as list
+
+            @param event: the S3TimePlotEvent
+            @param field: the attribute
+        """
+
+        value = event[field]
+        if value is None:
+            return []
+        elif type(value) is list:
+            return [v for v in value if v is not None]
+        else:
+            return [value]
 
-        self.empty = empty
-        return
-        
     # -------------------------------------------------------------------------
     def __iter__(self):
         """
@@ -1392,16 +1818,16 @@ class S3TimePlotEventFrame(object):
 
         rule = self.rule
         if rule:
-            for dt in rule:
-                if dt >= self.end:
-                    break
-                if dt in periods:
-                    yield periods[dt]
-                else:
-                    end = rule.after(dt)
-                    if not end:
-                        end = self.end
-                    yield S3TimePlotPeriod(dt, end=end)
+            starts, ends, index = self.index()
+            for k, dt in enumerate(starts):
+                period = periods.get(dt)
+                if period is None:
+                    period = periods[dt] = S3TimePlotPeriod(dt,
+                                                            end=ends[k],
+                                                            frame=self,
+                                                            index=k,
+                                                            )
+                yield period
         else:
             # @todo: continuous periods
             # sort actual periods and iterate over them
@@ -1409,4 +1835,91 @@ class S3TimePlotEventFrame(object):
             
         return
 
+# =============================================================================
+class S3TimePlotTotals(object):
+    """
+        Running totals over a sequence of periods, from the differences
+        between the periods - float values are summed up exactly (like
+        math.fsum), so that the totals do not drift when values get
+        added and removed again
+    """
+
+    def __init__(self, size):
+        """
+            Constructor
+
+            @param size: the number of periods (plus one for the
+                         differences after the last period)
+        """
+
+        self.size = size
+
+        self.ints = [0] * size
+        self.floats = [[] for i in xrange(size)]
+        self.numfloats = [0] * size
+
+    # -------------------------------------------------------------------------
+    def add(self, first, last, value):
+        """
+            Add a value to the totals
+
+            @param first: index of the first period to add the value to
+            @param last: index of the first period to no longer add
+                         the value to
+            @param value: the value
+        """
+
+        if type(value) is float:
+            floats = self.floats
+            floats[first].append(value)
+            floats[last].append(-value)
+            numfloats = self.numfloats
+            numfloats[first] += 1
+            numfloats[last] -= 1
+        else:
+            ints = self.ints
+            ints[first] += value
+            ints[last] -= value
+
+    # -------------------------------------------------------------------------
+    def totals(self):
+        """
+            Generator for the totals per period
+        """
+
+        total = numfloats = 0
+        partials = []
+        for k in xrange(self.size):
+            total += self.ints[k]
+            numfloats += self.numfloats[k]
+            for x in self.floats[k]:
+                # Shewchuk's algorithm, as in math.fsum
+                i = 0
+                for y in partials:
+                    if abs(x) < abs(y):
+                        x, y = y, x
+                    hi = x + y
+                    lo = y - (hi - x)
+                    if lo:
+                        partials[i] = lo
+                        i += 1
+                    x = hi
+                partials[i:] = [x]
+            if numfloats:
+                yield total + fsum(partials)
+            else:
+                yield total
+
+# =============================================================================
+class S3TimePlotMaxItem(object):
+    """ Heap item with reverse order, to find the maximum value """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
 # END =========================================================================
@@ -33,6 +33,7 @@
 """
 
 import datetime
+import hashlib
 import os
 import re
 import sys
@@ -160,6 +161,7 @@ class S3XML(S3Codec):
         url="url",
         filename="filename",
         error="error",
+        hash="hash",
         start="start",
         limit="limit",
         success="success",
@@ -686,6 +688,60 @@ class S3XML(S3Codec):
 
         return reference_map
 
+    # -------------------------------------------------------------------------
+    def record_hash(self, table, record, fields, rmap):
+        """
+            Generates a canonical hash of the content of a record, used
+            by the importer to detect records which haven't changed since
+            they were last imported (S3ImportItem.commit)
+
+            @param table: the database table
+            @param record: the record
+            @param fields: list of data field names to include
+            @param rmap: the reference map of the record (see rmap)
+
+            @return: the hash as hex string
+
+            @note: meta-fields are not included, and references are
+                   represented by the UIDs of the referenced records
+                   rather than by their (local) record IDs
+        """
+
+        DELETED = self.DELETED
+        UID = self.UID
+
+        content = {}
+        if DELETED in record and record[DELETED]:
+            content[DELETED] = True
+        else:
+            skip = ("id",
+                    self.CUSER,
+                    self.MUSER,
+                    self.OGROUP,
+                    self.OUSER,
+                    self.CTIME,
+                    self.MTIME,
+                    self.MCI,
+                    DELETED,
+                    )
+            for f in fields:
+                if f in skip or f not in record:
+                    continue
+                content[f] = record[f]
+        for entry in rmap:
+            uids = entry.uid
+            if uids:
+                content[entry.field] = sorted(uids)
+            else:
+                content[entry.field] = entry.value
+
+        uid = record[UID] if UID in record else None
+        data = json.dumps([table._tablename, uid, content],
+                          default=s3_unicode,
+                          separators=SEPARATORS,
+                          sort_keys=True)
+        return hashlib.md5(data).hexdigest()
+
     # -------------------------------------------------------------------------
     def add_references(self, element, rmap, show_ids=False, lazy=None):
         """
@@ -31,6 +31,11 @@ import sys
 import urllib, urllib2
 import traceback
 
+try:
+    from cStringIO import StringIO # Faster, where available
+except:
+    from StringIO import StringIO
+
 try:
     from lxml import etree
 except ImportError:
@@ -47,7 +52,7 @@ except ImportError:
 
 from gluon import *
 
-from ..s3sync import S3SyncBaseAdapter
+from ..s3sync import S3Sync, S3SyncBaseAdapter
 
 DEBUG = False
 if DEBUG:
@@ -64,6 +69,13 @@ class S3SyncAdapter(S3SyncBaseAdapter):
         API Adapter for Sahana Eden
     """
 
+    def __init__(self, repository):
+
+        S3SyncBaseAdapter.__init__(self, repository)
+
+        # Pull transfers started in advance {task_id: (url, S3SyncFuture)}
+        self.prefetched = {}
+
     # -------------------------------------------------------------------------
     def register(self):
         """ Register at the repository """
@@ -172,32 +184,41 @@ class S3SyncAdapter(S3SyncBaseAdapter):
         return None
 
     # -------------------------------------------------------------------------
-    def pull(self, task, onconflict=None):
+    def prefetch(self, tasks):
+        """
+            Start the transfers of the first chunks for the pulls of
+            multiple tasks concurrently (up to settings.sync.connections)
+
+            @param tasks: the sync_task Rows
+        """
+
+        chunk_size = current.deployment_settings.get_sync_chunk_size()
+        for task in tasks:
+            url = self._pull_url(task, chunk_size, task.pull_cursor)
+            self.prefetched[task.id] = (url, self._http_submit(url))
+
+    # -------------------------------------------------------------------------
+    def _pull_url(self, task, chunk_size=None, cursor=None):
         """
-            Outgoing pull
+            Construct the URL for a pull
 
             @param task: the task (sync_task Row)
+            @param chunk_size: the chunk size for chunked transfers
+            @param cursor: the continuation token for the chunk
         """
 
         repository = self.repository
-        xml = current.xml
-        config = repository.config
         resource_name = task.resource_name
 
-        _debug("S3SyncRepository.pull(%s, %s)" % (repository.url, resource_name))
-
-        # Construct the URL
         url = "%s/sync/sync.xml?resource=%s&repository=%s" % \
-              (repository.url, resource_name, config.uuid)
+              (repository.url, resource_name, repository.config.uuid)
         last_pull = task.last_pull
         if last_pull and task.update_policy not in ("THIS", "OTHER"):
-            url += "&msince=%s" % xml.encode_iso_datetime(last_pull)
+            url += "&msince=%s" % current.xml.encode_iso_datetime(last_pull)
         url += "&include_deleted=True"
 
         # Send sync filters to peer
         filters = current.sync.get_filters(task.id)
-        filter_string = None
-        resource_name = task.resource_name
         for tablename in filters:
             prefix = "~" if not tablename or tablename == resource_name \
                             else tablename
@@ -205,101 +226,125 @@ class S3SyncAdapter(S3SyncBaseAdapter):
                 urlfilter = "[%s]%s=%s" % (prefix, k, v)
                 url += "&%s" % urlfilter
 
-        _debug("...pull from URL %s" % url)
+        if chunk_size:
+            url += "&limit=%s&cursor=%s" % (chunk_size,
+                                            urllib.quote(cursor or ""))
+        return url
 
-        # Figure out the protocol from the URL
-        url_split = url.split("://", 1)
-        if len(url_split) == 2:
-            protocol, path = url_split
-        else:
-            protocol, path = "http", None
+    # -------------------------------------------------------------------------
+    def pull(self, task, onconflict=None):
+        """
+            Outgoing pull, in chunks of settings.sync.chunk_size records,
+            each chunk committed separately so that an interrupted pull
+            resumes after the last complete chunk (task.pull_cursor)
 
-        # Create the request
-        req = urllib2.Request(url=url)
-        handlers = []
+            @param task: the task (sync_task Row)
+        """
 
-        # Proxy handling
-        proxy = repository.proxy or config.proxy or None
-        if proxy:
-            _debug("using proxy=%s" % proxy)
-            proxy_handler = urllib2.ProxyHandler({protocol: proxy})
-            handlers.append(proxy_handler)
+        repository = self.repository
+        xml = current.xml
+        resource_name = task.resource_name
 
-        # Authentication handling
-        username = repository.username
-        password = repository.password
-        if username and password:
-            # Send auth data unsolicitedly (the only way with Eden instances):
-            import base64
-            base64string = base64.encodestring('%s:%s' %
-                                               (username, password))[:-1]
-            req.add_header("Authorization", "Basic %s" % base64string)
-            # Just in case the peer does not accept that, add a 401 handler:
-            passwd_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
-            passwd_manager.add_password(realm=None,
-                                        uri=url,
-                                        user=username,
-                                        passwd=password)
-            auth_handler = urllib2.HTTPBasicAuthHandler(passwd_manager)
-            handlers.append(auth_handler)
+        _debug("S3SyncRepository.pull(%s, %s)" % (repository.url, resource_name))
 
-        # Install all handlers
-        if handlers:
-            opener = urllib2.build_opener(*handlers)
-            urllib2.install_opener(opener)
+        last_pull = task.last_pull
 
-        # Execute the request
-        remote = False
-        output = None
-        response = None
+        # Get import strategy and update policy
+        strategy = task.strategy
+        update_policy = task.update_policy
+        conflict_policy = task.conflict_policy
+
+        chunk_size = current.deployment_settings.get_sync_chunk_size()
+        cursor = task.pull_cursor
+        resumed = cursor
+
+        # Transfer started in advance (prefetch or read-ahead)
+        pending = self.prefetched.pop(task.id, None)
+
+        db = current.db
         log = repository.log
-        try:
-            f = urllib2.urlopen(req)
-        except urllib2.HTTPError, e:
-            result = log.ERROR
-            remote = True # Peer error
-            code = e.code
-            message = e.read()
-            try:
-                # Sahana-Eden would send a JSON message,
-                # try to extract the actual error message:
-                message_json = json.loads(message)
-                message = message_json.get("message", message)
-            except:
-                pass
-            # Prefix as peer error and strip XML markup from the message
-            # @todo: better method to do this?
-            message = "<message>%s</message>" % message
-            try:
-                markup = etree.XML(message)
-                message = markup.xpath(".//text()")
-                if message:
-                    message = " ".join(message)
-                else:
-                    message = ""
-            except etree.XMLSyntaxError:
-                pass
-            output = xml.json_message(False, code, message, tree=None)
-        except:
-            result = log.FATAL
-            code = 400
-            message = sys.exc_info()[1]
-            output = xml.json_message(False, code, message)
-        else:
-            result = log.SUCCESS
-            response = f
 
-        # Process the response
+        remote = False
+        output = None
+        result = log.SUCCESS
+        message = ""
         mtime = None
-        if response:
+        count = 0
+        chunks = 0
+        while True:
 
-            # Get import strategy and update policy
-            strategy = task.strategy
-            update_policy = task.update_policy
-            conflict_policy = task.conflict_policy
+            chunk_url = self._pull_url(task, chunk_size, cursor)
+            _debug("...pull from URL %s" % chunk_url)
 
-            success = True
-            message = ""
+            # Execute the request (or wait for the response if started)
+            try:
+                if pending and pending[0] == chunk_url:
+                    f = pending[1].result()
+                else:
+                    f = self._http_request(chunk_url)
+                pending = None
+                info = f.info()
+                data = f.read()
+                if info.get("Content-Encoding") == "gzip":
+                    data = S3Sync.decompress(data)
+            except urllib2.HTTPError, e:
+                result = log.ERROR
+                remote = True # Peer error
+                code = e.code
+                message = e.read()
+                try:
+                    # Sahana-Eden would send a JSON message,
+                    # try to extract the actual error message:
+                    message_json = json.loads(message)
+                    message = message_json.get("message", message)
+                except:
+                    pass
+                # Prefix as peer error and strip XML markup from the message
+                # @todo: better method to do this?
+                message = "<message>%s</message>" % message
+                try:
+                    markup = etree.XML(message)
+                    message = markup.xpath(".//text()")
+                    if message:
+                        message = " ".join(message)
+                    else:
+                        message = ""
+                except etree.XMLSyntaxError:
+                    pass
+                output = xml.json_message(False, code, message, tree=None)
+                break
+            except:
+                result = log.FATAL
+                code = 400
+                message = sys.exc_info()[1]
+                output = xml.json_message(False, code, message)
+                break
+
+            if not data:
+                # No data received from peer
+                result = log.ERROR
+                remote = True
+                message = "no data received from peer"
+                break
+
+            if chunk_size:
+                complete = info.get("X-Sync-Complete")
+                if complete is None:
+                    # Peer does not support chunked transfers, and
+                    # has sent only the first chunk => pull all at once
+                    _debug("...peer does not support chunked transfers")
+                    chunk_size = None
+                    cursor = resumed = None
+                    continue
+                next_cursor = info.get("X-Sync-Cursor") \
+                              if complete != "True" else None
+            else:
+                next_cursor = None
+
+            if next_cursor:
+                # Read ahead while importing this chunk
+                next_url = self._pull_url(task, chunk_size, next_cursor)
+                pending = (next_url, self._http_submit(next_url))
 
             # Import the data
             resource = current.s3db.resource(resource_name)
@@ -309,21 +354,22 @@ class S3SyncAdapter(S3SyncBaseAdapter):
                                                               resource)
             else:
                 onconflict_callback = None
-            count = 0
+            success = True
             try:
                 success = resource.import_xml(
-                                response,
+                                StringIO(data),
                                 ignore_errors=True,
                                 strategy=strategy,
                                 update_policy=update_policy,
                                 conflict_policy=conflict_policy,
                                 last_sync=last_pull,
                                 onconflict=onconflict_callback)
-                count = resource.import_count
             except IOError, e:
                 result = log.FATAL
                 message = "%s" % e
                 output = xml.json_message(False, 400, message)
+                db.rollback()
+                break
             except Exception, e:
                 # If we end up here, an uncaught error during import
                 # has occured which indicates a code defect! We log it
@@ -334,13 +380,14 @@ class S3SyncAdapter(S3SyncBaseAdapter):
                 message = "Uncaught Exception During Import: %s" % \
                           traceback.format_exc()
                 output = xml.json_message(False, 500, sys.exc_info()[1])
-
-            mtime = resource.mtime
+                db.rollback()
+                break
 
             # Log all validation errors
             if resource.error_tree is not None:
                 result = log.WARNING
-                message = "%s" % resource.error
+                message = "%s%s" % (message and "%s, " % message or "",
+                                    resource.error)
                 for element in resource.error_tree.findall("resource"):
                     for field in element.findall("data[@error]"):
                         error_msg = field.get("error", None)
@@ -359,17 +406,32 @@ class S3SyncAdapter(S3SyncBaseAdapter):
                 if not message:
                     message = "%s" % resource.error
                 output = xml.json_message(False, 400, message)
-                mtime = None
+                db.rollback()
+                break
 
-            # ...or report success
-            elif not message:
-                message = "data imported successfully (%s records)" % count
+            count += resource.import_count
+            chunks += 1
+            if resource.mtime and (not mtime or resource.mtime > mtime):
+                mtime = resource.mtime
+
+            # Commit the chunk and record the progress
+            task.update_record(pull_cursor=next_cursor)
+            db.commit()
 
-        elif result == log.SUCCESS:
-            # No data received from peer
-            result = log.ERROR
-            remote = True
-            message = "no data received from peer"
+            if not next_cursor:
+                break
+            cursor = next_cursor
+
+        if output is not None:
+            mtime = None
+        else:
+            if mtime is None and resumed:
+                # All data received before the interruption
+                mtime = S3Sync.parse_cursor(resumed)[0]
+            if not message:
+                message = "data imported successfully (%s records)" % count
+                if chunks > 1:
+                    message = "%s in %s chunks" % (message, chunks)
 
         # Log the operation
         log.write(repository_id=repository.id,
@@ -387,7 +449,9 @@ class S3SyncAdapter(S3SyncBaseAdapter):
     # -------------------------------------------------------------------------
     def push(self, task):
         """
-            Outgoing push
+            Outgoing push, in chunks of settings.sync.chunk_size records,
+            each chunk committed separately so that an interrupted push
+            resumes after the last complete chunk (task.push_cursor)
 
             @param task: the sync_task Row
         """
@@ -418,98 +482,97 @@ class S3SyncAdapter(S3SyncBaseAdapter):
             last_push = None
         _debug("...push to URL %s" % url)
 
-        # Define the resource
-        resource = current.s3db.resource(resource_name,
-                                         include_deleted=True)
-
         # Apply sync filters for this task
         filters = current.sync.get_filters(task.id)
 
-        # Export the resource as S3XML
-        data = resource.export_xml(filters=filters,
-                                   msince=last_push)
-        count = resource.results or 0
-        mtime = resource.muntil
+        settings = current.deployment_settings
+        chunk_size = settings.get_sync_chunk_size()
+        compress = settings.get_sync_compress()
+        cursor = task.push_cursor
+
+        db = current.db
+        log = repository.log
 
-        # Transmit the data via HTTP
         remote = False
         output = None
-        log = repository.log
-        if data and count:
+        result = log.SUCCESS
+        mtime = None
+        count = 0
+        chunks = 0
+        while True:
+
+            # Define the resource
+            resource = current.s3db.resource(resource_name,
+                                             include_deleted=True)
 
-            # Find the protocol
-            url_split = url.split("://", 1)
-            if len(url_split) == 2:
-                protocol, path = url_split
+            # Export the next chunk as S3XML
+            if chunk_size:
+                orderby = S3Sync.apply_cursor(resource, cursor)
             else:
-                protocol, path = "http", None
-
-            # Generate the request
-            import urllib2
-            req = urllib2.Request(url=url, data=data)
-            req.add_header('Content-Type', "text/xml")
-            handlers = []
-
-            # Proxy handling
-            proxy = repository.proxy or config.proxy or None
-            if proxy:
-                _debug("using proxy=%s" % proxy)
-                proxy_handler = urllib2.ProxyHandler({protocol: proxy})
-                handlers.append(proxy_handler)
-
-            # Authentication
-            username = repository.username
-            password = repository.password
-            if username and password:
-                # send auth credentials unsolicitedly
-                import base64
-                base64string = base64.encodestring('%s:%s' %
-                                                   (username, password))[:-1]
-                req.add_header("Authorization", "Basic %s" % base64string)
-                # Just in case the peer does not accept that
-                # => add a 401 handler:
-                passwd_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
-                passwd_manager.add_password(realm=None,
-                                            uri=url,
-                                            user=username,
-                                            passwd=password)
-                auth_handler = urllib2.HTTPBasicAuthHandler(passwd_manager)
-                handlers.append(auth_handler)
-
-            # Install all handlers
-            if handlers:
-                opener = urllib2.build_opener(*handlers)
-                urllib2.install_opener(opener)
-
-            # Execute the request
-            try:
-                f = urllib2.urlopen(req)
-            except urllib2.HTTPError, e:
-                result = log.FATAL
-                remote = True # Peer error
-                code = e.code
-                message = e.read()
+                orderby = None
+            tree = resource.export_xml(filters=filters,
+                                       msince=last_push,
+                                       limit=chunk_size or None,
+                                       orderby=orderby,
+                                       as_tree=True,
+                                       content_hash=True)
+            next_cursor = S3Sync.get_cursor(resource, chunk_size) \
+                          if chunk_size else None
+            if resource.muntil and (not mtime or resource.muntil > mtime):
+                mtime = resource.muntil
+
+            # Transmit the data via HTTP
+            results = resource.results or 0
+            if tree is not None and results:
+                data = xml.tostring(tree, pretty_print=False)
                 try:
-                    # Sahana-Eden sends a JSON message,
-                    # try to extract the actual error message:
-                    message_json = json.loads(message)
-                    message = message_json.get("message", message)
+                    self._http_request(url, data=data, compress=compress)
+                except urllib2.HTTPError, e:
+                    if compress and e.code == 400:
+                        # Peer may not support compressed data => retry
+                        _debug("...retry uncompressed")
+                        compress = False
+                        continue
+                    result = log.FATAL
+                    remote = True # Peer error
+                    code = e.code
+                    message = e.read()
+                    try:
+                        # Sahana-Eden sends a JSON message,
+                        # try to extract the actual error message:
+                        message_json = json.loads(message)
+                        message = message_json.get("message", message)
+                    except:
+                        pass
+                    output = xml.json_message(False, code, message)
+                    break
                 except:
-                    pass
-                output = xml.json_message(False, code, message)
-            except:
-                result = log.FATAL
-                code = 400
-                message = sys.exc_info()[1]
-                output = xml.json_message(False, code, message)
-            else:
-                result = log.SUCCESS
+                    result = log.FATAL
+                    code = 400
+                    message = sys.exc_info()[1]
+                    output = xml.json_message(False, code, message)
+                    break
+                count += results
+                chunks += 1
+
+            # Record the progress
+            if chunk_size:
+                task.update_record(push_cursor=next_cursor)
+                db.commit()
+
+            if not next_cursor:
+                break
+            cursor = next_cursor
+
+        if output is None:
+            if count:
                 message = "data sent successfully (%s records)" % count
-
-        else:
-            # No data to send
-            result = log.WARNING
-            message = "No data to send"
+                if chunks > 1:
+                    message = "%s in %s chunks" % (message, chunks)
+            else:
+                # No data to send
+                result = log.WARNING
+                message = "No data to send"
 
         # Log the operation
         log.write(repository_id=repository.id,
@@ -525,4 +588,68 @@ class S3SyncAdapter(S3SyncBaseAdapter):
             mtime = None
         return (output, mtime)
 
+    # -------------------------------------------------------------------------
+    def _http_request(self, url, data=None, compress=False):
+        """
+            Send an HTTP request to the peer repository, using the
+            persistent session with the repository
+
+            @param url: the URL
+            @param data: the data to POST (S3XML), None for GET
+            @param compress: gzip-compress the data
+
+            @return: the response (file-like object)
+
+            @raises: urllib2.HTTPError for peer errors, or any other
+                     exception if the request fails
+        """
+
+        data, headers = self._http_prepare(data, compress)
+        return self.repository.session.request(url, data, headers)
+
+    # -------------------------------------------------------------------------
+    def _http_submit(self, url, data=None, compress=False):
+        """
+            Send an HTTP request to the peer repository in the background
+
+            @param url: the URL
+            @param data: the data to POST (S3XML), None for GET
+            @param compress: gzip-compress the data
+
+            @return: S3SyncFuture to get the response (or the exception)
+        """
+
+        data, headers = self._http_prepare(data, compress)
+        return self.repository.session.submit(url, data, headers)
+
+    # -------------------------------------------------------------------------
+    def _http_prepare(self, data=None, compress=False):
+        """
+            Prepare the data and headers for an HTTP request
+
+            @param data: the data to POST (S3XML), None for GET
+            @param compress: gzip-compress the data
+
+            @return: tuple (data, headers)
+        """
+
+        headers = {"Accept-Encoding": "gzip"}
+        if data is not None:
+            headers["Content-Type"] = "text/xml"
+            if compress:
+                data = S3Sync.compress(data)
+                headers["Content-Encoding"] = "gzip"
+
+        # Send auth data unsolicitedly (the only way with Eden instances)
+        repository = self.repository
+        username = repository.username
+        password = repository.password
+        if username and password:
+            import base64
+            base64string = base64.encodestring('%s:%s' %
+                                               (username, password))[:-1]
+            headers["Authorization"] = "Basic %s" % base64string
+
+        return data, headers
+
 # End =========================================================================
@@ -483,6 +483,14 @@ class S3Config(Storage):
         return self.security.get("audit_read", False)
     def get_security_audit_write(self):
         return self.security.get("audit_write", False)
+    def get_security_changelog(self):
+        """
+            Number of days to keep the change-log (which is used to find
+            deletions of components for sync), 0 to disable (default)
+            - writes to S3 tables bypassing S3 (i.e. without S3Audit) are
+              not logged, so only enable if the deployment does not do that
+        """
+        return self.security.get("changelog", 0)
     def get_security_policy(self):
         " Default is Simple Security Policy "
         return self.security.get("policy", 1)
@@ -527,6 +535,18 @@ class S3Config(Storage):
     def get_base_fake_migrate(self):
         """ Whether to have Web2Py create the .table files to match the expected SQL database structure """
         return self.base.get("fake_migrate", False)
+
+    def get_base_scheduler_queues(self):
+        """
+            Scheduler queues, in order of priority (highest first), as
+            list of tuples (name, number of workers)
+            - the workers of each queue also pick up tasks of the queues
+              with higher priority when idle, whilst tasks of a queue
+              never run on more than its own (and lower-priority) workers
+            - which task goes to which queue: s3.task_queues in models/tasks.py
+            - tasks of unconfigured queues go to the first queue
+        """
+        return self.base.get("scheduler_queues", [("main", 1)])
         
     def get_base_prepopulate(self):
         """ Whether to prepopulate the database &, if so, which set of data to use for this """
@@ -724,6 +744,15 @@ class S3Config(Storage):
         """
         return self.gis.get("cluster_label", True)
 
+    def get_gis_cluster_server(self):
+        """
+            Cluster the points of large Feature Layers on the server?
+            - if True, layers with more than max_features points in the
+              current bbox are returned as grid clusters (with counts)
+              rather than as individual features
+        """
+        return self.gis.get("cluster_server", False)
+
     def get_gis_cluster_stroke(self):
         """
             Stroke for Clustered points on Map, else default
@@ -778,6 +807,27 @@ class S3Config(Storage):
         """
         return self.gis.get("geocode_imported_addresses", False)
 
+    def get_gis_geocode_gazetteer(self):
+        """
+            Should addresses which the external Geocoder can't resolve
+            be matched against the names of our own Locations?
+        """
+        return self.gis.get("geocode_gazetteer", True)
+
+    def get_gis_geocode_rate(self):
+        """
+            Maximum number of requests per second to send to the
+            external Geocoder during bulk geocoding (0 = unlimited)
+        """
+        return self.gis.get("geocode_rate", 5)
+
+    def get_gis_geocode_threads(self):
+        """
+            Number of concurrent requests to the external Geocoder
+            during bulk geocoding
+        """
+        return self.gis.get("geocode_threads", 4)
+
     def get_gis_geolocate_control(self):
         """
             Whether the map should have a Geolocate control
@@ -1424,6 +1474,16 @@ class S3Config(Storage):
 
         return self.ui.get("summary", None)
 
+    def get_ui_widget_cache(self):
+        """
+            Time in seconds to cache the output of Ajax-requests for
+            summary and profile page widgets (per widget, URL filters and
+            realms of the user), set to 0 to disable
+            - cached outputs are invalidated anyway when any of the
+              tables they are read from are written to
+        """
+        return self.ui.get("widget_cache", 60)
+
     def get_ui_filter_auto_submit(self):
         """
             Time in milliseconds after the last filter option change to
@@ -1465,6 +1525,13 @@ class S3Config(Storage):
             to retry forever.
         """
         return self.msg.get("max_send_retries", 9)
+
+    def get_msg_outbox_workers(self):
+        """
+            Number of concurrent SMTP connections to send the emails
+            in the outbox with (each in a separate thread)
+        """
+        return self.msg.get("outbox_workers", 4)
     
     # -------------------------------------------------------------------------
     # Mail settings
@@ -1552,6 +1619,42 @@ class S3Config(Storage):
         """
         return self.msg.get("notify_renderer", None)
 
+    def get_msg_notify_batch(self):
+        """
+            Process update notifications in batches, i.e. look up the
+            updates once for all subscriptions with the same resource,
+            filter, check time and permissions, rather than sending a
+            separate lookup request to the server for every subscription
+            - the lookup does not run the controller pre-processing (prep),
+              so only enable this if the subscribed resources do not
+              require it in order to filter or represent the updates
+              correctly
+            - subscriptions with last check times in the same window (of
+              their check interval) share the lookup from the earliest
+              of them, so subscribers may receive some updates twice
+        """
+        return self.msg.get("notify_batch", False)
+
+    # -------------------------------------------------------------------------
+    # Inbound Channels
+    #
+    def get_msg_poll_all(self):
+        """
+            Inbound channel types (tablenames) to poll all at once in
+            a single scheduled task (msg_poll_all) rather than in a
+            separate task per channel, e.g. ["msg_rss_channel"]
+            - RSS feeds are then fetched concurrently
+            - the task is scheduled when enabling a channel of the type,
+              so re-enable existing channels after changing this setting
+        """
+        return self.msg.get("poll_all", [])
+
+    def get_msg_poll_workers(self):
+        """
+            Number of RSS feeds to fetch concurrently in msg_poll_all
+        """
+        return self.msg.get("poll_workers", 8)
+
     # -------------------------------------------------------------------------
     # SMS
     #
@@ -1562,6 +1665,32 @@ class S3Config(Storage):
         """
 
         return self.msg.get("require_international_phone_numbers", True)
+
+    def get_msg_sms_workers(self):
+        """
+            Number of concurrent requests per Web API channel when
+            sending the SMS in the outbox
+        """
+        return self.msg.get("sms_workers", 2)
+
+    def get_msg_sms_rate(self):
+        """
+            Maximum number of SMS per second to send through each
+            Web API channel (None for unlimited), or a dict with the
+            rate per channel name, like:
+                {"Clickatell": 5, None: 1}
+            where None is the default for all other channels
+        """
+        return self.msg.get("sms_rate", None)
+
+    def get_msg_sms_retries(self):
+        """
+            Number of times to retry sending an SMS through a Web API
+            channel if the gateway has not accepted it (connection refused,
+            HTTP 429 or 503), with exponential backoff starting at 1 second,
+            before counting the attempt as failed
+        """
+        return self.msg.get("sms_retries", 0)
     
     # =========================================================================
     # Search
@@ -1593,6 +1722,15 @@ class S3Config(Storage):
         """ Text for saved filter update-button """
         return self.search.get("filter_manager_update", None)
 
+    def get_search_filter_options_cache(self):
+        """
+            Time in seconds to cache the options of filter widgets (per
+            resource, field and realms of the user), set to 0 to disable
+            - cached options are invalidated anyway when any of the
+              tables they are looked up from are written to
+        """
+        return self.search.get("filter_options_cache", 300)
+
     def get_search_filter_manager_delete(self):
         """ Text for saved filter delete-button """
         return self.search.get("filter_manager_delete", None)
@@ -1604,6 +1742,42 @@ class S3Config(Storage):
     # =========================================================================
     # Sync
     #
+    def get_sync_chunk_size(self):
+        """
+            Maximum number of records per request in sync transfers with
+            Sahana Eden peers (pull and push), 0 or None to transfer all
+            records in one request
+            - each chunk is committed separately, and interrupted
+              transfers resume after the last complete chunk
+        """
+
+        return self.sync.get("chunk_size", 500)
+
+    def get_sync_connections(self):
+        """
+            Maximum number of concurrent connections to a Sahana Eden
+            peer during synchronization (the pulls of all tasks of a
+            repository are transferred concurrently)
+        """
+
+        return self.sync.get("connections", 4)
+
+    def get_sync_timeout(self):
+        """
+            Socket timeout (seconds) for HTTP requests to Sahana Eden
+            peers during synchronization
+        """
+
+        return self.sync.get("timeout", 120)
+
+    def get_sync_compress(self):
+        """
+            Whether to gzip-compress the data pushed to Sahana Eden peers
+            (pulled data are compressed if the peer supports it)
+        """
+
+        return self.sync.get("compress", True)
+
     def get_sync_mcb_resource_identifiers(self):
         """
             Resource (=data type) identifiers for synchronization with
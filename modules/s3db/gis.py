@@ -34,6 +34,7 @@ __all__ = ("S3LocationModel",
            "S3LocationTagModel",
            "S3LocationGroupModel",
            "S3LocationHierarchyModel",
+           "S3GeocodeCacheModel",
            "S3GISConfigModel",
            "S3LayerEntityModel",
            "S3FeatureLayerModel",
@@ -368,9 +369,11 @@ class S3LocationModel(S3Model):
                        context = {"location": "parent",
                                   },
                        deduplicate = self.gis_location_duplicate,
+                       fulltext = ["name"],
                        list_fields = list_fields,
                        list_orderby = "gis_location.name",
                        onaccept = self.gis_location_onaccept,
+                       onimport = self.gis_location_onimport,
                        onvalidation = self.gis_location_onvalidation,
                        )
 
@@ -465,6 +468,80 @@ class S3LocationModel(S3Model):
                                  args=[feature])
         return
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def gis_location_onimport(ids):
+        """
+            On Import for GIS Locations: geocode all imported addresses
+            without coordinates in a single bulk request
+
+            @param ids: the record IDs of the imported locations
+        """
+
+        if current.auth.rollback:
+            # Test import
+            return
+
+        geocoder = current.deployment_settings.get_gis_geocode_imported_addresses()
+        if not geocoder:
+            return
+
+        db = current.db
+        gis = current.gis
+        table = db.gis_location
+
+        query = (table.id.belongs(ids)) & \
+                (table.addr_street != None) & \
+                (table.lat == None) & \
+                (table.lon == None)
+        rows = db(query).select(table.id,
+                                table.addr_street,
+                                table.addr_postcode,
+                                table.parent,
+                                )
+        if not rows:
+            return
+
+        addresses = []
+        append = addresses.append
+        for row in rows:
+            parent = row.parent
+            if parent:
+                # Build Path (may not be populated yet)
+                Lx_ids = gis.get_parents(parent, ids_only=True)
+                if Lx_ids:
+                    Lx_ids.append(parent)
+                else:
+                    Lx_ids = [parent]
+            else:
+                Lx_ids = None
+            append((row.addr_street, row.addr_postcode, Lx_ids))
+
+        results = gis.geocode_bulk(addresses, geocoder)
+
+        spatialdb = current.deployment_settings.get_gis_spatialdb()
+        for row, result in zip(rows, results):
+            if isinstance(result, basestring):
+                # Error
+                current.log.error("%s (location %s)" % (result, row.id))
+                continue
+            lat = result["lat"]
+            lon = result["lon"]
+            wkt = "POINT(%f %f)" % (lon, lat)
+            data = dict(lat = lat,
+                        lon = lon,
+                        wkt = wkt,
+                        gis_feature_type = 1,
+                        lat_min = lat,
+                        lat_max = lat,
+                        lon_min = lon,
+                        lon_max = lon,
+                        )
+            if spatialdb:
+                data["the_geom"] = wkt
+            db(table.id == row.id).update(**data)
+        return
+
     # -------------------------------------------------------------------------
     @staticmethod
     def gis_location_onvalidation(form):
@@ -485,32 +562,6 @@ class S3LocationModel(S3Model):
         parent = vars_get("parent", None)
         lat = vars_get("lat", None)
         lon = vars_get("lon", None)
-        addr_street = vars_get("addr_street", None)
-
-        if addr_street and lat is None and lon is None and \
-           response.s3.bulk:
-            geocoder = current.deployment_settings.get_gis_geocode_imported_addresses()
-            if geocoder:
-                # Geocode imported addresses
-                postcode = vars_get("postcode", None)
-                # Build Path (won't be populated yet)
-                if parent:
-                    Lx_ids = gis.get_parents(parent, ids_only=True)
-                    if Lx_ids:
-                       Lx_ids.append(parent) 
-                    else:
-                        Lx_ids = [parent]
-                else:
-                    Lx_ids = None
-                results = gis.geocode(addr_street, postcode, Lx_ids, geocoder)
-                if isinstance(results, basestring):
-                    # Error
-                    current.log.error(results)
-                    form.errors["addr_street"] = results
-                    return
-                else:
-                    form_vars.lon = lon = results["lon"]
-                    form_vars.lat = lat = results["lat"]
 
         if lon:
             if lon > 180:
@@ -1490,6 +1541,36 @@ class S3LocationHierarchyModel(S3Model):
                 for gap in gaps:
                     form.errors[gap] = hierarchy_gap
 
+# =============================================================================
+class S3GeocodeCacheModel(S3Model):
+    """
+        Geocoder Results Cache
+        - used by GIS.geocode_bulk to avoid repeated calls to the
+          external geocoder for the same address
+    """
+
+    names = ("gis_geocode_cache",)
+
+    def model(self):
+
+        # ---------------------------------------------------------------------
+        # Geocoder Results
+        #
+        tablename = "gis_geocode_cache"
+        self.define_table(tablename,
+                          # Hash of geocoder name and query
+                          Field("query_key", length=64,
+                                notnull=True, unique=True,
+                                ),
+                          Field("location", "text"),
+                          Field("geocoder"),
+                          Field("lat", "double"),
+                          Field("lon", "double"),
+                          *s3_meta_fields())
+
+        # Pass names back to global scope (s3.*)
+        return dict()
+
 # =============================================================================
 class S3GISConfigModel(S3Model):
     """
@@ -206,6 +206,27 @@ class S3ChannelModel(S3Model):
         query = ((ttable.function_name == "msg_poll") & \
                  (ttable.args == args) & \
                  (ttable.status.belongs(["RUNNING", "QUEUED", "ALLOCATED"])))
+
+        if tablename in current.deployment_settings.get_msg_poll_all():
+            # Polled together with all other channels of this type
+            # => disable any old task for this channel
+            db(query).update(status="STOPPED")
+
+            # Schedule the msg_poll_all task unless it exists already
+            query = ((ttable.function_name == "msg_poll_all") & \
+                     (ttable.args == '["%s"]' % tablename) & \
+                     (ttable.status.belongs(["RUNNING", "QUEUED", "ALLOCATED"])))
+            exists = db(query).select(ttable.id,
+                                      limitby=(0, 1)).first()
+            if not exists:
+                current.s3task.schedule_task("msg_poll_all",
+                                             args = [tablename],
+                                             period = 300,  # seconds
+                                             timeout = 300, # seconds
+                                             repeats = 0    # unlimited
+                                             )
+            return "Channel enabled"
+
         exists = db(query).select(ttable.id,
                                   limitby=(0, 1)).first()
         if exists:
@@ -605,6 +626,15 @@ class S3EmailModel(S3ChannelModel):
                      # Set true to delete messages from the remote
                      # inbox after fetching them.
                      Field("delete_from_server", "boolean"),
+                     # IMAP: UIDs of already fetched messages (watermark)
+                     Field("uid_validity", "integer",
+                           readable = False,
+                           writable = False,
+                           ),
+                     Field("last_uid", "integer",
+                           readable = False,
+                           writable = False,
+                           ),
                      *s3_meta_fields())
 
         configure(tablename,
@@ -1302,6 +1332,11 @@ class S3RSSModel(S3ChannelModel):
                            readable = False,
                            writable = False,
                            ),
+                     # Hash of the feed entry, to skip unchanged entries
+                     Field("content_hash", length=32,
+                           readable = False,
+                           writable = False,
+                           ),
                      *s3_meta_fields())
 
         self.configure(tablename,
@@ -505,6 +505,9 @@ class S3OrganisationModel(S3Model):
                   crud_form = crud_form,
                   deduplicate = self.organisation_duplicate,
                   filter_widgets = filter_widgets,
+                  fulltext = ["name",
+                              "acronym",
+                              ],
                   list_fields = ["id",
                                  "name",
                                  "acronym",
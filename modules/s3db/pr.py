@@ -886,6 +886,11 @@ class S3PersonModel(S3Model):
                        crud_form = crud_form,
                        deduplicate = self.person_deduplicate,
                        filter_widgets = filter_widgets,
+                       fulltext = ["pe_label",
+                                   "first_name",
+                                   "middle_name",
+                                   "last_name",
+                                   ],
                        list_fields = ["id",
                                       "first_name",
                                       "middle_name",
@@ -3157,6 +3162,11 @@ class S3SavedFilterModel(S3Model):
                           Field("url"),
                           Field("description", "text"),
                           Field("query", "text"),
+                          # Compiled query, see S3FilterString
+                          Field("serialized", "text",
+                                readable = False,
+                                writable = False,
+                                ),
                           s3_comments(),
                           *s3_meta_fields())
 
@@ -3172,6 +3182,8 @@ class S3SavedFilterModel(S3Model):
                                     ondelete = "SET NULL")
 
         self.configure(tablename,
+                       # Compiled query for S3FilterString
+                       extra_fields = ["serialized"],
                        list_fields = ["title",
                                       "resource",
                                       "url",
@@ -3179,6 +3191,7 @@ class S3SavedFilterModel(S3Model):
                                       ],
                        listadd = False,
                        list_layout = pr_filter_list_layout,
+                       onaccept = self.pr_filter_onaccept,
                        onvalidation = self.pr_filter_onvalidation,
                        orderby = "pr_filter.resource",
                        )
@@ -3204,6 +3217,41 @@ class S3SavedFilterModel(S3Model):
                 form.errors.query = "%s: %s" % (current.T("Query invalid"), e)
             form.vars.query = query
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def pr_filter_onaccept(form):
+        """
+            Compile the filter query, so it doesn't need to be parsed
+            again every time the filter is used
+        """
+
+        try:
+            record_id = form.vars.id
+        except AttributeError:
+            return
+        if not record_id:
+            return
+
+        table = current.s3db.pr_filter
+        record = current.db(table.id == record_id).select(table.id,
+                                                          table.resource,
+                                                          table.query,
+                                                          limitby=(0, 1)
+                                                          ).first()
+        if not record:
+            return
+
+        serialized = None
+        if record.resource and record.query:
+            try:
+                resource = current.s3db.resource(record.resource)
+            except (AttributeError, KeyError, SyntaxError):
+                resource = None
+            if resource is not None:
+                fstring = S3FilterString(resource, record.query)
+                serialized = fstring.serialize()
+        record.update_record(serialized=serialized)
+
 # =============================================================================
 class S3SubscriptionModel(S3Model):
     """ Model for subscriptions """
@@ -6394,7 +6442,8 @@ def pr_filter_list_layout(list_id, item_id, resource, rfields, record):
     title = record["pr_filter.title"]
 
     # Filter Query
-    fstring = S3FilterString(resource, raw["pr_filter.query"])
+    fstring = S3FilterString(resource, raw["pr_filter.query"],
+                             serialized=raw.get("pr_filter.serialized"))
     query = fstring.represent()
 
     # Actions
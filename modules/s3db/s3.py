@@ -27,16 +27,137 @@
     OTHER DEALINGS IN THE SOFTWARE.
 """
 
-__all__ = ["S3HierarchyModel"]
+__all__ = ["S3ChangeLogModel",
+           "S3ContentHashModel",
+           "S3FullTextModel",
+           "S3HierarchyModel",
+           "S3ReportCubeModel",
+           "S3TableVersionModel",
+           "S3TaskBatchModel",
+           ]
 
 from gluon import *
 from ..s3 import *
 
+# =============================================================================
+class S3ChangeLogModel(S3Model):
+    """ Model for the change-log of record writes, see S3ChangeLog """
+
+    names = ["s3_changelog"]
+
+    def model(self):
+
+        define_table = self.define_table
+
+        # ---------------------------------------------------------------------
+        # Change-Log
+        # - one row per record write, the record ID is the sequence number,
+        #   plus a marker row (op="start") with the time since when the
+        #   log is complete
+        #
+        tablename = "s3_changelog"
+        define_table(tablename,
+                     Field("tablename", length=64),
+                     Field("record_id", "integer"),
+                     Field("op", length=8),
+                     Field("timestmp", "datetime"),
+                     )
+
+        # ---------------------------------------------------------------------
+        # Return global names to s3.*
+        #
+        return {}
+
+    # -------------------------------------------------------------------------
+    def defaults(self):
+        """ Safe defaults if module is disabled """
+
+        return {}
+
+# =============================================================================
+class S3ContentHashModel(S3Model):
+    """
+        Model for the content hashes of imported records, see
+        S3ImportItem.commit
+    """
+
+    names = ["s3_content_hash"]
+
+    def model(self):
+
+        define_table = self.define_table
+
+        # ---------------------------------------------------------------------
+        # Content hashes
+        # - one row per record imported from an element with a content
+        #   hash (S3XML "hash" attribute), with the modification date of
+        #   the record after the import, so that records can be skipped
+        #   if they are re-imported unchanged and haven't been modified
+        #   locally in the meantime
+        #
+        tablename = "s3_content_hash"
+        define_table(tablename,
+                     Field("tablename", length=64),
+                     Field("record_id", "integer"),
+                     Field("hash", length=32),
+                     Field("mtime", "datetime"),
+                     )
+
+        # ---------------------------------------------------------------------
+        # Return global names to s3.*
+        #
+        return {}
+
+    # -------------------------------------------------------------------------
+    def defaults(self):
+        """ Safe defaults if module is disabled """
+
+        return {}
+
+# =============================================================================
+class S3FullTextModel(S3Model):
+    """
+        Model for the full-text index of text fields (trigrams), used
+        where the database has no native full-text search, see S3FullText
+    """
+
+    names = ["s3_fulltext"]
+
+    def model(self):
+
+        define_table = self.define_table
+
+        # ---------------------------------------------------------------------
+        # Full-text Index
+        # - one row per distinct trigram of the indexed fields in a record,
+        #   plus one row per table with trigram=None and record_id=the
+        #   highest record ID at the time the index was built
+        #
+        tablename = "s3_fulltext"
+        define_table(tablename,
+                     Field("tablename", length=64),
+                     Field("record_id", "integer"),
+                     Field("trigram", length=3),
+                     )
+
+        # ---------------------------------------------------------------------
+        # Return global names to s3.*
+        #
+        return {}
+
+    # -------------------------------------------------------------------------
+    def defaults(self):
+        """ Safe defaults if module is disabled """
+
+        return {}
+
 # =============================================================================
 class S3HierarchyModel(S3Model):
     """ Model for stored object hierarchies, experimental """
 
-    names = ["s3_hierarchy"]
+    names = ["s3_hierarchy",
+             "s3_hierarchy_interval",
+             ]
 
     def model(self):
 
@@ -51,8 +172,138 @@ class S3HierarchyModel(S3Model):
                            length=64),
                      Field("dirty", "boolean",
                            default=False),
+                     # Version stamp of the stored hierarchy
+                     Field("version", length=32),
                      Field("hierarchy", "json"),
+                     # Version of the hierarchy the stored intervals
+                     # (s3_hierarchy_interval) have been computed for
+                     Field("intervals", length=32),
+                     *s3_timestamp())
+
+        # ---------------------------------------------------------------------
+        # Pre-order intervals of the nodes in a stored hierarchy
+        # (for range queries, see S3Hierarchy.range_query)
+        #
+        tablename = "s3_hierarchy_interval"
+        define_table(tablename,
+                     Field("hierarchy_id", "reference s3_hierarchy",
+                           ondelete = "CASCADE",
+                           ),
+                     Field("node_id", "integer"),
+                     Field("lft", "integer"),
+                     Field("rgt", "integer"),
+                     )
+        # ---------------------------------------------------------------------
+        # Return global names to s3.*
+        #
+        return {}
+
+    # -------------------------------------------------------------------------
+    def defaults(self):
+        """ Safe defaults if module is disabled """
+
+        return {}
+
+# =============================================================================
+class S3ReportCubeModel(S3Model):
+    """
+        Model for materialized report cubes (pre-aggregated pivot tables,
+        see S3ReportCube), experimental
+    """
+
+    names = ["s3_report_cube",
+             "s3_report_cube_cell",
+             "s3_report_cube_record",
+             ]
+
+    def model(self):
+
+        define_table = self.define_table
+
+        # ---------------------------------------------------------------------
+        # Report Cube
+        #
+        tablename = "s3_report_cube"
+        define_table(tablename,
+                     Field("tablename",
+                           length=64),
+                     # Hash of the cube definition
+                     Field("cube",
+                           length=32,
+                           unique=True),
+                     # Versions of the other tables the cube depends on
+                     Field("versions", "json"),
+                     *s3_timestamp())
+
+        # ---------------------------------------------------------------------
+        # Report Cube Cell
+        #
+        tablename = "s3_report_cube_cell"
+        define_table(tablename,
+                     Field("cube_id", "reference s3_report_cube",
+                           ondelete="CASCADE"),
+                     # Hash of the dimension values
+                     Field("cell",
+                           length=32),
+                     # Pickled (row value, column value)
+                     Field("dimensions", "text"),
+                     Field("numrecords", "integer"),
+                     # Pickled partial aggregate
+                     Field("partial", "text"),
+                     # Pickled distinct fact values (count layers)
+                     Field("fvalues", "text"),
+                     )
+
+        # ---------------------------------------------------------------------
+        # Report Cube Record: the cell of each record, to know which cells
+        # are affected when the record changes (cell=None for records which
+        # have been written since the last refresh of the cube)
+        #
+        tablename = "s3_report_cube_record"
+        define_table(tablename,
+                     Field("cube_id", "reference s3_report_cube",
+                           ondelete="CASCADE"),
+                     Field("record_id", "integer"),
+                     Field("cell",
+                           length=32),
+                     )
+
+        # ---------------------------------------------------------------------
+        # Return global names to s3.*
+        #
+        return {}
+
+    # -------------------------------------------------------------------------
+    def defaults(self):
+        """ Safe defaults if module is disabled """
+
+        return {}
+
+# =============================================================================
+class S3TableVersionModel(S3Model):
+    """
+        Model for per-table version counters, incremented whenever a
+        record in the table is written, used to invalidate caches
+    """
+
+    names = ["s3_table_version"]
+
+    def model(self):
+
+        define_table = self.define_table
+
+        # ---------------------------------------------------------------------
+        # Table Version
+        #
+        tablename = "s3_table_version"
+        define_table(tablename,
+                     Field("tablename",
+                           length=64,
+                           unique=True),
+                     Field("version", "integer",
+                           default=0),
                      *s3_timestamp())
+
         # ---------------------------------------------------------------------
         # Return global names to s3.*
         #
@@ -64,5 +315,45 @@ class S3HierarchyModel(S3Model):
 
         return {}
 
+# =============================================================================
+class S3TaskBatchModel(S3Model):
+    """ Model for the pending calls of batched tasks, see S3Task.async """
+
+    names = ["s3_task_batch"]
+
+    def model(self):
+
+        define_table = self.define_table
+
+        # ---------------------------------------------------------------------
+        # Pending calls of batched tasks
+        # - one row per distinct combination of args and vars, all rows
+        #   of a task are run together in a single scheduler task
+        # - rows are claimed by the batch running them (status RUNNING),
+        #   and removed after success
+        #
+        tablename = "s3_task_batch"
+        define_table(tablename,
+                     Field("task_name", length=64),
+                     Field("args", "text"),
+                     Field("vars", "text"),
+                     Field("timeout", "integer"),
+                     # None (pending), RUNNING or FAILED
+                     Field("status", length=16),
+                     # The batch which has claimed the call
+                     Field("worker", length=64),
+                     Field("claimed_on", "datetime"),
+                     )
+
+        # ---------------------------------------------------------------------
+        # Return global names to s3.*
+        #
+        return {}
+
+    # -------------------------------------------------------------------------
+    def defaults(self):
+        """ Safe defaults if module is disabled """
+
+        return {}
 
 # END =========================================================================
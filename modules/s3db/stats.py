@@ -544,7 +544,12 @@ class S3StatsDemographicModel(S3Model):
         ttable = db.scheduler_task
         rtable = db.scheduler_run
         wtable = db.scheduler_worker
-        query = (ttable.task_name == "stats_demographic_update_aggregates") & \
+        # NB The task is batched (see models/tasks.py), i.e. run by
+        #    s3task_batch tasks
+        task_name = "stats_demographic_update_aggregates"
+        query = ((ttable.task_name == task_name) | \
+                 ((ttable.task_name == S3Task.BATCH_TASK) & \
+                  (ttable.args == '["%s"]' % task_name))) & \
                 (rtable.task_id == ttable.id) & \
                 (rtable.status == "RUNNING")
         rows = db(query).select(rtable.id,
@@ -558,6 +563,11 @@ class S3StatsDemographicModel(S3Model):
             db(ttable.id == row.task_id).update(stop_time=now,
                                                 status="STOPPED")
 
+        # Remove all pending calls of the batch, as they are superseded
+        # by the rebuild
+        btable = current.s3db.s3_task_batch
+        db(btable.task_name == task_name).delete()
+
         # Delete the existing aggregates
         current.s3db.stats_demographic_aggregate.truncate()
 
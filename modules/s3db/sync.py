@@ -333,6 +333,13 @@ class SyncDataModel(S3Model):
                            readable=True,
                            writable=False,
                            label=T("Last push on")),
+                     # Continuation tokens of interrupted transfers
+                     Field("pull_cursor",
+                           readable=False,
+                           writable=False),
+                     Field("push_cursor",
+                           readable=False,
+                           writable=False),
                      Field("mode", "integer",
                            requires = IS_IN_SET(sync_mode,
                                                 zero=None),
@@ -397,6 +397,7 @@ class S3OptionsMenu(object):
                         M("Raw Database access", c="appadmin", f="index")
                     ),
                     M("Error Tickets", c="admin", f="errors"),
+                    M("Scheduler", c="admin", f="task"),
                     M("Synchronization", c="sync", f="index")(
                         M("Settings", f="config", args=[1], m="update"),
                         M("Repositories", f="repository"),
@@ -1,9 +1,11 @@
 from unit_tests.s3.s3aaa import *
 from unit_tests.s3.s3cfg import *
 from unit_tests.s3.s3crud import *
+from unit_tests.s3.s3data import *
 from unit_tests.s3.s3datatable import *
 from unit_tests.s3.s3fields import *
 from unit_tests.s3.s3filter import *
+from unit_tests.s3.s3gis import *
 from unit_tests.s3.s3hierarchy import *
 from unit_tests.s3.s3import import *
 from unit_tests.s3.s3model import *
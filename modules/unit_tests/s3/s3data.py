@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+#
+# S3Data Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3data.py
+#
+import imp
+import unittest
+
+from gluon import *
+from s3 import FS, s3_meta_fields, S3ReportCube
+from s3.s3data import S3PivotTable
+
+# =============================================================================
+class PythonPivotTable(S3PivotTable):
+    """ Pivot table which is always computed from the records """
+
+    def _cube_pivot(self):
+        return False
+
+    def _sql_pivot(self):
+        return False
+
+# =============================================================================
+class ScalarPivotTable(PythonPivotTable):
+    """ Pivot table which is computed without NumPy """
+
+    def _columnar_pivot(self, items, pkey_colname, rows_colname, cols_colname):
+        return False
+
+# =============================================================================
+class PivotTableTests(unittest.TestCase):
+    """ Tests for S3PivotTable """
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def setUpClass(cls):
+
+        s3db = current.s3db
+
+        s3db.define_table("test_pivot_category",
+                          Field("name"),
+                          *s3_meta_fields())
+
+        s3db.define_table("test_pivot",
+                          Field("category_id", "reference test_pivot_category"),
+                          Field("area"),
+                          Field("value", "integer"),
+                          Field("tags", "list:string"),
+                          *s3_meta_fields())
+
+        current.auth.override = True
+
+        db = current.db
+        ctable = db.test_pivot_category
+        categories = [ctable.insert(name=name) for name in ("A", "B", "C")]
+
+        table = db.test_pivot
+        data = (("A", "North", 3, ["x"]),
+                ("A", "North", 5, ["x", "y"]),
+                ("A", "South", None, []),
+                ("B", "South", 7, ["y"]),
+                ("B", "East", 1, ["z"]),
+                ("C", None, 4, ["x"]),
+                ("C", "East", 4, None),
+                )
+        for category, area, value, tags in data:
+            table.insert(category_id=categories["ABC".index(category)],
+                         area=area,
+                         value=value,
+                         tags=tags)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def tearDownClass(cls):
+
+        db = current.db
+        db.test_pivot.drop()
+        db.test_pivot_category.drop()
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def assertSamePivot(self, sql, python):
+        """ Check that two pivot tables have the same contents """
+
+        self.assertEqual(len(sql), len(python))
+        self.assertEqual(sql.numrows, python.numrows)
+        self.assertEqual(sql.numcols, python.numcols)
+
+        ridx = dict((row.value, i) for i, row in enumerate(python.row))
+        cidx = dict((col.value, j) for j, col in enumerate(python.col))
+
+        for layer in python.layers:
+            self.assertEqual(sql.totals[layer], python.totals[layer])
+            for i, row in enumerate(sql.row):
+                r = ridx[row.value]
+                self.assertEqual(row[layer], python.row[r][layer])
+                for j, col in enumerate(sql.col):
+                    c = cidx[col.value]
+                    self.assertEqual(col[layer], python.col[c][layer])
+                    self.assertEqual(sql.cell[i][j][layer],
+                                     python.cell[r][c][layer])
+
+    # -------------------------------------------------------------------------
+    def testSQLPivot(self):
+        """ Test aggregation in the database """
+
+        resource = current.s3db.resource("test_pivot")
+        layers = [("value", "sum"),
+                  ("value", "avg"),
+                  ("value", "min"),
+                  ("value", "max"),
+                  ("area", "count"),
+                  ("id", "count"),
+                  ]
+
+        sql = S3PivotTable(resource, "category_id", "area", list(layers))
+        self.assertEqual(sql.records, None)
+        self.assertEqual(len(sql), 7)
+
+        python = PythonPivotTable(resource, "category_id", "area", list(layers))
+        self.assertNotEqual(python.records, None)
+
+        self.assertSamePivot(sql, python)
+
+        # Drill-down values for count layers
+        json = sql.json(layer=("test_pivot.area", "count"))
+        self.assertNotEqual(json["lookup"], None)
+
+    # -------------------------------------------------------------------------
+    def testSQLPivotReference(self):
+        """ Test aggregation in the database with a referenced field """
+
+        resource = current.s3db.resource("test_pivot")
+        layers = [("value", "sum")]
+
+        sql = S3PivotTable(resource, "category_id$name", None, list(layers))
+        self.assertEqual(sql.records, None)
+
+        python = PythonPivotTable(resource, "category_id$name", None, list(layers))
+        self.assertSamePivot(sql, python)
+
+    # -------------------------------------------------------------------------
+    def testFallback(self):
+        """ Test fallback for list-type fields and list methods """
+
+        resource = current.s3db.resource("test_pivot")
+
+        pt = S3PivotTable(resource, "tags", "area", [("value", "sum")])
+        self.assertNotEqual(pt.records, None)
+
+        pt = S3PivotTable(resource, "category_id", "area", [("value", "list")])
+        self.assertNotEqual(pt.records, None)
+
+    # -------------------------------------------------------------------------
+    def testReportCube(self):
+        """ Test reading from a report cube, and incremental refresh """
+
+        db = current.db
+        s3db = current.s3db
+
+        s3db.configure("test_pivot",
+                       report_cubes = [{"rows": "category_id",
+                                        "cols": "area",
+                                        "fact": "sum(value)",
+                                        }],
+                       )
+        layers = [("value", "sum")]
+        try:
+            resource = s3db.resource("test_pivot")
+            cube = S3PivotTable(resource, "category_id", "area", list(layers))
+            # Read from the cube rather than aggregated in the database
+            self.assertEqual(cube.records, None)
+            self.assertEqual(cube.partials, None)
+
+            python = PythonPivotTable(resource, "category_id", "area", list(layers))
+            self.assertSamePivot(cube, python)
+
+            # Other facts or filters don't match
+            resource = s3db.resource("test_pivot", filter=FS("value") > 3)
+            pt = S3PivotTable(resource, "category_id", "area", list(layers))
+            self.assertNotEqual(pt.partials, None)
+
+            # Move a record to another cell, and delete another
+            table = db.test_pivot
+            moved = db(table.value == 7).select(table.id).first()
+            moved.update_record(area="North", value=8)
+            S3ReportCube.onwrite("test_pivot", moved.id)
+            deleted = db(table.value == 1).select(table.id).first()
+            deleted.update_record(deleted=True)
+            S3ReportCube.onwrite("test_pivot", deleted.id)
+
+            # Writes only mark the records as pending
+            rtable = s3db.s3_report_cube_record
+            query = (rtable.record_id.belongs((moved.id, deleted.id))) & \
+                    (rtable.cell == None)
+            self.assertEqual(db(query).count(), 2)
+
+            resource = s3db.resource("test_pivot")
+            cube = S3PivotTable(resource, "category_id", "area", list(layers))
+            self.assertEqual(cube.partials, None)
+            python = PythonPivotTable(resource, "category_id", "area", list(layers))
+            self.assertSamePivot(cube, python)
+            # Pending records applied at the read
+            self.assertEqual(db(query).count(), 0)
+
+            moved.update_record(area="South", value=7)
+            deleted.update_record(deleted=False)
+        finally:
+            s3db.clear_config("test_pivot", "report_cubes")
+            cube_table = s3db.s3_report_cube
+            db(cube_table.tablename == "test_pivot").delete()
+
+    # -------------------------------------------------------------------------
+    def testColumnarPivot(self):
+        """ Test vectorized pivoting with list-type dimensions """
+
+        try:
+            imp.find_module("numpy")
+        except ImportError:
+            return
+
+        resource = current.s3db.resource("test_pivot")
+        layers = [("value", "sum"),
+                  ("value", "avg"),
+                  ("value", "min"),
+                  ("value", "max"),
+                  ("value", "count"),
+                  ("area", "count"),
+                  ]
+
+        columnar = PythonPivotTable(resource, "tags", "area", list(layers))
+        scalar = ScalarPivotTable(resource, "tags", "area", list(layers))
+        self.assertSamePivot(columnar, scalar)
+
+        for row in columnar.row:
+            r = [s.value for s in scalar.row].index(row.value)
+            self.assertEqual(row.records, scalar.row[r].records)
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner(verbosity=2).run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        PivotTableTests,
+    )
+
+# END ========================================================================
@@ -3,9 +3,11 @@
 # To run this script use:
 # python web2py.py -S eden -M -R applications/eden/tests/unit_tests/modules/s3/s3filter.py
 
+import json
 import unittest
 
 from gluon import *
+from s3 import S3Represent, s3_meta_fields
 from s3.s3filter import *
 
 # =============================================================================
@@ -126,6 +128,155 @@ class S3FilterWidgetTests(unittest.TestCase):
         self.assertTrue("2" in values)
         self.assertTrue("3" in values)
 
+# =============================================================================
+class S3OptionsFilterTests(unittest.TestCase):
+    """ Tests for the options lookup of S3OptionsFilter """
+
+    @classmethod
+    def setUpClass(cls):
+
+        s3db = current.s3db
+
+        s3db.define_table("test_options_category",
+                          Field("name"),
+                          *s3_meta_fields())
+        s3db.define_table("test_options",
+                          Field("category_id", "reference test_options_category",
+                                represent = S3Represent(lookup="test_options_category"),
+                                ),
+                          Field("status"),
+                          *s3_meta_fields())
+
+        current.auth.override = True
+
+        db = current.db
+        ctable = db.test_options_category
+        cls.categories = [ctable.insert(name=name) for name in ("A", "B", "C")]
+
+        table = db.test_options
+        table.insert(category_id=cls.categories[0], status="open")
+        table.insert(category_id=cls.categories[1], status="closed")
+
+    @classmethod
+    def tearDownClass(cls):
+
+        db = current.db
+        db.test_options.drop()
+        db.test_options_category.drop()
+
+    def setUp(self):
+
+        current.auth.override = True
+        current.response.s3.table_updated = None
+
+    def tearDown(self):
+
+        current.auth.override = False
+
+    def testCachedOptions(self):
+        """ Test caching of options, and invalidation on table update """
+
+        db = current.db
+        s3db = current.s3db
+        settings = current.deployment_settings
+
+        expire = settings.get_search_filter_options_cache()
+        settings.search.filter_options_cache = 300
+        try:
+            resource = s3db.resource("test_options")
+            categories = self.categories
+
+            for selector in ("category_id", "status"):
+                widget = S3OptionsFilter(selector)
+
+                ftype, options, noopt = widget._options(resource)
+                self.assertEqual(noopt, None)
+                keys = [k for k, v in options]
+
+                # New record, but table version unchanged => from cache
+                record_id = db.test_options.insert(category_id=categories[2],
+                                                   status="new")
+                ftype, options, noopt = widget._options(resource)
+                self.assertEqual([k for k, v in options], keys)
+
+                # Table updated => new option
+                s3db.table_updated("test_options")
+                ftype, options, noopt = widget._options(resource)
+                new = categories[2] if selector == "category_id" else "new"
+                self.assertTrue(new in [k for k, v in options])
+
+                db(db.test_options.id == record_id).delete()
+                current.response.s3.table_updated = None
+                s3db.table_updated("test_options")
+
+            # Represents
+            widget = S3OptionsFilter("category_id")
+            ftype, options, noopt = widget._options(resource)
+            self.assertEqual(dict(options)[categories[0]], "A")
+        finally:
+            settings.search.filter_options_cache = expire
+
+# =============================================================================
+class S3FilterStringTests(unittest.TestCase):
+    """ Tests for S3FilterString """
+
+    def setUp(self):
+
+        current.auth.override = True
+
+    def tearDown(self):
+
+        current.auth.override = False
+
+    def testCompiledQuery(self):
+        """ Test compilation of saved filter queries """
+
+        resource = current.s3db.resource("pr_person")
+        query = [["~.first_name__like", "Test*"],
+                 ["contact.contact_method__belongs", "SMS,EMAIL"],
+                 ["~.last_name!", None],
+                 ]
+
+        fstring = S3FilterString(resource, query)
+        self.assertFalse(fstring.compiled)
+        serialized = fstring.serialize()
+        self.assertNotEqual(serialized, None)
+
+        # Compiled query is used instead of parsing the query
+        compiled = S3FilterString(resource, None, serialized=serialized)
+        self.assertTrue(compiled.compiled)
+        self.assertEqual(compiled.get_vars, fstring.get_vars)
+        self.assertEqual(compiled.represent(), fstring.represent())
+
+        queries = fstring.parse()
+        for alias, subqueries in compiled.parse().items():
+            self.assertEqual([q.serialize() for q in subqueries],
+                             [q.serialize() for q in queries[alias]])
+
+        # Outdated compiled query is ignored
+        data = json.loads(serialized)
+        data["signature"] = "outdated"
+        outdated = S3FilterString(resource, query,
+                                  serialized=json.dumps(data))
+        self.assertFalse(outdated.compiled)
+        self.assertEqual(outdated.get_vars, fstring.get_vars)
+
+        # Compiled query remains valid after record writes
+        current.s3db.table_updated("pr_contact")
+        compiled = S3FilterString(resource, query, serialized=serialized)
+        self.assertTrue(compiled.compiled)
+
+        # Compiled query is ignored after changes of the table structure
+        data = json.loads(serialized)
+        data["signature"] = S3FilterString.signature(resource,
+                                                     data["tables"] + ["pr_address"],
+                                                     data["components"],
+                                                     )
+        outdated = S3FilterString(resource, query,
+                                  serialized=json.dumps(data))
+        self.assertFalse(outdated.compiled)
+        self.assertEqual(outdated.get_vars, fstring.get_vars)
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -143,6 +294,8 @@ if __name__ == "__main__":
 
     run_suite(
         S3FilterWidgetTests,
+        S3OptionsFilterTests,
+        S3FilterStringTests,
     )
 
 # END ========================================================================
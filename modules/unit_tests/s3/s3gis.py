@@ -0,0 +1,542 @@
+# -*- coding: utf-8 -*-
+#
+# GIS Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/tests/unit_tests/modules/s3/s3gis.py
+#
+import imp
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from gluon import *
+from gluon.storage import Storage
+try:
+    import json # try stdlib (Python 2.6)
+except ImportError:
+    try:
+        import simplejson as json # try external module
+    except:
+        import gluon.contrib.simplejson as json # fallback to pure-Python module
+from s3 import s3gis
+from s3.s3geocode import *
+
+# =============================================================================
+class StubGeocoder(object):
+    """ Geocoder which answers from a dict, and counts the requests """
+
+    def __init__(self, results):
+
+        self.results = results
+        self.queries = []
+
+    def geocode(self, location, exactly_one=False):
+
+        self.queries.append(location)
+        return self.results.get(location, [])
+
+# =============================================================================
+class GazetteerTests(unittest.TestCase):
+    """ Tests for the local gazetteer """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        gazetteer = S3Gazetteer()
+        gazetteer.add(1, "Country", 0.0, 0.0, level="L0", path="1")
+        gazetteer.add(2, "Springfield", 10.0, 20.0, level="L3", path="1/2")
+        gazetteer.add(3, u"Zürich", 47.4, 8.5, level="L3", path="1/3")
+        gazetteer.add(4, "Springfield", 30.0, 40.0, level="L3", path="5/4")
+        gazetteer.add_name(3, "Zurich City")
+        self.gazetteer = gazetteer
+
+    # -------------------------------------------------------------------------
+    def testNormalize(self):
+        """ Test normalization of names """
+
+        normalize = S3Gazetteer.normalize
+        self.assertEqual(normalize(u"  Zürich-City "), u"zurich city")
+        self.assertEqual(normalize(None), "")
+
+    # -------------------------------------------------------------------------
+    def testExactMatch(self):
+        """ Test exact matches (incl. alternate names and diacritics) """
+
+        lookup = self.gazetteer.lookup
+        self.assertEqual(lookup("zurich"), [(1.0, 3)])
+        self.assertEqual(lookup("ZURICH CITY"), [(1.0, 3)])
+        self.assertEqual(len(lookup("Springfield")), 2)
+        self.assertEqual(lookup("Springfield", parent=1), [(1.0, 2)])
+
+    # -------------------------------------------------------------------------
+    def testPrefixMatch(self):
+        """ Test unique prefix matches """
+
+        lookup = self.gazetteer.lookup
+        self.assertEqual(lookup("Zuri"), [(0.9, 3)])
+        # Too short
+        self.assertEqual(lookup("Zu"), [])
+
+    # -------------------------------------------------------------------------
+    def testFuzzyMatch(self):
+        """ Test fuzzy matches """
+
+        matches = self.gazetteer.lookup("Sprngfield", parent=1)
+        self.assertEqual(len(matches), 1)
+        self.assertEqual(matches[0][1], 2)
+        self.assertTrue(matches[0][0] < 1.0)
+        self.assertEqual(self.gazetteer.lookup("Xylophone"), [])
+
+    # -------------------------------------------------------------------------
+    def testGeocode(self):
+        """ Test geocoding of addresses """
+
+        geocode = self.gazetteer.geocode
+        self.assertEqual(geocode("1 Main St, Springfield", [1]),
+                         {"lat": 10.0, "lon": 20.0})
+        # Ambiguous without ancestors
+        self.assertEqual(geocode("1 Main St, Springfield"), None)
+        self.assertEqual(geocode(None), None)
+
+    # -------------------------------------------------------------------------
+    def testRemove(self):
+        """ Test removal of locations (incremental updates) """
+
+        gazetteer = self.gazetteer
+        lookup = gazetteer.lookup
+
+        gazetteer.remove(3)
+        self.assertEqual(lookup("Zurich"), [])
+        self.assertEqual(lookup("Zurich City"), [])
+        self.assertFalse(3 in gazetteer.locations)
+
+        # Shared name still found for the remaining location
+        gazetteer.remove(4)
+        self.assertEqual(lookup("Springfield"), [(1.0, 2)])
+
+        # Re-add with a new name
+        gazetteer.add(3, "Zurich", 47.4, 8.5, level="L3", path="1/3")
+        self.assertEqual(lookup("Zurich"), [(1.0, 3)])
+        self.assertEqual(lookup("Zurich City"), [])
+
+# =============================================================================
+class GeocodeBulkTests(unittest.TestCase):
+    """ Tests for bulk geocoding """
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+
+    # -------------------------------------------------------------------------
+    def testThrottle(self):
+        """ Test concurrent requests with errors """
+
+        throttle = S3GeocodeThrottle()
+        results = throttle.map(lambda x: 10 / x, [1, 2, 0, 5], threads=3)
+        self.assertEqual(results[1], 10)
+        self.assertEqual(results[5], 2)
+        self.assertTrue(isinstance(results[0], ZeroDivisionError))
+
+    # -------------------------------------------------------------------------
+    def testGeocodeBulk(self):
+        """ Test bulk geocoding with result cache """
+
+        geocoder = StubGeocoder({
+            "1 Test Street": [("1 Test Street", (1.0, 2.0))],
+            "2 Test Street": [("2 Test Street", (3.0, 4.0))],
+        })
+        addresses = [("1 Test Street", None, None),
+                     ("2 Test Street", None, None),
+                     ("1 Test Street", None, None),
+                     ("No Such Street", None, None),
+                     ]
+
+        geocode_bulk = current.gis.geocode_bulk
+        results = geocode_bulk(addresses, geocoder=geocoder, gazetteer=False)
+        self.assertEqual(results[0], {"lat": 1.0, "lon": 2.0})
+        self.assertEqual(results[1], {"lat": 3.0, "lon": 4.0})
+        self.assertEqual(results[2], {"lat": 1.0, "lon": 2.0})
+        self.assertEqual(results[3], "No results found")
+        # Each query sent only once
+        self.assertEqual(len(geocoder.queries), 3)
+
+        # Second run is answered from the cache
+        geocoder.queries = []
+        results = geocode_bulk(addresses[:3], geocoder=geocoder, gazetteer=False)
+        self.assertEqual(results[1], {"lat": 3.0, "lon": 4.0})
+        self.assertEqual(geocoder.queries, [])
+
+    # -------------------------------------------------------------------------
+    def testCacheStore(self):
+        """ Test storing results for the same query concurrently """
+
+        db = current.db
+        ctable = current.s3db.gis_geocode_cache
+
+        store = current.gis._geocode_cache_store
+        store("testkey", "1 Test Street", "test", {"lat": 1.0, "lon": 2.0})
+        # Second store updates rather than failing on the unique key
+        store("testkey", "1 Test Street", "test", {"lat": 3.0, "lon": 4.0})
+
+        rows = db(ctable.query_key == "testkey").select(ctable.lat,
+                                                        ctable.lon)
+        self.assertEqual(len(rows), 1)
+        self.assertEqual((rows[0].lat, rows[0].lon), (3.0, 4.0))
+
+# =============================================================================
+class BulkBoundsTests(unittest.TestCase):
+    """ Tests for GIS.bulk_bounds """
+
+    # -------------------------------------------------------------------------
+    def testBulkBounds(self):
+        """ Test bounds and centroids of different geometry types """
+
+        wkts = ["POLYGON((0 0,10 0,10 10,0 10,0 0),(2 2,2 4,4 4,4 2,2 2))",
+                "MULTIPOLYGON(((0 0,2 0,2 2,0 2,0 0)),((4 0,6 0,6 2,4 2,4 0)))",
+                "LINESTRING(0 0,3 4,3 10)",
+                "MULTIPOINT(1 2,3 4)",
+                "GEOMETRYCOLLECTION(POINT(1 1))",
+                "INVALID",
+                ]
+        results = current.gis.bulk_bounds(wkts)
+
+        assertAlmostEqual = self.assertAlmostEqual
+
+        # Polygon with hole
+        result = results[0]
+        self.assertEqual(result["gis_feature_type"], 3)
+        assertAlmostEqual(result["lon"], 5.0 + 1.0 / 12)
+        assertAlmostEqual(result["lat"], 5.0 + 1.0 / 12)
+        self.assertEqual((result["lon_min"], result["lat_min"],
+                          result["lon_max"], result["lat_max"]),
+                         (0.0, 0.0, 10.0, 10.0))
+
+        # MultiPolygon
+        result = results[1]
+        self.assertEqual(result["gis_feature_type"], 6)
+        assertAlmostEqual(result["lon"], 3.0)
+        assertAlmostEqual(result["lat"], 1.0)
+
+        # LineString (length-weighted)
+        result = results[2]
+        self.assertEqual(result["gis_feature_type"], 2)
+        assertAlmostEqual(result["lon"], (5 * 1.5 + 6 * 3.0) / 11)
+        assertAlmostEqual(result["lat"], (5 * 2.0 + 6 * 7.0) / 11)
+
+        # MultiPoint
+        result = results[3]
+        self.assertEqual(result["gis_feature_type"], 4)
+        assertAlmostEqual(result["lon"], 2.0)
+        assertAlmostEqual(result["lat"], 3.0)
+
+        # Fallback
+        self.assertEqual(results[4]["gis_feature_type"], 7)
+        assertAlmostEqual(results[4]["lon"], 1.0)
+        self.assertEqual(results[5], None)
+
+# =============================================================================
+class ClusterTests(unittest.TestCase):
+    """ Tests for server-side clustering of Feature Layers """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        settings = current.deployment_settings
+        self.cluster_server = settings.gis.get("cluster_server")
+        self.max_features = settings.gis.get("max_features")
+        settings.gis.cluster_server = True
+        settings.gis.max_features = 3
+
+        s3db = current.s3db
+        gtable = s3db.gis_location
+        otable = s3db.org_organisation
+        ftable = s3db.org_office
+
+        org_id = otable.insert(name="ClusterTestOrganisation")
+        points = [(10.0, 10.0),
+                  (10.001, 10.002),
+                  (10.002, 10.001),
+                  (10.003, 10.003),
+                  (-50.0, -50.0),
+                  ]
+        for i, (lat, lon) in enumerate(points):
+            location_id = gtable.insert(name="ClusterTestLocation%s" % i,
+                                        lat=lat,
+                                        lon=lon)
+            ftable.insert(name="ClusterTestOffice%s" % i,
+                          organisation_id=org_id,
+                          location_id=location_id)
+        self.org_id = org_id
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        settings = current.deployment_settings
+        settings.gis.cluster_server = self.cluster_server
+        settings.gis.max_features = self.max_features
+
+        current.db.rollback()
+        current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def testClusterZoom(self):
+        """ Test the zoom level for clustering """
+
+        get_cluster_zoom = current.gis.get_cluster_zoom
+
+        self.assertEqual(get_cluster_zoom({"zoom": "5"}), 5)
+        self.assertEqual(get_cluster_zoom({"zoom": "99"}), 20)
+        self.assertEqual(get_cluster_zoom({"bbox": "-180,-90,180,90"}), 2)
+        self.assertEqual(get_cluster_zoom({"bbox": "invalid"}), 0)
+        self.assertEqual(get_cluster_zoom({}), 0)
+
+    # -------------------------------------------------------------------------
+    def testClusters(self):
+        """ Test aggregation of points into clusters """
+
+        s3db = current.s3db
+        ftable = s3db.org_office
+
+        resource = s3db.resource("org_office",
+                                 filter=(ftable.organisation_id == self.org_id))
+        output = current.gis.get_clusters(resource, zoom=4)
+        self.assertNotEqual(output, None)
+
+        features = json.loads(output)["features"]
+        self.assertEqual(len(features), 2)
+        features.sort(key=lambda f: f["properties"]["count"])
+
+        single, cluster = features
+        self.assertEqual(single["properties"]["count"], 1)
+        self.assertTrue("id" in single["properties"])
+        self.assertEqual(single["geometry"]["coordinates"], [-50.0, -50.0])
+
+        properties = cluster["properties"]
+        self.assertEqual(properties["count"], 4)
+        self.assertEqual(properties["bounds"], [10.0, 10.0, 10.003, 10.003])
+        lon, lat = cluster["geometry"]["coordinates"]
+        self.assertAlmostEqual(lon, 10.0015)
+        self.assertAlmostEqual(lat, 10.0015)
+
+    # -------------------------------------------------------------------------
+    def testNoClusters(self):
+        """ Test that small layers are not clustered """
+
+        s3db = current.s3db
+        ftable = s3db.org_office
+        gis = current.gis
+
+        current.deployment_settings.gis.max_features = 10
+        resource = s3db.resource("org_office",
+                                 filter=(ftable.organisation_id == self.org_id))
+        self.assertEqual(gis.get_clusters(resource, zoom=4), None)
+
+# =============================================================================
+class LayerCacheTests(unittest.TestCase):
+    """ Tests for the Feature Layer GeoJSON cache """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        self.path = tempfile.mkdtemp()
+        self.size = s3gis.LAYER_CACHE_SIZE
+        s3gis.LAYER_CACHE_SIZE = 3
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        s3gis.LAYER_CACHE_SIZE = self.size
+        shutil.rmtree(self.path, ignore_errors=True)
+        current.db.rollback()
+
+    # -------------------------------------------------------------------------
+    def testCacheKey(self):
+        """ Test that the cache key changes with the table version """
+
+        gis = current.gis
+        s3db = current.s3db
+
+        r = Storage(get_vars=Storage(layer="1"),
+                    resource=s3db.resource("org_office"))
+        etag, filename = gis.get_layer_cache(r)
+        self.assertEqual(gis.get_layer_cache(r), (etag, filename))
+
+        # Not cacheable without layer
+        self.assertEqual(gis.get_layer_cache(Storage(get_vars=Storage(),
+                                                     resource=r.resource)),
+                         None)
+
+        s3db.table_updated("org_office")
+        self.assertNotEqual(gis.get_layer_cache(r)[0], etag)
+
+    # -------------------------------------------------------------------------
+    def testReadWrite(self):
+        """ Test writing and reading of cache entries """
+
+        gis = current.gis
+        filename = os.path.join(self.path, "v1_a.json")
+
+        self.assertEqual(gis.read_layer_cache(filename), None)
+        gis.put_layer_cache(filename, "GEOJSON")
+        self.assertEqual(gis.read_layer_cache(filename), "GEOJSON")
+
+        # Expired entries are not returned
+        expired = time.time() - s3gis.LAYER_CACHE_TTL - 10
+        os.utime(filename, (expired, expired))
+        self.assertEqual(gis.read_layer_cache(filename), None)
+
+    # -------------------------------------------------------------------------
+    def testCleanup(self):
+        """ Test removal of old versions and size limit """
+
+        gis = current.gis
+        path = self.path
+        put = gis.put_layer_cache
+
+        put(os.path.join(path, "v1_a.json"), "A")
+        put(os.path.join(path, "v2_b.json"), "B")
+        self.assertEqual(os.listdir(path), ["v2_b.json"])
+
+        now = time.time()
+        filename = os.path.join(path, "v2_b.json")
+        os.utime(filename, (now - 10, now - 10))
+        for i, name in enumerate(("v2_c.json", "v2_d.json")):
+            filename = os.path.join(path, name)
+            put(filename, name)
+            os.utime(filename, (now + i, now + i))
+
+        # Oldest entry dropped when the limit is reached
+        put(os.path.join(path, "v2_e.json"), "E")
+        self.assertEqual(sorted(os.listdir(path)),
+                         ["v2_c.json", "v2_d.json", "v2_e.json"])
+
+# =============================================================================
+class VectorTileTests(unittest.TestCase):
+    """ Tests for Vector Tiles of Shapefile Layers """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        try:
+            imp.find_module("shapely")
+        except ImportError:
+            self.skipTest("Shapely not installed")
+
+        current.auth.override = True
+
+        s3db = current.s3db
+        gis = current.gis
+
+        ltable = s3db.gis_layer_shapefile
+        record = {"name": "TileTestShapefile",
+                  "data": json.dumps([["name", "string"]]),
+                  }
+        record["id"] = ltable.insert(**record)
+        s3db.update_super(ltable, record)
+        self.layer = ltable[record["id"]]
+
+        table = self.table = gis.define_shapefile_table(record["id"])
+        features = [("TileTestA", 10.0, 10.0,
+                     "POLYGON((9.5 9.5,10.5 9.5,10.5 10.5,9.5 10.5,9.5 9.5))"),
+                    ("TileTestB", -40.0, -100.0,
+                     "POINT(-100 -40)"),
+                    ]
+        for name, lat, lon, wkt in features:
+            data = {"name": name, "lat": lat, "lon": lon, "wkt": wkt}
+            if "the_geom" in table.fields:
+                data["the_geom"] = wkt
+            table.insert(**data)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.gis.tile_cache_clear(str(self.table))
+        current.db.rollback()
+        current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def testShapefileFeatures(self):
+        """ Test bbox filtering of Shapefile features """
+
+        source = current.gis._tile_source(str(self.layer.layer_id))
+        self.assertNotEqual(source, None)
+        features = source[3]
+
+        def names(bounds):
+            return sorted(f[2]["name"] for f in features(bounds))
+
+        # Bbox overlaps the polygon, but not its centroid
+        self.assertEqual(names((10.2, 10.2, 11.0, 11.0)), ["TileTestA"])
+        self.assertEqual(names((-101.0, -41.0, -99.0, -39.0)), ["TileTestB"])
+        self.assertEqual(names((20.0, 20.0, 30.0, 30.0)), [])
+
+    # -------------------------------------------------------------------------
+    def testEncodedTile(self):
+        """ Test the encoded tile """
+
+        gis = current.gis
+        layer = str(self.layer.layer_id)
+
+        # Tile containing the polygon
+        output = gis.get_vector_tile(layer, 4, 8, 7)
+        self.assertTrue(output)
+        # Tile message, layers field (3, length-delimited)
+        self.assertEqual(output[0], "\x1a")
+        self.assertTrue("TileTestShapefile" in output)
+        self.assertTrue("TileTestA" in output)
+        self.assertFalse("TileTestB" in output)
+
+        # Served from the cache
+        self.assertEqual(gis.get_vector_tile(layer, 4, 8, 7), output)
+
+        # Empty tile
+        self.assertEqual(gis.get_vector_tile(layer, 4, 0, 0), "")
+
+        # Invalid tile
+        self.assertEqual(gis.get_vector_tile(layer, 4, 16, 0), None)
+
+    # -------------------------------------------------------------------------
+    def testLayerUpdate(self):
+        """ Test that updating the layer invalidates its tiles """
+
+        gis = current.gis
+        layer = str(self.layer.layer_id)
+
+        gis.get_vector_tile(layer, 4, 8, 7)
+        path = gis.tile_cache_path(str(self.table), layer)
+        self.assertTrue(os.path.isdir(path))
+
+        gis.tile_cache_clear("gis_layer_shapefile", record_id=self.layer.id)
+        self.assertFalse(os.path.isdir(path))
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner(verbosity=2).run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        GazetteerTests,
+        GeocodeBulkTests,
+        BulkBoundsTests,
+        ClusterTests,
+        LayerCacheTests,
+        VectorTileTests,
+    )
+
+# END ========================================================================
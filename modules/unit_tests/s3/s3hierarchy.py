@@ -391,6 +391,155 @@ class S3HierarchyTests(unittest.TestCase):
             if parent_id:
                 assertTrue(parent_id in nodes)
 
+    # -------------------------------------------------------------------------
+    def testIntervals(self):
+        """ Test pre-order intervals and descendant checks """
+
+        uids = self.uids
+
+        assertEqual = self.assertEqual
+        assertTrue = self.assertTrue
+        assertFalse = self.assertFalse
+
+        h = S3Hierarchy("test_hierarchy")
+        intervals = h.intervals
+        assertEqual(len(intervals), len(uids))
+
+        # Descendants are exactly the nodes within the interval
+        for uid, node_id in uids.items():
+            left, right = intervals[node_id]
+            descendants = set(n for n, (l, r) in intervals.items()
+                              if left < l <= right)
+            assertEqual(descendants, h.findall(node_id))
+            assertEqual(right - left, len(descendants))
+
+        is_descendant = h.is_descendant
+        assertTrue(is_descendant(uids["HIERARCHY1-2-1"], uids["HIERARCHY1"]))
+        assertTrue(is_descendant(uids["HIERARCHY1-2-1"], uids["HIERARCHY1-2"]))
+        assertFalse(is_descendant(uids["HIERARCHY1-2-1"], uids["HIERARCHY1-1"]))
+        assertFalse(is_descendant(uids["HIERARCHY1"], uids["HIERARCHY1-2-1"]))
+        assertFalse(is_descendant(uids["HIERARCHY2"], uids["HIERARCHY2"]))
+        assertTrue(is_descendant(uids["HIERARCHY2"], uids["HIERARCHY2"],
+                                 inclusive=True))
+
+    # -------------------------------------------------------------------------
+    def testIncrementalUpdate(self):
+        """ Test incremental update of the stored hierarchy """
+
+        db = current.db
+        uids = self.uids
+
+        assertEqual = self.assertEqual
+        assertTrue = self.assertTrue
+
+        # Serialize the nodes for comparison
+        snapshot = lambda theset: dict((node_id, (node["p"],
+                                                  node["c"],
+                                                  sorted(node["s"])))
+                                       for node_id, node in theset.items())
+
+        table = db.test_hierarchy
+        node_id = uids["HIERARCHY1-1-1"]
+        parent_id = uids["HIERARCHY1-1"]
+        try:
+            h = S3Hierarchy("test_hierarchy")
+            theset = h.theset
+
+            # Move the node to another parent
+            db(table.id == node_id).update(parent=uids["HIERARCHY2"])
+            S3Hierarchy.onwrite("test_hierarchy", node_id)
+
+            h = S3Hierarchy("test_hierarchy")
+            assertEqual(h.parent(node_id), uids["HIERARCHY2"])
+            assertTrue(node_id not in h.children(parent_id))
+            # The original nodes are left unchanged
+            assertTrue(node_id in theset[parent_id]["s"])
+
+            # Same result as rebuilding the hierarchy
+            incremental = snapshot(h.theset)
+            h.read()
+            assertEqual(incremental, snapshot(h.theset))
+
+            # Shared with the next request (unless the version changes)
+            h.save()
+            del current.model.hierarchies["test_hierarchy"]
+            h = S3Hierarchy("test_hierarchy")
+            version, shared = S3Hierarchy._shared["test_hierarchy"][:2]
+            assertTrue(h.theset is shared)
+
+            # Remove the node
+            db(table.id == node_id).delete()
+            S3Hierarchy.onwrite("test_hierarchy", node_id)
+            h = S3Hierarchy("test_hierarchy")
+            assertTrue(node_id not in h.theset)
+            assertTrue(node_id not in h.children(uids["HIERARCHY2"]))
+            assertTrue(h.theset is not shared)
+
+        finally:
+            if not db(table.id == node_id).count():
+                table.insert(**self.rows["HIERARCHY1-1-1"].as_dict())
+            db(table.id == node_id).update(parent=parent_id)
+            S3Hierarchy.onwrite("test_hierarchy", node_id)
+
+    # -------------------------------------------------------------------------
+    def testDeferredSave(self):
+        """ Test saving of the hierarchy once at the end of the request """
+
+        db = current.db
+        s3db = current.s3db
+        uids = self.uids
+
+        assertEqual = self.assertEqual
+        assertNotEqual = self.assertNotEqual
+
+        htable = s3db.s3_hierarchy
+        query = (htable.tablename == "test_hierarchy")
+        stored = lambda: db(query).select(htable.version,
+                                          limitby=(0, 1)).first().version
+
+        table = db.test_hierarchy
+        node_id = uids["HIERARCHY1-1-1"]
+        parent_id = uids["HIERARCHY1-1"]
+
+        env = current.request.env
+        request_method = env.request_method
+        response = current.response
+        custom_commit = response.custom_commit
+        try:
+            h = S3Hierarchy("test_hierarchy")
+            h.save()
+            version = stored()
+
+            # Simulate an HTTP request
+            env.request_method = "POST"
+            response.s3.before_commit = None
+
+            # Multiple writes
+            db(table.id == node_id).update(parent=uids["HIERARCHY2"])
+            S3Hierarchy.onwrite("test_hierarchy", node_id)
+            db(table.id == node_id).update(parent=uids["HIERARCHY2-1"])
+            S3Hierarchy.onwrite("test_hierarchy", node_id)
+
+            # Not saved yet, but updated in this request
+            assertEqual(stored(), version)
+            h = S3Hierarchy("test_hierarchy")
+            assertEqual(h.parent(node_id), uids["HIERARCHY2-1"])
+
+            # Saved once before the commit (web2py calls the commit
+            # hook with the DAL adapter)
+            callbacks = response.s3.before_commit
+            assertEqual(len(callbacks), 1)
+            response.custom_commit(db._adapter)
+            assertEqual(response.s3.before_commit, None)
+            assertNotEqual(stored(), version)
+
+        finally:
+            env.request_method = request_method
+            response.s3.before_commit = None
+            response.custom_commit = custom_commit
+            db(table.id == node_id).update(parent=parent_id)
+            S3Hierarchy.onwrite("test_hierarchy", node_id)
+
 # =============================================================================
 class S3LinkedHierarchyTests(unittest.TestCase):
     """ Tests for linktable-based hierarchies """
@@ -1013,6 +1162,64 @@ class S3TypeOfTests(unittest.TestCase):
 
         self.assertEquivalent(query, expected_query)
 
+    # -------------------------------------------------------------------------
+    def testTypeOfRangeQuery(self):
+        """
+            Test resolution of __typeof queries as range queries over
+            the stored node intervals
+        """
+
+        db = current.db
+
+        uids = self.uids
+        resource = current.s3db.resource("typeof_hierarchy")
+        table = resource.table
+
+        expected = set(uids[uid] for uid in ("HIERARCHY1-2",
+                                             "HIERARCHY1-2-1",
+                                             "HIERARCHY1-2-2",
+                                             "HIERARCHY2",
+                                             "HIERARCHY2-1",
+                                             "HIERARCHY2-1-1",
+                                             "HIERARCHY2-1-2",
+                                             ))
+
+        RANGE_QUERY_MIN = S3Hierarchy.RANGE_QUERY_MIN
+        S3Hierarchy.RANGE_QUERY_MIN = 0
+        try:
+            expr = FS("id").typeof((uids["HIERARCHY1-2"],
+                                    uids["HIERARCHY2"],
+                                    ))
+            query = expr.query(resource)
+
+            # Range query rather than belongs
+            self.assertFalse(self.equivalent(query, table.id.belongs(expected)))
+
+            rows = db(query).select(table.id)
+            self.assertEqual(set(row.id for row in rows), expected)
+
+            # Stored intervals match the hierarchy
+            h = S3Hierarchy("typeof_hierarchy")
+            htable = current.s3db.s3_hierarchy
+            itable = current.s3db.s3_hierarchy_interval
+            query = (htable.tablename == "typeof_hierarchy") & \
+                    (itable.hierarchy_id == htable.id)
+            rows = db(query).select(itable.node_id,
+                                    itable.lft,
+                                    itable.rgt,
+                                    )
+            stored = dict((row.node_id, (row.lft, row.rgt)) for row in rows)
+            self.assertEqual(stored, h.intervals)
+
+            # Negated and with left join (as in resource queries)
+            resource = current.s3db.resource("typeof_hierarchy",
+                                             filter = ~expr)
+            rows = resource.select(["id"], as_rows=True)
+            self.assertEqual(set(row[table.id] for row in rows),
+                             set(uids.values()) - expected)
+        finally:
+            S3Hierarchy.RANGE_QUERY_MIN = RANGE_QUERY_MIN
+
     # -------------------------------------------------------------------------
     def testTypeOfReferenceNone(self):
         """
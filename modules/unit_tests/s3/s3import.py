@@ -384,6 +384,86 @@ class FailedReferenceTests(unittest.TestCase):
         current.db.rollback()
         current.auth.override = False
 
+# =============================================================================
+class ContentHashTests(unittest.TestCase):
+    """ Test change detection with content hashes """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        otable = current.s3db.org_organisation
+        self.org_id = otable.insert(uuid="CHTESTORG",
+                                    name="CHTestOrganisation")
+
+    # -------------------------------------------------------------------------
+    def testExportHash(self):
+        """ Test content hashes in the export """
+
+        s3db = current.s3db
+        otable = s3db.org_organisation
+
+        def export(content_hash=True):
+            resource = s3db.resource("org_organisation", id=self.org_id)
+            tree = resource.export_xml(dereference=False,
+                                       as_tree=True,
+                                       content_hash=content_hash)
+            return tree.getroot()[0].get("hash")
+
+        first = export()
+        self.assertTrue(first)
+        self.assertEqual(export(), first)
+
+        # Only added for Sync
+        self.assertEqual(export(content_hash=False), None)
+
+        # Changed content => different hash
+        current.db(otable.id == self.org_id).update(name="CHTestChanged")
+        self.assertNotEqual(export(), first)
+
+    # -------------------------------------------------------------------------
+    def testSkipUnchanged(self):
+        """ Test skipping of unchanged records on re-import """
+
+        db = current.db
+        s3db = current.s3db
+        otable = s3db.org_organisation
+        htable = s3db.s3_content_hash
+
+        resource = s3db.resource("org_organisation", id=self.org_id)
+        tree = resource.export_xml(dereference=False,
+                                   as_tree=True,
+                                   content_hash=True)
+
+        # First import => hash stored
+        resource = s3db.resource("org_organisation")
+        resource.import_xml(tree)
+        self.assertEqual(resource.import_count, 1)
+        query = (htable.tablename == "org_organisation") & \
+                (htable.record_id == self.org_id)
+        self.assertEqual(db(query).count(), 1)
+
+        # Re-import => skipped
+        resource = s3db.resource("org_organisation")
+        resource.import_xml(tree)
+        self.assertEqual(resource.import_count, 0)
+        self.assertEqual(db(query).count(), 1)
+
+        # Modified locally => imported again
+        db(otable.id == self.org_id).update(name="CHTestChanged")
+        resource = s3db.resource("org_organisation")
+        resource.import_xml(tree)
+        self.assertEqual(resource.import_count, 1)
+        row = db(otable.id == self.org_id).select(otable.name).first()
+        self.assertEqual(row.name, "CHTestOrganisation")
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -405,6 +485,7 @@ if __name__ == "__main__":
         ComponentDisambiguationTests,
         PostParseTests,
         FailedReferenceTests,
+        ContentHashTests,
     )
 
 # END ========================================================================
@@ -16,6 +16,74 @@ class S3ModelTests(unittest.TestCase):
 
     pass
 
+# =============================================================================
+class S3TableVersionTests(unittest.TestCase):
+    """ Tests for table versions """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        response = current.response
+        self.request_method = current.request.env.request_method
+        self.custom_commit = response.custom_commit
+        response.custom_commit = None
+        response.s3.table_updated = None
+        response.s3.table_versions = None
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        response = current.response
+        current.request.env.request_method = self.request_method
+        response.custom_commit = self.custom_commit
+        response.s3.table_updated = None
+        response.s3.table_versions = None
+        current.db.rollback()
+
+    # -------------------------------------------------------------------------
+    def version(self, tablename):
+        """ Read the current version of a table from the database """
+
+        current.response.s3.table_versions = None
+        return current.s3db.table_version(tablename)[tablename]
+
+    # -------------------------------------------------------------------------
+    def testUpdateOutsideHTTP(self):
+        """ Test that every write increments the version outside HTTP """
+
+        s3db = current.s3db
+        current.request.env.request_method = None
+
+        version = self.version("org_organisation")
+        s3db.table_updated("org_organisation")
+        self.assertEqual(self.version("org_organisation"), version + 1)
+        s3db.table_updated("org_organisation")
+        self.assertEqual(self.version("org_organisation"), version + 2)
+
+    # -------------------------------------------------------------------------
+    def testCommitHook(self):
+        """ Test the update of versions by the commit hook """
+
+        db = current.db
+        s3db = current.s3db
+        response = current.response
+        current.request.env.request_method = "POST"
+
+        version = self.version("org_organisation")
+        s3db.table_updated("org_organisation")
+        s3db.table_updated("org_organisation")
+        self.assertEqual(self.version("org_organisation"), version)
+
+        # web2py calls the commit hook with the DAL adapter
+        self.assertNotEqual(response.custom_commit, None)
+        response.custom_commit(db._adapter)
+        self.assertEqual(self.version("org_organisation"), version + 1)
+
+        # Writes in the next transaction increment the version again
+        s3db.table_updated("org_organisation")
+        response.custom_commit(db._adapter)
+        self.assertEqual(self.version("org_organisation"), version + 2)
+
 # =============================================================================
 class S3SuperEntityTests(unittest.TestCase):
 
@@ -244,6 +312,7 @@ if __name__ == "__main__":
 
     run_suite(
         #S3ModelTests,
+        S3TableVersionTests,
         S3SuperEntityTests,
     )
 
@@ -7,6 +7,11 @@
 #
 import unittest
 import datetime
+import threading
+import time
+import urlparse
+import BaseHTTPServer
+import SocketServer
 from lxml import etree
 from gluon import *
 from gluon.storage import Storage
@@ -286,6 +291,76 @@ class S3OutboxTests(unittest.TestCase):
         out_msg = outbox[outbox_id]
         self.assertEqual(out_msg.status, 5) # Failed
 
+    # -------------------------------------------------------------------------
+    def testProcessEmailDailyLimit(self):
+        """ Test that messages over the daily limit remain in the outbox """
+
+        db = current.db
+        s3db = current.s3db
+        settings = current.deployment_settings
+
+        resource = s3db.resource("pr_person", uid=["MsgTestPerson1",
+                                                   "MsgTestPerson2"])
+        rows = resource.select(["pe_id"], as_rows=True)
+
+        self.sent = []
+
+        outbox = s3db.msg_outbox
+        outbox_ids = []
+        for row in rows:
+            outbox_ids.append(outbox.insert(pe_id = row.pe_id,
+                                            message_id = self.message_id))
+
+        # Allow only one more message today
+        table = s3db.msg_channel_limit
+        cutoff = current.request.utcnow - datetime.timedelta(hours=24)
+        count = db(table.created_on > cutoff).count()
+        limit = settings.get_mail_limit()
+        settings.mail.limit = count + 1
+        try:
+            self.msg.send_email = self.send_email
+            self.msg.process_outbox()
+        finally:
+            settings.mail.limit = limit
+
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(db(table.created_on > cutoff).count(), count + 1)
+
+        query = (outbox.id.belongs(outbox_ids))
+        messages = db(query).select(outbox.status, outbox.retries)
+        self.assertEqual(sorted(m.status for m in messages), [1, 2])
+        for message in messages:
+            if message.status == 1:
+                # Not counted as failure
+                self.assertEqual(message.retries,
+                                 outbox.retries.default)
+
+    # -------------------------------------------------------------------------
+    def testSendEmailBatchCallback(self):
+        """ Test that the status of each email is reported when sent """
+
+        settings = current.deployment_settings
+        if not settings.get_mail_sender():
+            return
+
+        reported = []
+        def callback(index, status):
+            reported.append((index, status))
+
+        limit = settings.get_mail_limit()
+        settings.mail.limit = None
+        try:
+            self.msg.send_email = self.send_email
+            results = self.msg.send_email_batch([("test1@example.com", "", "Test"),
+                                                 ("test3@example.com", "", "Test"),
+                                                 ],
+                                                callback = callback)
+        finally:
+            settings.mail.limit = limit
+
+        self.assertEqual(results, [True, False])
+        self.assertEqual(sorted(reported), [(0, True), (1, False)])
+
     # -------------------------------------------------------------------------
     def send_email(self, recipient, *args, **kwargs):
         """ Dummy send mechanism """
@@ -324,6 +399,280 @@ class S3OutboxTests(unittest.TestCase):
         current.db.rollback()
         self.msg.send_email = self.save_email
 
+# =============================================================================
+class FakeSMSGateway(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Local SMS Web API for testing """
+
+    daemon_threads = True
+
+    def __init__(self):
+
+        BaseHTTPServer.HTTPServer.__init__(self,
+                                           ("127.0.0.1", 0),
+                                           FakeSMSGatewayHandler)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, failures=0, code=503):
+        """
+            Reset the gateway
+
+            @param failures: number of requests to fail before accepting
+                             messages
+            @param code: the HTTP status code for failed requests
+        """
+
+        with self.lock:
+            self.received = []
+            self.attempts = 0
+            self.failures = failures
+            self.code = code
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%s/send" % self.server_address[1]
+
+class FakeSMSGatewayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Request handler for FakeSMSGateway """
+
+    def do_POST(self):
+
+        length = int(self.headers.getheader("content-length") or 0)
+        data = urlparse.parse_qs(self.rfile.read(length))
+
+        server = self.server
+        with server.lock:
+            server.attempts += 1
+            fail = server.failures > 0
+            if fail:
+                server.failures -= 1
+            else:
+                server.received.append(data)
+
+        if fail:
+            self.send_response(server.code)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write("OK")
+
+    def log_message(self, *args):
+        pass
+
+# =============================================================================
+class S3SMSDispatchTests(unittest.TestCase):
+    """ Tests for concurrent sending of SMS via Web API """
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def setUpClass(cls):
+
+        gateway = cls.gateway = FakeSMSGateway()
+        thread = threading.Thread(target=gateway.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def tearDownClass(cls):
+
+        cls.gateway.shutdown()
+        cls.gateway.server_close()
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        s3db = current.s3db
+
+        table = s3db.msg_sms_webapi_channel
+        record_id = table.insert(name = "FakeSMSGateway",
+                                 url = self.gateway.url,
+                                 parameters = "api_id=test",
+                                 message_variable = "text",
+                                 to_variable = "to",
+                                 )
+        record = Storage(id=record_id)
+        s3db.update_super(table, record)
+        self.channel = {"outgoing_sms_handler": "msg_sms_webapi_channel",
+                        "channel_id": record["channel_id"],
+                        }
+
+        settings = current.deployment_settings
+        self.saved = dict((key, settings.msg.get(key))
+                          for key in ("sms_rate", "sms_retries", "sms_workers"))
+        settings.msg.sms_workers = 3
+        self.gateway.reset()
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        settings = current.deployment_settings
+        for key, value in self.saved.items():
+            if value is None:
+                settings.msg.pop(key, None)
+            else:
+                settings.msg[key] = value
+
+        current.auth.override = False
+        current.db.rollback()
+
+    # -------------------------------------------------------------------------
+    def messages(self, count):
+        """ Construct a number of test messages """
+
+        return [("+4412345%02d" % i, "Test %s" % i, None, None, self.channel)
+                for i in xrange(count)]
+
+    # -------------------------------------------------------------------------
+    def testSendBatch(self):
+        """ Test sending multiple SMS concurrently """
+
+        msg = current.msg
+        messages = self.messages(6)
+
+        results = msg.send_sms_batch(messages)
+        self.assertEqual(results, [True] * 6)
+
+        received = self.gateway.received
+        self.assertEqual(len(received), 6)
+        numbers = set(data["to"][0] for data in received)
+        self.assertEqual(numbers,
+                         set(msg.sanitise_phone(m[0]) for m in messages))
+        for data in received:
+            self.assertEqual(data["api_id"], ["test"])
+
+        # Throughput recorded in channel status
+        stable = current.s3db.msg_channel_status
+        query = (stable.channel_id == self.channel["channel_id"])
+        row = current.db(query).select(stable.status,
+                                       limitby=(0, 1)).first()
+        self.assertNotEqual(row, None)
+        self.assertTrue(row.status.startswith("Sent 6 of 6 messages"))
+
+    # -------------------------------------------------------------------------
+    def testRetry(self):
+        """ Test retrying after temporary errors """
+
+        msg = current.msg
+        settings = current.deployment_settings
+
+        # Fails without retries
+        settings.msg.sms_retries = 0
+        self.gateway.reset(failures=1)
+        results = msg.send_sms_batch(self.messages(1))
+        self.assertEqual(results, [False])
+
+        # Succeeds with retries
+        settings.msg.sms_retries = 1
+        self.gateway.reset(failures=1)
+        results = msg.send_sms_batch(self.messages(1))
+        self.assertEqual(results, [True])
+        self.assertEqual(self.gateway.attempts, 2)
+
+        # No retry after errors which may have occurred after sending
+        settings.msg.sms_retries = 1
+        self.gateway.reset(failures=1, code=500)
+        results = msg.send_sms_batch(self.messages(1))
+        self.assertEqual(results, [False])
+        self.assertEqual(self.gateway.attempts, 1)
+
+    # -------------------------------------------------------------------------
+    def testRateLimit(self):
+        """ Test the rate limit per channel """
+
+        msg = current.msg
+        settings = current.deployment_settings
+
+        settings.msg.sms_rate = {"FakeSMSGateway": 10}
+        start = time.time()
+        results = msg.send_sms_batch(self.messages(5))
+        duration = time.time() - start
+
+        self.assertEqual(results, [True] * 5)
+        # 5 messages at 10/s take at least 0.4s despite 3 workers
+        self.assertTrue(duration >= 0.4)
+
+# =============================================================================
+class S3RSSPollTests(unittest.TestCase):
+    """ Tests for storing polled RSS feeds """
+
+    FEED = """<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0">
+    <channel>
+        <title>Test Feed</title>
+        <link>http://www.example.com/</link>
+        <item>
+            <title>Item 1</title>
+            <link>http://www.example.com/item1</link>
+            <description>Description 1</description>
+        </item>
+        <item>
+            <title>%s</title>
+            <link>http://www.example.com/item2</link>
+            <description>Description 2</description>
+        </item>
+    </channel>
+</rss>"""
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        s3db = current.s3db
+
+        table = s3db.msg_rss_channel
+        record_id = table.insert(name = "RSSPollTestChannel",
+                                 url = "http://www.example.com/rss",
+                                 enabled = False,
+                                 )
+        record = Storage(id=record_id)
+        s3db.update_super(table, record)
+        self.channel_id = record["channel_id"]
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.auth.override = False
+        current.db.rollback()
+
+    # -------------------------------------------------------------------------
+    def testStoreUnchanged(self):
+        """ Test that unchanged entries are skipped """
+
+        try:
+            import feedparser
+        except ImportError:
+            return
+
+        db = current.db
+        table = current.s3db.msg_rss
+        channel_id = self.channel_id
+        query = (table.channel_id == channel_id)
+
+        def modified():
+            rows = db(query).select(table.title, table.modified_on)
+            return dict((row.title, row.modified_on) for row in rows)
+
+        S3Msg._store_rss(channel_id, feedparser.parse(self.FEED % "Item 2"))
+        before = modified()
+        self.assertEqual(set(before.keys()), set(["Item 1", "Item 2"]))
+
+        # Make sure modified_on would change
+        db(query).update(modified_on = datetime.datetime(2000, 1, 1))
+        before = modified()
+
+        # Item 2 updated, Item 1 unchanged
+        S3Msg._store_rss(channel_id, feedparser.parse(self.FEED % "Item 2a"))
+        after = modified()
+        self.assertEqual(db(query).count(), 2)
+        self.assertEqual(after["Item 1"], before["Item 1"])
+        self.assertTrue("Item 2a" in after)
+        self.assertNotEqual(after["Item 2a"], before["Item 2"])
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -341,6 +690,8 @@ if __name__ == "__main__":
 
     run_suite(
         S3OutboxTests,
+        S3SMSDispatchTests,
+        S3RSSPollTests,
     )
 
 # END ========================================================================
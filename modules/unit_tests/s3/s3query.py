@@ -1992,6 +1992,95 @@ class JoinResolutionTests(unittest.TestCase):
         self.assertEqual(str(left[0]), str(ltable_join))
         self.assertEqual(str(left[1]), str(ptable_join))
 
+# =============================================================================
+class FullTextTests(unittest.TestCase):
+    """ Tests for the full-text index """
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def setUpClass(cls):
+
+        s3db = current.s3db
+        s3db.define_table("test_fulltext",
+                          Field("name"),
+                          Field("comments"),
+                          *s3_meta_fields())
+        s3db.configure("test_fulltext",
+                       fulltext = ["name"],
+                       )
+
+        table = current.db.test_fulltext
+        for name in ("John Smith", "Johanna Meyer", "Bob Johnson", "Alice"):
+            table.insert(name=name)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def tearDownClass(cls):
+
+        db = current.db
+        itable = current.s3db.s3_fulltext
+        db(itable.tablename == "test_fulltext").delete()
+        db.test_fulltext.drop()
+        current.s3db.clear_config("test_fulltext")
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def testPatternTrigrams(self):
+        """ Test trigrams of LIKE patterns """
+
+        trigrams = S3FullText.pattern_trigrams
+        self.assertEqual(trigrams("%JOHN%"), set([u"joh", u"ohn"]))
+        self.assertEqual(trigrams("jo%hn_son"), set([u"son"]))
+        self.assertEqual(trigrams("%jo%"), set())
+
+    # -------------------------------------------------------------------------
+    def testLikeQuery(self):
+        """ Test LIKE queries using the full-text index """
+
+        if S3FullText.native():
+            return
+
+        db = current.db
+        s3db = current.s3db
+        table = db.test_fulltext
+
+        S3FullText.rebuild("test_fulltext")
+
+        def names(query):
+            resource = s3db.resource("test_fulltext", filter=query)
+            rows = resource.select(["name"], limit=None, as_rows=True)
+            return set(row.name for row in rows)
+
+        query = FS("name").lower().like("%john%")
+        resource = s3db.resource("test_fulltext", filter=query)
+        self.assertTrue("s3_fulltext" in str(resource.get_query()))
+        self.assertEqual(names(query), set(["John Smith", "Bob Johnson"]))
+
+        # Combination of fields, only one of which is indexed
+        query = (FS("name").lower().like("%meyer%")) | \
+                (FS("comments").lower().like("%meyer%"))
+        self.assertEqual(names(query), set(["Johanna Meyer"]))
+
+        # Updated via onwrite
+        record = db(table.name == "Alice").select(table.id).first()
+        record.update_record(name="Alice Johns")
+        S3FullText.onwrite("test_fulltext", record.id)
+        self.assertEqual(names(FS("name").lower().like("%johns%")),
+                         set(["Alice Johns", "Bob Johnson"]))
+
+        # Created after the index was built, without onwrite
+        table.insert(name="Little John")
+        self.assertTrue("Little John" in names(FS("name").lower().like("%john%")))
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -2022,6 +2111,8 @@ if __name__ == "__main__":
         
         ResourceFieldTests,
         ResourceDataAccessTests,
+
+        FullTextTests,
     )
 
 # END ========================================================================
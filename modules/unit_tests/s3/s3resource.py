@@ -2824,6 +2824,133 @@ class LinkDeletionTests(unittest.TestCase):
         self.assertNotEqual(row, None,
                             msg = "Unrelated component record deleted")
 
+# =============================================================================
+class ChangeLogTests(unittest.TestCase):
+    """ Tests for the change-log """
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def setUpClass(cls):
+
+        s3db = current.s3db
+
+        s3db.define_table("changelog_master",
+                          Field("name"),
+                          *s3_meta_fields())
+
+        s3db.define_table("changelog_component",
+                          Field("master_id", "reference changelog_master"),
+                          Field("name"),
+                          *s3_meta_fields())
+
+        s3db.add_components("changelog_master",
+                            changelog_component = "master_id",
+                            )
+
+        current.db.commit()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def tearDownClass(cls):
+
+        db = current.db
+        ltable = current.s3db.s3_changelog
+        db(ltable.tablename.belongs(("changelog_master",
+                                     "changelog_component"))).delete()
+        db.changelog_component.drop()
+        db.changelog_master.drop()
+        db.commit()
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        settings = current.deployment_settings
+        self.changelog = settings.get_security_changelog()
+        settings.security.changelog = 30
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.deployment_settings.security.changelog = self.changelog
+        current.auth.override = False
+        current.db.rollback()
+
+    # -------------------------------------------------------------------------
+    def testMasters(self):
+        """ Test lookup of changed master records """
+
+        db = current.db
+        s3db = current.s3db
+
+        mtable = db.changelog_master
+        ctable = db.changelog_component
+
+        master1 = mtable.insert(name="Master1")
+        master2 = mtable.insert(name="Master2")
+        master3 = mtable.insert(name="Master3")
+        component = ctable.insert(master_id=master2, name="Component")
+
+        cursor = S3ChangeLog.cursor()
+
+        # Changes of master records and their components
+        S3ChangeLog.onwrite("changelog_master", master1, "update")
+        S3ChangeLog.onwrite("changelog_component", component, "create")
+
+        changes = S3ChangeLog.changes(["changelog_master"], cursor)
+        self.assertEqual(changes["changelog_master"], set([master1]))
+
+        resource = s3db.resource("changelog_master",
+                                 components=["changelog_component"])
+        master_ids = S3ChangeLog.masters(resource, cursor)
+        self.assertEqual(master_ids, set([master1, master2]))
+        self.assertFalse(master3 in master_ids)
+
+        # Nothing changed after the end of the log
+        cursor = S3ChangeLog.cursor()
+        self.assertEqual(S3ChangeLog.masters(resource, cursor), set())
+
+        # Disabled
+        current.deployment_settings.security.changelog = 0
+        S3ChangeLog.onwrite("changelog_master", master3, "update")
+        self.assertEqual(S3ChangeLog.masters(resource, cursor), set())
+
+    # -------------------------------------------------------------------------
+    def testMastersDeleted(self):
+        """ Test lookup of masters of soft-deleted components """
+
+        db = current.db
+        s3db = current.s3db
+
+        mtable = db.changelog_master
+        ctable = db.changelog_component
+
+        master = mtable.insert(name="Master")
+        component = ctable.insert(master_id=master, name="Component")
+
+        cursor = S3ChangeLog.cursor()
+
+        # Soft-delete the component (moves the foreign key into deleted_fk)
+        resource = s3db.resource("changelog_component", id=component)
+        resource.delete()
+        row = db(ctable.id == component).select(ctable.master_id,
+                                                limitby=(0, 1)).first()
+        self.assertEqual(row.master_id, None)
+
+        resource = s3db.resource("changelog_master",
+                                 components=["changelog_component"])
+        master_ids = S3ChangeLog.masters(resource, cursor)
+        self.assertEqual(master_ids, set([master]))
+
+        # Deletions only
+        master_ids = S3ChangeLog.masters(resource, cursor, ops=("delete",))
+        self.assertEqual(master_ids, set([master]))
+        S3ChangeLog.onwrite("changelog_master", master, "update")
+        cursor = S3ChangeLog.cursor() - 1
+        master_ids = S3ChangeLog.masters(resource, cursor, ops=("delete",))
+        self.assertEqual(master_ids, set())
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -2868,6 +2995,7 @@ if __name__ == "__main__":
         ResourceImportTests,
         ResourceFilteredComponentTests,
         LinkDeletionTests,
+        ChangeLogTests,
     )
 
 # END ========================================================================
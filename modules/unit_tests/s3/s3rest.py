@@ -9,7 +9,8 @@ import unittest
 from gluon import *
 from gluon.storage import Storage
 from gluon.dal import Query
-from s3.s3rest import S3Request
+from s3 import FS
+from s3.s3rest import S3Method, S3Request
 
 # =============================================================================
 class URLBuilderTests(unittest.TestCase):
@@ -270,6 +271,94 @@ class URLBuilderTests(unittest.TestCase):
 
         current.auth.override = False
 
+# =============================================================================
+class WidgetCacheTests(unittest.TestCase):
+    """ Tests for caching of widget outputs for Ajax-requests """
+
+    def setUp(self):
+
+        current.auth.override = True
+        current.response.s3.table_updated = None
+
+        settings = current.deployment_settings
+        self.widget_cache = settings.get_ui_widget_cache()
+        settings.ui.widget_cache = 60
+
+    def tearDown(self):
+
+        current.deployment_settings.ui.widget_cache = self.widget_cache
+        current.auth.override = False
+
+    def request(self, **vars):
+
+        return S3Request(prefix="org",
+                         name="organisation",
+                         c="org",
+                         f="organisation",
+                         http="GET",
+                         vars=Storage(format="aadata", **vars))
+
+    def testCachedWidget(self):
+        """ Test caching of widget outputs, and invalidation on table update """
+
+        method = S3Method()
+        calls = []
+        def render():
+            calls.append(1)
+            return '{"sEcho":%s,"aaData":[]}' % len(calls)
+
+        widget_id = "test-%s" % current.request.now
+
+        r = self.request(sEcho="1", test="1")
+        output = method._cached_widget(r, widget_id, render)
+        self.assertEqual(output, '{"sEcho":1,"aaData":[]}')
+        self.assertEqual(len(calls), 1)
+
+        # Same filter => from cache, but echoes the request counter
+        r = self.request(sEcho="5", test="1")
+        output = method._cached_widget(r, widget_id, render)
+        self.assertEqual(output, '{"sEcho":5,"aaData":[]}')
+        self.assertEqual(len(calls), 1)
+
+        # Other filter => rendered
+        r = self.request(sEcho="6", test="2")
+        method._cached_widget(r, widget_id, render)
+        self.assertEqual(len(calls), 2)
+
+        # Table updated => rendered
+        current.s3db.table_updated("org_organisation")
+        r = self.request(sEcho="7", test="1")
+        method._cached_widget(r, widget_id, render)
+        self.assertEqual(len(calls), 3)
+
+        # Same URL, but other server-side filter => rendered
+        r = self.request(sEcho="8", test="1")
+        r.resource.add_filter(FS("name") == "Test")
+        method._cached_widget(r, widget_id, render)
+        self.assertEqual(len(calls), 4)
+
+        # Non-cacheable output => always rendered
+        render = lambda: calls.append(1) or Storage(test=object())
+        r = self.request(test="3")
+        method._cached_widget(r, widget_id, render)
+        method._cached_widget(r, widget_id, render)
+        self.assertEqual(len(calls), 6)
+
+    def testWidgetTablenames(self):
+        """ Test lookup of the tables a widget reads from """
+
+        resource = current.s3db.resource("org_office",
+                                         filter=FS("location_id$L1") == "Test")
+        tablenames = S3Method._widget_tablenames(resource,
+                                                 ["name",
+                                                  "organisation_id",
+                                                  "organisation_id$acronym",
+                                                  ])
+        self.assertEqual(tablenames, set(["org_office",
+                                          "org_organisation",
+                                          "gis_location",
+                                          ]))
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -287,6 +376,7 @@ if __name__ == "__main__":
 
     run_suite(
         URLBuilderTests,
+        WidgetCacheTests,
     )
 
 # END ========================================================================
@@ -6,9 +6,18 @@
 # python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3sync.py
 #
 import unittest
+import base64
+import datetime
+import threading
+import time
+import urllib2
+import BaseHTTPServer
+import SocketServer
 from gluon import current
 from gluon.dal import Query
+from gluon.storage import Storage
 from lxml import etree
+from s3 import S3Sync, S3SyncSession
 try:
     import json # try stdlib (Python 2.6)
 except ImportError:
@@ -438,6 +447,284 @@ class ImportMergeWithoutExistingRecords(unittest.TestCase):
         current.auth.override = False
         current.db.rollback()
 
+# =============================================================================
+class ChunkedExportTests(unittest.TestCase):
+    """ Test chunked export with continuation tokens """
+
+    def setUp(self):
+
+        current.auth.override = True
+
+        s3db = current.s3db
+        otable = s3db.org_organisation
+        self.org_id = otable.insert(name="TestSyncChunkOrganisation")
+
+        # Same modification date for all offices
+        # => paging must fall back to the record ID
+        table = s3db.org_office
+        for i in xrange(5):
+            table.insert(name="TestSyncChunkOffice%s" % i,
+                         organisation_id=self.org_id,
+                         modified_on=current.request.utcnow)
+
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
+    def testChunkedExport(self):
+        """ Test that chunks export all records exactly once """
+
+        s3db = current.s3db
+        names = []
+        cursor = None
+        chunks = 0
+        while True:
+            resource = s3db.resource("org_office",
+                                     filter=(s3db.org_office.organisation_id == self.org_id))
+            orderby = S3Sync.apply_cursor(resource, cursor)
+            tree = resource.export_xml(limit=2,
+                                       orderby=orderby,
+                                       dereference=False,
+                                       as_tree=True)
+            chunks += 1
+            names.extend(tree.xpath("resource[@name='org_office']/data[@field='name']/text()"))
+            cursor = S3Sync.get_cursor(resource, 2)
+            if not cursor:
+                break
+            self.assertTrue(chunks < 5)
+
+        self.assertEqual(chunks, 3)
+        self.assertEqual(sorted(names),
+                         ["TestSyncChunkOffice%s" % i for i in xrange(5)])
+
+    def testIncrementalChunk(self):
+        """ Test that incremental chunks only contain modified records """
+
+        db = current.db
+        s3db = current.s3db
+
+        otable = s3db.org_organisation
+        table = s3db.org_office
+
+        msince = current.request.utcnow
+        later = msince + datetime.timedelta(seconds=10)
+
+        # Unmodified organisations, one with a modified office
+        other_id = otable.insert(name="TestSyncChunkOrganisation2")
+        query = (otable.id.belongs((self.org_id, other_id)))
+        db(query).update(modified_on=msince)
+        office = db(table.organisation_id == self.org_id).select(table.id,
+                                                                 limitby=(0, 1)
+                                                                 ).first()
+        db(table.id == office.id).update(modified_on=later)
+
+        resource = s3db.resource("org_organisation", filter=query)
+        orderby = S3Sync.apply_cursor(resource, None)
+        resource.export_xml(msince=msince,
+                            mcomponents=["org_office"],
+                            limit=2,
+                            orderby=orderby,
+                            dereference=False,
+                            as_tree=True)
+
+        # Only the organisation with the modified office is loaded
+        self.assertEqual([row.id for row in resource], [self.org_id])
+        self.assertEqual(S3Sync.get_cursor(resource, 2), None)
+
+    def testInvalidCursor(self):
+        """ Test rejection of invalid continuation tokens """
+
+        resource = current.s3db.resource("org_office")
+        apply_cursor = S3Sync.apply_cursor
+        self.assertRaises(ValueError, apply_cursor, resource, "invalid")
+        self.assertRaises(ValueError, apply_cursor, resource, "2014-13-01T00:00:00Z,1")
+
+    def testCompression(self):
+        """ Test compression of transfer data """
+
+        data = "<s3xml>%s</s3xml>" % ("<resource/>" * 100)
+        compressed = S3Sync.compress(data)
+        self.assertTrue(len(compressed) < len(data))
+        self.assertEqual(S3Sync.decompress(compressed), data)
+        self.assertRaises(IOError, S3Sync.decompress, data)
+
+# =============================================================================
+class FakePeer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Local HTTP server for testing, with keep-alive connections """
+
+    daemon_threads = True
+
+    def __init__(self):
+
+        BaseHTTPServer.HTTPServer.__init__(self,
+                                           ("127.0.0.1", 0),
+                                           FakePeerHandler)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, delay=0):
+        """
+            Reset the peer
+
+            @param delay: time to respond (seconds)
+        """
+
+        with self.lock:
+            self.delay = delay
+            self.connections = set()
+            self.active = 0
+            self.max_active = 0
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%s" % self.server_address[1]
+
+class FakePeerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Request handler for FakePeer """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+
+        server = self.server
+        with server.lock:
+            server.connections.add(self.client_address)
+            server.active += 1
+            server.max_active = max(server.active, server.max_active)
+            delay = server.delay
+        if delay:
+            time.sleep(delay)
+        with server.lock:
+            server.active -= 1
+
+        headers = {}
+        if self.path.startswith("/error"):
+            status, body = 404, "not found"
+        elif self.path == "/redirect":
+            status, body = 302, ""
+            headers["Location"] = "/redirected"
+        elif self.path.startswith("/auth") and \
+             self.headers.getheader("authorization") != \
+             "Basic %s" % base64.b64encode("user:pass"):
+            status, body = 401, "unauthorized"
+            headers["WWW-Authenticate"] = 'Basic realm="test"'
+        else:
+            status, body = 200, self.path
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+# =============================================================================
+class SyncSessionTests(unittest.TestCase):
+    """ Test the HTTP session with peer repositories """
+
+    @classmethod
+    def setUpClass(cls):
+
+        peer = cls.peer = FakePeer()
+        thread = threading.Thread(target=peer.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+
+        cls.peer.shutdown()
+        cls.peer.server_close()
+
+    def setUp(self):
+
+        self.peer.reset()
+        self.session = S3SyncSession(workers=3)
+
+    def tearDown(self):
+
+        self.session.close()
+
+    def testKeepAlive(self):
+        """ Test re-use of the connection for subsequent requests """
+
+        url = self.peer.url
+        for i in xrange(5):
+            response = self.session.request("%s/test%s" % (url, i))
+            self.assertEqual(response.read(), "/test%s" % i)
+        self.assertEqual(len(self.peer.connections), 1)
+
+    def testConcurrentRequests(self):
+        """ Test the limit of concurrent requests """
+
+        peer = self.peer
+        peer.reset(delay=0.2)
+
+        submit = self.session.submit
+        futures = [submit("%s/test%s" % (peer.url, i)) for i in xrange(6)]
+        results = [future.result().read() for future in futures]
+
+        self.assertEqual(results, ["/test%s" % i for i in xrange(6)])
+        self.assertEqual(peer.max_active, 3)
+        self.assertEqual(len(peer.connections), 3)
+
+    def testHTTPError(self):
+        """ Test that HTTP errors are raised like with urllib2 """
+
+        future = self.session.submit("%s/error" % self.peer.url)
+        try:
+            future.result()
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 404)
+            self.assertEqual(e.read(), "not found")
+        else:
+            self.fail("HTTPError not raised")
+
+    def testRedirect(self):
+        """ Test following redirects """
+
+        response = self.session.request("%s/redirect" % self.peer.url)
+        self.assertEqual(response.read(), "/redirected")
+        self.assertEqual(response.geturl(), "%s/redirected" % self.peer.url)
+
+    def testAuthChallenge(self):
+        """ Test answering Basic authentication challenges """
+
+        url = "%s/auth" % self.peer.url
+
+        # Without credentials
+        try:
+            self.session.request(url)
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 401)
+        else:
+            self.fail("HTTPError not raised")
+
+        # With credentials
+        session = S3SyncSession(username="user", password="pass")
+        try:
+            response = session.request(url)
+            self.assertEqual(response.read(), "/auth")
+        finally:
+            session.close()
+
+# =============================================================================
+class DependencyOrderTests(unittest.TestCase):
+    """ Test the order of synchronization tasks """
+
+    def testDependencyOrder(self):
+        """ Test that referenced resources are synchronized first """
+
+        tasks = [Storage(id=1, resource_name="org_office"),
+                 Storage(id=2, resource_name="pr_person"),
+                 Storage(id=3, resource_name="org_organisation"),
+                 ]
+        ordered = S3Sync.dependency_order(tasks)
+        self.assertEqual([task.id for task in ordered], [3, 1, 2])
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -459,7 +746,10 @@ if __name__ == "__main__":
         ImportMergeWithExistingRecords,
         ImportMergeWithExistingOriginal,
         ImportMergeWithExistingDuplicate,
-        ImportMergeWithoutExistingRecords
+        ImportMergeWithoutExistingRecords,
+        ChunkedExportTests,
+        SyncSessionTests,
+        DependencyOrderTests,
     )
 
 # END ========================================================================
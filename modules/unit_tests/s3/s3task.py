@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+#
+# S3Task Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3task.py
+#
+import unittest
+import datetime
+from gluon import *
+from gluon.storage import Storage
+from s3 import *
+
+# =============================================================================
+class S3TaskAsyncTests(unittest.TestCase):
+    """ Tests for coalescing and batching of async tasks """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        db = current.db
+        s3 = current.response.s3
+
+        self.calls = calls = []
+        def test_task(*args, **vars):
+            if args and args[0] == "fail":
+                raise RuntimeError("Failed")
+            calls.append((args, vars))
+
+        self.tasks = s3.tasks
+        s3.tasks = dict(self.tasks or {})
+        s3.tasks["test_task"] = test_task
+        s3.tasks["test_batch_task"] = test_task
+        s3.queued_tasks = None
+        s3.batched_calls = None
+
+        self.s3task = current.s3task
+        self.batch_tasks = self.s3task.batch_tasks
+        self.s3task.batch_tasks = {"test_batch_task": 60}
+
+        # Pretend a worker is alive
+        db.scheduler_worker.insert(worker_name = "S3TaskAsyncTests",
+                                   first_heartbeat = datetime.datetime.now(),
+                                   last_heartbeat = datetime.datetime.now(),
+                                   )
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.response.s3.tasks = self.tasks
+        current.response.s3.queued_tasks = None
+        current.response.s3.batched_calls = None
+        self.s3task.batch_tasks = self.batch_tasks
+
+        # run_batch commits, so clean up explicitly
+        db = current.db
+        ttable = db.scheduler_task
+        query = (ttable.function_name.belongs(("test_task",
+                                               "test_batch_task"))) | \
+                ((ttable.function_name == S3Task.BATCH_TASK) & \
+                 (ttable.args == '["test_batch_task"]'))
+        db(query).delete()
+        btable = current.s3db.s3_task_batch
+        db(btable.task_name == "test_batch_task").delete()
+        wtable = db.scheduler_worker
+        db(wtable.worker_name == "S3TaskAsyncTests").delete()
+        db.commit()
+
+    # -------------------------------------------------------------------------
+    def testCoalesce(self):
+        """ Test merging of identical calls """
+
+        db = current.db
+        ttable = db.scheduler_task
+        async = self.s3task.async
+
+        first = async("test_task", args=[1])
+        self.assertTrue(first)
+        self.assertEqual(async("test_task", args=[1]), first)
+        self.assertNotEqual(async("test_task", args=[2]), first)
+
+        query = (ttable.function_name == "test_task")
+        self.assertEqual(db(query).count(), 2)
+
+        # Not merged once started
+        db(ttable.id == first).update(status = "RUNNING")
+        second = async("test_task", args=[1])
+        self.assertNotEqual(second, first)
+
+        # Not merged across requests (the other request could run the
+        # call before this request has committed its data)
+        current.response.s3.queued_tasks = None
+        self.assertNotEqual(async("test_task", args=[1]), second)
+
+    # -------------------------------------------------------------------------
+    def testBatch(self):
+        """ Test collecting calls of batched tasks """
+
+        db = current.db
+        ttable = db.scheduler_task
+        btable = current.s3db.s3_task_batch
+        async = self.s3task.async
+
+        batch = async("test_batch_task", args=[1])
+        self.assertTrue(batch)
+        self.assertEqual(async("test_batch_task", args=[2]), batch)
+        self.assertEqual(async("test_batch_task", args=[1]), batch)
+
+        # Scheduled once, at the end of the window
+        query = (ttable.function_name == S3Task.BATCH_TASK)
+        rows = db(query).select(ttable.id, ttable.args, ttable.next_run_time)
+        self.assertEqual(len(rows), 1)
+        self.assertTrue(rows.first().next_run_time > datetime.datetime.now())
+
+        # Identical calls pending only once
+        query = (btable.task_name == "test_batch_task")
+        self.assertEqual(db(query).count(), 2)
+
+        # Identical call of another request is added, too
+        current.response.s3.batched_calls = None
+        self.assertEqual(async("test_batch_task", args=[1]), batch)
+        self.assertEqual(db(query).count(), 3)
+
+        # Run the batch (identical calls only once)
+        db(ttable.id == batch).update(status = "RUNNING")
+        self.assertEqual(self.s3task.run_batch("test_batch_task"), 2)
+        self.assertEqual(sorted(call[0] for call in self.calls), [(1,), (2,)])
+        self.assertEqual(db(query).count(), 0)
+
+        # Next batch scheduled for calls which were not yet committed
+        # when this batch started
+        query = (ttable.function_name == S3Task.BATCH_TASK) & \
+                (ttable.args == '["test_batch_task"]') & \
+                (ttable.status == "QUEUED")
+        rows = db(query).select(ttable.id)
+        self.assertEqual(len(rows), 1)
+        self.assertNotEqual(rows.first().id, batch)
+
+    # -------------------------------------------------------------------------
+    def testBatchClaim(self):
+        """ Test claiming of batched calls, and keeping failed calls """
+
+        db = current.db
+        btable = current.s3db.s3_task_batch
+        async = self.s3task.async
+
+        async("test_batch_task", args=[1])
+        async("test_batch_task", args=["fail"])
+
+        # Claimed by another batch which is still running
+        async("test_batch_task", args=[2])
+        query = (btable.task_name == "test_batch_task") & \
+                (btable.args == "[2]")
+        db(query).update(status = "RUNNING",
+                         worker = "other",
+                         claimed_on = datetime.datetime.utcnow(),
+                         )
+
+        self.assertEqual(self.s3task.run_batch("test_batch_task"), 2)
+        self.assertEqual([call[0] for call in self.calls], [(1,)])
+
+        rows = db(btable.task_name == "test_batch_task").select(btable.args,
+                                                                btable.status,
+                                                                orderby=btable.id)
+        self.assertEqual([(row.args, row.status) for row in rows],
+                         [('["fail"]', "FAILED"), ("[2]", "RUNNING")])
+
+        # Identical call to a claimed call is added again
+        async("test_batch_task", args=[2])
+        query = (btable.task_name == "test_batch_task") & \
+                (btable.status == None)
+        self.assertEqual(db(query).count(), 1)
+
+# =============================================================================
+class S3TaskQueueTests(unittest.TestCase):
+    """ Tests for scheduler queues """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        db = current.db
+        s3 = current.response.s3
+
+        self.tasks = s3.tasks
+        s3.tasks = dict(self.tasks or {})
+        s3.tasks["test_task"] = lambda *args, **vars: None
+        s3.tasks["test_slow_task"] = lambda *args, **vars: None
+        s3.queued_tasks = None
+
+        s3task = self.s3task = current.s3task
+        self.queues = s3task.queues
+        self.task_queues = s3task.task_queues
+        s3task.queues = [("test_fast", 2), ("test_slow", 1)]
+        s3task.task_queues = {"test_task": "test_fast",
+                              "test_slow_task": "test_slow",
+                              "test_other_task": "test_other",
+                              }
+
+        # Pretend a worker is alive
+        db.scheduler_worker.insert(worker_name = "S3TaskQueueTests",
+                                   first_heartbeat = datetime.datetime.now(),
+                                   last_heartbeat = datetime.datetime.now(),
+                                   group_names = ["test_slow", "test_fast"],
+                                   )
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.response.s3.tasks = self.tasks
+        current.response.s3.queued_tasks = None
+        self.s3task.queues = self.queues
+        self.s3task.task_queues = self.task_queues
+
+    # -------------------------------------------------------------------------
+    def testQueue(self):
+        """ Test queue lookup for tasks """
+
+        queue = self.s3task.queue
+        self.assertEqual(queue("test_task"), "test_fast")
+        self.assertEqual(queue("test_slow_task"), "test_slow")
+
+        # Unconfigured queue or task => queue with highest priority
+        self.assertEqual(queue("test_other_task"), "test_fast")
+        self.assertEqual(queue("test_unknown_task"), "test_fast")
+
+    # -------------------------------------------------------------------------
+    def testWorkerGroups(self):
+        """ Test scheduler groups of the workers """
+
+        groups = self.s3task.worker_groups()
+        self.assertEqual(groups, [("test_fast", 2, ["test_fast"]),
+                                  ("test_slow", 1, ["test_slow", "test_fast"]),
+                                  ])
+
+    # -------------------------------------------------------------------------
+    def testStatus(self):
+        """ Test queue status """
+
+        db = current.db
+        ttable = db.scheduler_task
+        s3task = self.s3task
+
+        fast = s3task.async("test_task", args=[1])
+        slow = s3task.async("test_slow_task", args=[1])
+        self.assertEqual(ttable[fast].group_name, "test_fast")
+        self.assertEqual(ttable[slow].group_name, "test_slow")
+
+        later = datetime.datetime.now() + datetime.timedelta(hours=1)
+        db(ttable.id == slow).update(next_run_time = later)
+
+        status = s3task.status()
+        self.assertEqual([item.queue for item in status[:2]],
+                         ["test_fast", "test_slow"])
+        fast_status, slow_status = status[:2]
+        self.assertEqual(fast_status.workers, 2)
+        self.assertTrue(fast_status.alive >= 1)
+        self.assertTrue(fast_status.due >= 1)
+        self.assertEqual(slow_status.workers, 1)
+        self.assertTrue(slow_status.scheduled >= 1)
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner(verbosity=2).run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        S3TaskAsyncTests,
+        S3TaskQueueTests,
+    )
+
+# END ========================================================================
@@ -162,6 +162,25 @@ class PeriodTests(unittest.TestCase):
                              msg="Incorrect result for "
                                  "duration of event %s." % (index + 1))
         
+    # -------------------------------------------------------------------------
+    def testCountSlots(self):
+        """ Test counting of slots without iterating over the rule """
+
+        start = tp_datetime(2013, 1, 31)
+        end = tp_datetime(2014, 3, 1)
+        for slots in ("hours", "days", "2 weeks", "months", "3 months", "years"):
+            count = S3TimePlotPeriod.count_slots(start, end, slots)
+            rule = S3TimePlotPeriod.get_rule(start, end, slots)
+            self.assertEqual(count, rule.count(),
+                             msg="Incorrect slot count for %s" % slots)
+
+        count = S3TimePlotPeriod.count_slots(tp_datetime(2013, 1, 5),
+                                             tp_datetime(2013, 4, 5),
+                                             "months")
+        self.assertEqual(count, 4)
+        count = S3TimePlotPeriod.count_slots(end, start, "days")
+        self.assertEqual(count, 0)
+
     # -------------------------------------------------------------------------
     def testAggregateCount(self):
         """ Test count aggregation method """
@@ -480,6 +499,48 @@ class EventFrameTests(unittest.TestCase):
                                       event_type="A")
             assertEqual(result, expected_result[2])
 
+    # -------------------------------------------------------------------------
+    def testAggregateFrame(self):
+        """ Test aggregation for all periods against detached periods """
+
+        ef = S3TimePlotEventFrame(tp_datetime(2012,1,1),
+                                  tp_datetime(2012,12,15),
+                                  slots="months")
+        ef.extend(self.events)
+
+        aggregates = (("count", None, None),
+                      ("count", ["test"], None),
+                      ("sum", ["test"], None),
+                      ("avg", ["test"], None),
+                      ("min", ["test"], None),
+                      ("max", ["test"], None),
+                      ("cumulate", ["test"], ["weeks"]),
+                      ("cumulate", ["test", "test"], ["days"]),
+                      )
+
+        assertEqual = self.assertEqual
+        for period in ef:
+
+            # Copy of the period, with the events added manually
+            detached = S3TimePlotPeriod(period.start, end=period.end)
+            for event in period.current_events("A"):
+                detached.add_current(event)
+            for event in period.previous_events("A"):
+                detached.add_previous(event)
+
+            for method, fields, arguments in aggregates:
+                expected = detached.aggregate(method,
+                                              fields=fields,
+                                              arguments=arguments,
+                                              event_type="A")
+                result = period.aggregate(method,
+                                          fields=fields,
+                                          arguments=arguments,
+                                          event_type="A")
+                assertEqual(result, expected,
+                            msg="Incorrect %s result for period %s" %
+                                (method, period.start))
+
     # -------------------------------------------------------------------------
     def testPeriodsDays(self):
         """ Test iteration over periods (days) """
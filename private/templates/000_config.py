@@ -170,6 +170,11 @@ settings.frontpage.rss = [
 # Memcache server to allow sharing of sessions across instances
 #settings.base.session_memcache = '127.0.0.1:11211'
 
+# Scheduler queues, in order of priority: (name, number of workers)
+# - long-running tasks are confined to their queue (see s3.task_queues in
+#   models/tasks.py), start the workers with static/scripts/tools/scheduler_pool.py
+#settings.base.scheduler_queues = [("main", 2), ("slow", 1)]
+
 # UI options
 # Should user be prompted to save before navigating away?
 #settings.ui.navigate_away_confirm = False
@@ -292,7 +292,8 @@ class filters(S3CustomController):
         title = record["pr_filter.title"]
 
         # Filter Query and Summary URLs
-        fstring = S3FilterString(resource, raw["pr_filter.query"])
+        fstring = S3FilterString(resource, raw["pr_filter.query"],
+                                 serialized=raw.get("pr_filter.serialized"))
         query = fstring.represent()
         links = cls.summary_urls(resource,
                                  raw["pr_filter.url"],
@@ -45,4 +45,13 @@ class Daily():
                 except:
                     pass
 
+        # Rebuild the full-text index (to catch up with updates which
+        # have bypassed S3Audit.onwrite)
+        from s3 import S3FullText
+        S3FullText.rebuild()
+
+        # Remove outdated entries from the change-log
+        from s3 import S3ChangeLog
+        S3ChangeLog.prune()
+
 # END =========================================================================
@@ -1798,14 +1798,20 @@ OpenLayers.ProxyHost = S3.Ap.concat('/gis/proxy?url=');
         var marker_url = response[1];
 
         // Strategies
+        var bbox_options = {
+            // load features for a wider area than the visible extent to reduce calls
+            ratio: 1.5
+            // don't fetch features after every resolution change
+            //resFactor: 1
+        };
+        if (layer.cluster_server) {
+            // Server-side clusters depend on the zoom level
+            // => re-fetch features after every resolution change
+            bbox_options.resFactor = 1;
+        }
         var strategies = [
             // Need to be uniquely instantiated
-            new OpenLayers.Strategy.BBOX({
-                // load features for a wider area than the visible extent to reduce calls
-                ratio: 1.5
-                // don't fetch features after every resolution change
-                //resFactor: 1
-            })
+            new OpenLayers.Strategy.BBOX(bbox_options)
         ]
         if (refresh) {
             strategies.push(new OpenLayers.Strategy.Refresh({
@@ -1823,7 +1829,7 @@ OpenLayers.ProxyHost = S3.Ap.concat('/gis/proxy?url=');
                 //}
             }));
         }
-        if (cluster_threshold) {
+        if (cluster_threshold && !layer.cluster_server) {
             // Common Cluster Strategy for all layers
             //s3.common_cluster_strategy
             strategies.push(new OpenLayers.Strategy.AttributeCluster({
@@ -1866,11 +1872,30 @@ OpenLayers.ProxyHost = S3.Ap.concat('/gis/proxy?url=');
             'loadend': layer_loadend,
             'visibilitychanged': layer_visibilitychanged  
         });
+        if (layer.cluster_server) {
+            // Clusters are built on the server
+            geojsonLayer.events.on({
+                'beforefeaturesadded': server_clusters
+            });
+        }
         map.addLayer(geojsonLayer);
         // Ensure marker layers are rendered over other layers
         //map.setLayerIndex(geojsonLayer, 99);
     };
 
+    // Mark features which are server-side clusters so that they get
+    // styled as clusters (the count comes from the server)
+    var server_clusters = function(event) {
+        var features = event.features;
+        var feature;
+        for (var i = 0, len = features.length; i < len; i++) {
+            feature = features[i];
+            if (feature.attributes.count > 1) {
+                feature.cluster = [feature];
+            }
+        }
+    };
+
     // Google
     var addGoogleLayers = function(map) {
         var google = map.s3.options.Google;
@@ -37,3 +37,42 @@ try:
 except:
     # Index already present
     pass
+
+tablename = "msg_rss"
+s3db.table(tablename)
+field = "from_address"
+try:
+    db.executesql("CREATE INDEX %s_%s__idx on %s(%s);" % (tablename, field, tablename, field))
+except:
+    # Index already present
+    pass
+try:
+    db.executesql("CREATE INDEX %s_content_hash__idx on %s(channel_id,content_hash);" % (tablename, tablename))
+except:
+    # Index already present
+    pass
+
+tablename = "s3_hierarchy_interval"
+s3db.table(tablename)
+try:
+    db.executesql("CREATE INDEX %s__idx on %s(hierarchy_id,node_id,lft);" % (tablename, tablename))
+except:
+    # Index already present
+    pass
+
+tablename = "s3_content_hash"
+s3db.table(tablename)
+try:
+    db.executesql("CREATE INDEX %s__idx on %s(tablename,record_id);" % (tablename, tablename))
+except:
+    # Index already present
+    pass
+
+# Full-text index (trigram indexes on PostgreSQL, s3_fulltext otherwise)
+s3base.S3FullText.create_indexes()
+s3base.S3FullText.rebuild()
+
+# Change-log
+s3base.S3ChangeLog.create_indexes()
+s3base.S3ChangeLog.prune()
+db.commit()
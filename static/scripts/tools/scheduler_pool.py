@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+# Start the scheduler workers for all queues (settings.base.scheduler_queues),
+# and restart them if they die.
+#
+# Run this in the web2py folder, in the application models context:
+#
+# python web2py.py -S eden -M -R applications/eden/static/scripts/tools/scheduler_pool.py
+#
+# To only start the workers for some of the queues (e.g. to run different
+# queues on different hosts), list the queue names as script arguments:
+#
+# python web2py.py -S eden -M -R applications/eden/static/scripts/tools/scheduler_pool.py -A main
+#
+# Each worker is a separate "python web2py.py -K <app>:<group>..." process,
+# serving its own queue and all queues with higher priority, see
+# S3Task.worker_groups. Stop the pool with Ctrl-C or SIGTERM, which also
+# stops all workers.
+
+import signal
+import subprocess
+import sys
+import time
+
+# Seconds between checks for dead workers
+INTERVAL = 10
+
+app = request.application
+selected = sys.argv[1:]
+
+# Worker processes: [[queue, command, process]]
+workers = []
+for queue, number, groups in s3task.worker_groups():
+    if selected and queue not in selected:
+        continue
+    command = [sys.executable,
+               "web2py.py",
+               "-K", ":".join([app] + groups),
+               ]
+    for i in range(number):
+        workers.append([queue, command, None])
+
+if not workers:
+    print >> sys.stderr, "No scheduler workers configured"
+    sys.exit(1)
+
+# Release the database before forking
+db.commit()
+
+def start(worker):
+    queue, command, process = worker
+    worker[2] = subprocess.Popen(command)
+    print "Started worker %s for queue %s" % (worker[2].pid, queue)
+
+def stop(signum=None, frame=None):
+    for queue, command, process in workers:
+        if process and process.poll() is None:
+            process.terminate()
+    for queue, command, process in workers:
+        if process:
+            process.wait()
+    sys.exit(0)
+
+signal.signal(signal.SIGTERM, stop)
+
+try:
+    for worker in workers:
+        start(worker)
+    while True:
+        time.sleep(INTERVAL)
+        for worker in workers:
+            queue, command, process = worker
+            if process.poll() is not None:
+                print >> sys.stderr, "Worker %s for queue %s died (exit code %s), restarting" % \
+                                     (process.pid, queue, process.returncode)
+                start(worker)
+except KeyboardInterrupt:
+    stop()
+
+# END =========================================================================